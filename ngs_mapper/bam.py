@@ -5,17 +5,18 @@ import filehandle
 import logging
 log = logging.getLogger(__name__)
 
-def samtobam( sam, outbam ):
+def samtobam( sam, outbam, level=None ):
     '''
         Use samtools to convert a sam file to a bam file
         outbam will be overwritten if it already exists
 
         @sam - file path or file object(even pipe) of sam file input to convert
         @outbam - file path or file object(even pipe) of bam output destination
+        @level - 0 writes uncompressed bam. samtools view cannot set any other level
 
         @returns outbam or the file descriptor of the object
     '''
-    cmd = ['samtools','view','-Sb','-']
+    cmd = ['samtools','view','-Sbu' if level == 0 else '-Sb','-']
     log.info('Running {0}'.format(' '.join(cmd)))
     # Determine if sam is a filepath or file like object
     if isinstance(sam,str):
@@ -45,7 +46,27 @@ def samtobam( sam, outbam ):
         log.debug("Returning processes stdout value")
         return p.stdout
 
-def sortbam( bam, outbam ):
+def sort_cmd( outbam, threads=1, memory=None, level=None ):
+    '''
+        The samtools sort command that sorts a bam from stdin into outbam
+
+        @outbam - file path
+        @threads - how many threads samtools uses to sort and compress
+        @memory - memory each sort thread uses before it writes temporary files(Ex. 768M)
+        @level - compression level(0-9) of outbam. None uses the samtools default
+
+        @returns the command as a list
+    '''
+    cmd = ['samtools','sort','-f']
+    if threads and threads > 1:
+        cmd += ['-@', str(threads)]
+    if memory:
+        cmd += ['-m', str(memory)]
+    if level is not None:
+        cmd += ['-l', str(level)]
+    return cmd + ['-', outbam]
+
+def sortbam( bam, outbam, threads=1, memory=None, level=None ):
     '''
         Sorts a bam file using samtools
         outbam cannot be a pipe because samtools index won't allow it
@@ -53,10 +74,16 @@ def sortbam( bam, outbam ):
 
         @sam - file path or file object(even pipe) of sam file input to convert
         @outbam - file path
+        @threads - how many threads samtools sort uses
+        @memory - memory each sort thread uses(Ex. 768M)
+        @level - compression level(0-9) of outbam. None uses the samtools default
 
         @returns outbam or the file descriptor of the object
     '''
-    cmd = ['samtools','sort','-f','-']
+    # Determine if outbam is a filepath or file like object
+    if not isinstance(outbam,str):
+        raise ValueError("Output file for sortbam has to be a path not {0}".format(outbam))
+    cmd = sort_cmd( outbam, threads, memory, level )
     log.info('Running {0}'.format(' '.join(cmd)))
 
     # Determine if sam is a filepath or file like object
@@ -65,23 +92,18 @@ def sortbam( bam, outbam ):
     else:
         input = bam
 
-    # Determine if outbam is a filepath or file like object
-    if isinstance(outbam,str):
-        cmd.append( outbam )
-    else:
-        raise ValueError("Output file for sortbam has to be a path not {0}".format(outbam))
-
     log.debug("CMD: {0} STDIN: {1}".format(cmd,input))
     p = subprocess.Popen( cmd, stdin=input )
     p.wait()
     return outbam
 
-def mergebams( sortedbams, mergedbam ):
+def mergebams( sortedbams, mergedbam, level=None ):
     '''
         Merges the given sortedbams into a file specified by mergedbam
 
         @param sortedbams - List of sorted bam files to merge(Maybe don't even need to sort them?)
         @param mergedbam - Output file for samtools merge
+        @param level - compression level(0-9) of mergedbam. None uses the samtools default
 
         @returns the path to mergedbam
     '''
@@ -89,7 +111,10 @@ def mergebams( sortedbams, mergedbam ):
         raise ValueError( "Merging bams requires >= 2 bam files to merge. {0} was given".format(sortedbams) )
 
     print sortedbams
-    cmd = ['samtools','merge',mergedbam] + sortedbams
+    cmd = ['samtools','merge']
+    if level is not None:
+        cmd += ['-l', str(level)]
+    cmd += [mergedbam] + sortedbams
     log.info('Running {0}'.format(' '.join(cmd)))
 
     p = subprocess.Popen( cmd )
@@ -8,6 +8,7 @@ from StringIO import StringIO
 from os.path import basename
 import os
 import multiprocessing
+import json
 import time
 
 import vcf
@@ -35,8 +36,8 @@ def timeit(func):
         return result
     return wrapper
 
-def main():
-    args = parse_args()
+def main(args=sys.argv[1:]):
+    args = parse_args(args)
     if args.regionstr is not None:
         generate_vcf(
             args.bamfile,
@@ -302,6 +303,17 @@ def hpoly_list(refseqs, minlength=3):
         hpolys[seq] = [(m.group(0),m.start()+1,m.end()) for m in matches]
     return hpolys
 
+def load_hpolys(reffile, refseqs, minlength=3):
+    '''
+    hpoly_list for reffile read from reffile.hpoly.json if it was already
+    built(See :py:mod:`ngs_mapper.refstore`)
+    '''
+    hpolyfile = reffile + '.hpoly.json'
+    if minlength == 3 and os.path.exists(hpolyfile):
+        with open(hpolyfile) as fh:
+            return json.load(fh)
+    return hpoly_list(refseqs, minlength)
+
 def is_hpoly(hpolylist, seqid, curpos):
     '''
     Identifies if a position is contained inside of a homopolymer
@@ -340,7 +352,7 @@ def generate_vcf(bamfile, reffile, regionstr, vcf_output_file, minbq, maxd, mind
     # All the references indexed by the seq.id(first string after the > in the file until the first space)
     refseqs = SeqIO.index(reffile, 'fasta')
     # Homopolymers for references
-    hpolys = hpoly_list(refseqs, 3)
+    hpolys = load_hpolys(reffile, refseqs, 3)
     # Our pretend file object that has vcf stuff in it
     vcf_head = StringIO(vcf_template)
     vcf_head.name = 'header.vcf'
@@ -7,6 +7,7 @@ import json
 from collections import namedtuple
 from itertools import izip
 
+import numpy as np
 from matplotlib.lines import Line2D
 
 import log
@@ -25,6 +26,13 @@ REGIONTYPES = [
     G, N, LC, LQ, LCQ
 ]
 
+# Each pyramid level has PYRAMID_FACTOR times fewer bins than the one before it
+PYRAMID_FACTOR = 4
+# Levels with more bins than this are not stored
+PYRAMID_MAXBINS = 4096
+# Stop building levels once a level has this many bins or fewer
+PYRAMID_MINBINS = 64
+
 def parse_pileup( pileup ):
     '''
     Parses the raw pileup output from samtools mpileup and returns a dictionary
@@ -185,3 +193,97 @@ def lines2d_from_regions(yval, regions, line2dargs):
     '''
     for region in regions:
         yield Line2D([region.start,region.end], [yval,yval], **line2dargs[region.type])
+
+def pyramid_level(depths, avgquals, binsize):
+    '''
+    Bin depths and avgquals into bins of binsize positions and return the
+    min/mean/max of each bin
+
+    Positions without any quality(gaps) are treated as quality 0
+
+    :param numpy.ndarray depths: depth at each base position
+    :param numpy.ndarray avgquals: average quality at each base position
+    :param int binsize: how many base positions go into each bin
+    :return: dictionary with binsize, mind, meand, maxd, minq, meanq, maxq
+    '''
+    # Start index of every bin. The last bin may be shorter than binsize
+    starts = np.arange(0, len(depths), binsize)
+    counts = np.diff(np.append(starts, len(depths)))
+    level = {'binsize': binsize}
+    for key, values in (('d', depths), ('q', avgquals)):
+        level['min'+key] = np.minimum.reduceat(values, starts).tolist()
+        level['max'+key] = np.maximum.reduceat(values, starts).tolist()
+        means = np.add.reduceat(values, starts) / counts
+        level['mean'+key] = np.round(means, 2).tolist()
+    return level
+
+def build_pyramid(depths, avgquals, maxbins=PYRAMID_MAXBINS, minbins=PYRAMID_MINBINS, factor=PYRAMID_FACTOR):
+    '''
+    Build a min/mean/max pyramid for a single reference's depths and avgquals
+
+    Each level bins factor times more positions than the previous one. Only
+    levels that have <= maxbins bins are kept so the size of the pyramid
+    does not depend on the length of the reference.
+    Since the min of every bin is kept, a single position dropout is still
+    visible at every level.
+
+    :param list depths: depth at each base position
+    :param list avgquals: average quality at each base position
+    :param int maxbins: maximum bins for any level
+    :param int minbins: stop once a level has this many bins or less
+    :param int factor: how many bins of a level make up a bin in the next
+    :return: list of levels(see pyramid_level) ordered from finest to coarsest
+    '''
+    depths = np.asarray(depths, dtype=float)
+    # mpileup positions without bases give nan for the average quality
+    avgquals = np.nan_to_num(np.asarray(avgquals, dtype=float))
+    levels = []
+    if len(depths) == 0:
+        return levels
+    binsize = 1
+    while True:
+        nbins = int(np.ceil(len(depths) / float(binsize)))
+        if nbins <= maxbins:
+            levels.append(pyramid_level(depths, avgquals, binsize))
+        if nbins <= minbins:
+            break
+        binsize *= factor
+    return levels
+
+def qualdepth_pyramid(qualdepth):
+    '''
+    Build the pyramid for every reference in a qualdepth dictionary
+
+    The result mirrors the qualdepth layout so it can be used to draw
+    qualdepth graphics without loading the per base arrays
+
+    :param dict qualdepth: loaded qualdepth.json
+    :return: {'unmapped_reads': int, 'ref1': {'length':,'maxd':,'mapped_reads':,'levels':[]}, ...}
+    '''
+    pyramid = {'unmapped_reads': qualdepth.get('unmapped_reads', 0)}
+    for ref, stats in qualdepth.items():
+        if ref == 'unmapped_reads':
+            continue
+        pyramid[ref] = {
+            'length': stats['length'],
+            'maxd': stats['maxd'],
+            'mapped_reads': stats.get('mapped_reads', 0),
+            'levels': build_pyramid(stats['depths'], stats['avgquals'])
+        }
+    return pyramid
+
+def select_pyramid_level(levels, width):
+    '''
+    Pick the finest level that does not have more bins than width
+
+    :param list levels: levels as returned by build_pyramid
+    :param int width: how many pixels wide the plot is
+    :return: the level dictionary(coarsest level if none fit) or None if there
+             are no levels
+    '''
+    if not levels:
+        return None
+    for level in levels:
+        if len(level['maxd']) <= width:
+            return level
+    return levels[-1]
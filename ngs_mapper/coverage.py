@@ -54,27 +54,48 @@ Exclude pH1N1 H3N2, but show all references with /MP/ in them(even pH1N1 and H3N
     .. code-block:: bash
 
         sample_coverage Projects/* --exclude pH1N1 H3N2 --include '/MP/'
+
+Large numbers of samples
+------------------------
+
+Each reference is drawn as a single line collection so hundreds of samples can be drawn quickly.
+All samples go into the single ``--output`` image unless ``--page-size`` is given. Then when there are
+more samples than ``--page-size`` the samples are split up into several images that are numbered after
+the ``--output`` name(Coverage.1.png, Coverage.2.png, ...)
+
+    .. code-block:: bash
+
+        sample_coverage Projects/* --page-size 50
+
+The coverage regions for each project are saved next to its qualdepth.json file in a
+qualdepth.regions.json file for every --gap/--lowqual/--lowcov combination used. Running
+sample_coverage again only has to load projects whose qualdepth.json changed since then.
+Projects are loaded using ``--threads`` processes.
 """
 from glob import glob
 import json
-from os.path import join, basename
+import os
+from os.path import join, basename, splitext
 from collections import defaultdict
 from compat import OrderedDict
 import math
 import argparse
+import multiprocessing
 
 from bqd import (
-    lines2d_from_regions,
     regions_from_qualdepth,
+    CoverageRegion,
     G, N, LQ, LC, LCQ,
     REGIONTYPES,
 )
 
 import matplotlib.pyplot as plt
 from matplotlib.lines import Line2D
+from matplotlib.collections import LineCollection
 import matplotlib.gridspec as gridspec
 
 import log
+from util import pool_map
 
 logger = log.setup_logger(__name__, log.get_config())
 
@@ -140,48 +161,217 @@ def get_allrefs(projects, includes, excludes):
         allrefs.update(refs_from_project(p, includes, excludes))
     return allrefs
 
-def load_project_qualdepth(projpath):
+def project_qualdepth_path(projpath):
     '''
-    Simply load the qualdepth.json file for a given project path
+    Get the path to the qualdepth.json file for a given project path
     '''
     try:
-        qualdepthfile = glob(join(projpath, '*.bam.qualdepth.json'))[0]
+        return glob(join(projpath, '*.bam.qualdepth.json'))[0]
     except IndexError as e:
         raise ValueError('{0} missing qualdepth file'.format(projpath))
+
+def load_project_qualdepth(projpath):
+    '''
+    Simply load the qualdepth.json file for a given project path
+    '''
+    qualdepthfile = project_qualdepth_path(projpath)
     return json.load(open(qualdepthfile))
 
-def get_perreference_from_projects(projects, allrefs, refax, gap, lowqual, lowcov, lineargs):
+def project_regions(projpath, gap, lowqual, lowcov):
+    '''
+    Get the coverage regions for every reference in a project
+
+    projpath - project path that contains a qualdepth.json
+    gap, lowqual, lowcov are integers dictating how to call coverage regions
+
+    returns {ref1: {'length': int, 'regions': [CoverageRegion,...]}, ...}
+    '''
+    qualdepths = load_project_qualdepth(projpath)
+    regions = {}
+    for ref, qualdepth in qualdepths.items():
+        if ref == 'unmapped_reads':
+            continue
+        regions[ref] = {
+            'length': int(qualdepth['length']),
+            'regions': list(regions_from_qualdepth(qualdepth, gap, lowqual, lowcov))
+        }
+    return regions
+
+def region_cache_path(qualdepthfile):
+    '''
+    Path of the region summary cache that sits next to qualdepthfile
+    '''
+    return qualdepthfile.replace('.qualdepth.json', '.qualdepth.regions.json')
+
+def load_region_cache(cachefile, qualdepthfile):
+    '''
+    Load the region summary cache for qualdepthfile
+
+    The cache is only valid for the qualdepth file it was built from so if
+    the qualdepth file's mtime or size differ an empty cache is returned
+
+    returns {'qualdepth': {'mtime':, 'size':}, 'regions': {thresholds: {ref: ...}}}
     '''
-    Get a dictionary keyed by each reference in allrefs
-    Each item contains a list of generators that generate Line2D objects
-    for a sample's regions
+    st = os.stat(qualdepthfile)
+    source = {'mtime': st.st_mtime, 'size': st.st_size}
+    try:
+        with open(cachefile) as fh:
+            cache = json.load(fh)
+    except (IOError, ValueError):
+        cache = {}
+    if cache.get('qualdepth') != source:
+        cache = {'qualdepth': source, 'regions': {}}
+    return cache
+
+def write_region_cache(cachefile, cache):
+    '''
+    Write cache to cachefile through a temporary file so concurrent readers
+    never see a partial file. Failing to write is not fatal since the cache
+    can always be rebuilt.
+    '''
+    tmpfile = '{0}.{1}.tmp'.format(cachefile, os.getpid())
+    try:
+        with open(tmpfile, 'w') as fh:
+            json.dump(cache, fh)
+        os.rename(tmpfile, cachefile)
+    except (IOError, OSError) as e:
+        logger.warning('Could not write region cache {0}: {1}'.format(cachefile, e))
+        if os.path.exists(tmpfile):
+            os.unlink(tmpfile)
+
+def cached_project_regions(projpath, gap, lowqual, lowcov):
+    '''
+    Same as project_regions but uses the region summary cache next to the
+    project's qualdepth.json so the qualdepth only has to be loaded and
+    segmented when it changes or new thresholds are requested
+
+    returns {ref1: {'length': int, 'regions': [CoverageRegion,...]}, ...}
+    '''
+    qualdepthfile = project_qualdepth_path(projpath)
+    cachefile = region_cache_path(qualdepthfile)
+    cache = load_region_cache(cachefile, qualdepthfile)
+    thresholds = '{0},{1},{2}'.format(gap, lowqual, lowcov)
+    if thresholds in cache['regions']:
+        logger.debug('Using cached regions for {0}'.format(projpath))
+        cached = cache['regions'][thresholds]
+        return dict(
+            (ref, {
+                'length': r['length'],
+                'regions': [CoverageRegion._make(region) for region in r['regions']]
+            })
+            for ref, r in cached.items()
+        )
+    regions = project_regions(projpath, gap, lowqual, lowcov)
+    cache['regions'][thresholds] = regions
+    write_region_cache(cachefile, cache)
+    return regions
+
+def _cached_project_regions(args):
+    return (basename(args[0]), cached_project_regions(*args))
+
+def load_projects_regions(projects, regionmins, threads=1):
+    '''
+    Load the region summaries for all projects using threads processes
 
     projects - list of project paths
+    regionmins - [gap, lowqual, lowcov]
+
+    returns [(samplename, regions), ...] in the same order as projects
+    '''
+    gap, lowqual, lowcov = regionmins
+    jobs = [(p, gap, lowqual, lowcov) for p in projects]
+    return pool_map(_cached_project_regions, jobs, threads)
+
+def get_perreference_regions(projectregions, allrefs):
+    '''
+    Regroup the regions of every project by reference
+
+    projectregions - list of (samplename, project_regions(...)) in the order
+     they should be drawn
     allrefs - sequence of reference names
-    refax - {ref1:axes, ref2:axes,...}
-    gap, lowqual, lowcov are integers dictating how to call coverage regions
-    lineargs is a dictionary of kwargs for Line2D
+
+    returns {ref1: [(samplename, length, regions), ...], ...}
     '''
-    # Now build Line2D for everything
-    # This builds lines for each sample in each reference
     perreference = defaultdict(list)
-    for sampleno, projdir in enumerate(projects, start=1):
-        qualdepths = load_project_qualdepth(projdir)
-        # Add each sample's region lines to the reference key
+    for samplename, regions in projectregions:
         for ref in allrefs:
-            if ref not in qualdepths:
-                # Skip missing references for this sample
-                continue
-            # Get correct plot
-            ax = refax[ref]
-            # Get the qualdepth for reference
-            qualdepth = qualdepths[ref]
-            ax.set_xlim(0,int(qualdepth['length']))
-            regions = regions_from_qualdepth(qualdepth, gap, lowqual, lowcov)
-            # Each reference will hold a list of line2d generators
-            perreference[ref].append(lines2d_from_regions(sampleno, regions, lineargs))
+            # Skip missing references for this sample
+            if ref in regions:
+                perreference[ref].append(
+                    (samplename, regions[ref]['length'], regions[ref]['regions'])
+                )
     return perreference
 
+def linecollection_from_samples(samples, lineargs):
+    '''
+    Build a single LineCollection for all of the samples of a reference
+    Each sample's regions are drawn at y = 1, 2, 3... in the order given and
+    colored by region type
+
+    samples - [(samplename, length, regions), ...]
+    lineargs is a dictionary mapping each region.type to Line2D arguments
+     of which color and linewidth are used
+
+    returns LineCollection
+    '''
+    segments = []
+    colors = []
+    linewidths = []
+    for y, sample in enumerate(samples, start=1):
+        for region in sample[2]:
+            segments.append([(region.start, y), (region.end, y)])
+            colors.append(lineargs[region.type]['color'])
+            linewidths.append(lineargs[region.type]['linewidth'])
+    return LineCollection(segments, colors=colors, linewidths=linewidths)
+
+def plot_reference_collection(samples, ax, lineargs):
+    '''
+    Plot all samples for a reference on a given axes using a single
+    LineCollection
+
+    returns list of y tick labels(blank first so samples start at y=1)
+    '''
+    ax.add_collection(linecollection_from_samples(samples, lineargs))
+    ax.set_xlim(0, max([sample[1] for sample in samples]))
+    return [''] + [sample[0] for sample in samples]
+
+def plot_all_references_collections(perreference, refax, lineargs):
+    '''
+    Plot every reference on its axes drawing each reference with a single
+    LineCollection
+
+    perreference - output of get_perreference_regions
+    refax - {ref1:axes, ref2:axes,...}
+    '''
+    for ref in perreference:
+        ax = refax[ref]
+        ax.set_title(ref)
+        ax.set_xlabel('Reference Position')
+        samples = plot_reference_collection(perreference[ref], ax, lineargs)
+        ax.set_ylim(0,len(samples))
+        ax.set_yticks(xrange(len(samples)))
+        ax.set_yticklabels(samples)
+        ax.set_ylabel('Samples')
+
+def paginate(items, page_size):
+    '''
+    Split items into lists of at most page_size items
+    page_size < 1 means everything goes on a single page
+    '''
+    if page_size < 1:
+        return [items]
+    return [items[i:i+page_size] for i in range(0, len(items), page_size)]
+
+def page_output(output, pagenum, numpages):
+    '''
+    Get the image path for a page. Single pages just use output
+    otherwise the page number is put before the extension
+    '''
+    if numpages == 1:
+        return output
+    root, ext = splitext(output)
+    return '{0}.{1}{2}'.format(root, pagenum, ext)
+
 def set_figure_size(perreference, figure, min_subplot_height=1.5):
     '''
     Set figure size and dpi based on number of references and number of
@@ -223,61 +413,6 @@ def set_figure_size(perreference, figure, min_subplot_height=1.5):
     logger.debug('Setting 20.0, {0} inches(wxh) as the graphic dimensions'.format(height))
     figure.set_size_inches(20.0, height)
 
-def plot_all_references(projects, perreference, refax):
-    # Samplenames
-    # Should be just all the basenames of projects
-    # 0 index should be blank because the enumerate is start=1 above
-    samplenames = [''] + [basename(p) for p in projects]
-
-    # Do all plotting now
-    for ref in perreference:
-        # Get axes
-        ax = refax[ref]
-        # Set the title of the axes to current reference
-        ax.set_title(ref)
-        # Set the x-axis label
-        ax.set_xlabel('Reference Position')
-
-        # Plot the reference
-        samples = plot_reference(ref, perreference[ref], samplenames, ax)
-
-        # Set Y-Axis details
-        # Set y min,max
-        ax.set_ylim(0,len(samples))
-        # Tell y-axis to have same number of ticks as # samples
-        ax.set_yticks(xrange(len(samples)))
-        # Set each tick label
-        ax.set_yticklabels(samples)
-        # Set the Label that shows up for Y-Axis
-        ax.set_ylabel('Samples')
-
-def plot_reference(ref, line2dseq, samplenames, ax):
-    '''
-    Plot reference on a given axes using line2dsequences for reference
-    '''
-    # Samples for this axis in correct order
-    samples = ['']
-    # Also keep a quicker lookup
-    samplesseen = set()
-    # perreference contains key: list(generatorofline2ds, generatorofline2ds,)
-    for y, sampleslines in enumerate(line2dseq, start=1):
-        # Get samplename from samplenames
-        # Iterate all the line2d objects for each sample
-        for line in sampleslines:
-            # First get index which is same as Line2D ydata
-            i = line.get_ydata()[0]
-            # Fetch sample from samplenames list
-            sample = samplenames[i]
-            # Add sample to ylabels list(samples)
-            if sample not in samplesseen:
-                samples.append(sample)
-                samplesseen.add(sample)
-            # Reset this line to the correct y position
-            line.set_ydata([y,y])
-            # Add the line to the axes
-            ax.add_line(line)
-    return samples
-
 def create_legend(figure, regiontypes, lineargs):
     # Draw legend
     # First get a mock regions so we can get line2d objects for each region type
@@ -308,37 +443,36 @@ def get_gridspec(num_rows):
     logger.debug('Creating gridspec with {0} rows and 2 columns'.format(rows))
     return gridspec.GridSpec(rows, 2, width_ratios=[1,1])
 
-def create_figure_for_projects(projects, includes, excludes, lineargs, regionmins):
-    gap, lowqual, lowcov = regionmins
-
-    # Will hold our unique reference names from all projects
-    allrefs = get_allrefs(projects, includes, excludes)
+def create_figures_for_projects(projects, includes, excludes, lineargs, regionmins, page_size=0, threads=1):
+    '''
+    Create the coverage figure for projects where each reference is drawn as
+    a single LineCollection and projects are split into pages of page_size
+    projects. Each project's regions are loaded once, in parallel, from the
+    region summary cache.
 
-    # Get the figure object
-    fig = plt.figure()
+    returns a generator of figures, one per page
+    '''
+    projectregions = load_projects_regions(projects, regionmins, threads)
 
-    # Grid of figures for each reference
-    # 2 columns, numrefs rows
-    gs = get_gridspec(len(allrefs))
+    for page in paginate(projectregions, page_size):
+        allrefs = set()
+        for samplename, regions in page:
+            allrefs.update(filter_refs(regions.keys(), includes, excludes))
 
-    # Map reference name to it's subplot
-    # Keep sorted order of references so they are grouped together
-    refax = OrderedDict([(ref,plt.subplot(gs[i])) for i,ref in enumerate(sorted(allrefs))])
+        fig = plt.figure()
+        gs = get_gridspec(len(allrefs))
+        refax = OrderedDict([(ref,plt.subplot(gs[i])) for i,ref in enumerate(sorted(allrefs))])
 
-    # Get line segments for each sample broken down by reference
-    perreference = get_perreference_from_projects(projects, allrefs, refax, gap, lowqual, lowcov, lineargs)
+        perreference = get_perreference_regions(page, allrefs)
 
-    #Setup figure size
-    set_figure_size(perreference, fig)
+        set_figure_size(perreference, fig)
 
-    plot_all_references(projects, perreference, refax)
+        plot_all_references_collections(perreference, refax, lineargs)
 
-    create_legend(fig, REGIONTYPES, lineargs)
+        create_legend(fig, REGIONTYPES, lineargs)
 
-    # Adjust the subplots(reference graphs) so they have
-    # correct spacing
-    gs.tight_layout(fig)
-    return fig
+        gs.tight_layout(fig)
+        yield fig
 
 def parse_args():
     parser = argparse.ArgumentParser(
@@ -357,6 +491,24 @@ def parse_args():
         help='Path to save output image to[Default: %(default)s]'
     )
 
+    parser.add_argument(
+        '--page-size',
+        dest='page_size',
+        default=0,
+        type=int,
+        help='Maximum number of samples to put in a single image. If there ' \
+            'are more samples than this, multiple images are created that ' \
+            'are numbered after --output. 0 puts all samples in one image' \
+            '[Default: %(default)s]'
+    )
+
+    parser.add_argument(
+        '--threads',
+        default=multiprocessing.cpu_count(),
+        type=int,
+        help='How many processes to load projects with[Default: %(default)s]'
+    )
+
     parser.add_argument(
         '--lowcov',
         default=10,
@@ -409,12 +561,20 @@ def main():
 
     regionmins = [gap,lowqual,lowcov]
 
-    fig = create_figure_for_projects(projects, includes, excludes, lineargs, regionmins)
-    try:
-        fig.savefig(args.output, dpi=fig.dpi, bbox_inches='tight')
-    except ValueError as e:
-        print "!!!!!!!!!! Error: Image size too large to create !!!!!!!!!!!!!!"
-        raise e
+    pages = paginate(projects, args.page_size)
+    figures = create_figures_for_projects(
+        projects, includes, excludes, lineargs, regionmins, args.page_size,
+        args.threads
+    )
+    for pagenum, fig in enumerate(figures, start=1):
+        output = page_output(args.output, pagenum, len(pages))
+        logger.info('Saving {0}'.format(output))
+        try:
+            fig.savefig(output, dpi=fig.dpi, bbox_inches='tight')
+        except ValueError as e:
+            print "!!!!!!!!!! Error: Image size too large to create !!!!!!!!!!!!!!"
+            raise e
+        plt.close(fig)
 
 if __name__ == '__main__':
     main()
@@ -3,6 +3,7 @@ from os.path import *
 import os
 import sys
 import re
+import string
 import log
 from Bio import SeqIO
 import gzip
@@ -77,6 +78,61 @@ READ_ID_MAPPING = (
 )
 ''' Mapping of regular expression for a read identifier to the platform that it belongs to '''
 
+DIGITS_TO_ZERO = string.maketrans( string.digits, '0' * len( string.digits ) )
+''' Translation table that replaces every digit in a string with 0 '''
+
+class PlatformClassifier(object):
+    '''
+    Classifies read identifiers into platforms with a single regular expression
+
+    Every pattern becomes a named group in one alternation so each identifier is
+    matched once instead of once per platform. The first pattern that matches
+    the start of an identifier wins, just as when the patterns are tried in order.
+
+    Reads from the same run differ only in their numbers, so results are cached
+    under the identifier with every digit replaced by 0. None of the patterns
+    tell one digit from another, so this gives the same result as matching the
+    identifier itself.
+    '''
+    def __init__( self, mapping, maxcache=10000 ):
+        '''
+        :param mapping: sequence of (pattern, platform) in the order they are tried.
+                        Patterns can be strings or compiled regular expressions
+        :param int maxcache: most identifiers cached before the cache is emptied
+        '''
+        self.platforms = []
+        alternatives = []
+        for i, (pattern, platform) in enumerate( mapping ):
+            pattern = getattr( pattern, 'pattern', pattern )
+            alternatives.append( '(?P<p{0}>{1})'.format(i, pattern) )
+            self.platforms.append( platform )
+        self.regex = re.compile( '|'.join( alternatives ) )
+        self.maxcache = maxcache
+        self.cache = {}
+
+    def classify( self, identifier ):
+        '''
+        :param str identifier: read identifier
+        :return: platform of the first pattern that matches or None
+        '''
+        key = identifier.translate( DIGITS_TO_ZERO )
+        try:
+            return self.cache[key]
+        except KeyError:
+            pass
+        m = self.regex.match( identifier )
+        platform = None
+        if m is not None:
+            # The group around each pattern is always the last one to close
+            platform = self.platforms[int( m.lastgroup[1:] )]
+        if len( self.cache ) >= self.maxcache:
+            self.cache.clear()
+        self.cache[key] = platform
+        return platform
+
+READ_ID_CLASSIFIER = PlatformClassifier( READ_ID_MAPPING )
+''' Classifier for READ_ID_MAPPING '''
+
 class NoPlatformFound(Exception):
     '''Exception when no platform can be found for a read'''
     pass
@@ -140,9 +196,9 @@ def platform_for_read( filepath ):
             raise NoPlatformFound("No platform found for invalid read file {0}".format(filepath))
 
         # Find first platform that matches
-        for p, plat in READ_ID_MAPPING:
-            if re.match(p, first_record.id):
-                return plat
+        plat = READ_ID_CLASSIFIER.classify(first_record.id)
+        if plat is not None:
+            return plat
         raise NoPlatformFound("No platform found for {0}".format(filepath))
     finally:
         fh.close()
@@ -10,6 +10,7 @@ import matplotlib.gridspec as gridspec
 import os.path
 
 from graph_qualdepth import plot_mapunmap
+import summary
 
 def parse_args( args=sys.argv ):
     parser = argparse.ArgumentParser(
@@ -19,7 +20,9 @@ def parse_args( args=sys.argv ):
     parser.add_argument(
         dest='jsons',
         nargs='+',
-        help='List of qualdepth.json files'
+        help='List of qualdepth.json or summary.json files. If a ' \
+            'samplename.summary.json file exists next to a qualdepth.json ' \
+            'file it is used instead'
     )
 
     parser.add_argument(
@@ -41,10 +44,57 @@ def sample_from_filename( filename ):
         @returns the portion of the filename before .bam
     '''
     m = re.match( '(\S+)\.bam.*', os.path.basename(filename) )
+    if not m:
+        m = re.match( '(\S+)\.summary\.json$', os.path.basename(filename) )
     if not m:
         raise ValueError( "Filename given({0}) does not contain .bam".format(filename) )
     return m.group(1)
 
+def summary_for_json( jfile ):
+    '''
+        Returns the summary.json path for a qualdepth.json file or
+        None if the sample has no summary
+
+        @param jfile - qualdepth.json or summary.json path
+    '''
+    if jfile.endswith( '.summary.json' ):
+        return jfile
+    samplename = sample_from_filename( jfile )
+    summaryfile = summary.summary_path(
+        os.path.join( os.path.dirname(jfile), samplename )
+    )
+    if os.path.exists( summaryfile ):
+        return summaryfile
+    return None
+
+def mapunmap_from_json( jfile ):
+    '''
+        Gets the mapped and unmapped reads for a single sample
+        Uses the sample's summary.json if it exists and has them and only loads
+        the much larger qualdepth.json if it does not(summaries of runs that
+        never got to graphsample have no read counts)
+
+        @param jfile - qualdepth.json or summary.json path
+
+        @returns (mapped, unmapped)
+    '''
+    summaryfile = summary_for_json( jfile )
+    if summaryfile is not None:
+        s = summary.load_summary( summaryfile )
+        if 'mapped_reads' in s and 'unmapped_reads' in s:
+            return int(s['mapped_reads']), int(s['unmapped_reads'])
+        if jfile == summaryfile:
+            jfile = os.path.join(
+                os.path.dirname(jfile), sample_from_filename(jfile) + '.bam.qualdepth.json'
+            )
+    j = json.load( open(jfile) )
+    # Add up all the mapped_reads for every reference
+    mreads = 0
+    for ref in j:
+        if ref != 'unmapped_reads':
+            mreads += int(j[ref]['mapped_reads'])
+    return mreads, int(j['unmapped_reads'])
+
 def get_mapunmap( jsons ):
     '''
         Gets a list of tuples representing mapped,unmapped reads for each sample
@@ -58,14 +108,9 @@ def get_mapunmap( jsons ):
     unmapped_reads = []
     for jfile in jsons:
         samples.append( sample_from_filename( jfile ) )
-        j = json.load( open(jfile) )
-        # Add up all the mapped_reads for every reference
-        mreads = 0
-        for ref in j:
-            if ref != 'unmapped_reads':
-                mreads += int(j[ref]['mapped_reads'])
+        mreads, ureads = mapunmap_from_json( jfile )
         mapped_reads.append( mreads )
-        unmapped_reads.append( int(j['unmapped_reads']) )
+        unmapped_reads.append( ureads )
 
     return samples, mapped_reads, unmapped_reads
 
@@ -3,21 +3,39 @@
 import json
 import argparse
 import sys
-from os.path import basename
+from os.path import basename, exists
 import numpy as np
 
+from bqd import build_pyramid, select_pyramid_level
+
+# dpi the qualdepth images are saved with
+DPI = 100
+
 def main( args ):
     if args.title is None:
         title = basename(args.outfile)
     else:
         title = args.title
-    make_graphic( args.jsonfile, args.outfile, args.ref, titleprefix=title )
+    make_graphic( args.jsonfile, args.outfile, args.ref, titleprefix=title, pyramidfile=pyramid_path(args.jsonfile) )
 
-def plot_depths( ax, xvals, yvals, maxdepth, color, title ):
+def pyramid_path( qualdepthfile ):
+    '''
+        Returns the path of the pyramid file that goes with qualdepthfile
+        or None if it does not exist
+    '''
+    pyramidfile = qualdepthfile.replace( '.qualdepth.json', '.qualdepth.pyramid.json' )
+    if pyramidfile != qualdepthfile and exists( pyramidfile ):
+        return pyramidfile
+    return None
+
+def plot_depths( ax, xvals, yvals, maxdepth, color, title, minvals=None ):
     ax.set_title( "{0} Depth/Qual".format(title) )
     ax.set_xlabel( "Reference Position" )
     ax.set_ylabel( "Depth" )
-    ax.fill_between( xvals, yvals, facecolor=color, alpha=0.5 )
+    ax.fill_between( xvals, yvals, facecolor=color, alpha=0.5, step='post' )
+    # Darker fill up to the minimum depth so dropouts inside of a bin show
+    if minvals is not None:
+        ax.fill_between( xvals, minvals, facecolor=color, alpha=0.5, step='post' )
     #ax.plot( xvals, yvals, c=color )
     ax.set_xlim([0,xvals[-1]])
     ax.set_ylim([0,maxdepth])
@@ -29,14 +47,14 @@ def plot_quals( ax, xvals, yvals, color ):
     ticks = None
     # It looks nicer if you have ticks on multiples of 500,
     # but if the genome is very large just do every 20
-    if len( xvals ) < 15000:
+    if xvals[-1] < 15000:
         # Put ticks every 500 on the x axis
         ticks = MultipleLocator( 500 )
     else:
         ticks = LinearLocator( 10 )
     ax.xaxis.set_major_locator( ticks )
     #ax.plot( xvals, yvals, c=color )
-    ax.fill_between( xvals, yvals, facecolor=color, alpha=0.2 )
+    ax.fill_between( xvals, yvals, facecolor=color, alpha=0.2, step='post' )
     ax.set_ylabel( "Quality" )
     ax.set_xlim([0,xvals[-1]])
     ax.set_ylim([0,40])
@@ -76,24 +94,48 @@ def plot_mapunmap( ax, mapped, unmapped, mapped_color='g', unmapped_color='r', m
     autolabel( mr, bottom=unmapped )
     autolabel( ur, text_under=True, color=unmapped_read_text_color )
 
-def make_graphic( qualdepthfile, outputfile, ref=None, titleprefix='', compress_data=50 ):
+def level_xy( level, length, *keys ):
+    '''
+        Turn a pyramid level into x values and y values for each key that can
+        be drawn with step='post' so every bin spans its positions
+
+        @param level - pyramid level(see bqd.build_pyramid)
+        @param length - reference length
+        @param keys - keys in level to get y values for
+
+        @returns [xvals, yvals for keys[0], ...]
+    '''
+    binsize = level['binsize']
+    nbins = len( level[keys[0]] )
+    xvals = [i * binsize for i in range(nbins)] + [length]
+    yvals = [level[key] + level[key][-1:] for key in keys]
+    return [xvals] + yvals
+
+def make_graphic( qualdepthfile, outputfile, ref=None, titleprefix='', pyramidfile=None ):
     '''
         Makes a graphic for a reference showing depth and avg qualities
 
+        The data is drawn from the pyramid level whose bins match the pixel
+        width of the plot so the time it takes does not depend on the reference
+        length.
+
         @param qualdepthfile - Should be qualdepth.json file
         @param outputfile - Where to save the image
         @param ref - Which reference to do the image for
         @param titleprefix - What to put in title before the Qual/Depth text
-        @param compress_data - How many ref positions to skip between each data point
+        @param pyramidfile - qualdepth.pyramid.json file that goes with qualdepthfile.
+            If None the pyramid is built from qualdepthfile
         
         NOTE: This works for single reference mapped only!!
     '''
     import matplotlib.pyplot as plt
     import matplotlib.gridspec as gridspec
-    import numpy as np
 
     # Load the json
-    j = json.load( open(qualdepthfile) )
+    if pyramidfile is not None:
+        j = json.load( open(pyramidfile) )
+    else:
+        j = json.load( open(qualdepthfile) )
 
     refs = [r for r in j.keys() if r != 'unmapped_reads']
     if ref is None:
@@ -114,17 +156,41 @@ def make_graphic( qualdepthfile, outputfile, ref=None, titleprefix='', compress_
     ax2 = plt.subplot(gs[1])
     ax3 = ax1.twinx()
 
-    depths = j[ref]['depths'][::compress_data]
-    quals = j[ref]['avgquals'][::compress_data]
+    if pyramidfile is not None:
+        levels = j[ref]['levels']
+    else:
+        levels = build_pyramid( j[ref]['depths'], j[ref]['avgquals'] )
+    # How many pixels wide the depth/qual plot will be
+    width = int( ax1.get_position().width * fig.get_figwidth() * DPI )
+    level = select_pyramid_level( levels, width )
+    if level is not None:
+        xvals, maxdepths, mindepths, quals = level_xy(
+            level, j[ref]['length'], 'maxd', 'mind', 'meanq'
+        )
+    else:
+        # No pyramid(reference without any depths) so draw every base
+        if pyramidfile is not None:
+            raw = json.load( open(qualdepthfile) )[ref]
+        else:
+            raw = j[ref]
+        level = {
+            'binsize': 1,
+            'depths': list( raw['depths'] ) or [0],
+            'avgquals': list( raw['avgquals'] ) or [0]
+        }
+        xvals, maxdepths, quals = level_xy(
+            level, j[ref]['length'], 'depths', 'avgquals'
+        )
+        mindepths = maxdepths
     mapped_reads = j[ref]['mapped_reads']
     unmapped_reads = j['unmapped_reads']
-    xvals = range(0,len(j[ref]['depths']), compress_data)
 
-    plot_depths( ax1, xvals, depths, max_depth, title=titleprefix, color='blue' )
+    plot_depths( ax1, xvals, maxdepths, max_depth, title=titleprefix, color='blue', minvals=mindepths )
     plot_quals( ax3, xvals, quals, color='green' )
     plot_mapunmap( ax2, mapped_reads, unmapped_reads )
 
-    fig.savefig( outputfile, bbox_inches='tight', dpi=100, pad_inches=0.1 )
+    fig.savefig( outputfile, bbox_inches='tight', dpi=DPI, pad_inches=0.1 )
+    plt.close( fig )
 
 def parse_args( args=sys.argv[1:] ):
     parser = argparse.ArgumentParser(
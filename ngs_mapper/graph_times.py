@@ -7,6 +7,8 @@ from nose.tools import ok_, eq_
 
 from datetime import datetime
 import log
+import summary
+import metrics
 
 logc = log.get_config()
 logger = log.setup_logger( 'graph_times', logc )
@@ -30,6 +32,58 @@ def main():
     ax.set_xticklabels( x, rotation='vertical' )
     ax.set_ylabel( 'Seconds' )
     plt.savefig( 'PipelineTimes.png', bbox_inches='tight', dpi=100, pad_inches=0.1 )
+    plot_stages( get_projects( 'Projects' ), 'PipelineStageTimes.png' )
+
+# What is plotted for each stage by plot_stages as (value, title, ylabel, scale)
+STAGE_PLOTS = (
+    ('duration', 'Wall time per stage', 'Seconds', 1),
+    ('cpu', 'CPU time(user + sys) per stage', 'Seconds', 1),
+    ('maxrss', 'Peak memory per stage', 'MB', 1),
+    ('read_bytes', 'Disk read per stage', 'MB', 1024**2),
+    ('write_bytes', 'Disk written per stage', 'MB', 1024**2),
+)
+
+def plot_stages( projects, outfile ):
+    '''
+        Plot a breakdown of each stage's wall time, cpu time, peak memory and
+        disk io for every project from the projects' metrics files
+        Times and io are stacked so each bar is the sample's total while each
+        stage's peak memory is a line since stages do not hold memory at
+        the same time
+
+        @returns outfile or None if no project has stages
+    '''
+    samplenames = None
+    fig, axes = plt.subplots( len(STAGE_PLOTS), 1, sharex=True )
+    fig.set_size_inches( 20.0, 5.0 * len(STAGE_PLOTS) )
+    fig.suptitle( 'Pipeline Stages per Sample' )
+    for ax, (value, title, ylabel, scale) in zip( axes, STAGE_PLOTS ):
+        names, breakdown = metrics.stage_breakdown( projects, value )
+        projs = sorted( breakdown )
+        if samplenames is None:
+            if not projs:
+                plt.close( fig )
+                logger.warning( "No stages recorded for any project" )
+                return None
+            samplenames = [basename( p ) for p in projs]
+        x = np.arange( len(projs) )
+        bottom = np.zeros( len(projs) )
+        colors = plt.cm.jet( np.linspace( 0, 1, max( len(names), 1 ) ) )
+        for name, color in zip( names, colors ):
+            y = np.array( [breakdown[p].get( name, 0 ) for p in projs], dtype=float ) / scale
+            if value == 'maxrss':
+                ax.plot( x, y, label=name, color=color, marker='o' )
+            else:
+                ax.bar( x, y, bottom=bottom, label=name, color=color, align='center' )
+                bottom += y
+        ax.set_title( title )
+        ax.set_ylabel( ylabel )
+    axes[0].legend( loc='upper left', bbox_to_anchor=(1.0, 1.0) )
+    axes[-1].set_xticks( range( len(samplenames) ) )
+    axes[-1].set_xticklabels( samplenames, rotation='vertical' )
+    plt.savefig( outfile, bbox_inches='tight', dpi=100, pad_inches=0.1 )
+    plt.close( fig )
+    return outfile
 
 def datediff( start_stop ):
     '''
@@ -54,12 +108,25 @@ def start_stop( basedir ):
     ss = {}
     for p in projects:
         proj = basename( p )
-        diff = datediff( start_stop_for_project( p ) )
+        diff = duration_for_project( p )
         if diff < 60:
             logger.warning( "{0} ran in only {1} seconds".format(p,diff) )
         ss[proj] = diff
     return ss
 
+def duration_for_project( projectpath ):
+    '''
+        Seconds the project took to run
+        Read from the project's summary.json if it exists, otherwise the
+        Starting/Finished lines in the project's log file are used
+    '''
+    summaryfile = summary.project_summary_path( projectpath )
+    if exists( summaryfile ):
+        s = summary.load_summary( summaryfile )
+        if 'duration' in s:
+            return int( s['duration'] )
+    return datediff( start_stop_for_project( projectpath ) )
+
 def start_stop_for_project( projectpath ):
     '''
         >>> p = get_projects( 'Projects' )[0]
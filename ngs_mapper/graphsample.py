@@ -1,26 +1,39 @@
 import sys
 import os
 from os.path import *
-import subprocess
 import argparse
+import multiprocessing
+
+import numpy as np
 
 import bqd, graph_qualdepth as qd
 import samtools
 from bam_to_qualdepth import set_unmapped_mapped_reads
 import json
 import log
+from util import pool_map
 
 logc = log.get_config( 'graphsample.log' )
 logger = log.setup_logger( 'graphsample', logc )
 
-def main():
-    args = parse_args()
+def main( args=sys.argv[1:] ):
+    args = parse_args( args )
     args = handle_args( args )
     if not args.qualdepth:
         jfile = make_json( args.bamfile, args.outpath )
     else:
         jfile = args.qualdepth
-    pngfile = make_image( jfile, args.outpath )
+    pngfile = make_image( jfile, args.outpath, args.threads )
+    if pngfile is None:
+        return 1
+
+def main_projects():
+    args = parse_projects_args()
+    montages = graph_projects( args.projects, args.threads, not args.norecreate )
+    failed = montages.count( None )
+    if failed:
+        logger.error( 'Could not graph {0} of {1} projects'.format(failed, len(montages)) )
+        return 1
 
 def make_json( bamfile, outpathprefix ):
     pileup = samtools.nogap_mpileup(bamfile)
@@ -29,26 +42,86 @@ def make_json( bamfile, outpathprefix ):
     outfile = outpathprefix + '.qualdepth.json'
     with open( outfile, 'w' ) as fh:
         json.dump( stats, fh )
+    make_pyramid( stats, outpathprefix )
 
     return outfile
 
-def make_image( jfile, outpathprefix ):
+def make_pyramid( stats, outpathprefix ):
+    '''
+        Write the min/mean/max pyramid for each reference in stats
+        next to the qualdepth.json file
+
+        @param stats - qualdepth dictionary
+        @param outpathprefix - same prefix given to make_json
+
+        @returns path to the pyramid file
+    '''
+    outfile = outpathprefix + '.qualdepth.pyramid.json'
+    with open( outfile, 'w' ) as fh:
+        json.dump( bqd.qualdepth_pyramid( stats ), fh )
+    return outfile
+
+def reference_jobs( jfile, outpathprefix ):
+    '''
+        Build the list of per-reference render jobs for a qualdepth file
+
+        @param jfile - path to qualdepth.json file
+        @param outpathprefix - prefix the output files are named with
+
+        @returns list of (jfile, outputfile, ref, title, pyramidfile) tuples
+            which can be given to render_reference
+    '''
     prefix = basename( outpathprefix )
     imgdir = join( dirname(outpathprefix), 'qualdepth' )
     if not exists( imgdir ):
         os.mkdir( imgdir )
     outfile = join( imgdir, basename(outpathprefix) + '.qualdepth.' )
-    j = json.load( open(jfile) )
-    imagelist = []
+    pyramidfile = qd.pyramid_path( jfile )
+    if pyramidfile is not None:
+        j = json.load( open(pyramidfile) )
+    else:
+        j = json.load( open(jfile) )
+    jobs = []
     for ref in [r for r in j if r != 'unmapped_reads']:
         refname=normalize_ref(ref)
         title = prefix + ' ' + refname
         of = outfile + refname + '.png'
-        qd.make_graphic( jfile, of, ref=ref, titleprefix=title )
-        imagelist.append( of )
-    imagelist.append( outpathprefix + '.qualdepth.png' )
-    run_montage( *imagelist, compress='JPEG', quality=25, geometry='+1+1' )
-    return outfile
+        jobs.append( (jfile, of, ref, title, pyramidfile) )
+    return jobs
+
+def render_reference( job ):
+    '''
+        Render a single reference graphic from a job built by reference_jobs
+        Lives at module level so it can be handed to a multiprocessing.Pool
+
+        @returns the output image path or None if it could not be rendered
+    '''
+    jfile, of, ref, title, pyramidfile = job
+    try:
+        qd.make_graphic( jfile, of, ref=ref, titleprefix=title, pyramidfile=pyramidfile )
+    except Exception as e:
+        logger.error( 'Could not render {0} from {1}: {2}'.format(ref, jfile, e) )
+        return None
+    return of
+
+def make_image( jfile, outpathprefix, threads=1 ):
+    '''
+        Render every reference in jfile and montage them into
+        outpathprefix.qualdepth.png
+
+        @param threads - how many processes to render references with
+
+        @returns path to the montage image or None if any reference could
+            not be rendered(the montage has the ones that were)
+    '''
+    jobs = reference_jobs( jfile, outpathprefix )
+    imagelist = pool_map( render_reference, jobs, threads )
+    pngfile = montage_images(
+        [i for i in imagelist if i is not None], outpathprefix + '.qualdepth.png'
+    )
+    if None in imagelist:
+        return None
+    return pngfile
 
 def normalize_ref( refname ):
     '''
@@ -63,35 +136,125 @@ def normalize_ref( refname ):
             name += c
     return name
 
-class MissingCommandError(Exception): pass
-def run_montage( *args, **kwargs ):
+def montage_images( imagelist, outfile, border=1, columns=None ):
     '''
-        Runs montage on all the images to create the
-        final qualdepth.png file
-        
-        @param outprefix - Prefix that is common to all files to montage together
+        Tile images into a single image the same way montage -geometry +1+1
+        would. Every tile is the size of the largest image and the images
+        are centered in their tile.
 
-        @param args - Files to montage with the last item in the list being the output file
-        @param kwargs - options to pass to montage(compress='JPEG',quality=25)
+        @param imagelist - list of image paths to tile in row order
+        @param outfile - path to write the montage to
+        @param border - pixels of padding around each tile
+        @param columns - number of tiles per row. Default is as square as possible
 
-        @returns the output file path which should be outprefix + '.png'
+        @returns outfile which is not written if imagelist is empty
     '''
-    cmd = ['montage']
-    for k,v in kwargs.items():
-        cmd += ['-{0}'.format(k),str(v)]
-    cmd += args
-    logger.info( 'Running {0}'.format( ' '.join(cmd) ) )
+    import matplotlib.image as mpimg
+    if not imagelist:
+        logger.critical( 'Could not build montage image {0} because there are no images'.format(outfile) )
+        return outfile
+    images = []
+    for img in imagelist:
+        im = mpimg.imread( img )
+        # Normalize greyscale/RGB/uint8 images to float RGBA
+        if im.dtype == np.uint8:
+            im = im.astype( np.float32 ) / 255.0
+        if im.ndim == 2:
+            im = np.dstack( [im, im, im] )
+        if im.shape[2] == 3:
+            im = np.dstack( [im, np.ones(im.shape[:2], dtype=im.dtype)] )
+        images.append( im )
+    if columns is None:
+        columns = int( np.ceil( np.sqrt( len(images) ) ) )
+    columns = max( 1, min( columns, len(images) ) )
+    rows = int( np.ceil( len(images) / float(columns) ) )
+    tileh = max( [im.shape[0] for im in images] ) + 2 * border
+    tilew = max( [im.shape[1] for im in images] ) + 2 * border
+    montage = np.ones( (rows*tileh, columns*tilew, 4), dtype=np.float32 )
+    for i, im in enumerate( images ):
+        r, c = divmod( i, columns )
+        top = r * tileh + (tileh - im.shape[0]) // 2
+        left = c * tilew + (tilew - im.shape[1]) // 2
+        montage[top:top+im.shape[0], left:left+im.shape[1]] = im
+    logger.info( 'Montaged {0} images into {1}'.format(len(images), outfile) )
+    mpimg.imsave( outfile, montage )
+    return outfile
+
+def _make_json_job( job ):
     try:
-        subprocess.check_call( cmd )
-    except subprocess.CalledProcessError as e:
-        logger.critical('Could not build montage image because {0}'.format(e))
-    except OSError as e:
-        logger.critical('Montage command is missing')
-        raise MissingCommandError(
-            "Missing montage command from ImageMagick tools. Is ImageMagick installed?"
-        )
-    return args[-1]
-    
+        return make_json( *job )
+    except Exception as e:
+        logger.error( 'Could not make the qualdepth file for {0}: {1}'.format(job[0], e) )
+        return None
+
+def _montage_job( job ):
+    try:
+        return montage_images( *job )
+    except Exception as e:
+        logger.error( 'Could not build montage image {0}: {1}'.format(job[1], e) )
+        return None
+
+def graph_projects( projects, threads=1, recreate=True ):
+    '''
+        Run graphsample on every project directory sharing a single pool
+        of processes for creating the qualdepth files, rendering every
+        reference of every project and building the montages
+
+        Each project is expected to be a runsample output directory
+        containing <project>.bam
+
+        A project that fails at any step is logged and skipped so the
+        other projects are still graphed
+
+        @param projects - list of project directories
+        @param threads - size of the process pool
+        @param recreate - recreate the qualdepth.json files from the bam files
+
+        @returns the montage image of each project or None for the projects
+            that could not be graphed
+    '''
+    prefixes = [join(p, basename(normpath(p)) + '.bam') for p in projects]
+    pool = None
+    if threads > 1:
+        pool = multiprocessing.Pool( threads )
+    try:
+        if recreate:
+            jfiles = pool_map( _make_json_job, [(p, p) for p in prefixes], pool=pool )
+        else:
+            jfiles = [p + '.qualdepth.json' for p in prefixes]
+        projectjobs = {}
+        for jfile, prefix in zip( jfiles, prefixes ):
+            if jfile is None:
+                continue
+            try:
+                projectjobs[prefix] = reference_jobs( jfile, prefix )
+            except Exception as e:
+                logger.error( 'Could not read the references of {0}: {1}'.format(jfile, e) )
+        jobs = [j for p in prefixes for j in projectjobs.get( p, [] )]
+        logger.info( 'Rendering {0} references from {1} projects using {2} processes'.format(
+            len(jobs), len(projectjobs), threads
+        ))
+        rendered = dict( zip(
+            [j[1] for j in jobs], pool_map( render_reference, jobs, pool=pool )
+        ))
+        montages = []
+        for prefix in prefixes:
+            if prefix not in projectjobs:
+                continue
+            images = [j[1] for j in projectjobs[prefix]]
+            if not all( rendered[i] for i in images ):
+                logger.error( 'Not building the montage for {0} since not every reference rendered'.format(prefix) )
+                continue
+            montages.append( (images, prefix + '.qualdepth.png') )
+        created = dict( zip(
+            [m[1] for m in montages], pool_map( _montage_job, montages, pool=pool )
+        ))
+        return [created.get( p + '.qualdepth.png' ) for p in prefixes]
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
 def handle_args( args ):
     if args.outprefix is not None:
         outprefix = args.outprefix
@@ -135,4 +298,44 @@ def parse_args( args=sys.argv[1:] ):
         help='Specify an already existing qualdepth.json file so it doesn\'t have to be recreated'
     )
 
+    parser.add_argument(
+        '-t',
+        '--threads',
+        dest='threads',
+        type=int,
+        default=1,
+        help='How many processes to render references with[Default: %(default)s]'
+    )
+
+    return parser.parse_args( args )
+
+def parse_projects_args( args=sys.argv[1:] ):
+    parser = argparse.ArgumentParser(
+        description='Runs graphsample on many project directories using a single pool of processes'
+    )
+
+    parser.add_argument(
+        'projects',
+        nargs='+',
+        help='Project directories created by runsample'
+    )
+
+    parser.add_argument(
+        '-t',
+        '--threads',
+        dest='threads',
+        type=int,
+        default=multiprocessing.cpu_count(),
+        help='How many processes to use[Default: %(default)s]'
+    )
+
+    parser.add_argument(
+        '-norecreate',
+        '--norecreate',
+        dest='norecreate',
+        action='store_true',
+        default=False,
+        help='Reuse existing qualdepth.json files instead of recreating them from the bam files'
+    )
+
     return parser.parse_args( args )
@@ -0,0 +1,468 @@
+"""
+Run samples across many machines that share a filesystem(such as NGSData)
+without needing a scheduler.
+
+A queue is just a directory with a file for every sample in it
+
+    .. code-block:: bash
+
+        queue/
+            pending/    samples waiting to be run
+            claimed/    samples a worker is running
+            done/       samples that finished
+            failed/     samples that failed too many times
+            logs/       runsample output for each sample
+            clock       touched to read the filesystem's idea of the time
+
+A worker claims a sample by renaming its file from pending into claimed. Renames
+are atomic, so only one worker can ever claim a sample. While the sample runs,
+the worker touches the claimed file every few seconds as a heartbeat. Any worker
+that finds a claimed sample whose heartbeat is older than the timeout puts it
+back into pending since the worker running it must have died(or into failed
+once it has used up its retries). Ages are measured
+against the time of the shared filesystem so nodes whose clocks do not agree do
+not requeue each other's samples.
+
+Basic Usage
+===========
+
+Put every sample in a samplesheet into a queue
+
+    .. code-block:: bash
+
+        jobqueue submit /path/to/queue /path/to/ReadsBySample samplesheet.tsv
+
+Submitting a samplesheet again only adds the samples that are not in the queue
+and do not have a project directory yet.
+
+Then start a worker on as many nodes(or as many times on one node) as you want.
+Each worker exits once the queue is empty
+
+    .. code-block:: bash
+
+        jobqueue worker /path/to/queue
+
+See how far along the queue is
+
+    .. code-block:: bash
+
+        jobqueue status /path/to/queue
+
+A queue can also hold shards of reads that run_bwa_on_samplename split up with
+--shard-size and --shard-queue. Workers started on that queue map the shards
+the same way they would run samples.
+"""
+
+import argparse
+import errno
+import json
+import os
+import shlex
+import socket
+import subprocess
+import sys
+import threading
+import time
+from os.path import join, isdir, abspath, exists
+
+import log
+from runsamplesheet import read_samplesheet, sample_size, order_samples, runsample_command, PROJDIR
+logger = log.setup_logger( 'jobqueue', log.get_config() )
+
+PENDING = 'pending'
+CLAIMED = 'claimed'
+DONE = 'done'
+FAILED = 'failed'
+STATES = (PENDING, CLAIMED, DONE, FAILED)
+
+def worker_id():
+    ''' Identifies this worker in the jobs it claims '''
+    return '{0}:{1}'.format( socket.gethostname(), os.getpid() )
+
+class JobQueue(object):
+    '''
+    A queue of jobs stored as json files inside of a directory
+    '''
+    def __init__( self, path ):
+        self.path = path
+        for d in STATES + ('logs',):
+            d = join( path, d )
+            if not isdir( d ):
+                try:
+                    os.makedirs( d )
+                except OSError as e:
+                    # Another worker made it first
+                    if e.errno != errno.EEXIST:
+                        raise
+
+    def jobpath( self, state, name ):
+        return join( self.path, state, name + '.json' )
+
+    def logpath( self, name ):
+        return join( self.path, 'logs', name + '.log' )
+
+    def jobs( self, state ):
+        '''
+        Names of the jobs in state in the order they should run
+        '''
+        return sorted(
+            f[:-5] for f in os.listdir( join( self.path, state ) )
+            if f.endswith( '.json' )
+        )
+
+    def read( self, state, name ):
+        with open( self.jobpath( state, name ) ) as fh:
+            return json.load( fh )
+
+    def write( self, state, name, job ):
+        '''
+        Write a job by renaming a temporary file into place so other workers
+        never read part of a job
+        '''
+        path = self.jobpath( state, name )
+        tmppath = '{0}.{1}.tmp'.format( path, worker_id() )
+        with open( tmppath, 'w' ) as fh:
+            json.dump( job, fh, indent=1 )
+        os.rename( tmppath, path )
+
+    def move( self, name, src, dst ):
+        '''
+        Atomically move a job from src state to dst state
+
+        :return: True if this call moved it. False if it was not in src(another
+                 worker moved it first)
+        '''
+        try:
+            os.rename( self.jobpath( src, name ), self.jobpath( dst, name ) )
+            return True
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                return False
+            raise
+
+    def submit( self, job ):
+        '''
+        Add a job to pending unless the queue already has it
+
+        :param dict job: must have a name. The name is also used to order jobs
+        :return: True if it was added
+        '''
+        for state in STATES:
+            if exists( self.jobpath( state, job['name'] ) ):
+                return False
+        job.setdefault( 'attempts', 0 )
+        self.write( PENDING, job['name'], job )
+        return True
+
+    def samples( self ):
+        '''
+        Samples of every job in any state
+        '''
+        samples = set()
+        for state in STATES:
+            for name in self.jobs( state ):
+                try:
+                    samples.add( self.read( state, name ).get( 'sample' ) )
+                except (IOError, ValueError):
+                    # Moved to another state while it was listed
+                    continue
+        samples.discard( None )
+        return samples
+
+    def claim( self, accept=None ):
+        '''
+        Claim the first pending job
+
+        :param callable accept: only claim jobs this returns True for
+        :return: (name, job) or None if nothing is pending
+        '''
+        for name in self.jobs( PENDING ):
+            if accept is not None:
+                try:
+                    if not accept( self.read( PENDING, name ) ):
+                        continue
+                except (IOError, ValueError):
+                    # Claimed by another worker while it was listed
+                    continue
+            # rename keeps the modification time so the job would look like
+            # it stopped responding as soon as it was claimed
+            try:
+                os.utime( self.jobpath( PENDING, name ), None )
+            except OSError:
+                continue
+            if not self.move( name, PENDING, CLAIMED ):
+                continue
+            job = self.read( CLAIMED, name )
+            job['attempts'] += 1
+            job['worker'] = worker_id()
+            job['claimed'] = time.time()
+            self.write( CLAIMED, name, job )
+            return name, job
+        return None
+
+    def heartbeat( self, name ):
+        '''
+        Mark a claimed job as still running
+        '''
+        os.utime( self.jobpath( CLAIMED, name ), None )
+
+    def finish( self, name, job, returncode, retries ):
+        '''
+        Move a claimed job to done, back to pending if it failed with retries
+        left or to failed
+
+        :return: state the job was moved to or None if the job was requeued
+                 while it was running
+        '''
+        if not exists( self.jobpath( CLAIMED, name ) ):
+            logger.warning( "{0} was requeued while it was running".format(name) )
+            return None
+        job['returncode'] = returncode
+        job['finished'] = time.time()
+        if returncode == 0:
+            state = DONE
+        elif job['attempts'] <= retries:
+            state = PENDING
+        else:
+            state = FAILED
+        # Update it in place first so the move stays atomic
+        self.write( CLAIMED, name, job )
+        self.move( name, CLAIMED, state )
+        return state
+
+    def now( self ):
+        '''
+        Current time according to the filesystem the queue is on
+        '''
+        clock = join( self.path, 'clock' )
+        with open( clock, 'a' ):
+            os.utime( clock, None )
+        return os.stat( clock ).st_mtime
+
+    def requeue_stale( self, timeout, retries=None ):
+        '''
+        Put claimed jobs whose heartbeat is older than timeout seconds back
+        into pending or into failed once they have been claimed more than
+        retries times so a job that kills its worker is not run forever
+
+        :return: names of the jobs that were requeued
+        '''
+        now = self.now()
+        requeued = []
+        for name in self.jobs( CLAIMED ):
+            try:
+                age = now - os.stat( self.jobpath( CLAIMED, name ) ).st_mtime
+                job = self.read( CLAIMED, name )
+            except (OSError, IOError, ValueError):
+                continue
+            if age <= timeout:
+                continue
+            if retries is not None and job['attempts'] > retries:
+                if self.move( name, CLAIMED, FAILED ):
+                    logger.error( "{0} failed because its worker stopped responding {1:.0f} seconds ago on all {2} attempts".format(
+                        name, age, job['attempts']
+                    ))
+            elif self.move( name, CLAIMED, PENDING ):
+                logger.warning( "Requeued {0} because its worker stopped responding {1:.0f} seconds ago".format(name, age) )
+                requeued.append( name )
+        return requeued
+
+    def counts( self ):
+        return dict( (state, len(self.jobs( state ))) for state in STATES )
+
+def submit_samplesheet( queue, readsdir, samplesheet, options, projdir=PROJDIR ):
+    '''
+    Put every sample in samplesheet into queue, largest first and grouped by
+    reference like runsamplesheet does. Samples that are already in the queue
+    or already have a project directory are skipped so a samplesheet can be
+    submitted again
+
+    :return: number of samples added
+    '''
+    # Job names include the order so the same sample can have a different name
+    queued = queue.samples()
+    samples = []
+    for sample, reference in read_samplesheet( samplesheet ):
+        if sample in queued:
+            continue
+        if isdir( join( projdir, sample ) ):
+            logger.warning( "Skipping {0} because it already exists".format(sample) )
+            continue
+        samples.append(
+            {'name': sample, 'reference': abspath( reference ), 'size': sample_size( join( readsdir, sample ) )}
+        )
+    bysample = dict( (s['name'], s) for s in samples )
+    added = 0
+    for i, name in enumerate( order_samples( samples ) ):
+        job = dict(
+            bysample[name],
+            readsdir=abspath( readsdir ),
+            projdir=abspath( projdir ),
+            options=options,
+        )
+        # The number keeps the order when jobs are listed
+        job['name'] = '{0:06d}-{1}'.format( i, name )
+        job['sample'] = name
+        if queue.submit( job ):
+            added += 1
+    return added
+
+def run_job( queue, name, job, broker=None ):
+    '''
+    Run runsample for a job writing its output to the queue's logs directory
+    or map a shard of reads if the job is one
+
+    :return: runsample's return code
+    '''
+    if is_shard( job ):
+        # Reads that run_bwa_on_samplename split up
+        import run_bwa
+        return run_bwa.run_shard_job( job )
+    sample = {'name': job['sample'], 'reference': job['reference']}
+    outdir = join( job['projdir'], job['sample'] )
+    # Anything in the project directory is from an earlier attempt
+    resume = isdir( outdir ) and bool( os.listdir( outdir ) )
+    cmd = runsample_command(
+        job['readsdir'], sample, job['options'], broker, resume, job['projdir']
+    )
+    logger.info( "{0} running {1}".format(worker_id(), ' '.join(cmd)) )
+    with open( queue.logpath( name ), 'a' ) as fh:
+        try:
+            return subprocess.call( cmd, stdout=fh, stderr=subprocess.STDOUT )
+        except OSError as e:
+            logger.critical( "Could not run runsample: {0}".format(e) )
+            return 1
+
+def is_shard( job ):
+    '''
+    If job is a shard of reads that run_bwa_on_samplename put into the queue
+    '''
+    return job.get( 'kind' ) == 'shard'
+
+def run_worker( queue, retries=1, heartbeat=30, timeout=300, broker=None,
+        wait=False, runner=run_job, accept=None ):
+    '''
+    Claim and run jobs until there are none left
+
+    :param JobQueue queue: the queue
+    :param int retries: how many times a failed job is retried
+    :param int heartbeat: seconds between heartbeats of a running job
+    :param int timeout: seconds without a heartbeat before a claimed job is
+                        considered dead and requeued
+    :param str broker: resource broker path to pass to runsample
+    :param bool wait: keep waiting for jobs while other workers still have
+                      jobs claimed(they may be requeued)
+    :param callable runner: called with queue, name, job, broker to run a job
+                            and return its return code
+    :param callable accept: only run jobs this returns True for(See JobQueue.claim)
+    :return: number of jobs this worker ran
+    '''
+    ran = 0
+    while True:
+        queue.requeue_stale( timeout, retries )
+        claimed = queue.claim( accept )
+        if claimed is None:
+            if wait and queue.jobs( CLAIMED ):
+                time.sleep( heartbeat )
+                continue
+            return ran
+        name, job = claimed
+        stop = threading.Event()
+        def beat():
+            while not stop.wait( heartbeat ):
+                try:
+                    queue.heartbeat( name )
+                except OSError as e:
+                    logger.warning( "Heartbeat for {0} failed: {1}".format(name, e) )
+        t = threading.Thread( target=beat )
+        t.daemon = True
+        t.start()
+        try:
+            r = runner( queue, name, job, broker )
+        finally:
+            stop.set()
+            t.join()
+        state = queue.finish( name, job, r, retries )
+        logger.info( "{0} {1} exited {2} and is now {3}".format(worker_id(), name, r, state) )
+        ran += 1
+
+def parse_args( args=sys.argv[1:] ):
+    parser = argparse.ArgumentParser(
+        description='Run samples on many machines through a queue directory on a shared filesystem'
+    )
+    subparsers = parser.add_subparsers( dest='command' )
+
+    submit = subparsers.add_parser( 'submit', help='Add every sample in a samplesheet to the queue' )
+    submit.add_argument( 'queue', help='Queue directory' )
+    submit.add_argument( 'readsdir', help='Directory that contains a directory of reads for each sample' )
+    submit.add_argument( 'samplesheet', help='Space or tab delimited file of samplename reference one per line' )
+    submit.add_argument(
+        '--projdir',
+        default=PROJDIR,
+        help='Where to put each sample\'s project directory[Default: %(default)s]'
+    )
+    submit.add_argument(
+        '--runsample-options',
+        dest='runsample_options',
+        default=os.environ.get( 'RUNSAMPLEOPTIONS', '' ),
+        help='Options to pass to every runsample[Default: %(default)s]'
+    )
+
+    worker = subparsers.add_parser( 'worker', help='Run samples from the queue until it is empty' )
+    worker.add_argument( 'queue', help='Queue directory' )
+    worker.add_argument(
+        '--retries',
+        type=int,
+        default=1,
+        help='How many times to retry a sample that fails[Default: %(default)s]'
+    )
+    worker.add_argument(
+        '--heartbeat',
+        type=int,
+        default=30,
+        help='Seconds between heartbeats while a sample runs[Default: %(default)s]'
+    )
+    worker.add_argument(
+        '--timeout',
+        type=int,
+        default=300,
+        help='Seconds without a heartbeat before a sample is put back into pending[Default: %(default)s]'
+    )
+    worker.add_argument(
+        '--broker',
+        default=os.environ.get( 'BROKER' ),
+        help='Resource broker that every runsample on this node shares[Default: %(default)s]'
+    )
+    worker.add_argument(
+        '--wait',
+        action='store_true',
+        default=False,
+        help='Do not exit while other workers still have samples claimed'
+    )
+
+    status = subparsers.add_parser( 'status', help='Show how many samples are in each state' )
+    status.add_argument( 'queue', help='Queue directory' )
+
+    return parser.parse_args( args )
+
+def main( args=sys.argv[1:] ):
+    args = parse_args( args )
+    queue = JobQueue( args.queue )
+    if args.command == 'submit':
+        added = submit_samplesheet(
+            queue, args.readsdir, args.samplesheet,
+            shlex.split( args.runsample_options ), args.projdir
+        )
+        logger.info( "Added {0} samples to {1}".format(added, args.queue) )
+    elif args.command == 'worker':
+        ran = run_worker(
+            queue, args.retries, args.heartbeat, args.timeout, args.broker, args.wait
+        )
+        logger.info( "{0} ran {1} samples".format(worker_id(), ran) )
+    else:
+        counts = queue.counts()
+        for state in STATES:
+            print '{0}: {1}'.format(state, counts[state])
+        for name in queue.jobs( CLAIMED ):
+            print '{0} claimed by {1}'.format(name, queue.read( CLAIMED, name ).get( 'worker' ))
+    return 0
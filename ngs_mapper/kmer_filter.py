@@ -0,0 +1,268 @@
+"""
+Drop reads that cannot map to the reference before they are mapped.
+
+Samples that are mostly host reads make bwa spend most of its time aligning
+reads that end up unmapped anyway. kmer_filter builds a set of every k-mer of
+both strands of the reference and only keeps the reads that share at least one
+k-mer with it, so mapping time follows the reads of the target instead of every
+read in the sample.
+
+Every fastq in the reads directory is written to the output directory under the
+same name with only the reads that were kept. Mates are kept or dropped together
+so paired files stay in lockstep. How many reads each file had and how many of
+them were dropped is written as json to --stats.
+
+    .. code-block:: bash
+
+        kmer_filter trimmed_reads Den3.fasta -o kmer_filtered --stats kmer_filter.json
+
+runsample runs it between trim_reads and run_bwa_on_samplename with ``--kmer-filter``.
+Reads that share no k-mer at all with the reference are far more diverged than
+bwa would map anyway, but a smaller ``-k`` keeps more of the reads of a distant
+strain.
+
+Only every ``--stride`` k-mer of a read is looked up. A run of k+stride-1 bases
+that a read shares with the reference holds stride k-mers that start one after
+another and one of them is always looked up, so every read sharing such a run is
+still kept while reads are checked stride times faster. ``--stride 1`` looks up
+every k-mer. With ``-t`` the read files are filtered by that many processes at
+once.
+"""
+
+import os
+import sys
+import json
+import shutil
+import argparse
+import multiprocessing
+from glob import glob
+from itertools import islice
+from os.path import join, basename, isdir
+
+from Bio import SeqIO
+
+import data
+import log
+
+logger = log.setup_logger('kmer_filter', log.get_config())
+
+class KmerFilterError(Exception):
+    pass
+
+# Reference k-mers for the processes of kmer_filter_dir which inherit them when
+# they are forked instead of each being sent its own copy
+_kmers = None
+
+def main(args=sys.argv[1:]):
+    args = parse_args(args)
+    stats = kmer_filter_dir(
+        args.readsdir, args.reference, args.outputdir, args.kmer_size,
+        args.stride, args.threads
+    )
+    with open(args.stats, 'w') as fh:
+        json.dump(stats, fh, indent=1)
+    logger.info("Dropped {0} of {1} reads that share no {2}-mer with {3}".format(
+        stats['dropped'], stats['reads'], args.kmer_size, args.reference
+    ))
+
+def reference_kmers(reference, k):
+    '''
+    Every k-mer of both strands of every sequence in reference
+
+    :param str reference: fasta file or directory of fasta files
+    :param int k: k-mer size
+    :return: set of k-mers
+    '''
+    paths = [reference]
+    if isdir(reference):
+        paths = sorted(glob(join(reference, '*')))
+    kmers = set()
+    for path in paths:
+        for rec in SeqIO.parse(path, 'fasta'):
+            for seq in (rec.seq, rec.seq.reverse_complement()):
+                seq = str(seq).upper()
+                kmers.update(seq[i:i+k] for i in xrange(len(seq) - k + 1))
+    return kmers
+
+def shares_kmer(seq, kmers, k, stride=1):
+    '''
+    If any k-mer of seq that starts at a multiple of stride is in kmers. Always
+    True if seq shares k+stride-1 bases in a row with what kmers came from
+    '''
+    seq = seq.upper()
+    for i in xrange(0, len(seq) - k + 1, stride):
+        if seq[i:i+k] in kmers:
+            return True
+    return False
+
+def fastq_records(fh):
+    '''
+    Yield each fastq record in fh as its list of 4 lines
+    '''
+    while True:
+        record = list(islice(fh, 4))
+        if not record:
+            return
+        if len(record) != 4:
+            raise KmerFilterError("{0} ends in the middle of a record".format(fh.name))
+        yield record
+
+def filter_reads(readfiles, outfiles, kmers, k, stride=1):
+    '''
+    Copy the records of readfiles that share a k-mer with kmers into outfiles.
+    Multiple readfiles are mates in the same order and a set of mates is kept
+    if any of them shares a k-mer
+
+    :param list readfiles: fastq files(may be gzipped)
+    :param list outfiles: where to write the kept records of each readfile
+    :param set kmers: as returned by reference_kmers
+    :param int k: k-mer size
+    :param int stride: only look up every stride k-mer(See shares_kmer)
+    :return: (records in each readfile, records dropped from each readfile)
+    '''
+    inputs = [data.file_handle(f)[0] for f in readfiles]
+    outputs = [open(f, 'w') for f in outfiles]
+    total = dropped = 0
+    try:
+        records = [fastq_records(fh) for fh in inputs]
+        while True:
+            mates = [next(r, None) for r in records]
+            if all(m is None for m in mates):
+                break
+            if any(m is None for m in mates):
+                raise KmerFilterError("{0} do not have the same number of reads".format(readfiles))
+            total += 1
+            if any(shares_kmer(m[1].rstrip(), kmers, k, stride) for m in mates):
+                for fh, m in zip(outputs, mates):
+                    fh.writelines(m)
+            else:
+                dropped += 1
+    finally:
+        for fh in inputs + outputs:
+            fh.close()
+    return total, dropped
+
+def _filter_job(job):
+    '''
+    filter_reads for a job built by kmer_filter_dir
+    Lives at module level so it can be handed to a multiprocessing.Pool
+    '''
+    readfiles, outfiles, k, stride = job
+    logger.info("Filtering {0}".format(readfiles))
+    return filter_reads(readfiles, outfiles, _kmers, k, stride)
+
+def kmer_filter_dir(readsdir, reference, outdir, k, stride=1, threads=1):
+    '''
+    Filter every read file of readsdir into outdir
+
+    :param str readsdir: directory of fastq files such as trim_reads makes
+    :param str reference: fasta file or directory of fasta files
+    :param str outdir: where to put the filtered files
+    :param int k: k-mer size
+    :param int stride: only look up every stride k-mer of each read
+    :param int threads: how many read files(or sets of mates) are filtered at once
+    :return: dictionary of kmer_size, stride, reads, dropped and files which is
+             filename -> {reads, dropped} for each read file
+    '''
+    global _kmers
+    kmers = reference_kmers(reference, k)
+    if not kmers:
+        raise KmerFilterError("{0} has no sequences of at least {1} bases".format(reference, k))
+    if not isdir(outdir):
+        os.makedirs(outdir)
+    jobs = []
+    for platform, reads in data.reads_by_plat(readsdir).items():
+        for r in reads:
+            readfiles = list(r) if isinstance(r, tuple) else [r]
+            names = [basename(f) for f in readfiles]
+            names = [n[:-3] if n.endswith('.gz') else n for n in names]
+            if not all(n.endswith('.fastq') for n in names):
+                logger.warning("Copying {0} as only fastq files can be filtered".format(readfiles))
+                for f in readfiles:
+                    shutil.copy(f, outdir)
+                continue
+            jobs.append((readfiles, [join(outdir, n) for n in names], k, stride))
+    _kmers = kmers
+    pool = None
+    if threads > 1 and len(jobs) > 1:
+        pool = multiprocessing.Pool(min(threads, len(jobs)))
+    try:
+        if pool is None:
+            counts = map(_filter_job, jobs)
+        else:
+            counts = pool.map(_filter_job, jobs)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        _kmers = None
+    stats = {'kmer_size': k, 'stride': stride, 'reads': 0, 'dropped': 0, 'files': {}}
+    for (readfiles, outfiles, k, stride), (total, dropped) in zip(jobs, counts):
+        for f in readfiles:
+            stats['files'][basename(f)] = {'reads': total, 'dropped': dropped}
+            stats['reads'] += total
+            stats['dropped'] += dropped
+    return stats
+
+def parse_args(args=sys.argv[1:]):
+    from ngs_mapper import config
+    conf_parser, args, config, configfile = config.get_config_argparse(args)
+    defaults = config['kmer_filter']
+
+    parser = argparse.ArgumentParser(
+        description='Drops reads that share no k-mer with the reference before they are mapped',
+        parents=[conf_parser]
+    )
+
+    parser.add_argument(
+        dest='readsdir',
+        help='Directory of fastq read files'
+    )
+
+    parser.add_argument(
+        dest='reference',
+        help='Reference fasta file or directory of fasta files the reads will be mapped to'
+    )
+
+    parser.add_argument(
+        '-o',
+        dest='outputdir',
+        default=defaults['outputdir']['default'],
+        help=defaults['outputdir']['help']
+    )
+
+    parser.add_argument(
+        '-k',
+        '--kmer-size',
+        dest='kmer_size',
+        type=int,
+        default=defaults['kmer_size']['default'],
+        help=defaults['kmer_size']['help']
+    )
+
+    parser.add_argument(
+        '-s',
+        '--stride',
+        dest='stride',
+        type=int,
+        default=defaults['stride']['default'],
+        help=defaults['stride']['help']
+    )
+
+    parser.add_argument(
+        '-t',
+        '--threads',
+        dest='threads',
+        type=int,
+        default=defaults['threads']['default'],
+        help=defaults['threads']['help']
+    )
+
+    parser.add_argument(
+        '--stats',
+        dest='stats',
+        default=defaults['stats']['default'],
+        help=defaults['stats']['help']
+    )
+
+    return parser.parse_args(args)
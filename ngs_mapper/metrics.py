@@ -0,0 +1,108 @@
+"""
+Resource usage of every stage of a sample and of every process each stage ran
+that runsample writes next to the rest of a sample's output as
+samplename.metrics.json
+
+    .. code-block:: javascript
+
+        {
+            "samplename": "00005-01",
+            "host": "node01",
+            "stages": [
+                {"name": "run_bwa_on_samplename", "start": 1418398860.0, "end": 1418399000.0,
+                 "duration": 140.0, "returncode": 0, "pid": 4100, "tid": 139872,
+                 "user": 510.2, "sys": 4.1, "cpu": 514.3, "maxrss": 310.5,
+                 "read_bytes": 52428800, "write_bytes": 10485760,
+                 "processes": [
+                    {"command": "run_bwa_on_samplename ...", "pid": 4105,
+                     "end": 1418398999.9, "wall": 139.8,
+                     "user": 510.2, "sys": 4.1, "maxrss": 310.5,
+                     "read_bytes": 52428800, "write_bytes": 10485760}
+                 ]},
+                ...
+            ]
+        }
+
+user and sys are cpu seconds, maxrss is the peak memory in MB of the largest
+process and read_bytes/write_bytes are what was read from and written to disk.
+A stage only has the usage that could be measured for it.
+"""
+
+import json
+import socket
+from os.path import join, basename, normpath, exists
+
+import summary
+
+# Values recorded for each stage
+VALUES = ('duration', 'user', 'sys', 'cpu', 'maxrss', 'read_bytes', 'write_bytes')
+
+def metrics_path(outprefix):
+    '''
+    Path of the metrics file for a sample output prefix(outdir/samplename)
+    '''
+    return outprefix + '.metrics.json'
+
+def project_metrics_path(projectpath):
+    '''
+    Path of the metrics file inside of a runsample project directory
+    '''
+    projectpath = normpath(projectpath)
+    return metrics_path(join(projectpath, basename(projectpath)))
+
+def make_metrics(samplename, stages):
+    '''
+    :param str samplename: name of the sample
+    :param list stages: stage timings as recorded by stages.run_stages
+    :return: metrics dictionary
+    '''
+    return {'samplename': samplename, 'host': socket.gethostname(), 'stages': stages}
+
+def write_metrics(path, metrics):
+    with open(path, 'w') as fh:
+        json.dump(metrics, fh, indent=1)
+    return path
+
+def load_metrics(path):
+    with open(path) as fh:
+        return json.load(fh)
+
+def project_stages(projectpath):
+    '''
+    Stages of a project from its metrics file or from its summary file for
+    projects that were run before there were metrics files
+
+    :return: list of stage dictionaries or None if the project has neither
+    '''
+    for path, load in ((project_metrics_path(projectpath), load_metrics),
+                       (summary.project_summary_path(projectpath), summary.load_summary)):
+        if exists(path):
+            try:
+                return load(path).get('stages', [])
+            except ValueError:
+                continue
+    return None
+
+def stage_breakdown(projects, value='duration'):
+    '''
+    A value of each stage across many projects
+
+    :param list projects: runsample project directories
+    :param str value: one of VALUES
+    :return: (stagenames in the order they first appear, {project: {stagename: value}})
+             Projects without any stages are left out
+    '''
+    names = []
+    breakdown = {}
+    for p in projects:
+        stages = project_stages(p)
+        if not stages:
+            continue
+        values = {}
+        for s in stages:
+            if s['name'] not in names:
+                names.append(s['name'])
+            if s.get(value) is not None:
+                values[s['name']] = s[value]
+        breakdown[p] = values
+    return names, breakdown
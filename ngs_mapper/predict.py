@@ -0,0 +1,227 @@
+"""
+Predict how long a sample will take to run and how much memory it needs from
+the samples that have already been run.
+
+runsample records the features of each sample's input(bytes of reads for each
+platform and the length of the reference along with how many reads graphsample
+counted) in the sample's summary.json along with the wall time, cpu time and
+peak memory of every stage. Runs that were resumed are not used as the stages
+that did not run again have no timings. A ResourceModel fits those numbers
+against the features that are known before a sample runs so new samples can be
+ordered and packed into jobs by how long they will actually take instead of by
+their size alone.
+
+    .. code-block:: python
+
+        from ngs_mapper import predict
+
+        model = predict.ResourceModel(predict.load_history('Projects'))
+        if model.ready:
+            features = predict.input_features('ReadsBySample/00005-01', 'Den3.fasta')
+            p = model.predict(features)
+            # p['walltime'] seconds, p['cpu'] seconds, p['memory'] MB
+
+Predictions are a least squares fit of each number against the MB of reads for
+each platform and the length of the reference, multiplied by a safety margin.
+Only features that some sample in the history has are fit and there have to be
+at least as many samples as fitted values. A prediction is never less than the
+smallest number seen or than the number of any sample whose features are all
+no larger than the new sample's.
+"""
+
+import os
+from glob import glob
+from os.path import join, isdir
+
+import numpy as np
+
+import data
+import summary
+import log
+
+logger = log.setup_logger( 'predict', log.get_config() )
+
+PLATFORMS = ('MiSeq', 'Sanger', 'Roche454', 'IonTorrent')
+
+def reference_length( fasta ):
+    '''
+    Total length of every sequence in a fasta file
+    '''
+    length = 0
+    with open( fasta ) as fh:
+        for line in fh:
+            if not line.startswith( '>' ):
+                length += len( line.strip() )
+    return length
+
+def read_files( readsdir ):
+    '''
+    Every read file in a sample's directory
+    '''
+    files = []
+    for root, dirs, names in os.walk( readsdir ):
+        files += [join( root, n ) for n in sorted( names )]
+    return files
+
+def input_features( readsdir, reference ):
+    '''
+    Features of a sample that are known before it runs
+
+    :param str readsdir: directory of the sample's reads
+    :param str reference: reference fasta
+    :return: dictionary with input_bytes(platform -> bytes) and reference_length
+    '''
+    input_bytes = {}
+    for f in read_files( readsdir ):
+        try:
+            platform = data.platform_for_read( f )
+        except (data.NoPlatformFound, IOError):
+            continue
+        input_bytes[platform] = input_bytes.get( platform, 0 ) + os.stat( f ).st_size
+    return {
+        'input_bytes': input_bytes,
+        'reference_length': reference_length( reference ),
+    }
+
+def feature_row( features ):
+    '''
+    Values a prediction is fit against for a sample's features
+    '''
+    input_bytes = features.get( 'input_bytes', {} )
+    return [1.0] + \
+        [input_bytes.get( p, 0 ) / 1024.0**2 for p in PLATFORMS] + \
+        [features.get( 'reference_length', 0 ) / 1000.0]
+
+def sample_usage( s ):
+    '''
+    Wall time, cpu time and peak memory of a sample and of each of its stages
+    from its summary
+
+    :return: dictionary of name -> value where name is walltime, cpu and memory
+             for the whole sample and stagename.walltime, ... for each stage.
+             Values that were not recorded are left out
+    '''
+    usage = {}
+    stages = s.get( 'stages', [] )
+    if 'duration' in s:
+        usage['walltime'] = s['duration']
+    if stages and all( 'cpu' in st for st in stages ):
+        usage['cpu'] = sum( st['cpu'] for st in stages )
+    if any( 'maxrss' in st for st in stages ):
+        usage['memory'] = max( st.get( 'maxrss', 0 ) for st in stages )
+    for st in stages:
+        usage[st['name'] + '.walltime'] = st['duration']
+        if 'cpu' in st:
+            usage[st['name'] + '.cpu'] = st['cpu']
+        if 'maxrss' in st:
+            usage[st['name'] + '.memory'] = st['maxrss']
+    return usage
+
+def load_history( projdir ):
+    '''
+    Summaries of every sample in projdir that ran successfully, has its
+    features recorded and timed every stage
+
+    :param str projdir: directory of runsample project directories
+    :return: list of summary dictionaries
+    '''
+    history = []
+    for p in sorted( glob( join( projdir, '*' ) ) ):
+        path = summary.project_summary_path( p )
+        if not isdir( p ) or not os.path.exists( path ):
+            continue
+        try:
+            s = summary.load_summary( path )
+        except ValueError:
+            logger.warning( "Could not read {0}".format(path) )
+            continue
+        if 'features' not in s or not s.get( 'stages' ):
+            continue
+        if any( st['returncode'] != 0 for st in s['stages'] ):
+            continue
+        # Resumed so only the stages that ran again were timed
+        if s.get( 'cached' ):
+            continue
+        history.append( s )
+    return history
+
+class ResourceModel(object):
+    '''
+    Wall time, cpu time and memory predictions fit from sample summaries
+    '''
+    def __init__( self, history, margin=1.25, minsamples=3 ):
+        '''
+        :param list history: summaries as returned by load_history
+        :param float margin: predictions are multiplied by this
+        :param int minsamples: fewest samples a value is predicted from. More
+                               are needed if more features are fit
+        '''
+        self.margin = margin
+        self.minsamples = minsamples
+        self.samples = len( history )
+        rows = {}
+        for s in history:
+            row = feature_row( s['features'] )
+            for name, value in sample_usage( s ).items():
+                rows.setdefault( name, [] ).append( (row, value) )
+        self.fits = {}
+        for name, pairs in rows.items():
+            if len( pairs ) < minsamples:
+                continue
+            x = np.array( [r for r, v in pairs] )
+            y = np.array( [v for r, v in pairs], dtype=float )
+            # Features no sample has would only make the fit underdetermined
+            columns = np.flatnonzero( x.any( axis=0 ) )
+            if len( pairs ) < len( columns ):
+                continue
+            coef = np.linalg.lstsq( x[:, columns], y, rcond=-1 )[0]
+            self.fits[name] = (columns, coef, x, y)
+
+    @property
+    def ready( self ):
+        ''' If the whole sample's wall time can be predicted '''
+        return 'walltime' in self.fits
+
+    def value( self, name, features ):
+        '''
+        Predict a single value such as walltime or run_bwa_on_samplename.memory
+
+        :return: float or None if it cannot be predicted
+        '''
+        if name not in self.fits:
+            return None
+        columns, coef, x, y = self.fits[name]
+        row = np.array( feature_row( features ) )
+        predicted = float( np.dot( coef, row[columns] ) )
+        # A sample that is no larger in any way took at least this long
+        smaller = y[(x <= row).all( axis=1 )]
+        minimum = max( [y.min()] + smaller.tolist() )
+        return max( predicted, minimum ) * self.margin
+
+    def predict( self, features ):
+        '''
+        Predict everything that can be for a sample
+
+        :param dict features: as returned by input_features
+        :return: dictionary with walltime, cpu and memory(None if they cannot
+                 be predicted) and stages which is stagename -> dictionary of
+                 the same values for each stage
+        '''
+        prediction = {'stages': {}}
+        for name in self.fits:
+            if '.' in name:
+                stage, what = name.rsplit( '.', 1 )
+                prediction['stages'].setdefault( stage, {} )[what] = self.value( name, features )
+        for what in ('walltime', 'cpu', 'memory'):
+            prediction[what] = self.value( what, features )
+        return prediction
+
+def format_walltime( seconds ):
+    '''
+    PBS walltime string for seconds rounded up to the next minute
+
+        >>> format_walltime( 3661 )
+        '01:02:00'
+    '''
+    minutes = int( -(-seconds // 60) )
+    return '{0:02d}:{1:02d}:00'.format( minutes // 60, minutes % 60 )
@@ -1,4 +1,7 @@
 import os
+import gzip
+import errno
+import threading
 from os.path import *
 from Bio import SeqIO
 
@@ -55,6 +58,33 @@ def sffs_to_fastq( sfflist, outfile, trim=True ):
 
 class InvalidReadFile(Exception): pass
 
+class ReadPipeError(Exception): pass
+
+def group_reads( readfilelist, valid=None ):
+    '''
+    Sort the read files in readfilelist into forward, reverse and nonpaired lists
+
+    @param readfilelist - List of read file paths where 2 item tuples are mate pairs
+    @param valid - function that tells if a read file can be used[Default: is_valid_read]
+
+    @returns a dictionary {'F': [...], 'R': [...], 'NP': [...]}
+    '''
+    valid = valid or is_valid_read
+    grouped = {'F':[],'R':[],'NP':[]}
+    for read in readfilelist:
+        # Non Paired read
+        if isinstance(read,str):
+            reads = [('NP', read)]
+        elif isinstance(read,tuple) and len(read) == 2:
+            reads = [('F', read[0]), ('R', read[1])]
+        else:
+            raise ValueError("Somehow neither got 1 or 2 items for a read in readfilelist")
+        for key, path in reads:
+            if not valid( path ):
+                raise InvalidReadFile("{0} is not a fastq file. Only fastq files are supported at this time.".format(path))
+            grouped[key].append( path )
+    return grouped
+
 def compile_reads( readfilelist, outputdir ):
     '''
     Compiles all read files inside of readfilelist into respective files.
@@ -73,27 +103,7 @@ def compile_reads( readfilelist, outputdir ):
     if not os.path.exists(outputdir):
         os.makedirs(outputdir)
 
-    files_written = {'F':[],'R':[],'NP':[]}
-
-    # Build the list of files to be written for each type
-    for read in readfilelist:
-        # Non Paired read
-        if isinstance(read,str):
-            if is_valid_read( read ):
-                files_written['NP'].append(read)
-            else:
-                raise InvalidReadFile("{0} is not a fastq file. Only fastq files are supported at this time.".format(read))
-        elif isinstance(read,tuple) and len(read) == 2:
-            if is_valid_read( read[0] ):
-                files_written['F'].append(read[0])
-            else:
-                raise InvalidReadFile("{0} is not a fastq file. Only fastq files are supported at this time.".format(read[0]))
-            if is_valid_read( read[1] ):
-                files_written['R'].append(read[1])
-            else:
-                raise InvalidReadFile("{0} is not a fastq file. Only fastq files are supported at this time.".format(read[1]))
-        else:
-            raise ValueError("Somehow neither got 1 or 2 items for a read in readfilelist")
+    files_written = group_reads( readfilelist )
 
     # Now concat the files to their respective output file
     for f,files in files_written.items():
@@ -148,3 +158,139 @@ def is_valid_read( readpath ):
     '''
     # File extension without the period in VALID_READ_EXT ?
     return splitext( readpath )[1][1:] in VALID_READ_EXT
+
+def read_type( readpath ):
+    '''
+    Extension of readpath without the period or .gz
+
+    @returns fastq for reads.fastq and reads.fastq.gz
+    '''
+    root, ext = splitext( readpath )
+    if ext == '.gz':
+        ext = splitext( root )[1]
+    return ext[1:]
+
+def write_reads( files, fh ):
+    '''
+    Write every read in files to fh as fastq. sff files are converted and trimmed
+    and gzip files are decompressed while they are written
+
+    @param files - List of fastq, sff or gzipped read files
+    @param fh - file object to write to
+
+    @returns number of reads written
+    '''
+    count = 0
+    for f in files:
+        if f.endswith( '.gz' ):
+            infh = gzip.open( f, 'rb' )
+        else:
+            infh = open( f, 'rb' )
+        try:
+            if read_type( f ) == 'sff':
+                for rec in SeqIO.parse( infh, 'sff' ):
+                    count += SeqIO.write( clip_seq_record( rec ), fh, 'fastq' )
+                continue
+            lines = 0
+            last = '\n'
+            while True:
+                chunk = infh.read( 1024*1024 )
+                if not chunk:
+                    break
+                fh.write( chunk )
+                lines += chunk.count( '\n' )
+                last = chunk[-1]
+            # So the next file does not start on the last line of this one
+            if last != '\n':
+                fh.write( '\n' )
+                lines += 1
+            count += lines // 4
+        finally:
+            infh.close()
+    return count
+
+class ReadPipes(object):
+    '''
+    Named pipes F.fq, R.fq and NP.fq that stand in for the files compile_reads
+    makes. The reads are written into each pipe straight from the original
+    files(converting sff and decompressing gzip) while whatever opened the pipe
+    reads them so no copy of the reads is ever written to disk.
+
+    Each pipe can only be read once from start to finish.
+
+        pipes = ReadPipes( [('F.fastq.gz','R.fastq.gz'), 'NP.sff'], 'reads' )
+        try:
+            map( pipes.files['F'], pipes.files['R'] )
+            map( pipes.files['NP'] )
+            pipes.wait()
+        finally:
+            pipes.close()
+    '''
+    def __init__( self, readfilelist, outputdir ):
+        '''
+        @param readfilelist - same as compile_reads except gzipped reads can be used
+        @param outputdir - Where to make the pipes
+        '''
+        grouped = group_reads( readfilelist, lambda r: read_type( r ) in VALID_READ_EXT )
+        if not os.path.exists( outputdir ):
+            os.makedirs( outputdir )
+        self.files = {}
+        self.counts = {}
+        self.errors = {}
+        self.threads = {}
+        for key, files in grouped.items():
+            if not files:
+                self.files[key] = None
+                continue
+            path = join( outputdir, key + '.fq' )
+            os.mkfifo( path )
+            self.files[key] = path
+            t = threading.Thread( target=self._write, args=(key, files) )
+            t.daemon = True
+            t.start()
+            self.threads[key] = t
+
+    def _write( self, key, files ):
+        path = self.files[key]
+        try:
+            # Blocks until something opens the pipe to read it
+            with open( path, 'wb' ) as fh:
+                log.debug( "Streaming {0} into {1}".format(files, path) )
+                self.counts[key] = write_reads( files, fh )
+        except IOError as e:
+            if e.errno == errno.EPIPE:
+                e = ReadPipeError( "{0} was closed before all of {1} was read".format(path, files) )
+            self.errors[key] = e
+        except Exception as e:
+            self.errors[key] = e
+
+    def wait( self ):
+        '''
+        Wait for every pipe to be read completely
+
+        @raises ReadPipeError if any pipe was not read completely or the reads could not be written
+
+        @returns dictionary of how many reads went through each pipe
+        '''
+        for t in self.threads.values():
+            t.join()
+        for key, e in sorted( self.errors.items() ):
+            raise ReadPipeError( "Could not stream reads into {0}: {1}".format(self.files[key], e) )
+        return self.counts
+
+    def close( self ):
+        '''
+        Stop writing into pipes that are not being read and remove the pipes
+        '''
+        for key, t in self.threads.items():
+            if t.is_alive():
+                # Lets a writer that is still waiting for a reader open its
+                # pipe so it finds out nobody is reading
+                try:
+                    os.close( os.open( self.files[key], os.O_RDONLY | os.O_NONBLOCK ) )
+                except OSError:
+                    pass
+            t.join( 10 )
+        for path in self.files.values():
+            if path and exists( path ):
+                os.unlink( path )
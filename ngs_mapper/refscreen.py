@@ -0,0 +1,136 @@
+"""
+Pick the references in a directory of references that the reads actually come
+from before they are compiled and indexed.
+
+Mapping against a whole panel of references(every influenza subtype for
+instance) makes the index, the mapping and everything done for each reference
+afterwards(base_caller, graphsample) as large as the panel. A sketch of the
+reads is made by sampling their k-mers and every reference file is ranked by how
+much of that sketch it contains. Only the best references are then compiled.
+
+A k-mer is sampled when its hash is divisible by the scale, so every read that
+has a k-mer samples it and how much of the sketch a reference contains estimates
+how much of the reads' sequence it contains(FracMinHash containment). Both
+strands of the references are searched since reads can come from either one.
+
+    .. code-block:: python
+
+        from ngs_mapper.refscreen import screen_references
+
+        # Directory of symlinks to the 2 references that contain the most of the reads
+        refdir = screen_references('Influenza', ['r1.fastq', 'r2.fastq'], 2, 'screened')
+"""
+
+import os
+from glob import glob
+from os.path import join, basename, splitext, abspath, isdir
+
+from Bio import SeqIO
+
+import data
+import log
+
+logger = log.setup_logger('refscreen', log.get_config())
+
+# Same files compile_refs concatenates
+REF_EXTENSIONS = ('.fa', '.fasta', '.fna', '.fas')
+KMER_SIZE = 21
+# 1 in this many k-mers is sampled
+SCALE = 8
+
+def reference_files(refdir):
+    '''
+    Reference files in refdir that compile_refs would compile
+    '''
+    return sorted(
+        f for f in glob(join(refdir, '*')) if splitext(f)[1] in REF_EXTENSIONS
+    )
+
+def read_sketch(readfiles, reads=10000, k=KMER_SIZE, scale=SCALE):
+    '''
+    k-mers sampled from the first reads of each fastq in readfiles
+
+    :param list readfiles: fastq files(may be gzipped). Other files are skipped
+    :param int reads: most reads sampled from each file
+    :param int k: k-mer size
+    :param int scale: 1 in this many k-mers is sampled
+    :return: set of k-mers
+    '''
+    sketch = set()
+    for f in readfiles:
+        fh, ext = data.file_handle(f)
+        try:
+            if ext != 'fastq':
+                logger.debug("Not sampling {0} as it is not fastq".format(f))
+                continue
+            for i, line in enumerate(fh):
+                if i >= reads * 4:
+                    break
+                # Sequence is the second line of every record
+                if i % 4 != 1:
+                    continue
+                seq = line.rstrip().upper()
+                for j in xrange(len(seq) - k + 1):
+                    kmer = seq[j:j+k]
+                    if hash(kmer) % scale == 0:
+                        sketch.add(kmer)
+        finally:
+            fh.close()
+    return sketch
+
+def containment(sketch, fasta, k=KMER_SIZE):
+    '''
+    Fraction of sketch found in either strand of any sequence in fasta
+    '''
+    if not sketch:
+        return 0.0
+    found = set()
+    for rec in SeqIO.parse(fasta, 'fasta'):
+        for seq in (rec.seq, rec.seq.reverse_complement()):
+            seq = str(seq).upper()
+            found.update(sketch.intersection(seq[i:i+k] for i in xrange(len(seq) - k + 1)))
+    return len(found) / float(len(sketch))
+
+def rank_references(refdir, readfiles, reads=10000):
+    '''
+    Rank every reference file in refdir by how much of the sketch of
+    readfiles it contains
+
+    :return: list of (containment, reference file) with the best first
+    '''
+    sketch = read_sketch(readfiles, reads)
+    logger.debug("Sampled {0} k-mers from {1}".format(len(sketch), readfiles))
+    ranked = [(containment(sketch, f), f) for f in reference_files(refdir)]
+    # Stable so references that tie stay in name order
+    ranked.sort(key=lambda r: -r[0])
+    return ranked
+
+def screen_references(refdir, readfiles, top, outdir, reads=10000):
+    '''
+    Make outdir a directory of symlinks to the top references in refdir that
+    contain the most of the reads. References that contain none of them are
+    always left out
+
+    :param str refdir: directory of reference files
+    :param list readfiles: read files to sample
+    :param int top: most references to keep
+    :param str outdir: directory to put the symlinks in
+    :param int reads: most reads sampled from each read file
+    :return: outdir or refdir if no reference contains any of the reads
+    '''
+    ranked = rank_references(refdir, readfiles, reads)
+    for c, f in ranked:
+        logger.info("{0} contains {1:.1%} of the sampled read k-mers".format(basename(f), c))
+    if not ranked or ranked[0][0] == 0:
+        logger.warning("No reference in {0} contains any of the sampled reads so all are used".format(refdir))
+        return refdir
+    if not isdir(outdir):
+        os.makedirs(outdir)
+    for c, f in ranked[:top]:
+        if c == 0:
+            break
+        os.symlink(abspath(f), join(outdir, basename(f)))
+    logger.info("Using {0} of {1} references in {2}".format(
+        len(os.listdir(outdir)), len(ranked), refdir
+    ))
+    return outdir
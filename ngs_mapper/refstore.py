@@ -0,0 +1,199 @@
+"""
+Index each reference once and share the index between every sample mapped to it.
+
+References are stored by the sha1 of their contents so the same reference under
+different names(or copied into every sample's directory) is only indexed once.
+Every reference in the store has
+
+* reference.fasta
+* the bwa index(reference.fasta.amb, .ann, .bwt, .pac, .sa)
+* the samtools faidx index(reference.fasta.fai)
+* the homopolymers base_caller looks for(reference.fasta.hpoly.json)
+
+A directory of references is compiled into a single fasta the same way
+run_bwa_on_samplename does before it is stored.
+
+Samples symlink the index files next to their own copy of the reference so bwa,
+samtools and base_caller find them already built. runsample replaces the
+symlinks with copies(copy_links) before it moves the sample into its project
+directory so projects never point into a store that may be cleaned up.
+
+    .. code-block:: python
+
+        from ngs_mapper.refstore import RefStore
+
+        store = RefStore('/tmp/ngs_mapper.refs')
+        # Indexes Den3.fasta unless another sample already has
+        store.link_into('Den3.fasta', 'sample1/Den3.fasta')
+
+Building an entry holds an exclusive lock on its lock file so samples that start
+at the same time wait for the first one to finish indexing instead of indexing it
+themselves.
+"""
+
+import os
+import json
+import fcntl
+import shutil
+import tempfile
+import subprocess
+from os.path import join, exists, isdir, basename
+
+from Bio import SeqIO
+
+from stages import file_digest
+import log
+
+logger = log.setup_logger( 'refstore', log.get_config() )
+
+# Files every reference in the store has besides the fasta
+BWA_INDEX = ('.amb', '.ann', '.bwt', '.pac', '.sa')
+INDEX_EXTENSIONS = BWA_INDEX + ('.fai', '.hpoly.json')
+REFNAME = 'reference.fasta'
+
+class RefStoreError(Exception):
+    pass
+
+def compile_directory( refdir, output ):
+    '''
+    Concatenate every fasta inside of refdir into output the same way
+    bwa.bwa.compile_refs does, but without changing into another directory
+    (the working directory is shared by every stage runsample runs inline)
+    or exiting when a reference cannot be read
+
+    :raises RefStoreError: if refdir has no references or one cannot be read
+    '''
+    from bwa.seqio import concat_files
+    from refscreen import reference_files
+    try:
+        concat_files( reference_files( refdir ), str( output ) )
+    except (OSError, IOError, ValueError) as e:
+        raise RefStoreError( "Could not compile the references in {0}: {1}".format(refdir, e) )
+    return output
+
+def write_hpolys( fasta, output ):
+    '''
+    Write base_caller.hpoly_list of fasta as json to output
+    '''
+    from base_caller import hpoly_list
+    with open( output, 'w' ) as fh:
+        json.dump( hpoly_list( SeqIO.index( fasta, 'fasta' ), 3 ), fh )
+    return output
+
+def index_reference( fasta ):
+    '''
+    Build every index the store keeps for fasta next to it
+
+    :raises RefStoreError: if an index cannot be built
+    '''
+    from bwa.bwa import index_ref
+    if not index_ref( fasta ):
+        raise RefStoreError( "bwa could not index {0}".format(fasta) )
+    try:
+        subprocess.check_call( ['samtools', 'faidx', fasta] )
+    except (OSError, subprocess.CalledProcessError) as e:
+        raise RefStoreError( "samtools could not index {0}: {1}".format(fasta, e) )
+    write_hpolys( fasta, fasta + '.hpoly.json' )
+
+class RefStore(object):
+    '''
+    Directory of indexed references keyed by the sha1 of their contents
+    '''
+    def __init__( self, root, indexer=index_reference ):
+        '''
+        :param str root: directory the references are kept in
+        :param callable indexer: builds the indexes next to a fasta
+        '''
+        self.root = root
+        self.indexer = indexer
+        if not isdir( root ):
+            try:
+                os.makedirs( root )
+            except OSError:
+                # Made by another sample at the same time
+                if not isdir( root ):
+                    raise
+
+    def entry( self, digest ):
+        return join( self.root, digest )
+
+    def reference( self, reference ):
+        '''
+        Path of reference inside of the store, indexing it first if it is not
+        already there
+
+        :param str reference: fasta file or directory of fasta files
+        :return: path to the stored fasta which has every index next to it
+        '''
+        compiled = None
+        if isdir( reference ):
+            fh, compiled = tempfile.mkstemp( suffix='.fasta', dir=self.root )
+            os.close( fh )
+        try:
+            if compiled is not None:
+                reference = compile_directory( reference, compiled )
+            digest = file_digest( reference )
+            if digest is None:
+                raise RefStoreError( "{0} does not exist".format(reference) )
+            entry = self.entry( digest )
+            with open( entry + '.lock', 'a' ) as lockfh:
+                fcntl.flock( lockfh, fcntl.LOCK_EX )
+                try:
+                    if not exists( entry ):
+                        self._build( reference, entry )
+                    else:
+                        logger.debug( "Using stored index of {0} in {1}".format(reference, entry) )
+                finally:
+                    fcntl.flock( lockfh, fcntl.LOCK_UN )
+        finally:
+            if compiled is not None:
+                os.unlink( compiled )
+        return join( entry, REFNAME )
+
+    def _build( self, reference, entry ):
+        ''' Index reference into a new entry that only appears once it is complete '''
+        logger.info( "Indexing {0} into {1}".format(reference, entry) )
+        tdir = tempfile.mkdtemp( prefix=basename( entry ) + '.', dir=self.root )
+        try:
+            fasta = join( tdir, REFNAME )
+            shutil.copy( reference, fasta )
+            self.indexer( fasta )
+            os.rename( tdir, entry )
+        except:
+            shutil.rmtree( tdir, ignore_errors=True )
+            raise
+
+    def link_into( self, reference, dst ):
+        '''
+        Make dst a copy of reference and symlink every stored index of
+        reference next to it replacing whatever index files were there
+
+        :param str reference: fasta file or directory of fasta files
+        :param str dst: where the sample's copy of the reference goes
+        :return: dst
+        '''
+        stored = self.reference( reference )
+        if not exists( dst ) or file_digest( dst ) != file_digest( stored ):
+            shutil.copy( stored, dst )
+        for ext in INDEX_EXTENSIONS:
+            link = dst + ext
+            if os.path.lexists( link ):
+                os.unlink( link )
+            os.symlink( os.path.abspath( stored + ext ), link )
+        return dst
+
+def copy_links( dst ):
+    '''
+    Replace the index symlinks link_into made next to dst with copies of the
+    files they point to
+
+    :param str dst: sample's copy of the reference
+    '''
+    for ext in INDEX_EXTENSIONS:
+        link = dst + ext
+        if not os.path.islink( link ):
+            continue
+        # Copied next to it first so the index is never missing a file
+        tmppath = link + '.tmp'
+        shutil.copy( os.path.realpath( link ), tmppath )
+        os.rename( tmppath, link )
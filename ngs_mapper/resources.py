@@ -0,0 +1,225 @@
+"""
+Share the cpus and memory of a single machine between every runsample that is
+running on it at the same time.
+
+Every runsample registers itself with the same broker file and asks it for a
+grant before each stage runs. The broker hands out at most the machine's cpus
+and memory across all samples and splits the cpus evenly between the samples
+that are registered. While many samples are running each stage gets a single
+cpu, but once only a few samples are left each stage gets a larger share so the
+machine does not sit idle while the last samples finish.
+
+The broker's state is a small json file that is only read or written while
+holding an exclusive lock on a lock file next to it, so any number of processes
+can use it without a server running. Grants held by processes that no longer
+exist are dropped the next time the state is read.
+
+    .. code-block:: python
+
+        from ngs_mapper.resources import ResourceBroker
+
+        broker = ResourceBroker('/tmp/ngs_mapper.resources')
+        broker.register()
+        with broker.grant(cpus=8, memory=2000) as grant:
+            run_bwa(threads=grant.cpus)
+        broker.unregister()
+"""
+
+import os
+import json
+import time
+import fcntl
+import errno
+import logging
+import multiprocessing
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+def total_memory(meminfo='/proc/meminfo'):
+    '''
+    Total memory of this machine in MB
+
+    :return: int or None if it cannot be determined
+    '''
+    try:
+        with open(meminfo) as fh:
+            for line in fh:
+                if line.startswith('MemTotal:'):
+                    return int(line.split()[1]) / 1024
+    except IOError:
+        pass
+    return None
+
+def pid_alive(pid):
+    '''
+    If a process with pid exists on this machine
+    '''
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+class Grant(object):
+    '''
+    Resources handed out by a ResourceBroker
+    '''
+    def __init__(self, id, cpus, memory):
+        self.id = id
+        self.cpus = cpus
+        self.memory = memory
+
+    def __repr__(self):
+        return 'Grant({0}, cpus={1}, memory={2})'.format(self.id, self.cpus, self.memory)
+
+class ResourceBroker(object):
+    '''
+    Hands out cpus and memory shared by every process that uses the same path
+    '''
+    def __init__(self, path, cpus=None, memory=None, poll=1.0):
+        '''
+        :param str path: json state file. path.lock is used as the lock file
+        :param int cpus: cpus that can be handed out. Defaults to all of them
+        :param int memory: MB of memory that can be handed out. Defaults to
+                           all of it. 0 means memory is not limited
+        :param float poll: seconds between checks while waiting for a grant
+        '''
+        self.path = path
+        self.lockpath = path + '.lock'
+        self.cpus = cpus or multiprocessing.cpu_count()
+        if memory is None:
+            memory = total_memory() or 0
+        self.memory = memory
+        self.poll = poll
+
+    @contextmanager
+    def _state(self):
+        '''
+        Exclusively lock the state and yield it as a dictionary that is
+        written back when the block finishes
+        '''
+        with open(self.lockpath, 'a') as lockfh:
+            fcntl.flock(lockfh, fcntl.LOCK_EX)
+            try:
+                state = {'clients': {}, 'grants': {}, 'next': 1}
+                if os.path.exists(self.path):
+                    try:
+                        with open(self.path) as fh:
+                            state = json.load(fh)
+                    except ValueError:
+                        logger.warning('Resetting unreadable broker state {0}'.format(self.path))
+                self._reap(state)
+                yield state
+                tmppath = self.path + '.tmp'
+                with open(tmppath, 'w') as fh:
+                    json.dump(state, fh)
+                os.rename(tmppath, self.path)
+            finally:
+                fcntl.flock(lockfh, fcntl.LOCK_UN)
+
+    def _reap(self, state):
+        ''' Drop clients and grants of processes that have exited '''
+        for pid in list(state['clients']):
+            if not pid_alive(int(pid)):
+                del state['clients'][pid]
+        for id, grant in state['grants'].items():
+            if not pid_alive(grant['pid']):
+                logger.warning('Dropping grant {0} of exited process {1}'.format(id, grant['pid']))
+                del state['grants'][id]
+
+    def register(self, pid=None):
+        '''
+        Count a sample as running so it gets a share of the cpus
+
+        :param int pid: process the sample runs in. Defaults to this process
+        '''
+        with self._state() as state:
+            state['clients'][str(pid or os.getpid())] = time.time()
+
+    def unregister(self, pid=None):
+        with self._state() as state:
+            state['clients'].pop(str(pid or os.getpid()), None)
+
+    def share(self, state):
+        '''
+        Most cpus a single grant gets while the registered clients split them
+        '''
+        clients = max(1, len(state['clients']))
+        return max(1, self.cpus // clients)
+
+    def try_acquire(self, cpus=1, mincpus=1, memory=0):
+        '''
+        Get a grant if the resources are available now
+
+        :param int cpus: most cpus that are wanted
+        :param int mincpus: fewest cpus that are useful
+        :param int memory: MB of memory needed
+        :return: Grant or None
+        '''
+        with self._state() as state:
+            grants = state['grants'].values()
+            usedcpus = sum(g['cpus'] for g in grants)
+            usedmemory = sum(g['memory'] for g in grants)
+            freecpus = self.cpus - usedcpus
+            freememory = self.memory - usedmemory
+            # Anything is granted when nothing else holds a grant so a request
+            # that is larger than the machine cannot wait forever
+            if grants:
+                if freecpus < mincpus:
+                    return None
+                if self.memory and memory > freememory:
+                    return None
+            n = max(mincpus, min(cpus, self.share(state), freecpus))
+            n = max(1, min(n, self.cpus))
+            id = str(state['next'])
+            state['next'] += 1
+            state['grants'][id] = {
+                'pid': os.getpid(), 'cpus': n, 'memory': memory, 'time': time.time()
+            }
+            return Grant(id, n, memory)
+
+    def acquire(self, cpus=1, mincpus=1, memory=0, timeout=None):
+        '''
+        Wait until a grant is available
+
+        :param int timeout: seconds to wait before giving up. Waits forever if None
+        :return: Grant or None if timeout was reached
+        '''
+        start = time.time()
+        while True:
+            grant = self.try_acquire(cpus, mincpus, memory)
+            if grant is not None:
+                return grant
+            if timeout is not None and time.time() - start >= timeout:
+                return None
+            time.sleep(self.poll)
+
+    def release(self, grant):
+        with self._state() as state:
+            state['grants'].pop(grant.id, None)
+
+    @contextmanager
+    def grant(self, cpus=1, mincpus=1, memory=0):
+        '''
+        acquire a grant for the duration of a with block
+        '''
+        g = self.acquire(cpus, mincpus, memory)
+        try:
+            yield g
+        finally:
+            self.release(g)
+
+    def status(self):
+        '''
+        :return: dictionary of registered clients, held grants and the cpus and
+                 memory that are in use
+        '''
+        with self._state() as state:
+            grants = state['grants'].values()
+            return {
+                'clients': len(state['clients']),
+                'grants': len(grants),
+                'cpus': sum(g['cpus'] for g in grants),
+                'memory': sum(g['memory'] for g in grants),
+            }
@@ -1,7 +1,10 @@
-from bwa.bwa import BWAMem, index_ref, which_bwa, compile_refs
+from bwa.bwa import BWA, BWAMem, index_ref, which_bwa, compile_refs
 from ngs_mapper.data import reads_by_plat
-from ngs_mapper.reads import compile_reads
+from ngs_mapper.reads import compile_reads, ReadPipes
 import ngs_mapper.bam
+from ngs_mapper.refstore import RefStore, compile_directory
+from ngs_mapper.shmindex import SharedIndex, SharedIndexError
+from ngs_mapper.refscreen import screen_references
 
 import os
 import sys
@@ -9,20 +12,31 @@ from os.path import *
 import log
 import tempfile
 import shutil
-from subprocess import PIPE
+import socket
+import time
+from itertools import islice
+from multiprocessing.pool import ThreadPool
+from subprocess import Popen, PIPE
 
 logger = log.setup_logger(__name__, log.get_config())
 
 # For bwa errors
 class BWAError(Exception): pass
 
-def main():
+# bwa mem estimates the insert size of each batch of reads it loads and a batch
+# is 10M bases per thread unless -K fixes it. Fixed so alignments do not depend
+# on the threads and shards can start where bwa would start a new batch anyway
+BATCH_BASES = 10000000
+
+def main( args=sys.argv[1:] ):
     '''
         Compiles and runs everything
 
+        @param args - command line arguments as a list[Default: sys.argv[1:]]
+
         @returns path to the final bam file which will be dictated by the --ouput arg value
     '''
-    args = parse_args( sys.argv[1:] )
+    args = parse_args( args )
     tdir = join(dirname(args.output), 'bwa')
     
     # Compile together all the reads into a list
@@ -35,58 +49,137 @@ def main():
     # Creates reads/F.fq, reads/R.fq, reads/NP.fq
     readdir = join(tdir,'reads')
     os.makedirs( readdir )
-    reads = compile_reads( reads, readdir )
+    if args.screen and os.path.isdir( args.reference ):
+        # Only compile the references the reads come from
+        readfiles = [f for r in reads for f in (r if isinstance(r, tuple) else (r,))]
+        args.reference = screen_references(
+            args.reference, readfiles, args.screen, join(tdir, 'references'), reads=args.screen_reads
+        )
+    pipes = None
+    if args.stream or args.shard_size:
+        # Named pipes that the original read files are streamed through
+        pipes = ReadPipes( reads, readdir )
+        reads = pipes.files
+    else:
+        reads = compile_reads( reads, readdir )
     if not reads:
         raise Exception( "Somehow no reads were compiled" )
 
-    if os.path.isdir( args.reference ):
-        cwd = os.getcwd()
-        os.chdir( tdir )
-        ref = join( tdir, compile_refs( args.reference ) )
-        os.chdir( cwd )
-    else:
-        ref = args.reference
-
-    # Keeps track so we know to merge bams later if it is 3
-    merge = 0
-
-    if reads['F'] is not None:
-        merge += 1
-        pairedsai = bwa_mem( reads['F'], reads['R'], ref, join(tdir, 'paired.sai'), t=args.threads )
-        if isinstance(pairedsai,int):
-            raise BWAError("There was an error running bwa")
-        pairedbam = ngs_mapper.bam.sortbam( ngs_mapper.bam.samtobam( pairedsai, PIPE ), join(tdir, 'paired.bam') )
-        #bam.indexbam( pairedbam )
-
-    if reads['NP'] is not None:
-        merge += 2
-        nonpairedsai = bwa_mem( reads['NP'], ref=ref, output=join(tdir, 'nonpaired.sai'), t=args.threads )
-        if isinstance(nonpairedsai,int):
-            raise BWAError("There was an error running bwa")
-        nonpairedbam = ngs_mapper.bam.sortbam( ngs_mapper.bam.samtobam( nonpairedsai, PIPE ), join(tdir, 'nonpaired.bam') )
-        #bam.indexbam( nonpairedbam )
-
-    # Now decide if any merging needs to happen
-    bampath = args.output
-    if merge == 3:
-        ngs_mapper.bam.mergebams( [pairedbam, nonpairedbam], args.output )
-    elif merge == 1:
-        logger.debug( "Paired only. Moving result file {0} to {1}".format(pairedbam, bampath) )
-        shutil.move( pairedbam, bampath )
-    elif merge == 2:
-        logger.debug( "Includes non-paired. Moving result file {0} to {1}".format(nonpairedbam, bampath) )
-        shutil.move( nonpairedbam, bampath )
-    else:
-        raise Exception( "Somehow no reads were compiled" )
+    try:
+        map_sample( args, reads, tdir )
+        if pipes is not None:
+            pipes.wait()
+    finally:
+        if pipes is not None:
+            pipes.close()
 
     # Index the resulting bam
-    ngs_mapper.bam.indexbam( bampath )
+    ngs_mapper.bam.indexbam( args.output )
 
     if not args.keep_temp:
         shutil.rmtree( tdir )
     else:
         logger.info( "Keeping temporary directory {0}. You will probably want to delete it yourself or move it".format(tdir) )
 
+def map_sample( args, reads, tdir ):
+    '''
+        Map the reads the way args says to into args.output
+
+        @param args - parsed arguments
+        @param reads - dictionary of F, R and NP read files
+        @param tdir - temporary directory to work in
+
+        @returns path to the sorted bam
+    '''
+    if os.path.isdir( args.reference ) and args.refstore:
+        # Compiled and indexed once for every sample
+        ref = RefStore( args.refstore ).reference( args.reference )
+    elif os.path.isdir( args.reference ):
+        ref = compile_directory( args.reference, abspath( join( tdir, 'reference.fa' ) ) )
+    else:
+        ref = args.reference
+
+    shared = None
+    if args.shm:
+        shared = SharedIndex( args.refstore )
+        try:
+            ref = shared.acquire( ref )
+        except SharedIndexError as e:
+            logger.warning( "Could not load the index of {0} into shared memory so bwa will load it itself: {1}".format(ref, e) )
+            shared = None
+    try:
+        return map_reference( args, reads, ref, tdir )
+    finally:
+        if shared is not None:
+            try:
+                shared.release( ref )
+            except SharedIndexError as e:
+                # The bam is fine so only the index is left behind
+                logger.warning( "Could not release the shared memory index of {0}: {1}".format(ref, e) )
+
+def map_reference( args, reads, ref, tdir ):
+    '''
+        Map the reads against an indexed ref the way args says to into args.output
+
+        @returns path to the sorted bam
+    '''
+    bampath = args.output
+    if args.shard_size:
+        sharddir = join( tdir, 'shards' )
+        shards = split_reads( reads, args.shard_size, sharddir )
+        logger.info( "Mapping {0} shards of at most {1} reads each".format(len(shards), args.shard_size) )
+        # A single shard becomes the output as it is
+        level = args.temp_compression if len( shards ) > 1 else args.compression
+        bams = map_shards(
+            shards, ref, sharddir, threads=args.threads, memory=args.sort_memory,
+            workers=args.shard_workers, queue=args.shard_queue, level=level
+        )
+        if len( bams ) > 1:
+            ngs_mapper.bam.mergebams( bams, bampath, level=args.compression )
+        else:
+            shutil.move( bams[0], bampath )
+    elif args.stream:
+        # Paired and nonpaired alignments all go into one sort
+        map_reads( reads, ref, bampath, threads=args.threads, memory=args.sort_memory, level=args.compression )
+    else:
+        # Keeps track so we know to merge bams later if it is 3
+        merge = 0
+        # Either bam becomes the output as it is unless both have to be merged
+        if reads['F'] is not None and reads['NP'] is not None:
+            level = args.temp_compression
+        else:
+            level = args.compression
+
+        if reads['F'] is not None:
+            merge += 1
+            pairedsai = bwa_mem( reads['F'], reads['R'], ref, join(tdir, 'paired.sai'), t=args.threads )
+            if isinstance(pairedsai,int):
+                raise BWAError("There was an error running bwa")
+            pairedbam = ngs_mapper.bam.sortbam( ngs_mapper.bam.samtobam( pairedsai, PIPE, level=0 ), join(tdir, 'paired.bam'), threads=args.threads, memory=args.sort_memory, level=level )
+            #bam.indexbam( pairedbam )
+
+        if reads['NP'] is not None:
+            merge += 2
+            nonpairedsai = bwa_mem( reads['NP'], ref=ref, output=join(tdir, 'nonpaired.sai'), t=args.threads )
+            if isinstance(nonpairedsai,int):
+                raise BWAError("There was an error running bwa")
+            nonpairedbam = ngs_mapper.bam.sortbam( ngs_mapper.bam.samtobam( nonpairedsai, PIPE, level=0 ), join(tdir, 'nonpaired.bam'), threads=args.threads, memory=args.sort_memory, level=level )
+            #bam.indexbam( nonpairedbam )
+
+        # Now decide if any merging needs to happen
+        if merge == 3:
+            ngs_mapper.bam.mergebams( [pairedbam, nonpairedbam], args.output, level=args.compression )
+        elif merge == 1:
+            logger.debug( "Paired only. Moving result file {0} to {1}".format(pairedbam, bampath) )
+            shutil.move( pairedbam, bampath )
+        elif merge == 2:
+            logger.debug( "Includes non-paired. Moving result file {0} to {1}".format(nonpairedbam, bampath) )
+            shutil.move( nonpairedbam, bampath )
+        else:
+            raise Exception( "Somehow no reads were compiled" )
+
+    return bampath
+
 def parse_args( args=sys.argv[1:] ):
     '''
         Uses argparse to parse arguments
@@ -107,7 +200,8 @@ def parse_args( args=sys.argv[1:] ):
             'the platforms you select and it will pull those reads onto the current host. It will ' \
             'compile references if they are multiple ones in a directory you select onto the local computer. Then it ' \
             'will map any mated reads against to those refs and also map the nonpaired reads against that ref in a separate ' \
-            'call. Then when both are finished it will convert to bam/sort/index/merge/reindex the results. It attempts all of ' \
+            'call. The alignments of both are piped straight into a single samtools sort and then indexed. With --no-stream ' \
+            'each is written to disk and then converted to bam/sorted/merged/indexed instead. It attempts all of ' \
             'this inside of the /dev/shm filesystem which should be very fast. If /dev/shm cannot be used then /tmp will be used. '\
             'If you want the temporary files that are created to stay then you can use the --keep-temp argument',
         parents=[conf_parser]
@@ -156,10 +250,348 @@ def parse_args( args=sys.argv[1:] ):
         help=defaults['threads']['help']
     )
 
-    return parser.parse_args( args )
+    parser.add_argument(
+        '--no-stream',
+        dest='stream',
+        action='store_false',
+        default=defaults['stream']['default'],
+        help=defaults['stream']['help']
+    )
+
+    parser.add_argument(
+        '--sort-memory',
+        dest='sort_memory',
+        default=defaults['sort_memory']['default'],
+        help=defaults['sort_memory']['help']
+    )
+
+    parser.add_argument(
+        '--shard-size',
+        dest='shard_size',
+        type=int,
+        default=defaults['shard_size']['default'],
+        help=defaults['shard_size']['help']
+    )
+
+    parser.add_argument(
+        '--shard-workers',
+        dest='shard_workers',
+        type=int,
+        default=defaults['shard_workers']['default'],
+        help=defaults['shard_workers']['help']
+    )
+
+    parser.add_argument(
+        '--shard-queue',
+        dest='shard_queue',
+        default=defaults['shard_queue']['default'],
+        help=defaults['shard_queue']['help']
+    )
+
+    parser.add_argument(
+        '--refstore',
+        dest='refstore',
+        default=defaults['refstore']['default'],
+        help=defaults['refstore']['help']
+    )
+
+    parser.add_argument(
+        '--shm',
+        dest='shm',
+        action='store_true',
+        default=defaults['shm']['default'],
+        help=defaults['shm']['help']
+    )
+
+    parser.add_argument(
+        '--screen',
+        dest='screen',
+        type=int,
+        default=defaults['screen']['default'],
+        help=defaults['screen']['help']
+    )
+
+    parser.add_argument(
+        '--screen-reads',
+        dest='screen_reads',
+        type=int,
+        default=defaults['screen_reads']['default'],
+        help=defaults['screen_reads']['help']
+    )
+
+    parser.add_argument(
+        '--compression',
+        dest='compression',
+        type=int,
+        choices=range(10),
+        default=defaults['compression']['default'],
+        help=defaults['compression']['help']
+    )
+
+    parser.add_argument(
+        '--temp-compression',
+        dest='temp_compression',
+        type=int,
+        choices=range(10),
+        default=defaults['temp_compression']['default'],
+        help=defaults['temp_compression']['help']
+    )
+
+    args = parser.parse_args( args )
+    if args.shm and not args.refstore:
+        parser.error( '--shm needs --refstore' )
+    return args
 
 class InvalidReference(Exception): pass
 
+def relay_sam( samfh, outfh, header=True ):
+    '''
+        Copy sam output from samfh to outfh
+
+        @param samfh - file object to read sam from
+        @param outfh - file object to write sam to
+        @param header - False to leave out the header lines(lines starting with @)
+    '''
+    line = samfh.readline()
+    while line.startswith( '@' ):
+        if header:
+            outfh.write( line )
+        line = samfh.readline()
+    outfh.write( line )
+    shutil.copyfileobj( samfh, outfh, 1024*1024 )
+
+def ensure_indexed( ref ):
+    '''
+        Index ref with bwa unless it already is
+
+        @raises InvalidReference if bwa cannot index it
+    '''
+    logger.debug( "Ensuring {0} is indexed".format(ref) )
+    if not index_ref(ref):
+        raise InvalidReference("{0} cannot be indexed by bwa".format(ref))
+
+def stream_bwa_mem( runs, ref, outbam, threads=1, memory=None, level=None, index=True ):
+    '''
+        Runs bwa mem for each set of reads in runs against ref one after another
+        and pipes all of the alignments straight into a single samtools sort so
+        neither sam nor unsorted bam files are written
+
+        Only the header of the first run is kept since every run is against the same ref
+
+        @param runs - list of (read1, mate) where mate is None for nonpaired reads
+        @param ref - Indexed reference file path
+        @param outbam - Sorted bam file path to create
+        @param threads - threads for bwa and samtools sort
+        @param memory - memory each samtools sort thread uses
+        @param level - compression level(0-9) of outbam. None uses the samtools default
+        @param index - False if ref is already indexed
+
+        @returns outbam
+    '''
+    if index:
+        ensure_indexed( ref )
+
+    # Uncompressed bam is the cheapest way to hand alignments to sort
+    view = Popen( ['samtools','view','-Sbu','-'], stdin=PIPE, stdout=PIPE )
+    cmd = ngs_mapper.bam.sort_cmd( outbam, threads, memory, level )
+    logger.info( "Running {0}".format(' '.join(cmd)) )
+    sort = Popen( cmd, stdin=view.stdout )
+    view.stdout.close()
+
+    failed = None
+    try:
+        for i, (read1, mate) in enumerate( runs ):
+            # Built here instead of with BWAMem since BWAMem reads every read
+            # file to validate it and again to count the reads which named
+            # pipes cannot do
+            cmd = [which_bwa(), 'mem', '-t', str(threads), '-K', str(BATCH_BASES), ref, read1] + ([mate] if mate else [])
+            logger.info( "Running {0}".format(' '.join(cmd)) )
+            # bwa writes a lot to stderr so it cannot be a pipe that is only read at the end
+            with tempfile.TemporaryFile() as errfh:
+                p = Popen( cmd, stdout=PIPE, stderr=errfh )
+                relay_sam( p.stdout, view.stdin, header=(i == 0) )
+                p.wait()
+                errfh.seek( 0 )
+                stderr = errfh.read()
+            logger.debug( "STDERR: {0}".format(stderr) )
+            if p.returncode != 0 or BWA.USAGE_REGEX.search( stderr ):
+                failed = ' '.join( cmd )
+                break
+    finally:
+        view.stdin.close()
+        view.wait()
+        sort.wait()
+
+    if failed is not None:
+        raise BWAError( "There was an error running {0}".format(failed) )
+    if view.returncode != 0 or sort.returncode != 0:
+        raise BWAError( "samtools could not sort the alignments into {0}".format(outbam) )
+    return outbam
+
+def map_reads( reads, ref, outbam, threads=1, memory=None, level=None, index=True ):
+    '''
+        Map paired and nonpaired reads into a single sorted bam with stream_bwa_mem
+
+        @param reads - dictionary of F, R and NP read files such as compile_reads returns
+        @param ref - Indexed reference file path
+        @param outbam - Sorted bam file path to create
+
+        @returns outbam
+    '''
+    runs = []
+    if reads.get('F') is not None:
+        runs.append( (reads['F'], reads['R']) )
+    if reads.get('NP') is not None:
+        runs.append( (reads['NP'], None) )
+    return stream_bwa_mem( runs, ref, outbam, threads=threads, memory=memory, level=level, index=index )
+
+def split_reads( reads, shard_size, outdir ):
+    '''
+        Split compiled fastq reads into shards of at least shard_size reads.
+        Paired reads are split in lockstep so mates end up at the same position
+        in the same shard
+
+        A shard only ends where bwa mem would start a new batch of BATCH_BASES
+        if it mapped all of the reads at once so every shard maps exactly like
+        those reads would have
+
+        @param reads - dictionary of F, R and NP read files such as compile_reads returns
+        @param shard_size - fewest reads(or pairs of reads) in each shard
+        @param outdir - where to write the shards
+
+        @returns list of dictionaries of F, R and NP read files for each shard.
+        Files a shard does not have are None
+    '''
+    if not os.path.isdir( outdir ):
+        os.makedirs( outdir )
+    shards = []
+    for keys in (('F','R'), ('NP',)):
+        if reads.get(keys[0]) is None:
+            continue
+        inputs = [open( reads[k] ) for k in keys]
+        outputs = []
+        try:
+            # Reads and bases bwa mem has loaded into its current batch
+            i = written = batched = bases = 0
+            while True:
+                # fastq records are always 4 lines
+                records = [''.join( islice( fh, 4 ) ) for fh in inputs]
+                if not records[0] and not records[-1]:
+                    break
+                if not all( records ):
+                    raise BWAError( "{0} do not have the same number of reads".format(
+                        [reads[k] for k in keys]) )
+                if not outputs or (written >= shard_size and not batched):
+                    for fh in outputs:
+                        fh.close()
+                    if i == len( shards ):
+                        shards.append( dict.fromkeys( ('F','R','NP') ) )
+                    for k in keys:
+                        shards[i][k] = join( outdir, '{0}.{1:04d}.fq'.format(k, i) )
+                    outputs = [open( shards[i][k], 'w' ) for k in keys]
+                    i += 1
+                    written = 0
+                for fh, record in zip( outputs, records ):
+                    fh.write( record )
+                written += 1
+                # bwa mem ends a batch once it has enough bases and an even number of reads
+                batched += len( records )
+                bases += sum( len( r.split('\n')[1] ) for r in records )
+                if bases >= BATCH_BASES and batched % 2 == 0:
+                    batched = bases = 0
+        finally:
+            for fh in inputs + outputs:
+                fh.close()
+    return shards
+
+def map_shards( shards, ref, outdir, threads=1, memory=None, workers=1, queue=None, level=None ):
+    '''
+        Map every shard into its own sorted bam either with workers shards at a
+        time on this host or through a jobqueue directory so workers on other
+        hosts can map them as well
+
+        @param shards - list of read dictionaries from split_reads
+        @param ref - Reference file path. It is indexed before any shard is mapped
+        @param outdir - where to write the shard bams
+        @param threads - threads this host uses in total. Each local worker gets an even part of them
+        @param workers - how many shards to map at once on this host
+        @param queue - jobqueue directory to map the shards through instead
+        @param level - compression level(0-9) of the shard bams
+
+        @returns list of sorted bam files in the same order as shards
+    '''
+    bams = [join( outdir, 'shard.{0:04d}.bam'.format(i) ) for i in range( len( shards ) )]
+    # Once here as shards mapped at the same time would all write the same index files
+    ensure_indexed( ref )
+    if queue:
+        queue_shards( queue, shards, ref, bams, threads, memory, level=level )
+        return bams
+    each = max( 1, threads // max( 1, workers ) )
+    def map_one( shard_bam ):
+        return map_reads( shard_bam[0], ref, shard_bam[1], threads=each, memory=memory, level=level, index=False )
+    pool = ThreadPool( max( 1, workers ) )
+    try:
+        pool.map( map_one, zip( shards, bams ) )
+    finally:
+        pool.close()
+        pool.join()
+    return bams
+
+def queue_shards( queue, shards, ref, bams, threads=1, memory=None, poll=30, level=None ):
+    '''
+        Put every shard into a jobqueue and work on the queue until every
+        shard has been mapped by this or any other worker
+
+        @raises BWAError if any shard failed
+    '''
+    from ngs_mapper.jobqueue import JobQueue, run_worker, is_shard, DONE, FAILED
+    q = JobQueue( queue )
+    # Unique so reruns of the same sample do not find the earlier shards
+    prefix = '{0}.{1}.{2}'.format(
+        splitext( basename( bams[0] ) )[0], socket.gethostname(), os.getpid()
+    )
+    names = []
+    for i, (shard, bam) in enumerate( zip( shards, bams ) ):
+        name = '{0}-{1:04d}'.format(prefix, i)
+        q.submit( {
+            'name': name,
+            'kind': 'shard',
+            'reads': dict( (k, abspath(v) if v else None) for k, v in shard.items() ),
+            'reference': abspath( ref ),
+            'output': abspath( bam ),
+            'threads': threads,
+            'memory': memory,
+            'level': level,
+        } )
+        names.append( name )
+    while True:
+        # Samples in the same queue are left to the jobqueue workers
+        run_worker( q, accept=is_shard )
+        failed = [n for n in names if exists( q.jobpath( FAILED, n ) )]
+        if failed:
+            raise BWAError( "Shards {0} could not be mapped. See {1}".format(failed, q.path) )
+        if all( exists( q.jobpath( DONE, n ) ) for n in names ):
+            return bams
+        # Other workers are still mapping some of them
+        time.sleep( poll )
+
+def run_shard_job( job ):
+    '''
+        Map a shard that queue_shards put into a jobqueue. map_shards
+        indexed the reference before it was queued
+
+        @returns 0 if it mapped or 1 if it did not
+    '''
+    try:
+        map_reads(
+            job['reads'], job['reference'], job['output'], job['threads'], job['memory'],
+            job.get( 'level' ), index=False
+        )
+    except (BWAError, InvalidReference, ValueError, OSError) as e:
+        logger.critical( "Could not map {0}: {1}".format(job['name'], e) )
+        return 1
+    return 0
+
 def bwa_mem( read1, mate=None, ref=None, output='bwa.sai', **kwargs ):
     '''
         Runs the bwa mem algorithm on read1 against ref. If mate is given then run that file with the read1 file
@@ -10,6 +10,7 @@ Current Pipeline Stages
 
 * :py:mod:`ngs_mapper.nfilter`
 * :py:mod:`ngs_mapper.trim_reads`
+* :py:mod:`ngs_mapper.kmer_filter` (only with ``--kmer-filter``)
 * :py:mod:`ngs_mapper.run_bwa_on_samplename <ngs_mapper.run_bwa>`
 * :py:mod:`ngs_mapper.tagreads`
 * :py:mod:`ngs_mapper.base_caller`
@@ -47,6 +48,75 @@ Same example as above, but shortened a bit using bash variables
 
         runsample ${READSDIR}/${SAMPLE} ${REFDIR}/${REF} ${SAMPLE} -od ${SAMPLE}
 
+Stages that do not depend on each other(base_caller, graphsample, fqstats, ...) are run at the same time
+as long as they fit within ``--threads`` cpus. Stages that use more than one cpu(run_bwa_on_samplename,
+base_caller, ngs_filter) are counted using the threads set for them in the config file.
+
+    .. code-block:: bash
+
+        runsample ${READSDIR}/${SAMPLE} ${REFDIR}/${REF} ${SAMPLE} -od ${SAMPLE} --threads 4
+
+Every stage is normally run as its own command which means each one has to start python and import
+everything it needs again. For samples that map quickly(Sanger, small Ion runs) that startup time can be
+most of the run time. ``--stage-mode fork`` calls each python stage's main function inside of a forked
+copy of runsample instead so everything is only imported once, while each stage still runs in its own process.
+``--stage-mode inline`` calls them directly inside of runsample(one at a time) which avoids forking, but
+a stage that crashes python takes runsample with it.
+Stages listed with ``--isolate`` are always run as their own command.
+
+    .. code-block:: bash
+
+        runsample ${READSDIR}/${SAMPLE} ${REFDIR}/${REF} ${SAMPLE} -od ${SAMPLE} --stage-mode fork --isolate base_caller
+
+When many samples run on the same machine at once they can share its cpus and memory through a
+:py:mod:`resource broker <ngs_mapper.resources>` file. Every stage then waits for a grant from the broker and
+multithreaded stages(ngs_filter, trim_reads, run_bwa_on_samplename, base_caller) use as many cpus as they are
+granted which is more once fewer samples are running.
+
+    .. code-block:: bash
+
+        runsample ${READSDIR}/${SAMPLE} ${REFDIR}/${REF} ${SAMPLE} -od ${SAMPLE} --broker /tmp/ngs_mapper.resources
+
+The bwa index, samtools faidx index and homopolymers of a reference can be built once for every
+sample that uses it with ``--refstore``. References are kept in that directory by the hash of their
+contents and each sample symlinks the indexes next to its copy of the reference while it runs. The
+symlinks are replaced with copies before the sample is moved into its output directory(See
+:py:mod:`ngs_mapper.refstore`).
+
+    .. code-block:: bash
+
+        runsample ${READSDIR}/${SAMPLE} ${REFDIR}/${REF} ${SAMPLE} -od ${SAMPLE} --refstore /tmp/ngs_mapper.refs
+
+Samples that map against the same reference on the same machine at the same time can also share a
+single copy of its bwa index in shared memory with ``--shm`` instead of each loading its own(See
+:py:mod:`ngs_mapper.shmindex`).
+
+    .. code-block:: bash
+
+        runsample ${READSDIR}/${SAMPLE} ${REFDIR}/${REF} ${SAMPLE} -od ${SAMPLE} --refstore /tmp/ngs_mapper.refs --shm
+
+The bam that run_bwa_on_samplename makes(and every bam it merges into it) is only read by the next
+step, so it is written uncompressed and only the final bam that tagreads writes is fully compressed.
+``--temp-compression`` or TEMP_COMPRESSION in the config sets another level(0-9) for them.
+
+Samples that are mostly host reads can drop every trimmed read that shares no k-mer with the reference
+before it is mapped with ``--kmer-filter`` so mapping only takes as long as the reads of the target
+need(See :py:mod:`ngs_mapper.kmer_filter`).
+
+    .. code-block:: bash
+
+        runsample ${READSDIR}/${SAMPLE} ${REFDIR}/${REF} ${SAMPLE} -od ${SAMPLE} --kmer-filter
+
+Every stage that succeeds is recorded in samplename.stages.json along with a hash of its inputs,
+parameters and the tools it ran. If a stage fails(or you want to change a setting) the sample can be run
+again into the same output directory with ``--resume`` and only the stages that are affected are run.
+For example, changing ``-minth`` only runs base_caller and vcf_consensus again while the already trimmed
+and mapped reads are used as they are.
+
+    .. code-block:: bash
+
+        runsample ${READSDIR}/${SAMPLE} ${REFDIR}/${REF} ${SAMPLE} -od ${SAMPLE} --resume -minth 0.9
+
 .. _runsample-output-directory:
 
 Output Analysis Directory
@@ -63,6 +133,9 @@ Output Analysis Directory
 * samplename.bam.qualdepth.json (:py:mod:`ngs_mapper.graphs`)
     * Contains statistics about your bam alignment such as depth and coverage.
       Not really meant for humans to read
+* samplename.bam.qualdepth.pyramid.json (:py:mod:`ngs_mapper.graphs`)
+    * Min/mean/max of depth and quality binned at several zoom levels that is used
+      to draw the qualdepth graphics
 * samplename.bam.qualdepth.png (:py:mod:`ngs_mapper.graphs`)
     * Graphic showing quality vs depth across your references
 * samplename.bam.vcf (:py:mod:`ngs_mapper.base_caller`)
@@ -74,6 +147,15 @@ Output Analysis Directory
 * samplename.reads.png (:py:mod:`ngs_mapper.fqstats`)
     * Graphic showing quality information about each read file
     * You can view this with any image application. I like to use eog from the command line to open it quickly
+* samplename.summary.json (:py:mod:`ngs_mapper.summary`)
+    * Read counts, breadth of coverage, how long each stage took and how much cpu and memory
+      it used along with the features of the input reads. Used by the graphics that compare
+      all samples and to predict the resources new samples need
+* samplename.metrics.json (:py:mod:`ngs_mapper.metrics`)
+    * Wall time, user and sys cpu time, peak memory and bytes read and written of every stage
+      and of every process each stage ran
+* samplename.stages.json (:py:mod:`ngs_mapper.stages`)
+    * Which stages succeeded and the hashes used to tell if they have to run again with ``--resume``
 * samplename.std.log (:py:mod:`ngs_mapper.runsample`)
     * Log file that contains any output from scripts that was not captured in other logs
 * bwa.log (:py:mod:`ngs_mapper.run_bwa_on_samplename`)
@@ -85,6 +167,8 @@ Output Analysis Directory
 * reference.fasta.bwt (:py:mod:`ngs_mapper.runsample`)
 * reference.fasta.pac (:py:mod:`ngs_mapper.runsample`)
 * reference.fasta.sa( :py:mod:`ngs_mapper.runsample`)
+    * With ``--refstore`` the index files are copied from the reference store along with
+      reference.fasta.fai and reference.fasta.hpoly.json
 * flagstats.txt (:py:mod:`ngs_mapper.gen_flagstats`)
     * Just the dump from samtools flagstats
 * qualdepth (:py:mod:`ngs_mapper.graphs`)
@@ -96,6 +180,10 @@ Output Analysis Directory
     * unpaired.fastq
 * trim_stats (:py:mod:`ngs_mapper.trim_reads`)
     * sampleread.trim
+* kmer_filtered (:py:mod:`ngs_mapper.kmer_filter`)
+    * Only with --kmer-filter. The trimmed reads that share a k-mer with the reference
+* kmer_filter.json (:py:mod:`ngs_mapper.kmer_filter`)
+    * Only with --kmer-filter. How many reads were dropped from each read file
 * filtered (:py:mod:`ngs_mapper.nfilter`)
     * filtered.sampleread1.fastq
     * filtered.sampleread2.fastq
@@ -112,16 +200,25 @@ import tempfile
 import logging
 import shutil
 import glob
+import filecmp
+import time
 from ngs_mapper import compat
 import sh
 from data import fastas_to_40s_fastqs
 import nfilter
+import summary
+import metrics
+import predict
+from stages import Stage, StageCache, run_stages, fork_main, inline_main, wait_popen
+from resources import ResourceBroker
+from refstore import RefStore, INDEX_EXTENSIONS, copy_links
 # Everything to do with running a single sample
 # Geared towards running in a Grid like universe(HTCondor...)
 # Ideally the entire sample would be run inside of a prefix directory under
 # /dev/shm and drop back on tmpdir if /dev/shm didn't exist
 
 from ngs_mapper import config
+from ngs_mapper import __version__
 import log
 # We will configure this later after args have been parsed
 logger = None
@@ -251,8 +348,111 @@ def parse_args( args=sys.argv[1:] ):
         help='Input is fasta format. Default is False.'
     )
 
+    parser.add_argument(
+        '--threads',
+        dest='threads',
+        type=int,
+        default=_config['runsample']['threads']['default'],
+        help=_config['runsample']['threads']['help'],
+    )
+
+    parser.add_argument(
+        '--stage-mode',
+        dest='stage_mode',
+        choices=_config['runsample']['stage_mode']['choices'],
+        default=_config['runsample']['stage_mode']['default'],
+        help=_config['runsample']['stage_mode']['help'],
+    )
+
+    parser.add_argument(
+        '--isolate',
+        dest='isolate',
+        nargs='+',
+        default=_config['runsample']['isolate']['default'],
+        help=_config['runsample']['isolate']['help'],
+    )
+
+    parser.add_argument(
+        '--resume',
+        dest='resume',
+        action='store_true',
+        default=_config['runsample']['resume']['default'],
+        help=_config['runsample']['resume']['help'],
+    )
+
+    parser.add_argument(
+        '--broker',
+        dest='broker',
+        default=_config['runsample']['broker']['default'],
+        help=_config['runsample']['broker']['help'],
+    )
+
+    parser.add_argument(
+        '--broker-cpus',
+        dest='broker_cpus',
+        type=int,
+        default=_config['runsample']['broker_cpus']['default'],
+        help=_config['runsample']['broker_cpus']['help'],
+    )
+
+    parser.add_argument(
+        '--broker-memory',
+        dest='broker_memory',
+        type=int,
+        default=_config['runsample']['broker_memory']['default'],
+        help=_config['runsample']['broker_memory']['help'],
+    )
+
+    parser.add_argument(
+        '--refstore',
+        dest='refstore',
+        default=_config['runsample']['refstore']['default'],
+        help=_config['runsample']['refstore']['help'],
+    )
+
+    parser.add_argument(
+        '--shm',
+        dest='shm',
+        action='store_true',
+        default=_config['runsample']['shm']['default'],
+        help=_config['runsample']['shm']['help'],
+    )
+
+    parser.add_argument(
+        '--temp-compression',
+        dest='temp_compression',
+        type=int,
+        choices=range(10),
+        default=_config['runsample']['temp_compression']['default'],
+        help=_config['runsample']['temp_compression']['help'],
+    )
+
+    parser.add_argument(
+        '--kmer-filter',
+        dest='kmer_filter',
+        action='store_true',
+        default=_config['runsample']['kmer_filter']['default'],
+        help=_config['runsample']['kmer_filter']['help'],
+    )
+
     args, rest = parser.parse_known_args(args)
     args.config = configfile
+    # How many cpus each stage will use so they can be scheduled within --threads
+    args.stage_cpus = dict(
+        (stage, _config[stage]['threads']['default'])
+        for stage in ('ngs_filter', 'trim_reads', 'kmer_filter', 'run_bwa_on_samplename', 'base_caller')
+    )
+    # MB of memory each stage asks the broker for
+    args.stage_memory = _config['runsample']['stage_memory']['default'] or {}
+    # Config values that change what each stage creates so changing them only
+    # reruns the stages that use them
+    args.stage_config = dict(
+        (stage, dict(
+            (k, v['default']) for k, v in _config[stage].items()
+            if k != 'threads' and isinstance(v, dict) and 'default' in v
+        ))
+        for stage in ('ngs_filter', 'trim_reads', 'kmer_filter', 'run_bwa_on_samplename', 'tagreads', 'base_caller')
+    )
 
     # Parse qsub args if found
     if rest and rest[0].startswith('--qsub'):
@@ -308,6 +508,313 @@ def run_cmd( cmdstr, stdin=sys.stdin, stdout=sys.stdout, stderr=sys.stderr, scri
     except OSError as e:
         raise MissingCommand( "{0} is not an executable?".format(cmd[0]) )
 
+def stage_mains():
+    '''
+        Python main functions for the console scripts that runsample can run
+        without starting a new command. Importing them here means forked stages
+        do not have to import anything again.
+
+        @returns {scriptname: main function}
+    '''
+    import trim_reads, kmer_filter, run_bwa, tagreads, base_caller, graphsample, fqstats, vcf_consensus
+    return {
+        'trim_reads': trim_reads.main,
+        'kmer_filter': kmer_filter.main,
+        'run_bwa_on_samplename': run_bwa.main,
+        'tagreads': tagreads.main,
+        'base_caller': base_caller.main,
+        'graphsample': graphsample.main,
+        'fqstats': fqstats.main,
+        'vcf_consensus': vcf_consensus.main,
+    }
+
+def command( cmdstr, stdout, stderr=subprocess.STDOUT, script_dir=None, mode='subprocess', mains=None ):
+    '''
+        Returns a function that runs cmdstr, waits for it to finish and logs
+        if it did not exit successfully
+
+        @param mode - subprocess runs cmdstr as a command through run_cmd.
+            fork calls the command's python main function in a forked process.
+            inline calls the command's python main function in this process.
+            Commands without a main function in mains always use subprocess
+        @param mains - {scriptname: main function} as returned by stage_mains
+
+        @returns function that returns the command's return code
+    '''
+    argv = shlex.split( cmdstr )
+    main = (mains or {}).get( argv[0] )
+    if main is None or script_dir is not None:
+        mode = 'subprocess'
+    def run():
+        if mode == 'subprocess':
+            start = time.time()
+            p = run_cmd( cmdstr, stdout=stdout, stderr=stderr, script_dir=script_dir )
+            r = wait_popen( p, cmdstr, start )
+        elif mode == 'fork':
+            logger.debug( "Running {0} in forked process".format(cmdstr) )
+            if stderr == subprocess.STDOUT:
+                r = fork_main( main, argv[1:], stdout )
+            else:
+                r = fork_main( main, argv[1:], stdout, stderr )
+        else:
+            logger.debug( "Running {0} inside of runsample".format(cmdstr) )
+            if stderr == subprocess.STDOUT:
+                r = inline_main( main, argv[1:], stdout )
+            else:
+                r = inline_main( main, argv[1:], stdout, stderr )
+        if r != 0:
+            logger.critical( "{0} did not exit sucessfully".format(cmdstr) )
+        return r
+    return run
+
+def make_stages( args, cmd_args, lfile, bwalog, flagstats, broker=None ):
+    '''
+        Declare every stage of the pipeline for a single sample along with the
+        stages each one requires
+
+        @param args - parsed runsample arguments
+        @param cmd_args - dictionary of values used to build each stage's command
+        @param lfile - open file that stage output goes to
+        @param bwalog - path to write bwa's output to
+        @param flagstats - path to write samtools flagstat output to
+        @param broker - resources.ResourceBroker that every stage gets its
+            cpus and memory from. Without one, stages use the threads in the
+            config and are scheduled within --threads
+
+        @returns list of stages.Stage
+    '''
+    def select_keys(d, keys):
+        return dict( ((k, v) for k, v in d.items() if k in keys))
+
+    tdir = cmd_args['tdir']
+    def tpath( *paths ):
+        return os.path.join( tdir, *paths )
+
+    def params( stage, cmd ):
+        ''' What is hashed into a stage's cache key besides its inputs '''
+        # Commands contain the random temporary directory which must not
+        # change the key between runs
+        return {
+            'version': __version__,
+            'command': cmd.replace( tdir, '.' ),
+            'config': args.stage_config.get( stage ),
+        }
+
+    convert_dir = tpath('converted')
+    stage_cpus = args.stage_cpus
+    mains = {}
+    if args.stage_mode != 'subprocess':
+        mains = stage_mains()
+
+    def mode( stage ):
+        ''' How to run stage '''
+        if stage in args.isolate:
+            return 'subprocess'
+        return args.stage_mode
+
+    def granted( stage, run ):
+        '''
+            Stages in stage_cpus have run called with how many threads they
+            can use. With a broker every stage waits for a grant first and
+            multithreaded stages use as many cpus as they are granted
+        '''
+        threaded = stage in stage_cpus
+        if broker is None:
+            if threaded:
+                return lambda: run( stage_cpus[stage] )
+            return run
+        want = broker.cpus if threaded else 1
+        def run_granted():
+            with broker.grant( cpus=want, memory=args.stage_memory.get( stage, 0 ) ) as grant:
+                logger.debug( "{0} granted {1} cpus and {2}MB memory".format(
+                    stage, grant.cpus, grant.memory
+                ))
+                if threaded:
+                    return run( grant.cpus )
+                return run()
+        return run_granted
+
+    #convert sffs to fastq
+    def convert():
+        print sh.convert_formats(cmd_args['readsdir'], convert_dir, _out=sys.stdout, _err=sys.stderr)
+        #print sh.sff_to_fastq(cmd_args['readsdir'], _out=sys.stdout, _err=sys.stderr)
+
+        if args.fasta:
+            fastas = glob.glob(os.path.join(cmd_args['readsdir'], '*.fasta'))
+            fastas_to_40s_fastqs(convert_dir, fastas)
+        return 0
+
+    #Filter on index quality and Ns
+    def ngs_filter( threads ):
+        try:
+            if cmd_args['config']:
+                __result = sh.ngs_filter(convert_dir, config=cmd_args['config'], outdir=cmd_args['filtered_dir'], threads=threads)
+            else:
+                filter_args = select_keys(cmd_args, ["drop_ns", "platforms", "index_min"])
+                __result = sh.ngs_filter(convert_dir, outdir=cmd_args['filtered_dir'], threads=threads, **filter_args)
+            logger.debug( 'ngs_filter: %s' % __result )
+        except sh.ErrorReturnCode, e:
+            logger.error(e.stderr)
+            return 1
+        return 0
+
+    #Trim reads
+    cmd = 'trim_reads {filtered_dir} -q {trim_qual} -o {trim_outdir} --head-crop {head_crop}'
+    if cmd_args['config']:
+        cmd += ' -c {config}'
+    primer_info = cmd_args['primer_info']
+    if primer_info[0]:
+        cmd += " --primer-file %s --primer-seed %s --palindrome-clip %s --simple-clip %s " % primer_info
+    trim_cmd = cmd.format(**cmd_args)
+    def trim_reads( threads ):
+        cmd = trim_cmd + ' -t {0}'.format(threads)
+        return command( cmd, stdout=lfile, mode=mode('trim_reads'), mains=mains )()
+
+    # Drop reads that cannot map
+    kmer_outdir = tpath('kmer_filtered')
+    kmer_stats = tpath('kmer_filter.json')
+    cmd = 'kmer_filter {trim_outdir} {reference} -o {kmer_outdir} --stats {kmer_stats}'
+    if cmd_args['config']:
+        cmd += ' -c {config}'
+    kmer_cmd = cmd.format(kmer_outdir=kmer_outdir, kmer_stats=kmer_stats, **cmd_args)
+    def kmer_filter( threads ):
+        cmd = kmer_cmd + ' -t {0}'.format(threads)
+        return command( cmd, stdout=lfile, mode=mode('kmer_filter'), mains=mains )()
+
+    # Mapping
+    mapped_reads = kmer_outdir if args.kmer_filter else cmd_args['trim_outdir']
+    bwa_cmd = 'run_bwa_on_samplename {mapped_reads} {reference} -o {bamfile}'
+    if cmd_args['config']:
+        bwa_cmd += ' -c {config}'
+    bwa_cmd = bwa_cmd.format(mapped_reads=mapped_reads, **cmd_args)
+    # Do not change what is mapped so they are left out of the stage's params
+    shm_opts = ''
+    if args.shm and args.refstore:
+        shm_opts = ' --refstore {0} --shm'.format(args.refstore)
+    # tagreads rewrites the bam so it is only compressed once tagreads is done
+    compression_opts = ' --compression {0} --temp-compression {0}'.format(args.temp_compression)
+    def run_bwa( threads ):
+        with open(bwalog, 'wb') as blog:
+            # Wait for the sample to map
+            r = command(
+                bwa_cmd + compression_opts + shm_opts + ' -t {0}'.format(threads), stdout=blog,
+                mode=mode('run_bwa_on_samplename'), mains=mains
+            )()
+            if r != 0:
+                logger.critical( "{0} failed to complete sucessfully. Please check the log file {1} for more details".format(bwa_cmd,bwalog) )
+            return r
+
+    # Tag Reads
+    cmd = 'tagreads {bamfile} -CN {CN}'
+    if cmd_args['config']:
+        cmd += ' -c {config}'
+    tag_cmd = cmd.format(**cmd_args)
+    tagreads = command( tag_cmd, stdout=lfile, mode=mode('tagreads'), mains=mains )
+
+    # Variant Calling
+    cmd = 'base_caller {bamfile} {reference} {vcf} -minth {minth}'
+    if cmd_args['config']:
+        cmd += ' -c {config}'
+    caller_cmd = cmd.format(**cmd_args)
+    def base_caller( threads ):
+        cmd = caller_cmd + ' --threads {0}'.format(threads)
+        return command( cmd, stdout=lfile, mode=mode('base_caller'), mains=mains )()
+
+    # Flagstats
+    flagstat_cmd = 'samtools flagstat {bamfile}'.format(**cmd_args)
+    def flagstat():
+        with open(flagstats,'wb') as fh:
+            return command( flagstat_cmd, stdout=fh, stderr=lfile, script_dir='' )()
+
+    # Graphics
+    cmd = 'graphsample {bamfile} -od {tdir}'
+    graph_cmd = cmd.format(**cmd_args)
+    graphsample = command( graph_cmd, stdout=lfile, mode=mode('graphsample'), mains=mains )
+
+    # Read Graphics
+    readspng = cmd_args['bamfile'].replace('.bam','') + '.reads.png'
+    def fqstats():
+        fastqs = ' '.join( glob.glob( os.path.join( cmd_args['trim_outdir'], '*.fastq' ) ) )
+        cmd = 'fqstats -o {0} {1}'.format(readspng,fastqs)
+        return command( cmd, stdout=lfile, mode=mode('fqstats'), mains=mains )()
+
+    # Consensus
+    cmd = 'vcf_consensus {vcf} -i {samplename} -o {consensus}'
+    consensus_cmd = cmd.format(**cmd_args)
+    vcf_consensus = command( consensus_cmd, stdout=lfile, mode=mode('vcf_consensus'), mains=mains )
+
+    def cpus( stage ):
+        ''' cpus a stage counts against --threads '''
+        # The broker limits how many cpus a stage gets instead
+        if broker is not None:
+            return 1
+        return stage_cpus[stage]
+
+    # Inputs that do not come from another stage
+    config_input = [cmd_args['config']] if cmd_args['config'] else []
+    primer_input = [primer_info[0]] if primer_info[0] else []
+    bamfile = cmd_args['bamfile']
+    bam_outputs = [bamfile, bamfile + '.bai']
+    index_outputs = [
+        cmd_args['reference'] + '.' + ext for ext in ('amb','ann','bwt','pac','sa')
+    ]
+    # Optional stage between trimming and mapping
+    prefilter = []
+    if args.kmer_filter:
+        prefilter = [
+            Stage( 'kmer_filter', granted('kmer_filter', kmer_filter), requires=['trim_reads'],
+                cpus=cpus('kmer_filter'), params=params('kmer_filter', kmer_cmd),
+                inputs=[cmd_args['reference']] + config_input,
+                outputs=[kmer_outdir, kmer_stats] ),
+        ]
+    return prefilter + [
+        Stage( 'convert_formats', granted('convert_formats', convert), critical=True,
+            params={'version': __version__, 'fasta': args.fasta},
+            inputs=[cmd_args['readsdir']], outputs=[convert_dir] ),
+        Stage( 'ngs_filter', granted('ngs_filter', ngs_filter), requires=['convert_formats'],
+            cpus=cpus('ngs_filter'), critical=True,
+            params=dict(
+                params('ngs_filter', ''),
+                args=select_keys(cmd_args, ["drop_ns", "platforms", "index_min"])
+            ),
+            inputs=config_input, outputs=[cmd_args['filtered_dir']] ),
+        Stage( 'trim_reads', granted('trim_reads', trim_reads), requires=['ngs_filter'],
+            cpus=cpus('trim_reads'),
+            params=params('trim_reads', trim_cmd), inputs=config_input + primer_input,
+            tools=['trimmomatic'],
+            outputs=[cmd_args['trim_outdir'], tpath('trim_stats')] ),
+        # Everything else is dependant on bwa finishing
+        Stage( 'run_bwa_on_samplename', granted('run_bwa_on_samplename', run_bwa),
+            requires=['kmer_filter' if args.kmer_filter else 'trim_reads'], cpus=cpus('run_bwa_on_samplename'), critical=True,
+            params=params('run_bwa_on_samplename', bwa_cmd),
+            inputs=[cmd_args['reference']] + config_input,
+            tools=['bwa', 'samtools'],
+            outputs=bam_outputs + index_outputs + [bwalog] ),
+        # Modifies the bam that run_bwa_on_samplename creates
+        Stage( 'tagreads', granted('tagreads', tagreads), requires=['run_bwa_on_samplename'],
+            params=params('tagreads', tag_cmd), outputs=bam_outputs ),
+        # These only need the tagged bam
+        Stage( 'base_caller', granted('base_caller', base_caller), requires=['tagreads'],
+            cpus=cpus('base_caller'),
+            params=params('base_caller', caller_cmd), outputs=[cmd_args['vcf']] ),
+        Stage( 'flagstat', granted('flagstat', flagstat), requires=['tagreads'],
+            params=params('flagstat', flagstat_cmd), tools=['samtools'],
+            outputs=[flagstats] ),
+        Stage( 'graphsample', granted('graphsample', graphsample), requires=['tagreads'],
+            params=params('graphsample', graph_cmd), tools=['samtools'],
+            outputs=[
+                bamfile + '.qualdepth.json', bamfile + '.qualdepth.pyramid.json',
+                bamfile + '.qualdepth.png', tpath('qualdepth')
+            ] ),
+        # Only needs the trimmed reads
+        Stage( 'fqstats', granted('fqstats', fqstats), requires=['trim_reads'],
+            params=params('fqstats', 'fqstats -o {0}'.format(readspng)),
+            outputs=[readspng] ),
+        Stage( 'vcf_consensus', granted('vcf_consensus', vcf_consensus), requires=['base_caller'],
+            params=params('vcf_consensus', consensus_cmd),
+            outputs=[cmd_args['consensus']] ),
+    ]
+
 def main():
     args,qsubargs = parse_args()
     # Qsub job?
@@ -319,8 +826,11 @@ def main():
     global logger
     # Setup analysis directory
     if os.path.isdir( args.outdir ):
-        if os.listdir( args.outdir ):
-            raise AlreadyExists( "{0} already exists and is not empty".format(args.outdir) )
+        if os.listdir( args.outdir ) and not args.resume:
+            raise AlreadyExists(
+                "{0} already exists and is not empty. Use --resume to rerun only the " \
+                "stages that need to be".format(args.outdir)
+            )
     else:
         os.makedirs(args.outdir)
 
@@ -332,6 +842,9 @@ def main():
     # Directory analysis is run in will be inside of tmpdir
     tdir = tempfile.mkdtemp('runsample', args.prefix, dir=tmpdir)
     os.environ['TMPDIR'] = tdir
+    if args.resume:
+        # Continue from the previous run's output
+        resume_into( args.outdir, tdir, args.prefix )
 
     bamfile = os.path.join( tdir, args.prefix + '.bam' )
     flagstats = os.path.join( tdir, 'flagstats.txt' )
@@ -352,7 +865,7 @@ def main():
     if args.config:
         logger.info( "--- Using custom config from {0} ---".format(args.config) )
     # Write all stdout/stderr to a logfile from the various commands
-    with open(stdlog,'wb') as lfile:
+    with open(stdlog,'ab') as lfile:
         cmd_args = {
             'samplename': args.prefix,
             'tdir': tdir,
@@ -375,134 +888,90 @@ def main():
             'primer_info' : (args.primer_file, args.primer_seed, args.palindrom_clip, args.simple_clip)
         }
 
-        # Best not to run across multiple cpu/core/threads on any of the pipeline steps
-        # as multiple samples may be running concurrently already
-
-        logger.debug( "Copying reference file {0} to {1}".format(args.reference,cmd_args['reference']) )
-        shutil.copy( args.reference, cmd_args['reference'] )
+        # Independent stages run at the same time but never use more than
+        # --threads cpus as multiple samples may be running concurrently already
+
+        if args.refstore:
+            # Index the reference once for every sample that uses it
+            logger.info( "Using indexes of {0} from {1}".format(args.reference, args.refstore) )
+            RefStore( args.refstore ).link_into( args.reference, cmd_args['reference'] )
+        # Keep a resumed run's copy if it is the same so its index stays valid
+        elif not os.path.exists( cmd_args['reference'] ) or \
+                not filecmp.cmp( args.reference, cmd_args['reference'], shallow=False ):
+            logger.debug( "Copying reference file {0} to {1}".format(args.reference,cmd_args['reference']) )
+            # Indexes of a different reference from an earlier run
+            for ext in INDEX_EXTENSIONS:
+                if os.path.lexists( cmd_args['reference'] + ext ):
+                    os.unlink( cmd_args['reference'] + ext )
+            shutil.copy( args.reference, cmd_args['reference'] )
 
-        # Return code list
-        rets = []
         logger.debug(cmd_args)
-        #Filter
-        def select_keys(d, keys):
-            return dict( ((k, v) for k, v in d.items() if k in keys))
-
-
-        #convert sffs to fastq
-        convert_dir = os.path.join(tdir,'converted')
-
-        print sh.convert_formats(cmd_args['readsdir'], convert_dir, _out=sys.stdout, _err=sys.stderr)
-        #print sh.sff_to_fastq(cmd_args['readsdir'], _out=sys.stdout, _err=sys.stderr)
-
-        if args.fasta:
-            fastas = glob.glob(os.path.join(cmd_args['readsdir'], '*.fasta'))
-            fastas_to_40s_fastqs(convert_dir, fastas)
-
+        # Stages that already ran with the same inputs are not run again
+        cache = StageCache( os.path.join( tdir, args.prefix + '.stages.json' ), tdir )
+        # Share the machine with every other runsample using the same broker
+        broker = None
+        threads = args.threads
+        if args.broker:
+            broker = ResourceBroker( args.broker, args.broker_cpus, args.broker_memory )
+            logger.info( "Using resource broker {0} with {1} cpus".format(args.broker, broker.cpus) )
+            broker.register()
+            threads = broker.cpus
+        # Timing of each stage for the summary
+        stages = []
         try:
-            if cmd_args['config']:
-                __result = sh.ngs_filter(convert_dir, config=cmd_args['config'], outdir=cmd_args['filtered_dir'])
-            else:
-                filter_args = select_keys(cmd_args, ["drop_ns", "platforms", "index_min"])
-                __result = sh.ngs_filter(convert_dir, outdir=cmd_args['filtered_dir'], **filter_args)
-            logger.debug( 'ngs_filter: %s' % __result )
-        except sh.ErrorReturnCode, e:
-                logger.error(e.stderr)
-                sys.exit(1)
-
-        #sh.rm(convert_dir, r=True)
-
-        #Trim reads
-        cmd = 'trim_reads {filtered_dir} -q {trim_qual} -o {trim_outdir} --head-crop {head_crop}'
-        if cmd_args['config']:
-            cmd += ' -c {config}'
-        primer_info = cmd_args['primer_info']
-        if primer_info[0]:
-            cmd += " --primer-file %s --primer-seed %s --palindrome-clip %s --simple-clip %s " % primer_info
-        p = run_cmd( cmd.format(**cmd_args), stdout=lfile, stderr=subprocess.STDOUT )
-        rets.append( p.wait() )
-        if rets[-1] != 0:
-            logger.critical( "{0} did not exit sucessfully".format(cmd.format(**cmd_args)) )
-
-        # Filter on index quality and Ns
-
-        # Mapping
-        with open(bwalog, 'wb') as blog:
-            cmd = 'run_bwa_on_samplename {trim_outdir} {reference} -o {bamfile}'
-            if cmd_args['config']:
-                cmd += ' -c {config}'
-            p = run_cmd( cmd.format(**cmd_args), stdout=blog, stderr=subprocess.STDOUT )
-            # Wait for the sample to map
-            rets.append( p.wait() )
-            # Everything else is dependant on bwa finishing so might as well die here
-            if rets[-1] != 0:
-                cmd = cmd.format(**cmd_args)
-                logger.critical( "{0} failed to complete sucessfully. Please check the log file {1} for more details".format(cmd,bwalog) )
-                sys.exit(1)
-
-        # Tag Reads
-        cmd = 'tagreads {bamfile} -CN {CN}'
-        if cmd_args['config']:
-            cmd += ' -c {config}'
-        p = run_cmd( cmd.format(**cmd_args), stdout=lfile, stderr=subprocess.STDOUT )
-        r = p.wait()
-        if r != 0:
-            logger.critical( "{0} did not exit sucessfully".format(cmd.format(**cmd_args)) )
-        rets.append( r )
-
-        # Variant Calling
-        cmd = 'base_caller {bamfile} {reference} {vcf} -minth {minth}'
-        if cmd_args['config']:
-            cmd += ' -c {config}'
-        p = run_cmd( cmd.format(**cmd_args), stdout=lfile, stderr=subprocess.STDOUT )
-        r = p.wait()
-        if r != 0:
-            logger.critical( "{0} did not exit sucessfully".format(cmd.format(**cmd_args)) )
-        rets.append( r )
-        if rets[-1] != 0:
-            cmd = cmd.format(**cmd_args)
-            logger.critical( '{0} failed to complete successfully'.format(cmd.format(**cmd_args)) )
-
-        # Flagstats
-        with open(flagstats,'wb') as flagstats:
-            cmd = 'samtools flagstat {bamfile}'
-            p = run_cmd( cmd.format(**cmd_args), stdout=flagstats, stderr=lfile, script_dir='' )
-            r = p.wait()
-            if r != 0:
-                logger.critical( "{0} did not exit sucessfully".format(cmd.format(**cmd_args)) )
-            rets.append( r )
-
-        # Graphics
-        cmd = 'graphsample {bamfile} -od {tdir}'
-        p = run_cmd( cmd.format(**cmd_args), stdout=lfile, stderr=subprocess.STDOUT )
-        r = p.wait()
-        if r != 0:
-            logger.critical( "{0} did not exit sucessfully".format(cmd.format(**cmd_args)) )
-        rets.append( r )
-
-        # Read Graphics
-        fastqs = ' '.join( glob.glob( os.path.join( cmd_args['trim_outdir'], '*.fastq' ) ) )
-        cmd = 'fqstats -o {0}.reads.png {1}'.format(cmd_args['bamfile'].replace('.bam',''),fastqs)
-        p = run_cmd( cmd, stdout=lfile, stderr=subprocess.STDOUT )
-        r = p.wait()
-        if r != 0:
-            logger.critical( "{0} did not exit sucessfully".format(cmd) )
-        rets.append( r )
+            results = run_stages(
+                make_stages( args, cmd_args, lfile, bwalog, flagstats, broker ),
+                threads,
+                timings=stages,
+                logger=logger,
+                cache=cache
+            )
+        finally:
+            if broker is not None:
+                broker.unregister()
+        # Return code list
+        rets = [r for r in results.values() if r is not None]
 
-        # Consensus
-        cmd = 'vcf_consensus {vcf} -i {samplename} -o {consensus}'
-        p = run_cmd( cmd.format(**cmd_args), stdout=lfile, stderr=subprocess.STDOUT )
-        r = p.wait()
-        if r != 0:
-            logger.critical( "{0} did not exit sucessfully".format(cmd.format(**cmd_args)) )
-        rets.append( r )
+        # What the sample's resources are predicted from for new samples
+        try:
+            features = predict.input_features( args.readsdir, args.reference )
+        except Exception as e:
+            logger.warning( "Could not record input features: {0}".format(e) )
+            features = None
+        # Stages the cache had so they have no timings
+        timed = set( s['name'] for s in stages )
+        cached = [n for n, r in results.items() if r == 0 and n not in timed]
+
+        # Resource usage of every stage and process
+        metricsfile = metrics.metrics_path( os.path.join( tdir, args.prefix ) )
+        logger.debug( "Writing metrics to {0}".format(metricsfile) )
+        metrics.write_metrics( metricsfile, metrics.make_metrics( args.prefix, stages ) )
+
+        # Small summary of the sample for graphs across many samples
+        summaryfile = summary.summary_path( os.path.join( tdir, args.prefix ) )
+        logger.debug( "Writing summary to {0}".format(summaryfile) )
+        summary.write_summary(
+            summaryfile,
+            summary.make_summary( args.prefix, bamfile + '.qualdepth.json', stages, features, cached )
+        )
 
-        # If sum is > 0 then one of the commands failed
-        if sum(rets) != 0:
+        # If any return code is not 0 then one of the commands failed
+        failed = any( rets )
+        if failed:
             logger.critical( "!!! There was an error running part of the pipeline !!!" )
             logger.critical( "Please check the logfile {0}".format(logfile) )
-            sys.exit( 1 )
-        logger.info( "--- Finished {0} ---".format(args.prefix) )
+            logger.critical( "Rerun with --resume to run only the stages that did not finish" )
+        else:
+            logger.info( "--- Finished {0} ---".format(args.prefix) )
+
+        if args.refstore:
+            # The store may be cleaned up long before the project is
+            try:
+                copy_links( cmd_args['reference'] )
+            except (IOError, OSError) as e:
+                logger.warning( "Could not copy the indexes of {0} out of {1}: {2}".format(
+                    cmd_args['reference'], args.refstore, e
+                ))
 
         #subprocess.call( 'git add -A', cwd=tdir, shell=True, stdout=lfile, stderr=subprocess.STDOUT )
         #subprocess.call( 'git commit -am \'runsample\'', cwd=tdir, shell=True, stdout=lfile, stderr=subprocess.STDOUT )
@@ -514,7 +983,34 @@ def main():
         else:
             file_list = [os.path.join(tdir,m) for m in os.listdir(tdir)]
             for f in file_list:
-                shutil.move( f, args.outdir )
+                move_replace( f, args.outdir )
+    if failed:
+        sys.exit( 1 )
+
+def move_replace( path, dstdir ):
+    '''
+        shutil.move path into dstdir replacing anything there with the same name
+    '''
+    dst = os.path.join( dstdir, os.path.basename( path ) )
+    if os.path.isdir( dst ) and not os.path.islink( dst ):
+        shutil.rmtree( dst )
+    elif os.path.lexists( dst ):
+        os.unlink( dst )
+    shutil.move( path, dst )
+
+def resume_into( outdir, tdir, prefix ):
+    '''
+        Move a previous run's output from outdir into the new run directory tdir
+        so stages can use what is still valid. Temporary run directories left
+        behind by earlier runs are not moved.
+    '''
+    for f in os.listdir( outdir ):
+        path = os.path.join( outdir, f )
+        if os.path.samefile( path, tdir ):
+            continue
+        if os.path.isdir( path ) and f.startswith( prefix ) and f.endswith( 'runsample' ):
+            continue
+        move_replace( path, tdir )
 
 def pbs_job(runsampleargs, pbsargs):
     '''
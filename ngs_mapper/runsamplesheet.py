@@ -0,0 +1,873 @@
+"""
+Runs :py:mod:`runsample <ngs_mapper.runsample>` on every sample/reference pair
+inside of a :doc:`../samplesheet` and then creates the graphics and consensus
+links for all of them.
+
+Samples are kept in a work queue(runsamplesheet/queue.json) that is saved every
+time a sample starts or finishes so running the same command again after it was
+stopped only runs the samples that did not finish.
+
+* Samples with the most read data are started first so a large sample is not
+  the only thing left running at the end
+* Samples that map to the same reference are run next to each other so
+  anything cached for the reference is still warm
+* Samples that fail are retried with ``runsample --resume`` so only the stages
+  that did not finish are run again
+* The number of samples finished, samples per hour and an estimate of the time
+  remaining are logged as samples finish
+
+Basic Usage
+===========
+
+    .. code-block:: bash
+
+        runsamplesheet /path/to/ReadsBySample /path/to/samplesheet.tsv
+
+Options can be passed to runsample with RUNSAMPLEOPTIONS or --runsample-options
+
+    .. code-block:: bash
+
+        runsamplesheet /path/to/ReadsBySample samplesheet.tsv --runsample-options "-minth 0.95"
+
+PBS Array Jobs
+==============
+
+``--pbs-array`` writes a single Torque PBS array job for the whole samplesheet to
+runsamplesheet/array.pbs(or ``-o``) instead of running anything. Small samples are
+packed together into the same array element until their reads add up to
+``--pack-size`` MB and each element runs its samples
+with as many at a time as it has cpus(ppn in ``--qsub_l``). Hundreds of small
+Sanger or Ion samples then only need a handful of jobs.
+
+    .. code-block:: bash
+
+        runsamplesheet /path/to/ReadsBySample samplesheet.tsv --pbs-array --qsub_l nodes=1:ppn=8 -o array.pbs
+        qsub array.pbs
+
+The samples each element runs are listed in runsamplesheet/array.tsv. Each element runs
+``runsamplesheet --array-element N`` which can also be run by hand with ``--dry-run``
+to see what it would run without running anything. Once every element has finished,
+run graphs.sh and consensuses.sh(or runsamplesheet again which skips finished samples).
+
+Predicting Resources
+====================
+
+Once at least a few samples have been run, the samples in ``--history``(Projects) are used
+to predict how long each new sample takes and how much memory it needs(See :py:mod:`ngs_mapper.predict`).
+Samples are then run longest first, ``--pbs-array`` packs samples into elements until they are
+predicted to take ``--pack-time`` minutes on ppn cpus and the array job asks for the walltime and
+memory its largest element needs. ``--predict`` prints the predictions without running anything.
+
+    .. code-block:: bash
+
+        runsamplesheet /path/to/ReadsBySample samplesheet.tsv --predict
+"""
+
+import argparse
+import os
+import shlex
+import subprocess
+import sys
+import threading
+import json
+import time
+import multiprocessing
+import pipes
+import math
+from os.path import join, isdir, isfile, exists
+
+import log
+import predict
+import timeline
+logger = log.setup_logger( 'runsamplesheet', log.get_config() )
+
+# Where every sample's project directory goes
+PROJDIR = 'Projects'
+# Where the queue and each sample's runsample output go
+QUEUEDIR = 'runsamplesheet'
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+def read_samplesheet( samplesheet ):
+    '''
+    Read the samplename reference pairs from a samplesheet skipping comments
+    and lines that are not valid
+
+    :param str samplesheet: space or tab delimited file of samplename reference
+    :return: list of (samplename, reference)
+    '''
+    samples = []
+    with open( samplesheet ) as fh:
+        for line in fh:
+            line = line.rstrip( '\r\n' )
+            if not line.strip() or line.startswith( '#' ):
+                continue
+            parts = line.split()
+            if len(parts) < 2:
+                logger.error(
+                    "{0} must have an incorrect line. Could not read reference from '{1}'".format(
+                        samplesheet, line
+                    )
+                )
+                continue
+            sample, reference = parts[:2]
+            if not isfile( reference ):
+                logger.error( "{0} is not a file that can be read. Skipping {1}".format(reference, sample) )
+                continue
+            samples.append( (sample, reference) )
+    return samples
+
+def sample_size( readsdir ):
+    '''
+    Total size in bytes of every read file in a sample's directory
+    '''
+    size = 0
+    for root, dirs, files in os.walk( readsdir ):
+        for f in files:
+            size += os.stat( join( root, f ) ).st_size
+    return size
+
+def predict_samples( samples, readsdir, model ):
+    '''
+    Set the predicted walltime(seconds) and memory(MB) of each sample
+
+    :param list samples: list of dictionaries with name and reference
+    :param str readsdir: ReadsBySample directory
+    :param predict.ResourceModel model: model to predict with
+    :return: samples
+    '''
+    for s in samples:
+        features = predict.input_features( join( readsdir, s['name'] ), s['reference'] )
+        p = model.predict( features )
+        s['walltime'] = p['walltime']
+        s['memory'] = p['memory']
+    return samples
+
+def cost_key( samples ):
+    '''
+    Predicted walltime if every sample has one, otherwise size
+    '''
+    if samples and all( s.get( 'walltime' ) is not None for s in samples ):
+        return 'walltime'
+    return 'size'
+
+def order_samples( samples ):
+    '''
+    Order samples so samples sharing a reference are together and the groups
+    with the longest samples come first with the longest samples first inside
+    of each group. How long a sample takes is its predicted walltime if every
+    sample has one and its size otherwise
+
+    :param list samples: list of dictionaries with name, reference and size
+    :return: list of samples names in the order they should run
+    '''
+    key = cost_key( samples )
+    groups = {}
+    for s in samples:
+        groups.setdefault( s['reference'], [] ).append( s )
+    for group in groups.values():
+        group.sort( key=lambda s: (-s[key], s['name']) )
+    ordered = sorted( groups.values(), key=lambda g: (-g[0][key], g[0]['reference']) )
+    return [s['name'] for group in ordered for s in group]
+
+class SampleQueue(object):
+    '''
+    Status of every sample stored in a json file that is rewritten every time
+    a sample's status changes
+    '''
+    def __init__( self, path ):
+        self.path = path
+        self.lock = threading.Lock()
+        self.samples = {}
+        self.order = []
+        if exists( path ):
+            with open( path ) as fh:
+                state = json.load( fh )
+            self.samples = state['samples']
+            self.order = state['order']
+
+    def add( self, name, reference, size, walltime=None ):
+        '''
+        Add a sample if it is not already in the queue. The predicted walltime
+        of a sample that is already in the queue is updated
+
+        :return: True if it was added
+        '''
+        if name in self.samples:
+            self.samples[name]['walltime'] = walltime
+            return False
+        self.samples[name] = {
+            'name': name, 'reference': reference, 'size': size, 'walltime': walltime,
+            'status': PENDING, 'attempts': 0, 'returncode': None,
+        }
+        return True
+
+    def reset( self, retries ):
+        '''
+        Make samples that were running when the queue stopped and samples that
+        failed with retries left pending again
+        '''
+        for s in self.samples.values():
+            if s['status'] == RUNNING or \
+                    (s['status'] == FAILED and s['attempts'] <= retries):
+                s['status'] = PENDING
+
+    def reorder( self ):
+        self.order = order_samples( self.samples.values() )
+
+    def next( self ):
+        '''
+        Mark the first pending sample as running
+
+        :return: sample dictionary or None if nothing is pending
+        '''
+        with self.lock:
+            for name in self.order:
+                s = self.samples[name]
+                if s['status'] == PENDING:
+                    s['status'] = RUNNING
+                    s['attempts'] += 1
+                    s['start'] = time.time()
+                    self._save()
+                    return dict( s )
+        return None
+
+    def finish( self, name, returncode, retries ):
+        '''
+        Record a sample finishing. A failed sample goes back to pending while
+        it has retries left
+
+        :return: new status of the sample
+        '''
+        with self.lock:
+            s = self.samples[name]
+            s['returncode'] = returncode
+            s['end'] = time.time()
+            if returncode == 0:
+                s['status'] = DONE
+            elif s['attempts'] <= retries:
+                s['status'] = PENDING
+            else:
+                s['status'] = FAILED
+            self._save()
+            return s['status']
+
+    def counts( self ):
+        '''
+        :return: dictionary of status -> number of samples
+        '''
+        counts = dict( (st, 0) for st in (PENDING, RUNNING, DONE, FAILED) )
+        for s in self.samples.values():
+            counts[s['status']] += 1
+        return counts
+
+    def save( self ):
+        with self.lock:
+            self._save()
+
+    def _save( self ):
+        tmppath = self.path + '.tmp'
+        with open( tmppath, 'w' ) as fh:
+            json.dump( {'order': self.order, 'samples': self.samples}, fh, indent=1 )
+        os.rename( tmppath, self.path )
+
+def throughput( queue, started, now=None ):
+    '''
+    Progress message for the samples that finished since started
+
+    :param SampleQueue queue: the queue
+    :param float started: time the samples started running
+    :return: str
+    '''
+    now = now or time.time()
+    counts = queue.counts()
+    finished = [
+        s for s in queue.samples.values()
+        if s['status'] in (DONE, FAILED) and s.get('end', 0) >= started
+    ]
+    elapsed = float( max( now - started, 1 ) )
+    msg = '{0}/{1} samples done, {2} failed, {3} running, {4} pending'.format(
+        counts[DONE], len(queue.samples), counts[FAILED], counts[RUNNING], counts[PENDING]
+    )
+    if finished:
+        rate = len(finished) / elapsed
+        bytesrate = sum( s['size'] for s in finished ) / elapsed
+        remaining = sum(
+            s['size'] for s in queue.samples.values() if s['status'] in (PENDING, RUNNING)
+        )
+        msg += ' -- {0:.1f} samples/hour, {1:.1f} MB/minute'.format(
+            rate * 3600, bytesrate * 60 / 1024**2
+        )
+        if bytesrate > 0:
+            msg += ', about {0:.0f} minutes left'.format( remaining / bytesrate / 60 )
+    return msg
+
+def runsample_command( readsdir, sample, options, broker=None, resume=False, projdir=PROJDIR ):
+    '''
+    :param str readsdir: ReadsBySample directory
+    :param dict sample: sample from the queue
+    :param list options: extra runsample arguments
+    :param str broker: resource broker path to pass to runsample
+    :param bool resume: continue from an earlier attempt
+    :param str projdir: directory the sample's project directory goes in
+    :return: runsample command as a list
+    '''
+    cmd = [
+        'runsample', join( readsdir, sample['name'] ), sample['reference'],
+        sample['name'], '-od', join( projdir, sample['name'] )
+    ]
+    if broker:
+        cmd += ['--broker', broker]
+    if resume:
+        cmd.append( '--resume' )
+    return cmd + list( options )
+
+def pack_samples( samples, capacity, key='size' ):
+    '''
+    Pack samples into as few groups as possible where the total of key in each
+    group is at most capacity(first fit decreasing). Samples larger than
+    capacity are in a group by themselves.
+
+    :param list samples: list of dictionaries with name, reference and size
+    :param int capacity: most bytes of reads(or seconds of walltime) in a group
+    :param str key: size or walltime
+    :return: list of lists of samples with the largest groups first
+    '''
+    groups = []
+    for s in sorted( samples, key=lambda s: (-s[key], s['reference'], s['name']) ):
+        for group in groups:
+            if sum( g[key] for g in group ) + s[key] <= capacity:
+                group.append( s )
+                break
+        else:
+            groups.append( [s] )
+    return groups
+
+def write_manifest( path, groups ):
+    '''
+    Write which samples each array element runs as tab separated
+    element, samplename, reference and size
+    '''
+    with open( path, 'w' ) as fh:
+        for i, group in enumerate( groups ):
+            for s in group:
+                fh.write( '{0}\t{1}\t{2}\t{3}\n'.format(i, s['name'], s['reference'], s['size']) )
+    return path
+
+def read_manifest( path, element ):
+    '''
+    Samples that an array element runs
+
+    :return: list of dictionaries with name, reference and size
+    '''
+    samples = []
+    with open( path ) as fh:
+        for line in fh:
+            i, name, reference, size = line.rstrip( '\n' ).split( '\t' )
+            if int( i ) == element:
+                samples.append( {'name': name, 'reference': reference, 'size': int( size )} )
+    return samples
+
+def ppn_from_resources( qsub_l ):
+    '''
+    cpus requested by a -l resource string such as nodes=1:ppn=8
+
+    :return: int
+    '''
+    for part in qsub_l.replace( ',', ':' ).split( ':' ):
+        if part.startswith( 'ppn=' ):
+            return int( part[4:] )
+    return 1
+
+def element_resources( group, ppn ):
+    '''
+    Walltime and memory an array element needs to run its samples ppn at a
+    time from their predictions
+
+    :return: (seconds, MB)
+    '''
+    walltimes = [s['walltime'] for s in group]
+    # Longest a greedy pool can take to run them
+    walltime = sum( walltimes ) / float( ppn ) + max( walltimes ) * (1 - 1.0 / ppn)
+    memories = sorted( (s.get( 'memory' ) or 0 for s in group), reverse=True )
+    return walltime, sum( memories[:ppn] )
+
+def array_resources( groups, qsub_l ):
+    '''
+    Add the walltime and memory the largest element needs to qsub_l unless it
+    already sets them
+
+    :param list groups: samples with predictions as returned by pack_samples
+    :param str qsub_l: resources requested for each element
+    :return: str
+    '''
+    ppn = ppn_from_resources( qsub_l )
+    needs = [element_resources( g, ppn ) for g in groups]
+    walltime = max( n[0] for n in needs )
+    memory = max( n[1] for n in needs )
+    resources = [qsub_l]
+    if 'walltime=' not in qsub_l:
+        resources.append( 'walltime=' + predict.format_walltime( walltime ) )
+    if memory and 'mem=' not in qsub_l:
+        resources.append( 'mem={0}mb'.format(int( math.ceil( memory ) )) )
+    return ','.join( resources )
+
+def node_broker():
+    '''
+    Resource broker path runsamplesheet uses when neither --broker nor BROKER
+    is given. It is inside of TMPDIR so it is local to each node
+    '''
+    return join( os.environ.get( 'TMPDIR', '/tmp' ), 'ngs_mapper.resources' )
+
+def element_options( args ):
+    '''
+    runsamplesheet options every array element has to be given since the
+    elements do not see the environment runsamplesheet was run from(Torque
+    only exports it with -V)
+
+    :param Namespace args: parsed arguments
+    :return: list
+    '''
+    options = ['--retries', str( args.retries )]
+    # The default broker is for each node so it is left to each element
+    if args.broker != node_broker():
+        options += ['--broker', args.broker]
+    if args.refstore:
+        options += ['--refstore', args.refstore]
+        if args.shm:
+            options.append( '--shm' )
+    return options
+
+def pbs_array_job( readsdir, samplesheet, manifest, elements, qsub_l, qsub_M=None, options='',
+        element_options=() ):
+    '''
+    Torque PBS array job that runs every element of manifest
+
+    :param str readsdir: ReadsBySample directory
+    :param str samplesheet: samplesheet the manifest was made from
+    :param str manifest: path written by write_manifest
+    :param int elements: number of elements in manifest
+    :param str qsub_l: resources for each element
+    :param str qsub_M: email address to notify
+    :param str options: extra runsample options
+    :param list element_options: extra runsamplesheet options for each element
+                                 (See element_options)
+    :return: pbs job file string
+    '''
+    template = '#!/bin/bash\n' \
+        '#PBS -N {name}-ngs_mapper\n' \
+        '#PBS -j oe\n' \
+        '#PBS -l {qsub_l}\n' \
+        '#PBS -t 0-{last}\n'
+    if qsub_M is not None:
+        template += '#PBS -m abe\n' \
+            '#PBS -M ' + qsub_M + '\n'
+    template += '\n' \
+        'cd $PBS_O_WORKDIR\n' \
+        'runsamplesheet {readsdir} {samplesheet} --array-manifest {manifest} ' \
+        '--array-element $PBS_ARRAYID -j {ppn} --no-post{element_options}{options}\n'
+    return template.format(
+        name=os.path.splitext( os.path.basename( samplesheet ) )[0],
+        qsub_l=qsub_l,
+        last=elements - 1,
+        readsdir=pipes.quote( readsdir ),
+        samplesheet=pipes.quote( samplesheet ),
+        manifest=pipes.quote( manifest ),
+        ppn=ppn_from_resources( qsub_l ),
+        element_options=''.join( ' ' + pipes.quote( o ) for o in element_options ),
+        options=' --runsample-options ' + pipes.quote( options ) if options else '',
+    )
+
+def run_sample( readsdir, sample, options, broker=None ):
+    '''
+    Run runsample for sample writing its output to runsamplesheet/samplename.log
+
+    :return: runsample's return code
+    '''
+    outdir = join( PROJDIR, sample['name'] )
+    # Anything in the project directory is from an earlier attempt
+    resume = isdir( outdir ) and bool( os.listdir( outdir ) )
+    cmd = runsample_command( readsdir, sample, options, broker, resume )
+    logger.info( "Running {0}(attempt {1})".format(' '.join(cmd), sample['attempts']) )
+    with open( join( QUEUEDIR, sample['name'] + '.log' ), 'a' ) as fh:
+        try:
+            return subprocess.call( cmd, stdout=fh, stderr=subprocess.STDOUT )
+        except OSError as e:
+            logger.critical( "Could not run runsample: {0}".format(e) )
+            return 1
+
+def run_queue( queue, readsdir, jobs, retries, options, broker=None,
+        report_interval=60, runner=run_sample ):
+    '''
+    Run every pending sample in queue with jobs samples running at a time
+
+    :param SampleQueue queue: the queue
+    :param int jobs: how many samples to run at the same time
+    :param int retries: how many times to retry a failed sample
+    :param list options: extra runsample arguments
+    :param str broker: resource broker path to pass to runsample
+    :param int report_interval: seconds between progress messages
+    :param callable runner: called with readsdir, sample, options, broker to
+                            run a sample and return its return code
+    '''
+    started = time.time()
+
+    def worker():
+        while True:
+            sample = queue.next()
+            if sample is None:
+                return
+            r = runner( readsdir, sample, options, broker )
+            status = queue.finish( sample['name'], r, retries )
+            if status == PENDING:
+                logger.warning( "{0} failed with return code {1}. Retrying".format(sample['name'], r) )
+            elif status == FAILED:
+                logger.error( "{0} failed with return code {1}. Check {2}".format(
+                    sample['name'], r, join( QUEUEDIR, sample['name'] + '.log' )
+                ))
+            else:
+                logger.info( "{0} finished".format(sample['name']) )
+            logger.info( throughput( queue, started ) )
+
+    workers = [threading.Thread( target=worker ) for i in range( max(1, jobs) )]
+    for w in workers:
+        w.daemon = True
+        w.start()
+    lastreport = time.time()
+    for w in workers:
+        while w.is_alive():
+            w.join( 1 )
+            if time.time() - lastreport >= report_interval:
+                logger.info( throughput( queue, started ) )
+                lastreport = time.time()
+
+def post_steps( norecreate=True ):
+    '''
+    Run graphs.sh and consensuses.sh at the same time since neither depends
+    on the other
+
+    :return: dictionary of step -> return code
+    '''
+    cmds = {
+        'graphs.sh': ['graphs.sh'] + (['-norecreate'] if norecreate else []),
+        'consensuses.sh': ['consensuses.sh'],
+    }
+    procs = {}
+    for name, cmd in cmds.items():
+        logger.info( "Running {0}".format(' '.join(cmd)) )
+        try:
+            procs[name] = subprocess.Popen( cmd )
+        except OSError as e:
+            logger.critical( "Could not run {0}: {1}".format(name, e) )
+    results = dict( (name, 1) for name in cmds )
+    for name, p in procs.items():
+        results[name] = p.wait()
+        if results[name] != 0:
+            logger.error( "{0} exited with {1}".format(name, results[name]) )
+    return results
+
+def runsample_options( args ):
+    '''
+    Options every runsample is given
+
+    :param Namespace args: parsed arguments
+    :return: list
+    '''
+    options = shlex.split( args.runsample_options )
+    if args.refstore:
+        # Anything in --runsample-options still wins
+        options = ['--refstore', args.refstore] + (['--shm'] if args.shm else []) + options
+    return options
+
+def parse_args( args=sys.argv[1:] ):
+    parser = argparse.ArgumentParser(
+        description='Runs runsample on every sample in a samplesheet and creates graphics ' \
+            'and consensus links for all of them'
+    )
+
+    parser.add_argument(
+        dest='readsdir',
+        help='Directory that contains a directory of reads for each sample'
+    )
+
+    parser.add_argument(
+        dest='samplesheet',
+        help='Space or tab delimited file of samplename reference one per line'
+    )
+
+    parser.add_argument(
+        '-j',
+        '--jobs',
+        dest='jobs',
+        type=int,
+        default=multiprocessing.cpu_count(),
+        help='How many samples to run at the same time[Default: %(default)s]'
+    )
+
+    parser.add_argument(
+        '--retries',
+        dest='retries',
+        type=int,
+        default=1,
+        help='How many times to retry a sample that fails[Default: %(default)s]'
+    )
+
+    parser.add_argument(
+        '--runsample-options',
+        dest='runsample_options',
+        default=os.environ.get( 'RUNSAMPLEOPTIONS', '' ),
+        help='Options to pass to every runsample. Defaults to the ' \
+            'RUNSAMPLEOPTIONS environment variable[Default: %(default)s]'
+    )
+
+    parser.add_argument(
+        '--broker',
+        dest='broker',
+        default=os.environ.get( 'BROKER', node_broker() ),
+        help='Resource broker every runsample shares. Empty to not use one[Default: %(default)s]'
+    )
+
+    parser.add_argument(
+        '--refstore',
+        dest='refstore',
+        default=os.environ.get( 'REFSTORE', '' ),
+        help='Directory every runsample shares indexed references through so each ' \
+            'reference is only indexed once. Defaults to the REFSTORE environment ' \
+            'variable. Empty to not use one[Default: %(default)s]'
+    )
+
+    parser.add_argument(
+        '--shm',
+        dest='shm',
+        action='store_true',
+        default=False,
+        help='Samples mapping against the same reference on the same machine at the ' \
+            'same time share one copy of its bwa index in shared memory. Needs --refstore'
+    )
+
+    parser.add_argument(
+        '--report-interval',
+        dest='report_interval',
+        type=int,
+        default=60,
+        help='Seconds between progress messages[Default: %(default)s]'
+    )
+
+    parser.add_argument(
+        '--no-post',
+        dest='post',
+        action='store_false',
+        default=True,
+        help='Do not run graphs.sh and consensuses.sh after all samples finish'
+    )
+
+    parser.add_argument(
+        '--trace',
+        dest='trace',
+        default=None,
+        help='Write a Chrome trace of every sample\'s stages to this file once they finish'
+    )
+
+    parser.add_argument(
+        '--pbs-array',
+        dest='pbs_array',
+        action='store_true',
+        default=False,
+        help='Write a Torque PBS array job that runs the samplesheet to --output instead of running it'
+    )
+
+    parser.add_argument(
+        '--pack-size',
+        dest='pack_size',
+        type=int,
+        default=1024,
+        help='Pack samples into the same array element until their reads add ' \
+            'up to this many MB[Default: %(default)s]'
+    )
+
+    parser.add_argument(
+        '--pack-time',
+        dest='pack_time',
+        type=int,
+        default=60,
+        help='When resources can be predicted, pack samples into the same array ' \
+            'element until they are predicted to take this many minutes[Default: %(default)s]'
+    )
+
+    parser.add_argument(
+        '--history',
+        dest='history',
+        default=PROJDIR,
+        help='Project directories of samples that already ran to predict how long ' \
+            'samples take and how much memory they need from[Default: %(default)s]'
+    )
+
+    parser.add_argument(
+        '--predict',
+        dest='predict',
+        action='store_true',
+        default=False,
+        help='Print the predicted walltime and memory of every sample instead of running them'
+    )
+
+    parser.add_argument(
+        '-o',
+        '--output',
+        dest='output',
+        default=None,
+        help='File to write the --pbs-array job or the --predict table to' \
+            '[Default: {0} for --pbs-array and the console for --predict]'.format(join( QUEUEDIR, 'array.pbs' ))
+    )
+
+    parser.add_argument(
+        '--qsub_l',
+        default='nodes=1:ppn=1',
+        help='Resources for each array element[Default: %(default)s]'
+    )
+
+    parser.add_argument(
+        '--qsub_M',
+        default=None,
+        help='Email address to notify about the array job'
+    )
+
+    parser.add_argument(
+        '--array-manifest',
+        dest='array_manifest',
+        default=join( QUEUEDIR, 'array.tsv' ),
+        help='Samples each array element runs[Default: %(default)s]'
+    )
+
+    parser.add_argument(
+        '--array-element',
+        dest='array_element',
+        type=int,
+        default=None,
+        help='Only run the samples of this array element'
+    )
+
+    parser.add_argument(
+        '--dry-run',
+        dest='dry_run',
+        action='store_true',
+        default=False,
+        help='Print the runsample commands that would be run'
+    )
+
+    args = parser.parse_args( args )
+    if args.predict and args.array_element is not None:
+        parser.error( '--predict cannot be used with --array-element' )
+    return args
+
+def main( args=sys.argv[1:] ):
+    args = parse_args( args )
+    for d in (PROJDIR, QUEUEDIR):
+        if not isdir( d ):
+            os.makedirs( d )
+
+    if args.array_element is None:
+        samples = [
+            {'name': sample, 'reference': reference, 'size': sample_size( join( args.readsdir, sample ) )}
+            for sample, reference in read_samplesheet( args.samplesheet )
+        ]
+        queuepath = join( QUEUEDIR, 'queue.json' )
+        model = predict.ResourceModel( predict.load_history( args.history ) )
+        if model.ready:
+            # Would end up in front of the --predict table
+            if not args.predict:
+                logger.info( "Predicting resources from {0} samples in {1}".format(model.samples, args.history) )
+            predict_samples( samples, args.readsdir, model )
+        elif args.predict:
+            logger.error( "{0} does not have enough samples with recorded features to predict from".format(
+                args.history
+            ))
+            return 1
+    else:
+        samples = read_manifest( args.array_manifest, args.array_element )
+        # Elements run at the same time on different nodes
+        queuepath = join( QUEUEDIR, 'array-{0}.json'.format(args.array_element) )
+        args.post = False
+
+    if args.predict:
+        # The console also gets the log lines so only the table goes to the file
+        fh = sys.stdout if args.output is None else open( args.output, 'w' )
+        fh.write( 'sample\treference\tinput_mb\twalltime\tmemory_mb\n' )
+        for s in samples:
+            fh.write( '{0}\t{1}\t{2:.1f}\t{3}\t{4}\n'.format(
+                s['name'], s['reference'], s['size'] / 1024.0**2,
+                predict.format_walltime( s['walltime'] ),
+                '' if s['memory'] is None else '{0:.0f}'.format(s['memory'])
+            ))
+        if fh is not sys.stdout:
+            fh.close()
+        return 0
+
+    if args.pbs_array:
+        qsub_l = args.qsub_l
+        if cost_key( samples ) == 'walltime':
+            ppn = ppn_from_resources( qsub_l )
+            groups = pack_samples( samples, args.pack_time * 60 * ppn, 'walltime' )
+            if groups:
+                qsub_l = array_resources( groups, qsub_l )
+        else:
+            groups = pack_samples( samples, args.pack_size * 1024**2 )
+        if not groups:
+            logger.error( "No samples in {0}".format(args.samplesheet) )
+            return 1
+        write_manifest( args.array_manifest, groups )
+        # Not printed as the log lines would end up in front of the #PBS directives
+        output = args.output or join( QUEUEDIR, 'array.pbs' )
+        with open( output, 'w' ) as fh:
+            fh.write( pbs_array_job(
+                args.readsdir, args.samplesheet, args.array_manifest, len(groups),
+                qsub_l, args.qsub_M, args.runsample_options, element_options( args )
+            ))
+        logger.info( "Packed {0} samples into {1} array elements listed in {2}. Submit them with qsub {3}".format(
+            len(samples), len(groups), args.array_manifest, output
+        ))
+        return 0
+
+    if args.dry_run:
+        for s in samples:
+            print ' '.join( runsample_command(
+                args.readsdir, s, runsample_options( args ), args.broker
+            ))
+        return 0
+
+    queue = SampleQueue( queuepath )
+    for s in samples:
+        # Ran before there was a queue
+        if s['name'] not in queue.samples and isdir( join( PROJDIR, s['name'] ) ):
+            logger.warning( "Skipping {0} because it already exists".format(s['name']) )
+            continue
+        queue.add( s['name'], s['reference'], s['size'], s.get( 'walltime' ) )
+    queue.reset( args.retries )
+    queue.reorder()
+    queue.save()
+
+    counts = queue.counts()
+    logger.info( "{0} samples to run, {1} already done".format(counts[PENDING], counts[DONE]) )
+    run_queue(
+        queue, args.readsdir, args.jobs, args.retries,
+        runsample_options( args ), args.broker,
+        args.report_interval
+    )
+    counts = queue.counts()
+    logger.info( "--- {0} samples done, {1} failed ---".format(counts[DONE], counts[FAILED]) )
+
+    if args.trace:
+        timeline.write_trace(
+            args.trace, timeline.merge_projects( [join( PROJDIR, s['name'] ) for s in samples] )
+        )
+        logger.info( "Wrote the timeline of every sample to {0}".format(args.trace) )
+
+    if args.post:
+        results = post_steps()
+        if any( results.values() ):
+            return 1
+    if counts[FAILED]:
+        return 1
+    return 0
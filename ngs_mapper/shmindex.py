@@ -0,0 +1,180 @@
+"""
+Keep the bwa index of a reference in shared memory while samples on this
+machine are mapping against it so every bwa mem attaches to one copy instead
+of each loading its own.
+
+Indexes are loaded with ``bwa shm`` from the reference store(see
+:py:mod:`ngs_mapper.refstore`). bwa finds an index in shared memory by the file
+name of its prefix only, so each index is loaded under the hash of its
+reference's contents(refstore/<sha1>/<sha1>.fasta) which means references that
+happen to have the same file name never get each other's index.
+
+Every sample that maps against a reference holds its index while it maps. The
+holders of each index are kept in a small json file in the reference store for
+each machine(refstore/shm.<hostname>.json) that is only read or written while
+holding an exclusive lock on a lock file next to it. The first holder loads the
+index and the last one to release it unloads it. Holders whose process no
+longer exists are dropped the next time the file is read so a sample that was
+killed does not keep its index loaded forever.
+
+``bwa shm`` can only unload every index at once, so the indexes that are still
+held are loaded again right after one is unloaded. bwa mem processes that are
+already running keep the copy they attached to.
+
+    .. code-block:: python
+
+        from ngs_mapper.shmindex import SharedIndex
+
+        with SharedIndex('/tmp/ngs_mapper.refs').hold('Den3.fasta') as prefix:
+            # bwa mem finds the index of prefix already in shared memory
+            subprocess.call(['bwa', 'mem', prefix, 'reads.fq'])
+"""
+
+import os
+import json
+import fcntl
+import errno
+import socket
+import subprocess
+from os.path import join, basename, dirname
+from contextlib import contextmanager
+
+from refstore import RefStore, BWA_INDEX, REFNAME
+from resources import pid_alive
+import log
+
+logger = log.setup_logger('shmindex', log.get_config())
+
+class SharedIndexError(Exception):
+    pass
+
+def shm_prefix(store, reference):
+    '''
+    Index prefix of reference in store that is named after the hash of its
+    contents. The files are symlinks to the stored reference and its index
+
+    :param RefStore store: store to index reference in
+    :param str reference: fasta file or directory of fasta files
+    :return: path to the prefix
+    '''
+    stored = store.reference(reference)
+    entry = dirname(stored)
+    prefix = join(entry, basename(entry) + '.fasta')
+    for ext in ('',) + BWA_INDEX:
+        try:
+            os.symlink(REFNAME + ext, prefix + ext)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+    return prefix
+
+class SharedIndex(object):
+    '''
+    Reference counted bwa indexes in the shared memory of this machine
+    '''
+    def __init__(self, refstore, bwa_path=None):
+        '''
+        :param str refstore: reference store directory
+        :param str bwa_path: bwa executable. Defaults to the one bwa.which_bwa finds
+        '''
+        self.store = RefStore(refstore)
+        self.path = join(refstore, 'shm.{0}.json'.format(socket.gethostname()))
+        self.lockpath = self.path + '.lock'
+        self.bwa_path = bwa_path
+
+    def _shm(self, *args):
+        ''' Run bwa shm with args and return its output '''
+        if self.bwa_path is None:
+            from bwa.bwa import which_bwa
+            self.bwa_path = which_bwa()
+        cmd = [self.bwa_path, 'shm'] + list(args)
+        logger.info('Running {0}'.format(' '.join(cmd)))
+        p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output = p.communicate()[0]
+        if p.returncode != 0:
+            raise SharedIndexError('{0} failed: {1}'.format(' '.join(cmd), output))
+        return output
+
+    def loaded(self):
+        '''
+        Names of the indexes bwa has in shared memory
+        '''
+        return [line.split('\t')[0] for line in self._shm('-l').splitlines() if line.strip()]
+
+    @contextmanager
+    def _state(self):
+        '''
+        Exclusively lock the holders of every index and yield them as a
+        dictionary of prefix -> pids that is written back when the block finishes
+        '''
+        with open(self.lockpath, 'a') as lockfh:
+            fcntl.flock(lockfh, fcntl.LOCK_EX)
+            try:
+                state = {}
+                if os.path.exists(self.path):
+                    try:
+                        with open(self.path) as fh:
+                            state = json.load(fh)
+                    except ValueError:
+                        logger.warning('Resetting unreadable shared index state {0}'.format(self.path))
+                for prefix, pids in state.items():
+                    state[prefix] = [pid for pid in pids if pid_alive(pid)]
+                yield state
+                self._sync(state)
+                tmppath = self.path + '.tmp'
+                with open(tmppath, 'w') as fh:
+                    json.dump(state, fh)
+                os.rename(tmppath, self.path)
+            finally:
+                fcntl.flock(lockfh, fcntl.LOCK_UN)
+
+    def _sync(self, state):
+        '''
+        Unload every index nobody holds anymore and make sure every held
+        index is loaded
+        '''
+        unused = [prefix for prefix, pids in state.items() if not pids]
+        for prefix in unused:
+            del state[prefix]
+        loaded = set(self.loaded())
+        if [prefix for prefix in unused if basename(prefix) in loaded]:
+            logger.info('Unloading {0}'.format(unused))
+            self._shm('-d')
+            loaded = set()
+        for prefix in sorted(state):
+            if basename(prefix) not in loaded:
+                self._shm(prefix)
+
+    def acquire(self, reference, pid=None):
+        '''
+        Hold the index of reference loading it into shared memory if nobody
+        else on this machine holds it
+
+        :param str reference: fasta file or directory of fasta files
+        :param int pid: process holding it. Defaults to this one
+        :return: index prefix to give bwa mem
+        '''
+        prefix = shm_prefix(self.store, reference)
+        with self._state() as state:
+            state.setdefault(prefix, []).append(pid or os.getpid())
+        return prefix
+
+    def release(self, prefix, pid=None):
+        '''
+        Stop holding the index of prefix unloading it if nobody else holds it
+        '''
+        pid = pid or os.getpid()
+        with self._state() as state:
+            if pid in state.get(prefix, []):
+                state[prefix].remove(pid)
+
+    @contextmanager
+    def hold(self, reference):
+        '''
+        Hold the index of reference while the block runs and yield its prefix
+        '''
+        prefix = self.acquire(reference)
+        try:
+            yield prefix
+        finally:
+            self.release(prefix)
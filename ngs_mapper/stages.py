@@ -0,0 +1,716 @@
+"""
+Declare the stages of a pipeline along with the stages each one requires and
+run them with as many independent stages running at the same time as a cpu
+budget allows.
+
+Stages are run from threads since each stage is expected to spend its time
+waiting on a subprocess(or another process) to finish.
+
+    .. code-block:: python
+
+        from ngs_mapper.stages import Stage, run_stages
+
+        stages = [
+            Stage('map', run_mapping, cpus=4),
+            Stage('call', run_caller, requires=['map']),
+            Stage('graph', run_graphs, requires=['map']),
+        ]
+        results = run_stages(stages, cpus=4)
+        # results['call'] is the returncode of run_caller
+
+A stage's run function will usually start a command and wait for it, but python
+stages can also be run without starting a new interpreter. call_main runs a
+console script's main function directly and fork_main runs it inside of a forked
+copy of the current process so nothing has to be imported or configured again,
+but the stage still cannot change the state of the process that runs the
+stages(current directory, matplotlib figures, ...)
+
+Stages that declare their outputs can be cached with a StageCache. Every stage
+gets a key that is a hash of its parameters, the contents of its input files,
+the tools it runs and the keys of the stages it requires. A stage whose key has
+not changed since it last succeeded and whose outputs have not changed since
+then is not run again.
+
+    .. code-block:: python
+
+        stages = [
+            Stage('map', run_mapping, inputs=['ref.fasta'], params='bwa mem',
+                  tools=['bwa'], outputs=['sample.bam']),
+            Stage('call', run_caller, requires=['map'], params={'minth': 0.8},
+                  outputs=['sample.vcf']),
+        ]
+        cache = StageCache('stages.json', root='.')
+        # Changing minth only runs call again
+        results = run_stages(stages, cache=cache)
+
+Processes a stage waits on with wait_process(or fork_main) have their cpu time, peak
+memory and disk io added to the stage's timings along with the cpu time of the
+thread the stage ran in.
+"""
+
+import os
+import sys
+import json
+import errno
+import resource
+import hashlib
+from distutils.spawn import find_executable
+import threading
+import Queue
+import time
+import logging
+import traceback
+from collections import OrderedDict
+from contextlib import contextmanager
+
+# Used when run_stages is not given a logger
+logger = logging.getLogger(__name__)
+
+# Only one stage can run inside of the current process at a time since stages
+# share the process' current directory, sys.argv, matplotlib state, ...
+INLINE_LOCK = threading.Lock()
+# Forks are done one at a time while holding logging's lock so the child never
+# starts with the lock held by another thread
+FORK_LOCK = threading.Lock()
+# Resource usage of the processes waited on by the stage running in each thread
+_usage = threading.local()
+# getrusage for only the calling thread(linux only)
+RUSAGE_THREAD = getattr(resource, 'RUSAGE_THREAD', 1)
+
+class StageGraphError(Exception):
+    '''
+    Raised when the declared stages cannot be run(unknown requirements,
+    duplicate names or circular requirements)
+    '''
+    pass
+
+class Stage(object):
+    '''
+    A single named step of a pipeline
+    '''
+    def __init__(self, name, run, requires=(), cpus=1, critical=False,
+            params=None, inputs=(), tools=(), outputs=()):
+        '''
+        :param str name: unique name of the stage
+        :param callable run: called without arguments to run the stage. Returns
+                             the returncode of the stage where 0 is success
+        :param list requires: names of stages that have to finish successfully
+                              before this stage can start
+        :param int cpus: how many cpus the stage uses while it runs
+        :param bool critical: if this stage fails no new stages are started
+        :param params: anything json serializable that changes what the stage
+                       creates(command line, thresholds, ...)
+        :param list inputs: files or directories the stage reads that are not
+                            created by another stage
+        :param list tools: executables the stage runs
+        :param list outputs: files or directories the stage creates or modifies.
+                             Only stages with outputs are cached
+        '''
+        self.name = name
+        self.run = run
+        self.requires = list(requires)
+        self.cpus = cpus
+        self.critical = critical
+        self.params = params
+        self.inputs = list(inputs)
+        self.tools = list(tools)
+        self.outputs = list(outputs)
+
+    def __repr__(self):
+        return 'Stage({0})'.format(self.name)
+
+def check_stage_graph(stages):
+    '''
+    Make sure stage names are unique, every requirement is a declared stage
+    and there are no circular requirements
+
+    Raises StageGraphError if any of those are not true
+
+    :return: stage names ordered so every stage comes after the stages it requires
+    '''
+    names = [s.name for s in stages]
+    dups = set([n for n in names if names.count(n) > 1])
+    if dups:
+        raise StageGraphError('Duplicate stage names {0}'.format(sorted(dups)))
+    bystage = dict((s.name, s) for s in stages)
+    for s in stages:
+        missing = [r for r in s.requires if r not in bystage]
+        if missing:
+            raise StageGraphError(
+                '{0} requires unknown stages {1}'.format(s.name, missing)
+            )
+    # Repeatedly remove stages whose requirements are all removed
+    remaining = set(names)
+    order = []
+    while remaining:
+        ready = set(
+            n for n in remaining
+            if not set(bystage[n].requires) & remaining
+        )
+        if not ready:
+            raise StageGraphError(
+                'Circular requirements between stages {0}'.format(sorted(remaining))
+            )
+        remaining -= ready
+        order += [n for n in names if n in ready]
+    return order
+
+def file_digest(path):
+    '''
+    sha1 hex digest of the contents of a file or of every file under a directory
+    along with their relative paths
+
+    :return: hex digest or None if path does not exist
+    '''
+    if not os.path.exists(path):
+        return None
+    h = hashlib.sha1()
+    if os.path.isdir(path):
+        paths = []
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            paths += [os.path.join(root, f) for f in sorted(files)]
+    else:
+        paths = [path]
+    for p in paths:
+        h.update(os.path.relpath(p, path).encode('utf-8'))
+        with open(p, 'rb') as fh:
+            for chunk in iter(lambda: fh.read(1024*1024), b''):
+                h.update(chunk)
+    return h.hexdigest()
+
+def tool_version(tool):
+    '''
+    Identify the version of an executable by the digest of the file found
+    on the PATH so upgrading a tool changes the key of stages that use it
+
+    :return: hex digest or None if the tool cannot be found
+    '''
+    path = find_executable(tool)
+    if path is None:
+        return None
+    return file_digest(os.path.realpath(path))
+
+def path_fingerprint(path):
+    '''
+    Cheap fingerprint of a file or directory made of sizes and modification
+    times that is used to tell if a stage's outputs were changed after it ran
+
+    :return: list or None if path does not exist
+    '''
+    if not os.path.exists(path):
+        return None
+    if not os.path.isdir(path):
+        st = os.stat(path)
+        return [st.st_size, st.st_mtime]
+    fingerprint = []
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for f in sorted(files):
+            p = os.path.join(root, f)
+            fingerprint.append([os.path.relpath(p, path)] + path_fingerprint(p))
+    return fingerprint
+
+def stage_keys(stages):
+    '''
+    Build the cache key of every stage
+
+    :param list stages: list of Stage
+    :return: dictionary of stage name -> hex digest
+    '''
+    bystage = dict((s.name, s) for s in stages)
+    keys = {}
+    for name in check_stage_graph(stages):
+        stage = bystage[name]
+        key = {
+            'name': name,
+            'params': stage.params,
+            'inputs': [file_digest(p) for p in stage.inputs],
+            'tools': [tool_version(t) for t in stage.tools],
+            'requires': [keys[r] for r in stage.requires],
+        }
+        keys[name] = hashlib.sha1(json.dumps(key, sort_keys=True)).hexdigest()
+    return keys
+
+class StageCache(object):
+    '''
+    Keys and output fingerprints of stages that have succeeded stored in a
+    json file. Output paths are stored relative to root so the whole directory
+    can be moved.
+    '''
+    def __init__(self, path, root):
+        '''
+        :param str path: json file the cache is stored in
+        :param str root: directory stage outputs are relative to
+        '''
+        self.path = path
+        self.root = root
+        self.entries = {}
+        if os.path.exists(path):
+            try:
+                with open(path) as fh:
+                    self.entries = json.load(fh)
+            except ValueError:
+                logger.warning('Ignoring unreadable stage cache {0}'.format(path))
+
+    def fingerprints(self, stage):
+        return dict(
+            (os.path.relpath(p, self.root), path_fingerprint(p))
+            for p in stage.outputs
+        )
+
+    def is_fresh(self, stage, key):
+        '''
+        If stage succeeded before with the same key and its outputs all still
+        exist unchanged
+        '''
+        entry = self.entries.get(stage.name)
+        if not stage.outputs or entry is None or entry['key'] != key:
+            return False
+        outputs = self.fingerprints(stage)
+        if None in outputs.values():
+            return False
+        # json turns the fingerprint tuples into lists
+        return json.loads(json.dumps(outputs)) == entry['outputs']
+
+    def record(self, stage, key):
+        if stage.outputs:
+            self.entries[stage.name] = {
+                'key': key,
+                'outputs': self.fingerprints(stage),
+            }
+
+    def forget(self, name):
+        self.entries.pop(name, None)
+
+    def save(self):
+        '''
+        Write the cache to a temporary file and rename it into place so a run
+        that is killed never leaves a partial cache file
+        '''
+        tmppath = self.path + '.tmp'
+        with open(tmppath, 'w') as fh:
+            json.dump(self.entries, fh, indent=1, sort_keys=True)
+        os.rename(tmppath, self.path)
+
+def cached_stages(stages, keys, cache):
+    '''
+    Names of stages that do not need to run because cache has them as fresh.
+    A stage still has to run if any stage it requires runs and a stage has to
+    run if any stage that comes after it runs and modifies the same outputs
+    (run_bwa_on_samplename creates the bam that tagreads then modifies)
+
+    :return: set of stage names
+    '''
+    order = check_stage_graph(stages)
+    bystage = dict((s.name, s) for s in stages)
+    fresh = set(n for n in order if cache.is_fresh(bystage[n], keys[n]))
+
+    def ancestors(name):
+        found = set()
+        todo = list(bystage[name].requires)
+        while todo:
+            r = todo.pop()
+            if r not in found:
+                found.add(r)
+                todo += bystage[r].requires
+        return found
+
+    changed = True
+    while changed:
+        changed = False
+        for name in order:
+            if name in fresh and any(r not in fresh for r in bystage[name].requires):
+                fresh.discard(name)
+                changed = True
+        for name in order:
+            if name in fresh:
+                continue
+            outputs = set(bystage[name].outputs)
+            for a in ancestors(name) & fresh:
+                if outputs & set(bystage[a].outputs):
+                    fresh.discard(a)
+                    changed = True
+    return fresh
+
+def call_main(main, argv):
+    '''
+    Run a console script main function with argv the same way the
+    console script would have been run and return what its exit code
+    would have been
+
+    :param callable main: main function that accepts a list of arguments
+    :param list argv: arguments without the script name
+    :return: int exit code
+    '''
+    try:
+        r = main(argv)
+    except SystemExit as e:
+        if e.code is None:
+            return 0
+        if isinstance(e.code, int):
+            return e.code
+        sys.stderr.write('{0}\n'.format(e.code))
+        return 1
+    except Exception:
+        traceback.print_exc()
+        return 1
+    # Some mains return values such as the output path
+    if isinstance(r, int) and not isinstance(r, bool):
+        return r
+    return 0
+
+def console_handlers():
+    '''
+    Every logging.StreamHandler that is not a FileHandler of the root logger
+    and of every other logger
+    '''
+    loggers = [logging.getLogger()] + [
+        l for l in logging.Logger.manager.loggerDict.values()
+        if isinstance(l, logging.Logger)
+    ]
+    handlers = []
+    for l in loggers:
+        for h in l.handlers:
+            if isinstance(h, logging.StreamHandler) and \
+                    not isinstance(h, logging.FileHandler) and h not in handlers:
+                handlers.append(h)
+    return handlers
+
+@contextmanager
+def redirect_output(stdout=None, stderr=None):
+    '''
+    Point sys.stdout, sys.stderr and the log handlers that write to them at
+    stdout and stderr until the block finishes. None leaves that one alone
+
+    Only output written through python goes to them. Processes started inside
+    of the block still inherit this process' file descriptors
+    '''
+    streams = []
+    for new, name in ((stdout, 'stdout'), (stderr, 'stderr')):
+        if new is not None:
+            streams.append((name, getattr(sys, name), getattr(sys, '__' + name + '__'), new))
+    handlers = []
+    for h in console_handlers():
+        for name, current, original, new in streams:
+            if h.stream is current or h.stream is original:
+                handlers.append((h, h.stream))
+                h.stream = new
+                break
+    for name, current, original, new in streams:
+        setattr(sys, name, new)
+    try:
+        yield
+    finally:
+        for name, current, original, new in streams:
+            new.flush()
+            setattr(sys, name, current)
+        for h, stream in handlers:
+            h.stream = stream
+
+def inline_main(main, argv, stdout=None, stderr=None):
+    '''
+    call_main inside of this process making sure only one inline stage
+    runs at a time
+
+    :param file stdout: file that sys.stdout and the console log handlers
+                        write to while main runs
+    :param file stderr: file that sys.stderr writes to while main runs. Same
+                        as stdout if not given
+    '''
+    if stderr is None:
+        stderr = stdout
+    with INLINE_LOCK:
+        with redirect_output(stdout, stderr):
+            return call_main(main, argv)
+
+def thread_rusage():
+    '''
+    Resource usage of the current thread or None where that is not available
+    '''
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        return resource.getrusage(RUSAGE_THREAD)
+    except (ValueError, resource.error):
+        return None
+
+def start_usage():
+    '''
+    Start counting the resource usage of this thread and of the processes it
+    waits on
+    '''
+    _usage.processes = []
+    _usage.thread = thread_rusage()
+
+def process_usage(rusage, command=None, wall=None, pid=None):
+    '''
+    Dictionary of the parts of a resource.struct_rusage that are recorded
+
+    :param str command: what the process ran
+    :param float wall: seconds the process ran for
+    :param int pid: process id
+    :return: dictionary with command, pid, wall, end, user and sys cpu seconds,
+             maxrss in MB and read_bytes and write_bytes of disk io
+    '''
+    return {
+        'command': command,
+        'pid': pid,
+        'end': time.time(),
+        'wall': wall,
+        'user': rusage.ru_utime,
+        'sys': rusage.ru_stime,
+        # ru_maxrss is in KB on linux
+        'maxrss': rusage.ru_maxrss / 1024.0,
+        # Blocks are always 512 bytes
+        'read_bytes': rusage.ru_inblock * 512,
+        'write_bytes': rusage.ru_oublock * 512,
+    }
+
+def add_usage(rusage, command=None, wall=None, pid=None):
+    '''
+    Add the resource usage of a process that finished to this thread's usage
+    '''
+    if getattr(_usage, 'processes', None) is None:
+        return
+    _usage.processes.append(process_usage(rusage, command, wall, pid))
+
+def thread_usage():
+    '''
+    Resource usage counted since start_usage
+
+    :return: dictionary with user, sys and cpu seconds, read_bytes and write_bytes
+             summed over this thread and every process it waited on, the largest
+             maxrss in MB of those processes and processes which is the
+             process_usage of each process. Empty if nothing was counted
+    '''
+    processes = list(getattr(_usage, 'processes', None) or [])
+    before = getattr(_usage, 'thread', None)
+    after = thread_rusage()
+    counted = list(processes)
+    if before is not None and after is not None:
+        # Work done inside of this thread such as inline stages. Its maxrss
+        # would be the whole process' so it is left out
+        inthread = process_usage(after)
+        inthread.update(
+            user=after.ru_utime - before.ru_utime,
+            sys=after.ru_stime - before.ru_stime,
+            read_bytes=(after.ru_inblock - before.ru_inblock) * 512,
+            write_bytes=(after.ru_oublock - before.ru_oublock) * 512,
+        )
+        counted.append(inthread)
+    if not counted:
+        return {}
+    usage = {'processes': processes}
+    for key in ('user', 'sys', 'read_bytes', 'write_bytes'):
+        usage[key] = sum(p[key] for p in counted)
+    usage['cpu'] = usage['user'] + usage['sys']
+    if processes:
+        usage['maxrss'] = max(p['maxrss'] for p in processes)
+    return usage
+
+def wait_process(pid, command=None, start=None):
+    '''
+    Wait for a child process and count its resource usage
+
+    :param str command: what the process runs
+    :param float start: time the process started
+    :return: the wait status
+    '''
+    while True:
+        try:
+            _, status, rusage = os.wait4(pid, 0)
+            break
+        except OSError as e:
+            if e.errno != errno.EINTR:
+                raise
+    wall = None
+    if start is not None:
+        wall = time.time() - start
+    add_usage(rusage, command, wall, pid)
+    return status
+
+def exit_code(status):
+    '''
+    Exit code for a wait status. Negative signal number if it was killed
+    '''
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+def wait_popen(p, command=None, start=None):
+    '''
+    subprocess.Popen.wait that counts the process' resource usage
+    '''
+    p.returncode = exit_code(wait_process(p.pid, command, start))
+    return p.returncode
+
+def fork_main(main, argv, stdout=None, stderr=None):
+    '''
+    call_main inside of a forked child process and wait for it
+
+    :param callable main: main function that accepts a list of arguments
+    :param list argv: arguments without the script name
+    :param file stdout: file the child's stdout is written to
+    :param file stderr: file the child's stderr is written to. Same as stdout
+                        if not given
+    :return: exit code of the child. Negative signal number if it was killed
+    '''
+    if stderr is None:
+        stderr = stdout
+    # Anything still buffered would be written by both processes
+    sys.stdout.flush()
+    sys.stderr.flush()
+    start = time.time()
+    with FORK_LOCK:
+        logging._acquireLock()
+        try:
+            pid = os.fork()
+        finally:
+            logging._releaseLock()
+    if pid == 0:
+        code = 1
+        try:
+            if stdout is not None:
+                os.dup2(stdout.fileno(), 1)
+            if stderr is not None:
+                os.dup2(stderr.fileno(), 2)
+            # sys.stdout may have been replaced by something that is not
+            # writing to file descriptor 1
+            sys.stdout = sys.__stdout__
+            sys.stderr = sys.__stderr__
+            code = call_main(main, argv)
+            sys.stdout.flush()
+            sys.stderr.flush()
+        finally:
+            os._exit(code)
+    command = ' '.join([getattr(main, '__module__', None) or str(main)] + list(argv))
+    return exit_code(wait_process(pid, command, start))
+
+def _run_stage(stage, done, logger):
+    '''
+    Run a single stage and put (stage, returncode, usage) into done
+    Any exception the stage raises is logged and counted as a returncode of 1
+    '''
+    start_usage()
+    try:
+        returncode = stage.run()
+    except Exception as e:
+        logger.exception('{0} raised {1}'.format(stage.name, e))
+        returncode = 1
+    except SystemExit as e:
+        returncode = e.code if isinstance(e.code, int) else 1
+    done.put((stage, returncode, thread_usage()))
+
+def run_stages(stages, cpus=1, timings=None, logger=logger, cache=None):
+    '''
+    Run stages concurrently as soon as all of the stages they require have
+    succeeded, never running more stages at once than fit inside of cpus.
+    A stage that needs more cpus than the budget will still run, but only when
+    nothing else is running.
+
+    Stages whose requirements failed are skipped as are all stages that have
+    not started once a critical stage fails.
+
+    :param list stages: list of Stage
+    :param int cpus: cpu budget
+    :param list timings: if given, a dictionary with name, start, end, duration
+                         and returncode is appended for every stage that ran.
+                         The resource usage from thread_usage is included
+    :param logging.Logger logger: where to log stages starting and finishing
+    :param StageCache cache: if given, stages that are fresh in the cache are
+                             not run and count as succeeded. The cache is
+                             updated and saved once all stages are done
+    :return: OrderedDict of stage name -> returncode in the same order as stages.
+             Skipped stages have a returncode of None
+    '''
+    check_stage_graph(stages)
+    cpus = max(1, cpus)
+    results = OrderedDict((s.name, None) for s in stages)
+    finished = set()
+    pending = list(stages)
+    if cache is not None:
+        keys = stage_keys(stages)
+        fresh = cached_stages(stages, keys, cache)
+        for stage in stages:
+            if stage.name in fresh:
+                logger.info('Using cached results for stage {0}'.format(stage.name))
+                pending.remove(stage)
+                finished.add(stage.name)
+                results[stage.name] = 0
+    running = {}
+    used = 0
+    abort = False
+    done = Queue.Queue()
+
+    while pending or running:
+        # Start or skip anything that can be
+        for stage in list(pending):
+            failed = [
+                r for r in stage.requires
+                if r in finished and results[r] != 0
+            ]
+            if abort or failed:
+                pending.remove(stage)
+                finished.add(stage.name)
+                if failed:
+                    logger.warning(
+                        'Skipping {0} because {1} did not succeed'.format(stage.name, failed)
+                    )
+                else:
+                    logger.warning('Skipping {0}'.format(stage.name))
+                continue
+            if not all(r in finished for r in stage.requires):
+                continue
+            need = min(stage.cpus, cpus)
+            if running and used + need > cpus:
+                continue
+            pending.remove(stage)
+            used += need
+            logger.info('Starting stage {0}'.format(stage.name))
+            t = threading.Thread(target=_run_stage, args=(stage, done, logger))
+            t.daemon = True
+            running[stage.name] = (t, need, time.time())
+            t.start()
+
+        if not running:
+            # Everything left was skipped
+            continue
+
+        # A timeout keeps the wait interruptable with ctrl-c
+        stage, returncode, usage = done.get(True, 31536000)
+        t, need, start = running.pop(stage.name)
+        t.join()
+        end = time.time()
+        used -= need
+        finished.add(stage.name)
+        results[stage.name] = returncode
+        logger.info('Finished stage {0} in {1:.1f} seconds with returncode {2}'.format(
+            stage.name, end - start, returncode
+        ))
+        if timings is not None:
+            timing = {
+                'name': stage.name,
+                'start': start,
+                'end': end,
+                'duration': end - start,
+                'returncode': returncode,
+                'pid': os.getpid(),
+                'tid': t.ident,
+            }
+            timing.update(usage)
+            timings.append(timing)
+        if returncode != 0 and stage.critical:
+            logger.critical('Critical stage {0} failed'.format(stage.name))
+            abort = True
+
+    if cache is not None:
+        # Fingerprint outputs only now as later stages may modify them
+        for stage in stages:
+            if results[stage.name] == 0:
+                cache.record(stage, keys[stage.name])
+            else:
+                cache.forget(stage.name)
+        cache.save()
+
+    return results
@@ -0,0 +1,148 @@
+"""
+Small per-sample summary that runsample writes next to the rest of a sample's
+output as samplename.summary.json
+
+It holds only the numbers that are needed to compare samples against each other
+so scripts that graph many samples(graph_mapunmap, graph_times) do not have to load
+every sample's qualdepth.json or scan every sample's log file.
+
+    .. code-block:: javascript
+
+        {
+            "samplename": "00005-01",
+            "reads": 1100,
+            "mapped_reads": 1000,
+            "unmapped_reads": 100,
+            "breadth": 0.98,
+            "references": {
+                "Den3": {"length": 10000, "mapped_reads": 1000, "breadth": 0.98}
+            },
+            "start": 1418398800.0,
+            "end": 1418399100.0,
+            "duration": 300.0,
+            "stages": [
+                {"name": "trim_reads", "start": 1418398800.0, "end": 1418398860.0,
+                 "duration": 60.0, "returncode": 0, "cpu": 110.5, "maxrss": 250.0},
+                ...
+            ],
+            "features": {
+                "input_bytes": {"MiSeq": 52428800},
+                "reads": 1100,
+                "reference_length": 10000
+            }
+        }
+
+features are what :py:mod:`ngs_mapper.predict` uses to predict how long new
+samples take. A run that was resumed also lists the stages that did not have to
+run again as cached since they have no timings.
+"""
+
+import json
+from os.path import join, basename, normpath, exists
+
+def summary_path(outprefix):
+    '''
+    Path of the summary file for a sample output prefix(outdir/samplename)
+    '''
+    return outprefix + '.summary.json'
+
+def project_summary_path(projectpath):
+    '''
+    Path of the summary file inside of a runsample project directory
+    '''
+    projectpath = normpath(projectpath)
+    return summary_path(join(projectpath, basename(projectpath)))
+
+def breadth(depths, mindepth=1):
+    '''
+    Number of positions in depths that have at least mindepth depth
+
+    :param list depths: depth at each reference position
+    :param int mindepth: minimum depth to consider covered
+    :return: int
+    '''
+    return sum(1 for d in depths if d >= mindepth)
+
+def qualdepth_summary(qualdepth):
+    '''
+    Summarize a qualdepth dictionary as created by graphsample.make_json
+
+    :param dict qualdepth: loaded qualdepth.json
+    :return: dictionary with reads, mapped_reads, unmapped_reads, breadth and
+             references keys
+    '''
+    references = {}
+    covered = 0
+    total = 0
+    for ref, stats in qualdepth.items():
+        if ref == 'unmapped_reads':
+            continue
+        length = int(stats.get('reflen', stats['length']))
+        refcovered = breadth(stats['depths'])
+        references[ref] = {
+            'length': length,
+            'mapped_reads': int(stats.get('mapped_reads', 0)),
+            'breadth': float(refcovered) / length if length else 0.0,
+        }
+        covered += refcovered
+        total += length
+    mapped = sum(r['mapped_reads'] for r in references.values())
+    unmapped = int(qualdepth.get('unmapped_reads', 0))
+    return {
+        'reads': mapped + unmapped,
+        'mapped_reads': mapped,
+        'unmapped_reads': unmapped,
+        'breadth': float(covered) / total if total else 0.0,
+        'references': references,
+    }
+
+def make_summary(samplename, qualdepthfile, stages, features=None, cached=None):
+    '''
+    Build the summary for a sample
+
+    :param str samplename: name of the sample
+    :param str qualdepthfile: path to sample's qualdepth.json or None if it
+                              was not created
+    :param list stages: stage timings as recorded by stages.run_stages
+    :param dict features: input features as returned by predict.input_features.
+                          The reads counted in qualdepthfile are added to them
+    :param list cached: names of the stages that did not run because their
+                        results were cached
+    :return: summary dictionary
+    '''
+    summary = {'samplename': samplename}
+    if qualdepthfile is not None and exists(qualdepthfile):
+        with open(qualdepthfile) as fh:
+            summary.update(qualdepth_summary(json.load(fh)))
+    # Each process' usage is only kept in the metrics file
+    summary['stages'] = [
+        dict((k, v) for k, v in s.items() if k != 'processes') for s in stages
+    ]
+    if stages:
+        summary['start'] = min(s['start'] for s in stages)
+        summary['end'] = max(s['end'] for s in stages)
+        summary['duration'] = summary['end'] - summary['start']
+    if cached:
+        summary['cached'] = sorted(cached)
+    if features is not None:
+        summary['features'] = dict(features)
+        if 'reads' in summary:
+            summary['features']['reads'] = summary['reads']
+    return summary
+
+def write_summary(path, summary):
+    '''
+    Write summary dictionary to path
+    '''
+    with open(path, 'w') as fh:
+        json.dump(summary, fh, indent=1)
+    return path
+
+def load_summary(path):
+    '''
+    Load a summary file
+
+    :return: summary dictionary
+    '''
+    with open(path) as fh:
+        return json.load(fh)
@@ -4,13 +4,17 @@ import samtools
 import re
 import shutil
 import os.path
-from ngs_mapper.bam import sortbam, indexbam
+from subprocess import Popen, PIPE, CalledProcessError
+from ngs_mapper.bam import indexbam
+from data import PlatformClassifier
 
 import log
 logger = log.setup_logger('tagreads',log.get_config())
 
 # Exception for when headers exist
 class HeaderExists(Exception): pass
+# Exception for read names that do not belong to any platform
+class UnknownReadNameFormat(Exception): pass
 
 # The next 3 tuples have to be the same length and each index in each is related the same index in each tuple
 # AKA zip( IDS, PLATFORMS, ID_MAP ) should work as expected
@@ -25,6 +29,8 @@ ID_MAP = (
     re.compile( 'M[0-9]{5}:\d+:[\w\d-]+:\d:\d{4}:\d{4,5}:\d{4,5}' ),
     re.compile( '.*' )
 )
+# Classifies read names into IDS
+ID_CLASSIFIER = PlatformClassifier( zip( ID_MAP, IDS ) )
 # Read Group Template
 RG_TEMPLATE = {
     'SM': None,
@@ -33,8 +39,8 @@ RG_TEMPLATE = {
     'CN': None
 }
 
-def main():
-    args = parse_args()
+def main( args=sys.argv[1:] ):
+    args = parse_args( args )
     for bam in args.bamfiles:
         tag_bam( bam, args.SM, args.CN )
 
@@ -82,47 +88,73 @@ def tag_readgroup( read ):
     #logger.debug( "Tagging {0} with Read group {0}".format(read.qname,rg) )
     return tag_read( read, ['RG:Z:'+rg] )
 
+def tag_line( line ):
+    '''
+        Tags a single sam alignment line with the read group its qname belongs to
+        the same way tag_readgroup tags a samtools.SamRow without parsing the
+        whole line
+
+        @param line - sam alignment line without the newline
+
+        @returns the tagged line
+    '''
+    fields = line.split( '\t' )
+    if int( fields[1] ) >= 2048:
+        # Skip supplementary
+        return line
+    tag = 'RG:Z:' + get_rg_for_qname( fields[0] )
+    # Optional fields start at the 12th column
+    if tag in fields[11:]:
+        return line
+    return line + '\t' + tag
+
 def tag_reads( bam, hdr ):
     '''
         Sets header of bam and tags all reads appropriately for each platform
         Overwrites existing header
+
+        The reads are streamed from bam, tagged and compressed straight into a new
+        bam that replaces bam. Tagging does not change the order of the reads so the
+        bam stays sorted
         
         @param bam - Bam file to tag reads in
         @param hdr - Header string to set in the bam(needs newline at the end)
     '''
     # Open the existing bam to fetch the reads to modify from
     untagged_bam = samtools.view( bam )
-    # Open a file to write the sam output to with the tagged reads
-    samf = bam.replace('.bam','.sam')
-    with open( samf, 'w' ) as sam:
-        # Write the hdr to the file first
-        sam.write( hdr )
+    tagged = bam + '.tagged'
+    cmd = ['samtools','view','-Sb','-o',tagged,'-']
+    p = Popen( cmd, stdin=PIPE )
+    try:
+        # Write the hdr first
+        p.stdin.write( hdr )
         # Tag the reads
         logger.info( "Tagging reads for {0}".format(bam) )
         for read in untagged_bam:
-            samrow = samtools.SamRow(read)
-            read = tag_readgroup( samrow )
-            sam.write( str(read) + '\n' )
-    # Close stdout
-    untagged_bam.close()
+            p.stdin.write( tag_line( read.rstrip( '\n' ) ) + '\n' )
+    finally:
+        p.stdin.close()
+        p.wait()
+        # Close stdout
+        untagged_bam.close()
+    if p.returncode != 0:
+        if os.path.exists( tagged ):
+            os.unlink( tagged )
+        raise CalledProcessError( p.returncode, ' '.join( cmd ) )
+    os.rename( tagged, bam )
     logger.info( "Finished tagging reads for {0}".format(bam) )
-    logger.info( "Sorting {0}".format(bam) )
-    b = samtools.view( samf, h=True, S=True, b=True )
-    sortbam( b, bam )
-    # Close the fh
-    b.close()
-    # Remove temp sam file
-    # maybe some day could even just use pipes all the way through :)
-    os.unlink( samf )
     logger.info( "Indexing {0}".format(bam) )
     indexbam( bam )
 
 def get_rg_for_read( aread ):
     ''' Gets the read group name for the given samtools.SamRow '''
-    rname = aread.QNAME
-    for i, p in enumerate( ID_MAP ):
-        if p.match( rname ):
-            return IDS[i]
+    return get_rg_for_qname( aread.QNAME )
+
+def get_rg_for_qname( rname ):
+    ''' Gets the read group name for the given read name '''
+    rg = ID_CLASSIFIER.classify( rname )
+    if rg is not None:
+        return rg
     raise UnknownReadNameFormat( "{0} is from an unknown platform and cannot be tagged".format(rname) )
 
 def get_rg_headers( bam, SM=None, CN=None ):
@@ -20,6 +20,11 @@ class TestUnitMergeBam(Base):
         res = self._C( files, 'merged.bam' )
         eq_( [call(self.samtools_cmd+files)], popen_mock.call_args_list )
 
+    def test_level(self, popen_mock):
+        files = ['in1', 'in2']
+        self._C( files, 'merged.bam', level=0 )
+        eq_( [call(['samtools','merge','-l','0','merged.bam']+files)], popen_mock.call_args_list )
+
     def test_input_files_lt_2(self, popen_mock):
         files = ['in1.bam']
         try:
@@ -48,6 +53,18 @@ class TestUnitIndexBam(Base):
         eq_( [call(self.samtools_cmd+['sorted.bam'])], popen_mock.call_args_list )
         eq_( 'sorted.bam.bai', res )
 
+class TestUnitSortCmd(Base):
+    functionname = 'sort_cmd'
+
+    def test_defaults(self):
+        eq_( ['samtools','sort','-f','-','out.bam'], self._C( 'out.bam' ) )
+
+    def test_threads_memory(self):
+        eq_( ['samtools','sort','-f','-@','4','-m','1G','-','out.bam'], self._C( 'out.bam', 4, '1G' ) )
+
+    def test_level(self):
+        eq_( ['samtools','sort','-f','-l','0','-','out.bam'], self._C( 'out.bam', level=0 ) )
+
 @patch('ngs_mapper.bam.subprocess.Popen')
 @patch('__builtin__.open')
 class TestUnitSortBam(Base):
@@ -71,6 +88,11 @@ class TestUnitSortBam(Base):
         eq_( [call(self.samtools_cmd+['file'],stdin=input)], popen_mock.call_args_list )
         eq_( res, 'file' )
 
+    def test_threads_memory(self, open_mock, popen_mock):
+        input = Mock(spec=file)
+        self._C( input, 'file', threads=2, memory='500M' )
+        eq_( [call(['samtools','sort','-f','-@','2','-m','500M','-','file'],stdin=input)], popen_mock.call_args_list )
+
     def test_output_other_fails(self, open_mock, popen_mock):
         from subprocess import PIPE
         try:
@@ -121,6 +143,12 @@ class TestUnitSamToBam(Base):
         eq_( [call(self.samtools_cmd,stdin=PIPE,stdout=PIPE)], popen_mock.call_args_list )
         eq_( PIPE, res )
 
+    def test_uncompressed(self, open_mock, popen_mock):
+        from subprocess import PIPE
+        popen_mock.return_value.stdout = PIPE
+        self._C( PIPE, PIPE, level=0 )
+        eq_( [call(['samtools','view','-Sbu','-'],stdin=PIPE,stdout=PIPE)], popen_mock.call_args_list )
+
 class TestIntegrate(Base):
     samfile = join(THIS,'fixtures','bam','samfile.sam.gz')
     unsortedbam = join(THIS,'fixtures','bam','unsorted.bam.gz')
@@ -169,3 +169,78 @@ class TestLines2dFromRegion(Base):
             eq_([0,0], line.get_ydata())
             eq_(1, line.get_linewidth())
             eq_(regiontype, line.get_color())
+
+class TestBuildPyramid(Base):
+    functionname = 'build_pyramid'
+
+    def test_levels_get_coarser(self):
+        r = self._C([10]*1000, [30]*1000, maxbins=1000, minbins=10, factor=4)
+        eq_([1, 4, 16, 64, 256], [l['binsize'] for l in r])
+        eq_([1000, 250, 63, 16, 4], [len(l['maxd']) for l in r])
+
+    def test_skips_levels_with_too_many_bins(self):
+        r = self._C([10]*1000, [30]*1000, maxbins=100, minbins=10, factor=4)
+        eq_([16, 64, 256], [l['binsize'] for l in r])
+
+    def test_keeps_single_position_dropout(self):
+        depths = [100]*5000
+        depths[2501] = 0
+        r = self._C(depths, [30]*5000, maxbins=100, minbins=10)
+        for level in r:
+            eq_(0, min(level['mind']))
+            eq_(100, max(level['maxd']))
+
+    def test_min_mean_max(self):
+        r = self._C([1,2,3,4,5], [10,20,30,40,50], maxbins=100, minbins=2, factor=2)
+        level = r[1]
+        eq_(2, level['binsize'])
+        eq_([1,3,5], level['mind'])
+        eq_([2,4,5], level['maxd'])
+        eq_([1.5,3.5,5], level['meand'])
+        eq_([15,35,50], level['meanq'])
+
+    def test_gap_quality_is_zero(self):
+        r = self._C([0,1], [float('nan'),40], maxbins=100, minbins=1, factor=2)
+        eq_([0,40], r[0]['minq'])
+        eq_([20], r[1]['meanq'])
+
+    def test_empty(self):
+        eq_([], self._C([], []))
+
+class TestSelectPyramidLevel(Base):
+    functionname = 'select_pyramid_level'
+
+    def setUp(self):
+        from ngs_mapper.bqd import build_pyramid
+        self.levels = build_pyramid([1]*10000, [1]*10000, maxbins=20000, minbins=10)
+
+    def test_picks_finest_level_that_fits(self):
+        r = self._C(self.levels, 2000)
+        eq_(16, r['binsize'])
+
+    def test_picks_raw_if_fits(self):
+        r = self._C(self.levels, 10000)
+        eq_(1, r['binsize'])
+
+    def test_picks_coarsest_if_none_fit(self):
+        r = self._C(self.levels, 1)
+        eq_(self.levels[-1], r)
+
+    def test_no_levels(self):
+        eq_(None, self._C([], 100))
+
+class TestQualdepthPyramid(Base):
+    functionname = 'qualdepth_pyramid'
+
+    def test_mirrors_qualdepth(self):
+        qualdepth = {
+            'unmapped_reads': 5,
+            'Ref1': self._make_qualdepth(),
+        }
+        r = self._C(qualdepth)
+        eq_(5, r['unmapped_reads'])
+        eq_(25, r['Ref1']['length'])
+        eq_(100, r['Ref1']['maxd'])
+        eq_(1000, r['Ref1']['mapped_reads'])
+        ok_('depths' not in r['Ref1'])
+        ok_(len(r['Ref1']['levels']) > 0)
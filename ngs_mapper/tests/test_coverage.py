@@ -4,6 +4,8 @@ import tempdir
 
 from imports import *
 from test_bqd import Base as Base_
+from ngs_mapper.bqd import G, N, CoverageRegion, REGIONTYPES
+from ngs_mapper import coverage
 
 class Base(Base_):
     modulepath = 'ngs_mapper.coverage'
@@ -80,44 +82,6 @@ class TestGetAllRefs(Base):
         ok_(isinstance(r,set),'Did not return set')
         eq_(set(['Ref1','Ref2']),r)
 
-class TestGetPerreferenceFromProjects(Base):
-    functionname = 'get_perreference_from_projects'
-
-    def setUp(self):
-        super(TestGetPerreferenceFromProjects,self).setUp()
-        from ngs_mapper.bqd import REGIONTYPES
-
-        self.allrefs = ['Ref1','Ref2','Ref3']
-        self.refax = {}
-        for ref in self.allrefs:
-            self.refax[ref] = Mock()
-        self.lineargs = self._make_lineargs(REGIONTYPES)
-        self.qualdepth = {}
-        for ref in self.allrefs:
-            self.qualdepth[ref] = {
-                'depths':[0*5,10*5,10*5],
-                'avgquals':[0*5,40*5,0*5],
-                'length': 15,
-                'minq': 0,
-                'maxq': 40,
-                'mind': 0,
-                'maxd': 10,
-            }
-
-    @raises(ValueError)
-    @patch('ngs_mapper.coverage.glob',Mock(return_value=[]))
-    def test_missing_qualdepth(self):
-        self._C([''], [], [], 0, 0, 0, {})
-
-    @patch('ngs_mapper.coverage.load_project_qualdepth')
-    def test_returns_dict(self, mock_lpqd):
-        mock_lpqd.return_value = self.qualdepth
-        projects = ['1','2','3']
-        r = self._C(projects, self.allrefs,
-             self.refax, 0, 0, 0, self.lineargs
-        )
-        ok_(isinstance(r,dict),'Did not return dictionary')
-
 class TestSetFigureSize(Base):
     functionname = 'set_figure_size'
 
@@ -152,61 +116,11 @@ class TestSetFigureSize(Base):
         cl = fig.set_size_inches.call_args_list
         eq_([call(20.0,2)], cl)
 
-class PlotBase(Base):
-    def setUp(self):
-        super(PlotBase,self).setUp()
-        self.samplenames = ['1','2']
-        self.line2ds = [
-            self._mock_line2d([0,0],[i,i])
-            for i in range(len(self.samplenames))
-        ] + [self._mock_line2d([0,0],[0,0])]
-        self.perreference = {
-            'Ref1': [self.line2ds],
-            'Ref2': [self.line2ds],
-        }
-        self.refax = {}
-        for ref in self.perreference:
-            self.refax[ref] = Mock()
-        self.projects = [p for p in self.samplenames]
-
-    def _mock_line2d(self, xdata, ydata):
-        class Line2D(object):
-            _ydata = []
-            _xdata = []
-            def set_ydata(self,y):
-                self._ydata = y
-            def get_ydata(self,x):
-                self._xdata = x
-            def get_ydata(self):
-                return self._ydata
-            def get_xdata(self):
-                return self._xdata
-        line = Line2D()
-        line._ydata = ydata
-        line._xdata = xdata
-        return line
-
-class TestPlotReference(PlotBase):
-    functionname = 'plot_reference'
-
-    def test_adds_lines(self):
-        ax = Mock()
-        r = self._C('Ref1', self.perreference['Ref1'], self.samplenames, ax)
-        eq_( [''] + self.samplenames, r )
-        eq_(len(self.line2ds), ax.add_line.call_count)
-
-class TestPlotAllReferences(PlotBase):
-    functionname = 'plot_all_references'
-
-    def test_plots_all_references(self):
-        self._C(self.projects, self.perreference, self.refax)
-
 class TestCreateLegend(Base):
     functionname = 'create_legend'
 
     @patch('ngs_mapper.coverage.Line2D')
     def test_correct_legend(self, mock_line2d):
-        from ngs_mapper.bqd import REGIONTYPES
         fig = Mock()
         lineargs = self._make_lineargs(REGIONTYPES)
         mock_line2d.side_effect = range(len(REGIONTYPES))
@@ -215,21 +129,6 @@ class TestCreateLegend(Base):
         
         eq_( [0,1,2,3,4], fig.legend.call_args_list[0][0][0] )
 
-class TestCreateFigureForProjects(Base):
-    functionname = 'create_figure_for_projects'
-
-    @patch('ngs_mapper.coverage.plt')
-    @patch('ngs_mapper.coverage.get_allrefs')
-    @patch('ngs_mapper.coverage.get_perreference_from_projects')
-    @patch('ngs_mapper.coverage.set_figure_size')
-    @patch('ngs_mapper.coverage.plot_all_references')
-    @patch('ngs_mapper.coverage.create_legend')
-    @patch('ngs_mapper.coverage.gridspec')
-    def test_returns_figure(self,*args):
-        from ngs_mapper.bqd import REGIONTYPES
-        r = self._C([''], [], [], self._make_lineargs(REGIONTYPES), [0,25,10])
-        eq_( args[-1].figure(), r )
-
 class TestMain(Base):
     functionname = 'main'
     
@@ -246,6 +145,8 @@ class TestMain(Base):
         args.exclude = []
         args.include = []
         args.output = 'output.png'
+        args.page_size = 0
+        args.threads = 1
 
         with tempdir.TempDir() as t:
             projdir = join(t,'sample')
@@ -258,12 +159,175 @@ class TestMain(Base):
             with open(qdepthfile,'w') as fh:
                 json.dump(qd, fh)
             self._C()
+            ok_(exists(join(projdir,'sample.bam.qualdepth.regions.json')))
+
+class TestParseArgs(Base):
+    functionname = 'parse_args'
+
+    @patch('sys.argv', ['sample_coverage', 'p1', 'p2'])
+    def test_single_image_by_default(self):
+        r = self._C()
+        eq_(0, r.page_size)
+        eq_(1, len(coverage.paginate(r.projects, r.page_size)))
+
+class TestProjectRegions(Base):
+    functionname = 'project_regions'
+
+    @patch('ngs_mapper.coverage.load_project_qualdepth')
+    def test_regions_for_each_reference(self, mock_lpqd):
+        mock_lpqd.return_value = {
+            'unmapped_reads': 0,
+            'Ref1': self._make_qualdepth(),
+            'Ref2': self._make_qualdepth(length=100),
+        }
+        r = self._C('', 0, 25, 10)
+        eq_(set(['Ref1','Ref2']), set(r.keys()))
+        eq_(25, r['Ref1']['length'])
+        eq_(5, len(r['Ref1']['regions']))
+        eq_(G, r['Ref2']['regions'][-1].type)
+
+class TestCachedProjectRegions(Base):
+    functionname = 'cached_project_regions'
+
+    def setUp(self):
+        super(TestCachedProjectRegions,self).setUp()
+        self.tdir = tempfile.mkdtemp()
+        self.qdepthfile = join(self.tdir, 'sample.bam.qualdepth.json')
+        self._write_qualdepth(self._make_qualdepth())
+        self.cachefile = join(self.tdir, 'sample.bam.qualdepth.regions.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.tdir)
+
+    def _write_qualdepth(self, qualdepth):
+        with open(self.qdepthfile, 'w') as fh:
+            json.dump({'unmapped_reads':0, 'Ref1':qualdepth}, fh)
+
+    def test_creates_cache(self):
+        r = self._C(self.tdir, 0, 25, 10)
+        ok_(exists(self.cachefile))
+        eq_(5, len(r['Ref1']['regions']))
+
+    def _wrap_load(self):
+        return patch(
+            'ngs_mapper.coverage.load_project_qualdepth',
+            wraps=coverage.load_project_qualdepth
+        )
+
+    def test_uses_cache(self):
+        with self._wrap_load() as mock_lpqd:
+            e = self._C(self.tdir, 0, 25, 10)
+            r = self._C(self.tdir, 0, 25, 10)
+        eq_(1, mock_lpqd.call_count)
+        eq_(e, r)
+        ok_(isinstance(r['Ref1']['regions'][0], CoverageRegion))
+
+    def test_new_thresholds_are_added_to_cache(self):
+        with self._wrap_load() as mock_lpqd:
+            self._C(self.tdir, 0, 25, 10)
+            self._C(self.tdir, 0, 30, 10)
+            self._C(self.tdir, 0, 25, 10)
+        eq_(2, mock_lpqd.call_count)
+        eq_(2, len(json.load(open(self.cachefile))['regions']))
+
+    def test_changed_qualdepth_invalidates_cache(self):
+        self._C(self.tdir, 0, 25, 10)
+        self._write_qualdepth(self._make_qualdepth(length=100))
+        st = os.stat(self.qdepthfile)
+        os.utime(self.qdepthfile, (st.st_atime, st.st_mtime + 10))
+        r = self._C(self.tdir, 0, 25, 10)
+        eq_(100, r['Ref1']['length'])
+
+    def test_unwritable_cache_is_not_fatal(self):
+        with patch('ngs_mapper.coverage.os.rename', Mock(side_effect=OSError)):
+            r = self._C(self.tdir, 0, 25, 10)
+        eq_(25, r['Ref1']['length'])
+        eq_([], glob(join(self.tdir, '*.tmp')) + glob(self.cachefile))
+
+class TestLoadProjectsRegions(Base):
+    functionname = 'load_projects_regions'
+
+    @patch('ngs_mapper.coverage.cached_project_regions')
+    def test_keeps_project_order(self, mock_cpr):
+        mock_cpr.side_effect = lambda p, g, lq, lc: {p: g}
+        r = self._C(['a/p2', 'a/p1'], [0,25,10])
+        eq_([('p2', {'a/p2':0}), ('p1', {'a/p1':0})], r)
+        mock_cpr.assert_any_call('a/p1', 0, 25, 10)
+
+class TestGetPerreferenceRegions(Base):
+    functionname = 'get_perreference_regions'
+
+    def test_groups_by_reference_in_project_order(self):
+        region = [CoverageRegion(1,2,G)]
+        projectregions = [
+            ('s1', {'Ref1': {'length': 1, 'regions': region}}),
+            ('s2', {'Ref1': {'length': 2, 'regions': region},
+                    'Ref2': {'length': 3, 'regions': region}}),
+        ]
+        r = self._C(projectregions, ['Ref1','Ref2'])
+        eq_([('s1',1,region),('s2',2,region)], r['Ref1'])
+        eq_([('s2',3,region)], r['Ref2'])
+
+    def test_skips_excluded_references(self):
+        projectregions = [('s1', {'Ref1': {'length': 1, 'regions': []}})]
+        r = self._C(projectregions, [])
+        eq_({}, r)
+
+class TestLinecollectionFromSamples(Base):
+    functionname = 'linecollection_from_samples'
+
+    def test_one_segment_per_region(self):
+        lineargs = {
+            G: {'color':'red','linewidth':5},
+            N: {'color':'green','linewidth':5},
+        }
+        samples = [
+            ('s1', 10, [CoverageRegion(1,5,G), CoverageRegion(5,11,N)]),
+            ('s2', 10, [CoverageRegion(1,11,N)]),
+        ]
+        r = self._C(samples, lineargs)
+        segments = [s.tolist() for s in r.get_segments()]
+        eq_([[[1,1],[5,1]], [[5,1],[11,1]], [[1,2],[11,2]]], segments)
+        colors = [tuple(c) for c in r.get_colors()]
+        eq_([(1.0,0.0,0.0,1.0), (0.0,0.5019607843137255,0.0,1.0), (0.0,0.5019607843137255,0.0,1.0)], colors)
+
+class TestPaginate(Base):
+    functionname = 'paginate'
+
+    def test_splits_into_pages(self):
+        eq_([[1,2],[3,4],[5]], self._C([1,2,3,4,5], 2))
+
+    def test_zero_is_single_page(self):
+        eq_([[1,2,3]], self._C([1,2,3], 0))
+
+class TestPageOutput(Base):
+    functionname = 'page_output'
+
+    def test_single_page_unchanged(self):
+        eq_('Coverage.png', self._C('Coverage.png', 1, 1))
+
+    def test_numbers_pages(self):
+        eq_('out/Coverage.2.png', self._C('out/Coverage.png', 2, 3))
+
+class TestCreateFiguresForProjects(Base):
+    functionname = 'create_figures_for_projects'
+
+    @patch('ngs_mapper.coverage.cached_project_regions')
+    @patch('ngs_mapper.coverage.plt')
+    @patch('ngs_mapper.coverage.gridspec')
+    def test_one_figure_per_page(self, mock_gridspec, mock_plt, mock_regions):
+        mock_regions.return_value = {
+            'Ref1': {'length': 10, 'regions': [CoverageRegion(1,11,N)]}
+        }
+        mock_plt.figure.side_effect = lambda: Mock()
+        lineargs = dict((r, {'color':'black','linewidth':1}) for r in REGIONTYPES)
+        r = list(self._C(['p1','p2','p3'], [], [], lineargs, [0,25,10], 2))
+        eq_(2, len(r))
+        eq_(3, mock_regions.call_count)
 
 import unittest
 import mock
 
-from .. import coverage
-
 @mock.patch.object(coverage, 'gridspec')
 class TestGetGridSpec(unittest.TestCase):
     def test_only_1_reference(test, mock_gridspec):
@@ -426,3 +426,30 @@ class TestFilterReadsByPlatform(unittest.TestCase):
         self.mock_filehandle.side_effect = IOError('is directory')
         r = data.filter_reads_by_platform(self.path, 'Foo')
         self.assertEqual([], r)
+
+class TestPlatformClassifier(unittest.TestCase):
+    def test_first_matching_pattern_wins(self):
+        c = data.PlatformClassifier(data.READ_ID_MAPPING)
+        for plat, readid in READ_IDS.items():
+            self.assertEqual(plat, c.classify(readid))
+        self.assertEqual(None, c.classify('!@#$%^&*'))
+
+    def test_accepts_compiled_patterns(self):
+        c = data.PlatformClassifier([(re.compile('[A-Z]+:[0-9]+'), 'A'), ('.*', 'B')])
+        self.assertEqual('A', c.classify('AB:1'))
+        self.assertEqual('B', c.classify('ab:1'))
+
+    def test_caches_by_name_with_digits_zeroed(self):
+        c = data.PlatformClassifier(data.READ_ID_MAPPING)
+        c.classify('M02261:4:000000000-A6FWH:1:2106:7558:24138')
+        c.classify('M02261:4:000000000-A6FWH:1:1101:1234:56789')
+        self.assertEqual(1, len(c.cache))
+        with mock.patch.object(c, 'regex') as regex:
+            self.assertEqual('MiSeq', c.classify('M02261:4:000000000-A6FWH:1:2107:1111:22222'))
+            self.assertFalse(regex.match.called)
+
+    def test_cache_is_bounded(self):
+        c = data.PlatformClassifier(data.READ_ID_MAPPING, maxcache=2)
+        for readid in ('AAAA', 'BBBB', 'CCCC'):
+            c.classify(readid)
+        self.assertEqual({'CCCC': 'Sanger'}, c.cache)
@@ -3,6 +3,7 @@ from imports import *
 from subprocess import CalledProcessError, STDOUT
 from ngs_mapper.compat import check_output
 import numpy as np
+import json
 
 class Base(common.BaseBamRef):
     modulepath = 'ngs_mapper.graph_mapunmap'
@@ -82,6 +83,36 @@ class TestUnitGetMapUnmap(Base):
         eq_( [100, 200], res[1] )
         eq_( [10, 20], res[2] )
 
+class TestUnitMapunmapFromJson(BaseTester):
+    modulepath = 'ngs_mapper.graph_mapunmap'
+    functionname = 'mapunmap_from_json'
+
+    def setUp( self ):
+        self.tdir = tempfile.mkdtemp()
+        self.qdfile = join( self.tdir, 's1.bam.qualdepth.json' )
+        with open( self.qdfile, 'w' ) as fh:
+            json.dump( {'unmapped_reads': 1, 'Ref1': {'mapped_reads': 2}}, fh )
+
+    def tearDown( self ):
+        shutil.rmtree( self.tdir )
+
+    def test_reads_qualdepth_without_summary( self ):
+        eq_( (2, 1), self._C( self.qdfile ) )
+
+    def test_prefers_summary( self ):
+        summaryfile = join( self.tdir, 's1.summary.json' )
+        with open( summaryfile, 'w' ) as fh:
+            json.dump( {'mapped_reads': 20, 'unmapped_reads': 10}, fh )
+        eq_( (20, 10), self._C( self.qdfile ) )
+        eq_( (20, 10), self._C( summaryfile ) )
+
+    def test_summary_without_reads_uses_qualdepth( self ):
+        summaryfile = join( self.tdir, 's1.summary.json' )
+        with open( summaryfile, 'w' ) as fh:
+            json.dump( {'stages': {}}, fh )
+        eq_( (2, 1), self._C( self.qdfile ) )
+        eq_( (2, 1), self._C( summaryfile ) )
+
 class TestFunctional(Base):
     # Should make files with these extensions
     outfiles = ( '.mapunmap.png' )
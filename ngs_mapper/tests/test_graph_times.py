@@ -2,3 +2,56 @@ from imports import *
 
 class Base(BaseTester):
     modulepath = 'ngs_mapper.graph_times'
+
+class TestDurationForProject(Base):
+    functionname = 'duration_for_project'
+
+    def setUp(self):
+        self.tdir = tempfile.mkdtemp()
+        self.project = join(self.tdir, 's1')
+        os.mkdir(self.project)
+        with open(join(self.project, 's1.log'), 'w') as fh:
+            fh.write('2014-03-18 14:51:41,000 -- INFO -- runsample --- Starting s1 ---\n')
+            fh.write('2014-03-18 14:59:26,000 -- INFO -- runsample --- Finished s1 ---\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.tdir)
+
+    def test_uses_log_without_summary(self):
+        eq_(465, self._C(self.project))
+
+    def test_prefers_summary(self):
+        import json
+        with open(join(self.project, 's1.summary.json'), 'w') as fh:
+            json.dump({'duration': 100.5}, fh)
+        eq_(100, self._C(self.project))
+
+class TestPlotStages(Base):
+    functionname = 'plot_stages'
+
+    def setUp(self):
+        self.tdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tdir)
+
+    def test_creates_image(self):
+        from ngs_mapper import metrics
+        projects = []
+        for name in ('s1', 's2'):
+            p = join(self.tdir, name)
+            os.mkdir(p)
+            stages = [
+                {'name': 'trim', 'duration': 5.0, 'cpu': 4.0, 'maxrss': 10.0,
+                 'read_bytes': 1024, 'write_bytes': 2048},
+                {'name': 'bwa', 'duration': 20.0},
+            ]
+            metrics.write_metrics(metrics.project_metrics_path(p), metrics.make_metrics(name, stages))
+            projects.append(p)
+        outfile = join(self.tdir, 'stages.png')
+        eq_(outfile, self._C(projects, outfile))
+        ok_(os.stat(outfile).st_size > 0)
+
+    def test_no_stages(self):
+        eq_(None, self._C([self.tdir], join(self.tdir, 'stages.png')))
+        ok_(not exists(join(self.tdir, 'stages.png')))
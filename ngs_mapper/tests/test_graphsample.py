@@ -154,35 +154,109 @@ try:
 except ImportError:
     import unittest
 
+import numpy as np
+
 from .. import graphsample
 
-@attr('current')
-class TestRunMontage(unittest.TestCase):
+class TestMontageImages(unittest.TestCase):
+    def setUp(self):
+        import tempfile, shutil
+        import matplotlib.image as mpimg
+        self.tdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tdir)
+        self.images = []
+        for i, (h, w) in enumerate([(10,20), (6,20), (10,8)]):
+            img = join(self.tdir, 'img{0}.png'.format(i))
+            mpimg.imsave(img, np.zeros((h,w,4)) + [0,0,0,1])
+            self.images.append(img)
+        self.outfile = join(self.tdir, 'out.png')
+
+    def _read(self, path):
+        import matplotlib.image as mpimg
+        return mpimg.imread(path)
+
+    def test_tiles_into_square_grid(self):
+        r = graphsample.montage_images(self.images, self.outfile)
+        self.assertEqual(self.outfile, r)
+        # 2x2 grid of 12x22 tiles
+        self.assertEqual((24, 44), self._read(r).shape[:2])
+
+    def test_columns_and_border(self):
+        r = graphsample.montage_images(self.images, self.outfile, border=0, columns=3)
+        im = self._read(r)
+        self.assertEqual((10, 60), im.shape[:2])
+        # Shorter image is centered in its tile with white padding
+        self.assertEqual(1.0, im[1,25,0])
+        self.assertEqual(0.0, im[2,25,0])
+
+    def test_no_images(self):
+        r = graphsample.montage_images([], self.outfile)
+        self.assertEqual(self.outfile, r)
+        self.assertFalse(os.path.exists(self.outfile))
+
+class TestGraphProjects(unittest.TestCase):
     def setUp(self):
-        self.subprocess_patch = mock.patch.object(graphsample, 'subprocess')
-        self.m_subprocess = self.subprocess_patch.start()
-        self.addCleanup(self.subprocess_patch.stop)
-
-    def test_runs_montage_on_images(self):
-        infile = '/path/foo.png'
-        outfile = '/path/bar.png'
-        kwargs = {'foo':'bar', 'baz':1}
-        r = graphsample.run_montage(infile, outfile, **kwargs)
-        ca = self.m_subprocess.check_call.call_args
-        args = ca[0][0]
-        self.assertEqual('montage', args[0])
-        self.assertIn('-foo', args)
-        self.assertIn('bar', args)
-        self.assertIn('-baz', args)
-        self.assertIn('1', args)
-        self.assertIn(infile, args)
-        self.assertEqual([infile,outfile], args[-2:])
-        self.assertEqual(outfile, r)
-
-    def test_does_not_raise_exception_on_invalid_file(self):
-        self.m_subprocess.CalledProcessError = ValueError
-        self.m_subprocess.check_call.side_effect = ValueError
-        infile = '/path/foo.png'
-        outfile = '/path/bar.png'
-        kwargs = {'foo':'bar', 'baz':1}
-        r = graphsample.run_montage(infile, outfile, **kwargs)
+        patches = ('make_json', 'reference_jobs', 'render_reference', 'montage_images')
+        self.mocks = {}
+        for name in patches:
+            p = mock.patch.object(graphsample, name)
+            self.mocks[name] = p.start()
+            self.addCleanup(p.stop)
+        self.mocks['make_json'].side_effect = lambda b, p: p + '.qualdepth.json'
+        self.mocks['reference_jobs'].side_effect = lambda j, p: [
+            (j, p + '.r1.png', 'r1', 't', None),
+            (j, p + '.r2.png', 'r2', 't', None),
+        ]
+        self.mocks['montage_images'].side_effect = lambda imgs, out: out
+
+    def test_renders_all_references_and_montages_each_project(self):
+        r = graphsample.graph_projects(['Projects/s1', 'Projects/s2/'])
+        self.assertEqual(
+            ['Projects/s1/s1.bam.qualdepth.png', 'Projects/s2/s2.bam.qualdepth.png'], r
+        )
+        self.assertEqual(4, self.mocks['render_reference'].call_count)
+        self.mocks['montage_images'].assert_any_call(
+            ['Projects/s1/s1.bam.r1.png', 'Projects/s1/s1.bam.r2.png'],
+            'Projects/s1/s1.bam.qualdepth.png'
+        )
+        self.assertEqual(2, self.mocks['make_json'].call_count)
+
+    def test_broken_project_does_not_stop_others(self):
+        def make_json(bam, prefix):
+            if 's2' in bam:
+                raise IOError('missing bam')
+            return prefix + '.qualdepth.json'
+        def reference_jobs(jfile, prefix):
+            if 's3' in jfile:
+                raise ValueError('No JSON object could be decoded')
+            return [(jfile, prefix + '.r1.png', 'r1', 't', None)]
+        self.mocks['make_json'].side_effect = make_json
+        self.mocks['reference_jobs'].side_effect = reference_jobs
+        self.mocks['render_reference'].side_effect = \
+            lambda job: None if 's4' in job[0] else job[1]
+        r = graphsample.graph_projects(['Projects/s1', 'Projects/s2', 'Projects/s3', 'Projects/s4'])
+        self.assertEqual(['Projects/s1/s1.bam.qualdepth.png', None, None, None], r)
+        self.mocks['montage_images'].assert_called_once_with(
+            ['Projects/s1/s1.bam.r1.png'], 'Projects/s1/s1.bam.qualdepth.png'
+        )
+
+    def test_main_projects_fails_if_any_project_fails(self):
+        with mock.patch.object(graphsample, 'parse_projects_args'):
+            with mock.patch.object(graphsample, 'graph_projects') as graph_projects:
+                graph_projects.return_value = ['s1.png', None]
+                self.assertEqual(1, graphsample.main_projects())
+                graph_projects.return_value = ['s1.png', 's2.png']
+                self.assertEqual(None, graphsample.main_projects())
+
+    def test_norecreate_uses_existing_qualdepth(self):
+        graphsample.graph_projects(['Projects/s1'], recreate=False)
+        self.assertFalse(self.mocks['make_json'].called)
+        self.mocks['reference_jobs'].assert_called_once_with(
+            'Projects/s1/s1.bam.qualdepth.json', 'Projects/s1/s1.bam'
+        )
+
+class TestRenderReference(unittest.TestCase):
+    @mock.patch.object(graphsample.qd, 'make_graphic')
+    def test_failure_returns_none(self, make_graphic):
+        make_graphic.side_effect = KeyError('r1')
+        self.assertEqual(None, graphsample.render_reference(('j', 'o.png', 'r1', 't', None)))
@@ -0,0 +1,189 @@
+from imports import *
+
+import multiprocessing
+import time
+from ngs_mapper import jobqueue
+from ngs_mapper.jobqueue import JobQueue, PENDING, CLAIMED, DONE, FAILED
+
+def _record_runner(queue, name, job, broker):
+    ''' Module level so worker processes can use it '''
+    with open(join(queue.path, 'logs', name + '.' + str(os.getpid())), 'w') as fh:
+        fh.write(name)
+    return 0
+
+def _worker(path):
+    jobqueue.run_worker(JobQueue(path), heartbeat=1, runner=_record_runner)
+
+class Base(BaseTester):
+    modulepath = 'ngs_mapper.jobqueue'
+
+    def setUp(self):
+        self.tdir = tempfile.mkdtemp()
+        self.queue = JobQueue(join(self.tdir, 'queue'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tdir)
+
+    def _submit(self, *names):
+        for name in names:
+            self.queue.submit({'name': name})
+
+class TestJobQueue(Base):
+    def test_submit_once(self):
+        self._submit('a')
+        ok_(not self.queue.submit({'name': 'a'}))
+        eq_(['a'], self.queue.jobs(PENDING))
+
+    def test_claims_in_order(self):
+        self._submit('000001-b', '000000-a')
+        name, job = self.queue.claim()
+        eq_('000000-a', name)
+        eq_(1, job['attempts'])
+        eq_(jobqueue.worker_id(), job['worker'])
+        eq_(['000000-a'], self.queue.jobs(CLAIMED))
+
+    def test_claim_empty(self):
+        eq_(None, self.queue.claim())
+
+    def test_claim_lost_race(self):
+        self._submit('a')
+        with patch.object(self.queue, 'move', return_value=False):
+            eq_(None, self.queue.claim())
+
+    def test_claim_accepted(self):
+        self.queue.submit({'name': '000000-s1', 'sample': 's1'})
+        self.queue.submit({'name': 's1.host.1-0000', 'kind': 'shard'})
+        name, job = self.queue.claim(jobqueue.is_shard)
+        eq_('s1.host.1-0000', name)
+        eq_(None, self.queue.claim(jobqueue.is_shard))
+        eq_(['000000-s1'], self.queue.jobs(PENDING))
+
+    def test_finish_states(self):
+        self._submit('a', 'b')
+        name, job = self.queue.claim()
+        eq_(DONE, self.queue.finish(name, job, 0, 1))
+        name, job = self.queue.claim()
+        eq_(PENDING, self.queue.finish(name, job, 1, 1))
+        name, job = self.queue.claim()
+        eq_(FAILED, self.queue.finish(name, job, 1, 1))
+        eq_({PENDING: 0, CLAIMED: 0, DONE: 1, FAILED: 1}, self.queue.counts())
+
+    def test_requeues_stale_claims(self):
+        self._submit('a', 'b')
+        self.queue.claim()
+        name, job = self.queue.claim()
+        old = self.queue.now() - 600
+        os.utime(self.queue.jobpath(CLAIMED, name), (old, old))
+        eq_([name], self.queue.requeue_stale(300))
+        eq_([name], self.queue.jobs(PENDING))
+
+    def test_stale_claims_fail_after_retries(self):
+        self._submit('a')
+        for attempt, state in ((1, PENDING), (2, FAILED)):
+            name, job = self.queue.claim()
+            eq_(attempt, job['attempts'])
+            old = self.queue.now() - 600
+            os.utime(self.queue.jobpath(CLAIMED, name), (old, old))
+            self.queue.requeue_stale(300, 1)
+            eq_([name], self.queue.jobs(state))
+
+    def test_fresh_claim_is_not_stale(self):
+        self._submit('a')
+        old = time.time() - 600
+        os.utime(self.queue.jobpath(PENDING, 'a'), (old, old))
+        self.queue.claim()
+        eq_([], self.queue.requeue_stale(300))
+
+    def test_finish_after_requeue(self):
+        self._submit('a')
+        name, job = self.queue.claim()
+        self.queue.move(name, CLAIMED, PENDING)
+        eq_(None, self.queue.finish(name, job, 0, 1))
+        eq_(['a'], self.queue.jobs(PENDING))
+
+class TestSubmitSamplesheet(Base):
+    functionname = 'submit_samplesheet'
+
+    def setUp(self):
+        super(TestSubmitSamplesheet, self).setUp()
+        self.projdir = join(self.tdir, 'Projects')
+        self.ref = join(self.tdir, 'ref.fasta')
+        open(self.ref, 'w').close()
+
+    def _samplesheet(self, samples):
+        for name, size in samples:
+            if not isdir(join(self.tdir, 'reads', name)):
+                os.makedirs(join(self.tdir, 'reads', name))
+            with open(join(self.tdir, 'reads', name, 'r.fastq'), 'w') as fh:
+                fh.write('A' * size)
+        sheet = join(self.tdir, 'samplesheet.tsv')
+        with open(sheet, 'w') as fh:
+            for name, size in samples:
+                fh.write('{0} {1}\n'.format(name, self.ref))
+        return sheet
+
+    def test_ordered_largest_first(self):
+        sheet = self._samplesheet((('small', 1), ('big', 10)))
+        eq_(2, self._C(self.queue, join(self.tdir, 'reads'), sheet, ['-minth', '0.9'], self.projdir))
+        eq_(['000000-big', '000001-small'], self.queue.jobs(PENDING))
+        job = self.queue.read(PENDING, '000000-big')
+        eq_('big', job['sample'])
+        eq_(['-minth', '0.9'], job['options'])
+        eq_(0, self._C(self.queue, join(self.tdir, 'reads'), sheet, [], self.projdir))
+
+    def test_resubmit_with_new_samples(self):
+        sheet = self._samplesheet((('small', 1), ('big', 10)))
+        self._C(self.queue, join(self.tdir, 'reads'), sheet, [], self.projdir)
+        name, job = self.queue.claim()
+        self.queue.finish(name, job, 0, 1)
+        # huge sorts first and shifts the order of the others
+        sheet = self._samplesheet((('small', 1), ('big', 10), ('huge', 100)))
+        eq_(1, self._C(self.queue, join(self.tdir, 'reads'), sheet, [], self.projdir))
+        eq_(['000000-huge', '000001-small'], self.queue.jobs(PENDING))
+
+    def test_skips_existing_projects(self):
+        sheet = self._samplesheet((('small', 1), ('big', 10)))
+        os.makedirs(join(self.projdir, 'big'))
+        eq_(1, self._C(self.queue, join(self.tdir, 'reads'), sheet, [], self.projdir))
+        eq_(['000000-small'], self.queue.jobs(PENDING))
+
+class TestRunJob(Base):
+    functionname = 'run_job'
+
+    @patch('ngs_mapper.run_bwa.run_shard_job')
+    def test_shard_job(self, run_shard_job):
+        run_shard_job.return_value = 0
+        job = {'name': 'a', 'kind': 'shard'}
+        eq_(0, self._C(self.queue, 'a', job))
+        run_shard_job.assert_called_with(job)
+
+class TestRunWorker(Base):
+    functionname = 'run_worker'
+
+    def test_runs_until_empty(self):
+        self._submit('a', 'b')
+        runner = Mock(return_value=0)
+        eq_(2, self._C(self.queue, runner=runner))
+        eq_(['a', 'b'], self.queue.jobs(DONE))
+
+    def test_heartbeat_while_running(self):
+        self._submit('a')
+        def runner(queue, name, job, broker):
+            old = queue.now() - 600
+            os.utime(queue.jobpath(CLAIMED, name), (old, old))
+            time.sleep(1.5)
+            eq_([], queue.requeue_stale(300))
+            return 0
+        self._C(self.queue, heartbeat=1, runner=runner)
+
+    def test_several_worker_processes_never_share_a_job(self):
+        names = ['{0:03d}'.format(i) for i in range(30)]
+        self._submit(*names)
+        procs = [multiprocessing.Process(target=_worker, args=(self.queue.path,)) for i in range(4)]
+        for p in procs:
+            p.start()
+        for p in procs:
+            p.join()
+        eq_(names, self.queue.jobs(DONE))
+        ran = [f.rsplit('.', 1)[0] for f in os.listdir(join(self.queue.path, 'logs'))]
+        eq_(sorted(names), sorted(ran))
@@ -0,0 +1,128 @@
+from imports import *
+
+import json
+
+from ngs_mapper import kmer_filter
+
+REF = 'ACGTTGCAAGGCTTAACCGGATCGATCGGATTACAGGC'
+# Reverse complement of the first 23 bases of REF
+REVERSE = 'GATCCGGTTAAGCCTTGCAACGT'
+HOST = 'TTTTTTTTTTTTTTTTTTTTTTTTTTTTTT'
+
+def fastq(path, seqs, prefix='M00000:1:000000000-AAAAA:1:1101:'):
+    with open(path, 'w') as fh:
+        for i, seq in enumerate(seqs):
+            fh.write('@{0}{1}:1000\n{2}\n+\n{3}\n'.format(prefix, 1000 + i, seq, 'I' * len(seq)))
+    return path
+
+def seqs(path):
+    return [l.strip() for i, l in enumerate(open(path)) if i % 4 == 1]
+
+class Base(BaseTester):
+    modulepath = 'ngs_mapper.kmer_filter'
+
+    def setUp(self):
+        self.tdir = tempfile.mkdtemp()
+        self.readsdir = join(self.tdir, 'trimmed_reads')
+        os.mkdir(self.readsdir)
+        self.reference = join(self.tdir, 'ref.fasta')
+        with open(self.reference, 'w') as fh:
+            fh.write('>ref\n{0}\n{1}\n'.format(REF[:20], REF[20:]))
+
+    def tearDown(self):
+        shutil.rmtree(self.tdir)
+
+class TestReferenceKmers(Base):
+    functionname = 'reference_kmers'
+
+    def test_both_strands(self):
+        kmers = self._C(self.reference, 10)
+        ok_(REF[:10] in kmers)
+        ok_(REVERSE[:10] in kmers)
+        eq_(2 * (len(REF) - 9), len(kmers))
+
+    def test_directory(self):
+        refdir = join(self.tdir, 'refs')
+        os.mkdir(refdir)
+        shutil.move(self.reference, refdir)
+        with open(join(refdir, 'other.fasta'), 'w') as fh:
+            fh.write('>other\n{0}\n'.format(HOST))
+        kmers = self._C(refdir, 10)
+        ok_(REF[:10] in kmers)
+        ok_(HOST[:10] in kmers)
+
+class TestSharesKmer(Base):
+    functionname = 'shares_kmer'
+
+    def test_shares(self):
+        kmers = set(['ACGTA'])
+        ok_(self._C('ttacgtatt', kmers, 5))
+        ok_(not self._C('TTACGTTT', kmers, 5))
+        ok_(not self._C('ACG', kmers, 5))
+
+    def test_stride(self):
+        kmers = set(['ACGTA'])
+        # ACGTA starts at 2 so only a stride that lands on it finds it
+        ok_(self._C('TTACGTATT', kmers, 5, 2))
+        ok_(not self._C('TTACGTATT', kmers, 5, 3))
+        # Any 5+3-1 shared bases are always found
+        for i in range(4):
+            read = 'T' * i + REF[:7] + 'T' * 4
+            ok_(self._C(read, set([REF[j:j+5] for j in range(3)]), 5, 3))
+
+class TestFilterReads(Base):
+    functionname = 'filter_reads'
+
+    def test_mates_kept_together(self):
+        kmers = kmer_filter.reference_kmers(self.reference, 10)
+        r1 = fastq(join(self.readsdir, 'r1.fastq'), [REF[:25], HOST, HOST])
+        r2 = fastq(join(self.readsdir, 'r2.fastq'), [HOST, REVERSE, HOST])
+        out = [join(self.tdir, 'o1.fastq'), join(self.tdir, 'o2.fastq')]
+        eq_((3, 1), self._C([r1, r2], out, kmers, 10))
+        eq_([REF[:25], HOST], seqs(out[0]))
+        eq_([HOST, REVERSE], seqs(out[1]))
+
+    def test_mates_missing(self):
+        r1 = fastq(join(self.readsdir, 'r1.fastq'), [HOST, HOST])
+        r2 = fastq(join(self.readsdir, 'r2.fastq'), [HOST])
+        out = [join(self.tdir, 'o1.fastq'), join(self.tdir, 'o2.fastq')]
+        assert_raises(kmer_filter.KmerFilterError, self._C, [r1, r2], out, set(), 10)
+
+class TestKmerFilterDir(Base):
+    functionname = 'kmer_filter_dir'
+
+    def test_filters_every_file(self):
+        fastq(join(self.readsdir, 'sample1.fastq'), [HOST, REF[5:30], HOST], prefix='sanger_')
+        outdir = join(self.tdir, 'kmer_filtered')
+        stats = self._C(self.readsdir, self.reference, outdir, 10)
+        eq_(['sample1.fastq'], os.listdir(outdir))
+        eq_([REF[5:30]], seqs(join(outdir, 'sample1.fastq')))
+        eq_(3, stats['reads'])
+        eq_(2, stats['dropped'])
+        eq_({'reads': 3, 'dropped': 2}, stats['files']['sample1.fastq'])
+
+    def test_threads(self):
+        fastq(join(self.readsdir, 'sample1.fastq'), [HOST, REF[5:30]], prefix='sanger_')
+        fastq(join(self.readsdir, 'sample2.fastq'), [HOST, HOST, REVERSE], prefix='sanger_')
+        outdir = join(self.tdir, 'kmer_filtered')
+        stats = self._C(self.readsdir, self.reference, outdir, 10, 2, 2)
+        eq_([REF[5:30]], seqs(join(outdir, 'sample1.fastq')))
+        eq_([REVERSE], seqs(join(outdir, 'sample2.fastq')))
+        eq_(5, stats['reads'])
+        eq_(3, stats['dropped'])
+        eq_(2, stats['stride'])
+
+    def test_reference_shorter_than_k(self):
+        assert_raises(kmer_filter.KmerFilterError, self._C, self.readsdir, self.reference, self.tdir, 100)
+
+class TestMain(Base):
+    functionname = 'main'
+
+    def test_writes_stats(self):
+        fastq(join(self.readsdir, 'sample1.fastq'), [HOST], prefix='sanger_')
+        outdir = join(self.tdir, 'out')
+        statsfile = join(self.tdir, 'stats.json')
+        self._C([self.readsdir, self.reference, '-o', outdir, '--stats', statsfile, '-k', '10', '-s', '1', '-t', '2'])
+        stats = json.load(open(statsfile))
+        eq_(1, stats['dropped'])
+        eq_(10, stats['kmer_size'])
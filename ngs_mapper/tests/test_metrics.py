@@ -0,0 +1,62 @@
+from imports import *
+
+from ngs_mapper import metrics, summary
+
+class Base(BaseTester):
+    modulepath = 'ngs_mapper.metrics'
+
+    def setUp(self):
+        self.tdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tdir)
+
+    def _project(self, name, stages=None, summary_stages=None):
+        path = join(self.tdir, name)
+        os.mkdir(path)
+        if stages is not None:
+            metrics.write_metrics(
+                metrics.project_metrics_path(path), metrics.make_metrics(name, stages)
+            )
+        if summary_stages is not None:
+            summary.write_summary(
+                summary.project_summary_path(path), {'stages': summary_stages}
+            )
+        return path
+
+class TestProjectMetricsPath(Base):
+    functionname = 'project_metrics_path'
+
+    def test_path(self):
+        eq_('Projects/s1/s1.metrics.json', self._C('Projects/s1/'))
+
+class TestProjectStages(Base):
+    functionname = 'project_stages'
+
+    def test_prefers_metrics(self):
+        p = self._project('s1', [{'name': 'a', 'cpu': 1.0}], [{'name': 'a'}])
+        eq_([{'name': 'a', 'cpu': 1.0}], self._C(p))
+
+    def test_summary_without_metrics(self):
+        p = self._project('s1', summary_stages=[{'name': 'a', 'duration': 2.0}])
+        eq_([{'name': 'a', 'duration': 2.0}], self._C(p))
+
+    def test_neither(self):
+        eq_(None, self._C(self._project('s1')))
+
+class TestStageBreakdown(Base):
+    functionname = 'stage_breakdown'
+
+    def test_values_for_each_project(self):
+        p1 = self._project('s1', [
+            {'name': 'trim', 'duration': 5.0, 'maxrss': 10.0},
+            {'name': 'bwa', 'duration': 20.0, 'maxrss': 300.0},
+        ])
+        p2 = self._project('s2', [
+            {'name': 'trim', 'duration': 3.0},
+            {'name': 'call', 'duration': 1.0, 'maxrss': 50.0},
+        ])
+        p3 = self._project('s3')
+        names, breakdown = self._C([p1, p2, p3], 'maxrss')
+        eq_(['trim', 'bwa', 'call'], names)
+        eq_({p1: {'trim': 10.0, 'bwa': 300.0}, p2: {'call': 50.0}}, breakdown)
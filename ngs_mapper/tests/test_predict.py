@@ -0,0 +1,150 @@
+from imports import *
+
+from ngs_mapper import predict, summary
+
+MISEQ = '@M02261:15:000000000-A9PH1:1:1101:17136:1452 1:N:0:14\n{0}\n+\n{1}\n'
+
+class Base(BaseTester):
+    modulepath = 'ngs_mapper.predict'
+
+    def setUp(self):
+        self.tdir = tempfile.mkdtemp()
+        self.readsdir = join(self.tdir, 'sample1')
+        os.mkdir(self.readsdir)
+        self.reference = join(self.tdir, 'ref.fasta')
+        with open(self.reference, 'w') as fh:
+            fh.write('>ref1\nACGT\nAC\n>ref2\nAAAA\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.tdir)
+
+    def _fastq(self, name, lengths, opener=open):
+        path = join(self.readsdir, name)
+        fh = opener(path, 'wb')
+        for l in lengths:
+            fh.write(MISEQ.format('A' * l, 'I' * l))
+        fh.close()
+        return path
+
+class TestReferenceLength(Base):
+    functionname = 'reference_length'
+
+    def test_all_sequences(self):
+        eq_(10, self._C(self.reference))
+
+class TestInputFeatures(Base):
+    functionname = 'input_features'
+
+    def test_bytes_by_platform(self):
+        r1 = self._fastq('s_S1_L001_R1_001_2014_01_01.fastq', [10, 20])
+        open(join(self.readsdir, 'notes.txt'), 'w').close()
+        r = self._C(self.readsdir, self.reference)
+        eq_({'MiSeq': os.stat(r1).st_size}, r['input_bytes'])
+        eq_(10, r['reference_length'])
+
+class TestSampleUsage(Base):
+    functionname = 'sample_usage'
+
+    def test_sample_and_stages(self):
+        s = {
+            'duration': 100.0,
+            'stages': [
+                {'name': 'a', 'duration': 60.0, 'cpu': 100.0, 'maxrss': 50.0},
+                {'name': 'b', 'duration': 40.0, 'cpu': 10.0, 'maxrss': 500.0},
+            ]
+        }
+        r = self._C(s)
+        eq_(100.0, r['walltime'])
+        eq_(110.0, r['cpu'])
+        eq_(500.0, r['memory'])
+        eq_(60.0, r['a.walltime'])
+        eq_(50.0, r['a.memory'])
+
+    def test_usage_not_recorded(self):
+        s = {'duration': 10.0, 'stages': [{'name': 'a', 'duration': 10.0}]}
+        eq_({'walltime': 10.0, 'a.walltime': 10.0}, self._C(s))
+
+def make_history(mbs, reflen=1000):
+    '''
+    Summaries where run_bwa takes 10 seconds per MB of MiSeq reads and
+    uses 100MB plus 2MB per MB of reads
+    '''
+    history = []
+    for i, mb in enumerate(mbs):
+        history.append({
+            'samplename': 's{0}'.format(i),
+            'duration': 30.0 + 10 * mb,
+            'stages': [
+                {'name': 'trim_reads', 'duration': 30.0, 'cpu': 30.0, 'maxrss': 20.0, 'returncode': 0},
+                {'name': 'run_bwa_on_samplename', 'duration': 10.0 * mb,
+                 'cpu': 40.0 * mb, 'maxrss': 100 + 2.0 * mb, 'returncode': 0},
+            ],
+            'features': {
+                'input_bytes': {'MiSeq': mb * 1024**2},
+                'reference_length': reflen,
+            },
+        })
+    return history
+
+class TestLoadHistory(Base):
+    functionname = 'load_history'
+
+    def test_only_successful_with_features(self):
+        projdir = join(self.tdir, 'Projects')
+        history = make_history([1, 2, 3])
+        history[1]['stages'][0]['returncode'] = 1
+        del history[2]['features']
+        history.append({'samplename': 's3'})
+        history.append(dict(make_history([4])[0], samplename='s4', cached=['trim_reads']))
+        for s in history:
+            os.makedirs(join(projdir, s['samplename']))
+            summary.write_summary(
+                summary.project_summary_path(join(projdir, s['samplename'])), s
+            )
+        eq_(['s0'], [s['samplename'] for s in self._C(projdir)])
+
+class TestResourceModel(Base):
+    def test_predicts_from_history(self):
+        model = predict.ResourceModel(make_history([1, 5, 10, 20]), margin=1.0)
+        ok_(model.ready)
+        p = model.predict({'input_bytes': {'MiSeq': 40 * 1024**2}, 'reference_length': 1000})
+        assert_almost_equal(430.0, p['walltime'], 3)
+        assert_almost_equal(30.0 + 1600.0, p['cpu'], 3)
+        assert_almost_equal(180.0, p['memory'], 3)
+        assert_almost_equal(400.0, p['stages']['run_bwa_on_samplename']['walltime'], 3)
+
+    def test_never_below_smallest_and_margin(self):
+        model = predict.ResourceModel(make_history([1, 5, 10]), margin=2.0)
+        p = model.predict({'input_bytes': {}, 'reference_length': 1000})
+        assert_almost_equal(80.0, p['walltime'], 3)
+
+    def test_larger_input_never_below_largest_seen(self):
+        history = make_history([1, 2, 3, 4])
+        # Noisy history where the fit slopes down
+        for s, duration in zip(history, [400.0, 300.0, 200.0, 100.0]):
+            s['duration'] = duration
+        model = predict.ResourceModel(history, margin=1.0)
+        p = model.predict({'input_bytes': {'MiSeq': 10 * 1024**2}, 'reference_length': 1000})
+        ok_(p['walltime'] >= 400.0)
+
+    def test_needs_a_sample_for_each_feature(self):
+        history = make_history([1, 2, 3])
+        for s, platform in zip(history, ['MiSeq', 'Sanger', 'IonTorrent']):
+            s['features']['input_bytes'] = {platform: 1024**2}
+        # Intercept, 3 platforms and the reference length from 3 samples
+        ok_(not predict.ResourceModel(history).ready)
+        history += make_history([4, 5])
+        ok_(predict.ResourceModel(history).ready)
+
+    def test_too_few_samples(self):
+        model = predict.ResourceModel(make_history([1, 5]))
+        ok_(not model.ready)
+        eq_(None, model.predict({})['walltime'])
+
+class TestFormatWalltime(Base):
+    functionname = 'format_walltime'
+
+    def test_rounds_up(self):
+        eq_('00:01:00', self._C(1))
+        eq_('01:02:00', self._C(3661))
+        eq_('25:00:00', self._C(90000))
@@ -273,3 +273,101 @@ class TestIntegrationCompileReads(Base):
             with open(result[k]) as fh:
                 contents = fh.read()
                 eq_( v, len(contents.splitlines()) )
+
+class TestUnitGroupReads(Base):
+    functionname = 'group_reads'
+
+    def test_groups(self):
+        reads = [('f1.fastq','r1.fastq'),'np1.fastq','np2.sff']
+        eq_( {'F':['f1.fastq'],'R':['r1.fastq'],'NP':['np1.fastq','np2.sff']}, self._C( reads ) )
+
+    def test_invalid(self):
+        from ngs_mapper.reads import InvalidReadFile
+        assert_raises( InvalidReadFile, self._C, [('f1.fastq','r1.fastq.gz')] )
+
+    def test_valid_function(self):
+        eq_( ['r1.fastq.gz'], self._C( [('f1.fastq','r1.fastq.gz')], lambda r: True )['R'] )
+
+class TestUnitReadType(Base):
+    functionname = 'read_type'
+
+    def test_gzip(self):
+        eq_( 'fastq', self._C( 'reads.fastq.gz' ) )
+        eq_( 'sff', self._C( 'reads.sff' ) )
+
+def _fastq_names( fastq ):
+    return [l.strip() for i, l in enumerate( fastq.splitlines() ) if i % 4 == 0]
+
+class TestUnitWriteReads(Base):
+    functionname = 'write_reads'
+
+    def test_plain_gzip_and_no_newline(self):
+        import gzip
+        with open( 'a.fastq', 'w' ) as fh:
+            fh.write( '@a1\nACGT\n+\nIIII' )
+        fh = gzip.open( 'b.fastq.gz', 'wb' )
+        fh.write( '@b1\nACGT\n+\nIIII\n@b2\nACGT\n+\nIIII\n' )
+        fh.close()
+        out = StringIO()
+        eq_( 3, self._C( ['a.fastq', 'b.fastq.gz'], out ) )
+        eq_( ['@a1', '@b1', '@b2'], _fastq_names( out.getvalue() ) )
+
+    def test_sff(self):
+        sff = glob( join( fixtures.THIS, 'fixtures', 'reads', '*.sff' ) )[0]
+        out = StringIO()
+        eq_( 100, self._C( [sff], out ) )
+        eq_( 400, len( out.getvalue().splitlines() ) )
+
+class TestReadPipes(Base):
+    def setUp(self):
+        super(TestReadPipes,self).setUp()
+        for name in ('f', 'r', 'np'):
+            with open( name + '.fastq', 'w' ) as fh:
+                fh.write( '@{0}1\nACGT\n+\nIIII\n'.format(name) )
+
+    def _pipes(self):
+        from ngs_mapper.reads import ReadPipes
+        return ReadPipes( [('f.fastq','r.fastq'), 'np.fastq'], 'reads' )
+
+    def test_streams_each_file(self):
+        import stat
+        pipes = self._pipes()
+        try:
+            eq_( join('reads','F.fq'), pipes.files['F'] )
+            ok_( stat.S_ISFIFO( os.stat( pipes.files['F'] ).st_mode ) )
+            eq_( ['@f1'], _fastq_names( open( pipes.files['F'] ).read() ) )
+            eq_( ['@r1'], _fastq_names( open( pipes.files['R'] ).read() ) )
+            eq_( ['@np1'], _fastq_names( open( pipes.files['NP'] ).read() ) )
+            eq_( {'F':1,'R':1,'NP':1}, pipes.wait() )
+        finally:
+            pipes.close()
+        ok_( not exists( join('reads','F.fq') ) )
+
+    def test_nonpaired_only(self):
+        from ngs_mapper.reads import ReadPipes
+        pipes = ReadPipes( ['np.fastq'], 'reads' )
+        try:
+            eq_( (None, None), (pipes.files['F'], pipes.files['R']) )
+            open( pipes.files['NP'] ).read()
+            pipes.wait()
+        finally:
+            pipes.close()
+
+    def test_close_without_reading(self):
+        pipes = self._pipes()
+        pipes.close()
+        eq_( [], [t for t in pipes.threads.values() if t.is_alive()] )
+        eq_( [], os.listdir('reads') )
+
+    def test_not_read_completely(self):
+        from ngs_mapper.reads import ReadPipes, ReadPipeError
+        with open( 'big.fastq', 'w' ) as fh:
+            for i in range( 100000 ):
+                fh.write( '@r{0}\nACGT\n+\nIIII\n'.format(i) )
+        pipes = ReadPipes( ['big.fastq'], 'reads' )
+        try:
+            with open( pipes.files['NP'] ) as fh:
+                fh.read( 10 )
+            assert_raises( ReadPipeError, pipes.wait )
+        finally:
+            pipes.close()
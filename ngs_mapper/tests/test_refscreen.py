@@ -0,0 +1,94 @@
+from imports import *
+
+import random
+import string
+
+from ngs_mapper import refscreen
+
+def random_seq(length, seed):
+    r = random.Random(seed)
+    return ''.join(r.choice('ACGT') for i in range(length))
+
+def revcomp(seq):
+    return seq[::-1].translate(string.maketrans('ACGT', 'TGCA'))
+
+def fastq(path, seqs):
+    with open(path, 'w') as fh:
+        for i, seq in enumerate(seqs):
+            fh.write('@read{0}\n{1}\n+\n{2}\n'.format(i, seq, 'I' * len(seq)))
+    return path
+
+class Base(BaseTester):
+    modulepath = 'ngs_mapper.refscreen'
+
+    def setUp(self):
+        self.tdir = tempfile.mkdtemp()
+        self.refdir = join(self.tdir, 'refs')
+        os.mkdir(self.refdir)
+        self.refs = {}
+        for i, name in enumerate(('H1N1', 'H3N2', 'H5N1')):
+            self.refs[name] = random_seq(1000, i)
+            with open(join(self.refdir, name + '.fasta'), 'w') as fh:
+                fh.write('>{0}\n{1}\n'.format(name, self.refs[name]))
+        open(join(self.refdir, 'notes.txt'), 'w').close()
+        # Mostly H3N2 reads from both strands, some H1N1 and some host
+        h3, h1 = self.refs['H3N2'], self.refs['H1N1']
+        self.reads = fastq(join(self.tdir, 'reads.fastq'),
+            [h3[i:i+100] for i in range(0, 900, 50)] +
+            [revcomp(h3[i:i+100]) for i in range(25, 900, 50)] +
+            [h1[i:i+100] for i in range(0, 300, 50)] +
+            [random_seq(100, 10 + i) for i in range(10)]
+        )
+
+    def tearDown(self):
+        shutil.rmtree(self.tdir)
+
+class TestReferenceFiles(Base):
+    functionname = 'reference_files'
+
+    def test_only_fasta_extensions(self):
+        eq_(['H1N1.fasta', 'H3N2.fasta', 'H5N1.fasta'], [basename(f) for f in self._C(self.refdir)])
+
+class TestReadSketch(Base):
+    functionname = 'read_sketch'
+
+    def test_samples_by_hash(self):
+        sketch = self._C([self.reads], scale=1)
+        ok_(self.refs['H3N2'][:21] in sketch)
+        ok_(all(hash(k) % 4 == 0 for k in self._C([self.reads], scale=4)))
+
+    def test_most_reads(self):
+        # Every 21-mer of the first 100 base read
+        eq_(80, len(self._C([self.reads], reads=1, scale=1)))
+
+    def test_skips_other_files(self):
+        eq_(set(), self._C([join(self.refdir, 'notes.txt')]))
+
+class TestRankReferences(Base):
+    functionname = 'rank_references'
+
+    def test_best_first(self):
+        ranked = self._C(self.refdir, [self.reads])
+        eq_(['H3N2.fasta', 'H1N1.fasta', 'H5N1.fasta'], [basename(f) for c, f in ranked])
+        ok_(ranked[0][0] > ranked[1][0] > 0)
+        eq_(0, ranked[2][0])
+
+class TestScreenReferences(Base):
+    functionname = 'screen_references'
+
+    def test_links_top_references(self):
+        outdir = join(self.tdir, 'screened')
+        eq_(outdir, self._C(self.refdir, [self.reads], 1, outdir))
+        eq_(['H3N2.fasta'], os.listdir(outdir))
+        eq_(join(self.refdir, 'H3N2.fasta'), os.path.realpath(join(outdir, 'H3N2.fasta')))
+
+    def test_leaves_out_references_without_reads(self):
+        outdir = join(self.tdir, 'screened')
+        self._C(self.refdir, [self.reads], 3, outdir)
+        eq_(['H1N1.fasta', 'H3N2.fasta'], sorted(os.listdir(outdir)))
+
+    def test_no_match_uses_every_reference(self):
+        reads = fastq(join(self.tdir, 'host.fastq'), [random_seq(100, 20)])
+        outdir = join(self.tdir, 'screened')
+        eq_(self.refdir, self._C(self.refdir, [reads], 1, outdir))
+        ok_(not os.path.exists(outdir))
@@ -0,0 +1,131 @@
+from imports import *
+
+import multiprocessing
+
+from ngs_mapper.refstore import RefStore, RefStoreError, INDEX_EXTENSIONS, REFNAME, copy_links
+
+def fake_indexer(fasta):
+    ''' Creates empty index files and counts how many times it ran '''
+    for ext in INDEX_EXTENSIONS:
+        open(fasta + ext, 'w').close()
+    with open(join(dirname(dirname(fasta)), 'indexed.count'), 'a') as fh:
+        fh.write('x')
+
+def use_store(root, reference):
+    RefStore(root, fake_indexer).reference(reference)
+
+class Base(BaseTester):
+    modulepath = 'ngs_mapper.refstore'
+
+    def setUp(self):
+        self.tdir = tempfile.mkdtemp()
+        self.root = join(self.tdir, 'refs')
+        self.store = RefStore(self.root, fake_indexer)
+        self.ref = self._fasta('den3.fasta', '>den3\nACGTTTTACG\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.tdir)
+
+    def _fasta(self, name, contents):
+        path = join(self.tdir, name)
+        with open(path, 'w') as fh:
+            fh.write(contents)
+        return path
+
+    def _indexed(self):
+        path = join(self.root, 'indexed.count')
+        if not exists(path):
+            return 0
+        return len(open(path).read())
+
+class TestReference(Base):
+    def test_indexes_same_contents_once(self):
+        stored = self.store.reference(self.ref)
+        copy = self._fasta('other_name.fasta', open(self.ref).read())
+        eq_(stored, self.store.reference(copy))
+        eq_(1, self._indexed())
+        eq_(REFNAME, basename(stored))
+        for ext in INDEX_EXTENSIONS:
+            ok_(exists(stored + ext))
+
+    def test_different_contents(self):
+        other = self._fasta('den1.fasta', '>den1\nAAAAC\n')
+        ok_(self.store.reference(self.ref) != self.store.reference(other))
+        eq_(2, self._indexed())
+
+    def test_failed_index_is_not_stored(self):
+        def broken(fasta):
+            raise ValueError('broken')
+        store = RefStore(self.root, broken)
+        assert_raises(ValueError, store.reference, self.ref)
+        eq_([], [f for f in os.listdir(self.root) if not f.endswith('.lock')])
+
+    def test_directory_of_references(self):
+        refdir = join(self.tdir, 'refdir')
+        os.mkdir(refdir)
+        shutil.copy(self.ref, refdir)
+        with open(join(refdir, 'den1.fasta'), 'w') as fh:
+            fh.write('>den1\nAAAAC\n')
+        stored = self.store.reference(refdir)
+        ids = sorted(r.id for r in SeqIO.parse(stored, 'fasta'))
+        eq_(['den1', 'den3'], ids)
+        eq_(stored, self.store.reference(refdir))
+        eq_(1, self._indexed())
+
+    def test_unreadable_directory_of_references(self):
+        refdir = join(self.tdir, 'refdir')
+        os.mkdir(refdir)
+        os.symlink(join(self.tdir, 'missing.fasta'), join(refdir, 'den1.fasta'))
+        cwd = os.getcwd()
+        assert_raises(RefStoreError, self.store.reference, refdir)
+        eq_(cwd, os.getcwd())
+        eq_([], [f for f in os.listdir(self.root) if not f.endswith('.lock')])
+
+    def test_concurrent_samples_index_once(self):
+        procs = [
+            multiprocessing.Process(target=use_store, args=(self.root, self.ref))
+            for i in range(4)
+        ]
+        for p in procs:
+            p.start()
+        for p in procs:
+            p.join()
+        eq_([0] * 4, [p.exitcode for p in procs])
+        eq_(1, self._indexed())
+
+class TestLinkInto(Base):
+    def test_copies_reference_and_links_indexes(self):
+        sample = join(self.tdir, 'sample')
+        os.mkdir(sample)
+        dst = join(sample, 'den3.fasta')
+        # Left over from a different reference
+        open(dst + '.fai', 'w').close()
+        eq_(dst, self.store.link_into(self.ref, dst))
+        ok_(not os.path.islink(dst))
+        eq_(open(self.ref).read(), open(dst).read())
+        stored = self.store.reference(self.ref)
+        for ext in INDEX_EXTENSIONS:
+            eq_(stored + ext, os.readlink(dst + ext))
+        # Linking again is fine
+        self.store.link_into(self.ref, dst)
+        eq_(1, self._indexed())
+
+    def test_copy_links(self):
+        dst = self.store.link_into(self.ref, join(self.tdir, 'sample.fasta'))
+        copy_links(dst)
+        shutil.rmtree(self.root)
+        for ext in INDEX_EXTENSIONS:
+            ok_(not os.path.islink(dst + ext))
+            ok_(exists(dst + ext))
+
+class TestWriteHpolys(Base):
+    functionname = 'write_hpolys'
+
+    def test_same_as_base_caller(self):
+        import json
+        from ngs_mapper.base_caller import hpoly_list, load_hpolys
+        out = self._C(self.ref, self.ref + '.hpoly.json')
+        refseqs = SeqIO.index(self.ref, 'fasta')
+        expected = hpoly_list(refseqs, 3)
+        eq_(json.loads(json.dumps(expected)), json.load(open(out)))
+        eq_([['TTTT', 4, 7]], load_hpolys(self.ref, refseqs)['den3'])
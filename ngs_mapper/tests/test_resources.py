@@ -0,0 +1,91 @@
+from imports import *
+
+from ngs_mapper.resources import ResourceBroker, Grant
+
+class Base(BaseTester):
+    modulepath = 'ngs_mapper.resources'
+
+    def setUp(self):
+        self.tdir = tempfile.mkdtemp()
+        self.path = join(self.tdir, 'resources')
+
+    def tearDown(self):
+        shutil.rmtree(self.tdir)
+
+    def _broker(self, cpus=8, memory=1000):
+        return ResourceBroker(self.path, cpus=cpus, memory=memory, poll=0.01)
+
+class TestTotalMemory(Base):
+    functionname = 'total_memory'
+
+    def test_reads_meminfo(self):
+        meminfo = join(self.tdir, 'meminfo')
+        with open(meminfo, 'w') as fh:
+            fh.write('MemTotal:        8388608 kB\nMemFree:         1024 kB\n')
+        eq_(8192, self._C(meminfo))
+
+    def test_missing_meminfo(self):
+        eq_(None, self._C(join(self.tdir, 'missing')))
+
+class TestResourceBroker(Base):
+    def test_single_client_gets_everything(self):
+        broker = self._broker()
+        broker.register()
+        grant = broker.acquire(cpus=8)
+        eq_(8, grant.cpus)
+
+    def test_cpus_are_split_between_clients(self):
+        broker = self._broker()
+        for pid in (os.getpid(), os.getppid()):
+            broker.register(pid)
+        eq_(4, broker.acquire(cpus=8).cpus)
+        eq_(4, broker.acquire(cpus=8).cpus)
+        eq_(None, broker.try_acquire(cpus=8))
+
+    def test_never_grants_more_than_wanted(self):
+        broker = self._broker()
+        broker.register()
+        eq_(2, broker.acquire(cpus=2).cpus)
+
+    def test_release_frees_cpus(self):
+        broker = self._broker(cpus=2)
+        grant = broker.acquire(cpus=2)
+        eq_(None, broker.try_acquire())
+        broker.release(grant)
+        eq_(1, broker.acquire().cpus)
+
+    def test_waits_for_memory(self):
+        broker = self._broker(memory=1000)
+        broker.acquire(memory=800)
+        eq_(None, broker.acquire(memory=800, timeout=0.05))
+        eq_(200, broker.acquire(memory=200).memory)
+
+    def test_oversized_request_granted_when_idle(self):
+        broker = self._broker(cpus=2, memory=1000)
+        grant = broker.acquire(cpus=4, mincpus=4, memory=5000)
+        eq_(2, grant.cpus)
+        eq_(5000, grant.memory)
+
+    def test_grants_of_exited_processes_are_dropped(self):
+        broker = self._broker(cpus=2)
+        with patch('ngs_mapper.resources.os.getpid', return_value=99999999):
+            broker.register()
+            broker.acquire(cpus=2)
+        eq_(2, broker.acquire(cpus=2).cpus)
+        eq_(0, broker.status()['clients'])
+
+    def test_grant_context_releases(self):
+        broker = self._broker()
+        with broker.grant(cpus=3) as grant:
+            ok_(isinstance(grant, Grant))
+            eq_(3, broker.status()['cpus'])
+        eq_(0, broker.status()['grants'])
+
+    def test_shared_between_brokers(self):
+        self._broker(cpus=4).acquire(cpus=4)
+        eq_(None, self._broker(cpus=4).try_acquire())
+
+    def test_unreadable_state_is_reset(self):
+        with open(self.path, 'w') as fh:
+            fh.write('{')
+        eq_(1, self._broker().acquire().cpus)
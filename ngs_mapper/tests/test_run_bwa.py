@@ -62,6 +62,238 @@ class TestUnitBWAMem(Base):
         ret = self._C( 'F.fq', ref='ref.fna', output='file.sai', t=8 )
         bwamem_mock.assert_called_with( 'ref.fna', 'F.fq', bwa_path='bwa', t=8 )
 
+class TestUnitRelaySam(Base):
+    functionname = 'relay_sam'
+
+    def setUp(self):
+        super(TestUnitRelaySam,self).setUp()
+        self.sam = '@SQ\tSN:ref\tLN:10\n@PG\tID:bwa\nr1\t0\tref\nr2\t0\tref\n'
+
+    def test_keeps_header(self):
+        out = StringIO()
+        self._C( StringIO(self.sam), out )
+        eq_( self.sam, out.getvalue() )
+
+    def test_leaves_out_header(self):
+        out = StringIO()
+        self._C( StringIO(self.sam), out, header=False )
+        eq_( 'r1\t0\tref\nr2\t0\tref\n', out.getvalue() )
+
+    def test_empty(self):
+        out = StringIO()
+        self._C( StringIO(''), out )
+        eq_( '', out.getvalue() )
+
+@patch('ngs_mapper.run_bwa.which_bwa', Mock(return_value='bwa'))
+@patch('ngs_mapper.run_bwa.index_ref', Mock(return_value=True))
+@patch('ngs_mapper.run_bwa.Popen')
+class TestUnitStreamBwaMem(Base):
+    functionname = 'stream_bwa_mem'
+
+    def _popen(self, popen, sams, returncode=0, bwareturncode=0, stderr=''):
+        self.sorted = StringIO()
+        self.view = Mock(stdin=Mock(), returncode=0)
+        self.view.stdin.write = self.sorted.write
+        self.sort = Mock(returncode=returncode)
+        self.bwa = [Mock(stdout=StringIO(sam), returncode=bwareturncode) for sam in sams]
+        def start(cmd, **kwargs):
+            if cmd[0] == 'bwa':
+                kwargs['stderr'].write(stderr)
+            return ([self.view, self.sort] + self.bwa)[popen.call_count-1]
+        popen.side_effect = start
+
+    def test_one_sort_for_every_run(self, popen):
+        self._popen(popen, ['@SQ\tSN:ref\nr1\n', '@SQ\tSN:ref\nr2\n'])
+        r = self._C( [('F.fq','R.fq'),('NP.fq',None)], 'ref.fa', 'out.bam', threads=2, memory='1G' )
+        eq_( 'out.bam', r )
+        eq_( '@SQ\tSN:ref\nr1\nr2\n', self.sorted.getvalue() )
+        eq_(
+            [['bwa','mem','-t','2','-K','10000000','ref.fa','F.fq','R.fq'], ['bwa','mem','-t','2','-K','10000000','ref.fa','NP.fq']],
+            [c[0][0] for c in popen.call_args_list[2:]]
+        )
+        eq_( ['samtools','sort','-f','-@','2','-m','1G','-','out.bam'], popen.call_args_list[1][0][0] )
+        ok_( self.view.stdin.close.called )
+
+    def test_bwa_error_raises(self, popen):
+        from ngs_mapper.run_bwa import BWAError
+        self._popen(popen, ['r1\n', 'r2\n'], bwareturncode=1)
+        assert_raises( BWAError, self._C, [('F.fq','R.fq'),('NP.fq',None)], 'ref.fa', 'out.bam' )
+        # Second run never starts
+        eq_( 3, popen.call_count )
+        ok_( self.sort.wait.called )
+
+    def test_bwa_usage_raises(self, popen):
+        from ngs_mapper.run_bwa import BWAError
+        self._popen(popen, [''], stderr='Usage: bwa mem [options]')
+        assert_raises( BWAError, self._C, [('NP.fq',None)], 'ref.fa', 'out.bam' )
+
+    def test_sort_error_raises(self, popen):
+        from ngs_mapper.run_bwa import BWAError
+        self._popen(popen, ['r1\n'], returncode=1)
+        assert_raises( BWAError, self._C, [('NP.fq',None)], 'ref.fa', 'out.bam' )
+
+def _fastq(path, names):
+    with open(path, 'w') as fh:
+        for n in names:
+            fh.write('@{0}\nACGT\n+\nIIII\n'.format(n))
+    return path
+
+def _names(path):
+    return [l.strip()[1:] for i, l in enumerate(open(path)) if i % 4 == 0]
+
+# Every pair of reads ends a batch
+@patch('ngs_mapper.run_bwa.BATCH_BASES', 1)
+class TestUnitSplitReads(Base):
+    functionname = 'split_reads'
+
+    def test_mates_stay_together(self):
+        reads = {
+            'F': _fastq('F.fq', ['p1','p2','p3','p4','p5']),
+            'R': _fastq('R.fq', ['p1','p2','p3','p4','p5']),
+            'NP': _fastq('NP.fq', ['n1','n2']),
+        }
+        shards = self._C( reads, 2, 'shards' )
+        eq_( 3, len(shards) )
+        eq_( [['p1','p2'],['p3','p4'],['p5']], [_names(s['F']) for s in shards] )
+        eq_( [_names(s['F']) for s in shards], [_names(s['R']) for s in shards] )
+        eq_( ['n1','n2'], _names(shards[0]['NP']) )
+        eq_( [None, None], [s['NP'] for s in shards[1:]] )
+
+    def test_nonpaired_only(self):
+        shards = self._C( {'F':None,'R':None,'NP':_fastq('NP.fq', ['n1','n2','n3'])}, 2, 'shards' )
+        eq_( [['n1','n2'],['n3']], [_names(s['NP']) for s in shards] )
+        eq_( [None, None], [s['F'] for s in shards] )
+
+    def test_shards_end_with_bwa_batches(self):
+        reads = {
+            'F': _fastq('F.fq', ['p1','p2','p3','p4','p5']),
+            'R': _fastq('R.fq', ['p1','p2','p3','p4','p5']),
+            'NP': _fastq('NP.fq', ['n1','n2','n3','n4','n5','n6','n7']),
+        }
+        # Batches of 3 pairs and 6 nonpaired reads as a batch never ends on an odd read
+        with patch('ngs_mapper.run_bwa.BATCH_BASES', 20):
+            shards = self._C( reads, 1, 'shards' )
+        eq_( [['p1','p2','p3'],['p4','p5']], [_names(s['F']) for s in shards] )
+        eq_( [['n1','n2','n3','n4','n5','n6'],['n7']], [_names(s['NP']) for s in shards] )
+
+    def test_mates_missing(self):
+        from ngs_mapper.run_bwa import BWAError
+        reads = {'F': _fastq('F.fq', ['p1','p2']), 'R': _fastq('R.fq', ['p1']), 'NP': None}
+        assert_raises( BWAError, self._C, reads, 5, 'shards' )
+
+@patch('ngs_mapper.run_bwa.index_ref', Mock(return_value=True))
+@patch('ngs_mapper.run_bwa.map_reads')
+class TestUnitMapShards(Base):
+    functionname = 'map_shards'
+
+    def test_local_workers(self, map_reads):
+        shards = [{'NP':'a'}, {'NP':'b'}, {'NP':'c'}]
+        bams = self._C( shards, 'ref.fa', 'out', threads=8, memory='1G', workers=2 )
+        eq_( ['out/shard.0000.bam','out/shard.0001.bam','out/shard.0002.bam'], bams )
+        eq_(
+            sorted([call(s, 'ref.fa', b, threads=4, memory='1G', level=None, index=False) for s, b in zip(shards, bams)]),
+            sorted(map_reads.call_args_list)
+        )
+
+    def test_indexes_once(self, map_reads):
+        from ngs_mapper.run_bwa import index_ref
+        index_ref.reset_mock()
+        self._C( [{'NP':'a'}, {'NP':'b'}], 'ref.fa', 'out', workers=2 )
+        eq_( [call('ref.fa')], index_ref.call_args_list )
+
+    def test_reference_cannot_be_indexed(self, map_reads):
+        from ngs_mapper.run_bwa import InvalidReference
+        with patch('ngs_mapper.run_bwa.index_ref', Mock(return_value=False)):
+            assert_raises( InvalidReference, self._C, [{'NP':'a'}], 'ref.fa', 'out' )
+        eq_( 0, map_reads.call_count )
+
+    def test_shard_fails(self, map_reads):
+        from ngs_mapper.run_bwa import BWAError
+        map_reads.side_effect = BWAError('failed')
+        assert_raises( BWAError, self._C, [{'NP':'a'}], 'ref.fa', 'out' )
+
+    def test_queue(self, map_reads):
+        from ngs_mapper.jobqueue import JobQueue, DONE
+        shards = [{'F':'F.0.fq','R':'R.0.fq','NP':None}, {'F':'F.1.fq','R':'R.1.fq','NP':None}]
+        bams = self._C( shards, 'ref.fa', 'out', threads=2, queue='queue' )
+        eq_( 2, len(JobQueue('queue').jobs(DONE)) )
+        eq_( call({'F':abspath('F.0.fq'),'R':abspath('R.0.fq'),'NP':None}, abspath('ref.fa'), abspath(bams[0]), 2, None, None, index=False),
+            sorted(map_reads.call_args_list)[0] )
+
+    def test_queue_leaves_samples(self, map_reads):
+        from ngs_mapper.jobqueue import JobQueue, PENDING, DONE
+        JobQueue('queue').submit({'name': '000000-s1', 'sample': 's1'})
+        self._C( [{'NP':'a'}], 'ref.fa', 'out', queue='queue' )
+        eq_( ['000000-s1'], JobQueue('queue').jobs(PENDING) )
+        eq_( 1, len(JobQueue('queue').jobs(DONE)) )
+
+    def test_queue_shard_fails(self, map_reads):
+        from ngs_mapper.run_bwa import BWAError
+        map_reads.side_effect = OSError('no bwa')
+        assert_raises( BWAError, self._C, [{'NP':'a'}], 'ref.fa', 'out', queue='queue' )
+
+@patch('ngs_mapper.run_bwa.map_reference')
+@patch('ngs_mapper.run_bwa.SharedIndex')
+class TestUnitMapSample(Base):
+    functionname = 'map_sample'
+
+    def _args(self, shm):
+        return Mock(reference='ref.fasta', refstore='refs', shm=shm)
+
+    def test_maps_against_shared_index(self, shared, map_reference):
+        shared.return_value.acquire.return_value = 'refs/abc/abc.fasta'
+        args = self._args(True)
+        self._C( args, {}, 'tdir' )
+        shared.assert_called_with('refs')
+        map_reference.assert_called_with(args, {}, 'refs/abc/abc.fasta', 'tdir')
+        shared.return_value.release.assert_called_with('refs/abc/abc.fasta')
+
+    def test_released_when_mapping_fails(self, shared, map_reference):
+        from ngs_mapper.run_bwa import BWAError
+        map_reference.side_effect = BWAError('failed')
+        assert_raises( BWAError, self._C, self._args(True), {}, 'tdir' )
+        ok_( shared.return_value.release.called )
+
+    def test_release_fails(self, shared, map_reference):
+        from ngs_mapper.shmindex import SharedIndexError
+        shared.return_value.acquire.return_value = 'refs/abc/abc.fasta'
+        shared.return_value.release.side_effect = SharedIndexError('state is locked')
+        map_reference.return_value = 'out.bam'
+        eq_( 'out.bam', self._C( self._args(True), {}, 'tdir' ) )
+
+    def test_compiles_directory_without_changing_directory(self, shared, map_reference):
+        os.mkdir( 'refs' )
+        os.mkdir( 'tdir' )
+        for name in ('a.fasta', 'b.fna'):
+            with open( join( 'refs', name ), 'w' ) as fh:
+                fh.write( '>{0}\nACGT\n'.format(name) )
+        cwd = os.getcwd()
+        self._C( Mock(reference='refs', refstore='', shm=False), {}, 'tdir' )
+        eq_( cwd, os.getcwd() )
+        ref = map_reference.call_args[0][2]
+        eq_( os.path.abspath( join( 'tdir', 'reference.fa' ) ), ref )
+        eq_( '>a.fasta\nACGT\n>b.fna\nACGT\n', open( ref ).read() )
+
+    def test_bad_directory_keeps_directory(self, shared, map_reference):
+        from ngs_mapper.refstore import RefStoreError
+        os.mkdir( 'refs' )
+        os.mkdir( 'tdir' )
+        cwd = os.getcwd()
+        assert_raises( RefStoreError, self._C, Mock(reference='refs', refstore='', shm=False), {}, 'tdir' )
+        eq_( cwd, os.getcwd() )
+
+    def test_shared_memory_fails(self, shared, map_reference):
+        from ngs_mapper.shmindex import SharedIndexError
+        shared.return_value.acquire.side_effect = SharedIndexError('no space')
+        args = self._args(True)
+        self._C( args, {}, 'tdir' )
+        map_reference.assert_called_with(args, {}, 'ref.fasta', 'tdir')
+        eq_( 0, shared.return_value.release.call_count )
+
+    def test_no_shm(self, shared, map_reference):
+        self._C( self._args(False), {}, 'tdir' )
+        eq_( 0, shared.call_count )
+
 class TestUnitParseArgs(Base):
     functionname = 'parse_args'
 
@@ -110,6 +342,32 @@ class TestUnitParseArgs(Base):
         res = self._C( ['fake_read', 'fake_ref', '-t', '5'] )
         eq_( res.threads, 5 )
 
+    def test_stream_default( self ):
+        res = self._C( ['fake_read', 'fake_ref'] )
+        eq_( res.stream, True )
+        eq_( res.sort_memory, '768M' )
+
+    def test_shard_defaults( self ):
+        res = self._C( ['fake_read', 'fake_ref'] )
+        eq_( (0, 1, None), (res.shard_size, res.shard_workers, res.shard_queue) )
+
+    def test_shard_options( self ):
+        res = self._C( ['fake_read', 'fake_ref', '--shard-size', '100', '--shard-workers', '4', '--shard-queue', 'q'] )
+        eq_( (100, 4, 'q'), (res.shard_size, res.shard_workers, res.shard_queue) )
+
+    def test_shm( self ):
+        eq_( False, self._C( ['fake_read', 'fake_ref'] ).shm )
+        eq_( True, self._C( ['fake_read', 'fake_ref', '--shm', '--refstore', 'refs'] ).shm )
+
+    @raises(SystemExit)
+    def test_shm_needs_refstore( self ):
+        self._C( ['fake_read', 'fake_ref', '--shm'] )
+
+    def test_no_stream( self ):
+        res = self._C( ['fake_read', 'fake_ref', '--no-stream', '--sort-memory', '2G'] )
+        eq_( res.stream, False )
+        eq_( res.sort_memory, '2G' )
+
 # Pretty sure this isn't the way to do this, but I'm learning here
 @patch('shutil.move')
 @patch('shutil.rmtree')
@@ -146,7 +404,8 @@ class TestUnitMain(Base):
         compile_reads_mock.return_value = {'F':'F.fq','R':'R.fq','NP':None}
         parse_args.return_value = Mock(
             reads='/reads', reference='/reference.fa', platforms=['MiSeq','Sanger'],
-            keep_temp=False, threads=1, output='tdir/out.bam'
+            keep_temp=False, threads=1, output='tdir/out.bam', stream=False, sort_memory=None, shard_size=0, shm=False, screen=0,
+            compression=None, temp_compression=0
         )
         bwa_mem_mock.return_value = 'tdir/out.bam'
 
@@ -191,10 +450,32 @@ class TestUnitMain(Base):
         eq_( 1, self.merge.call_count )
         self.shrmtree.assert_called_with('tdir/bwa')
 
+    def test_only_merged_bam_is_compressed(self, *mocks):
+        self._setUp(*mocks)
+        self.reads_mock.return_value = {'MiSeq':[('r1.fq','r2.fq')],'Sanger':['r3.fq']}
+        self.compile_reads_mock.return_value = {'F':'F.fq','R':'R.fq','NP':'NP.fq'}
+        self.parse_args.return_value.compression = 6
+        self.parse_args.return_value.temp_compression = 1
+        res = self._C()
+        eq_( [1, 1], [c[1]['level'] for c in self.sort.call_args_list] )
+        eq_( 6, self.merge.call_args[1]['level'] )
+
+    @patch('ngs_mapper.run_bwa.screen_references')
+    def test_screens_reference_directory(self, screen, *mocks):
+        self._setUp(*mocks)
+        os.mkdir('refs')
+        self.parse_args.return_value.reference = 'refs'
+        self.parse_args.return_value.screen = 2
+        self.parse_args.return_value.screen_reads = 100
+        screen.return_value = 'tdir/bwa/references'
+        res = self._C()
+        screen.assert_called_once_with('refs', ['r1.fq','r2.fq'], 2, 'tdir/bwa/references', reads=100)
+        eq_( 'tdir/bwa/references', self.parse_args.return_value.reference )
+
     def test_keeptemp(self, *mocks):
         self._setUp(*mocks)
         self.shrmtree.side_effect = AssertionError("Should not remove files with keeptemp option")
-        self.parse_args.return_value = Mock(reads='/reads', reference='/reference.fa', platforms=['MiSeq','Sanger'], keep_temp=True, threads=1, output='tdir/out.bam')
+        self.parse_args.return_value = Mock(reads='/reads', reference='/reference.fa', platforms=['MiSeq','Sanger'], keep_temp=True, threads=1, output='tdir/out.bam', stream=False, sort_memory=None, shard_size=0, shm=False, screen=0, compression=None, temp_compression=0)
         res = self._C()
         eq_( 0, self.shrmtree.call_count )
 
@@ -202,16 +483,78 @@ class TestUnitMain(Base):
         self._setUp(*mocks)
         self.reads_mock.return_value = {'MiSeq':[('r1.fq','r2.fq')],'Sanger':['r3.fq']}
         self.compile_reads_mock.return_value = {'F':'F.fq','R':'R.fq','NP':'NP.fq'}
-        self.parse_args.return_value = Mock(reads='reads', reference='reference.fa', platforms=['MiSeq','Sanger'], keep_temp=False, threads=8, output='tdir/out.bam')
+        self.parse_args.return_value = Mock(reads='reads', reference='reference.fa', platforms=['MiSeq','Sanger'], keep_temp=False, threads=8, output='tdir/out.bam', stream=False, sort_memory=None, shard_size=0, shm=False, screen=0, compression=None, temp_compression=0)
         res = self._C()
         self.bwa_mem_mock.assert_called_with('NP.fq', ref='reference.fa', output='tdir/bwa/nonpaired.sai', t=8)
 
+    @patch('ngs_mapper.run_bwa.ReadPipes')
+    @patch('ngs_mapper.run_bwa.stream_bwa_mem')
+    def test_stream_maps_everything_into_one_sort(self, *mocks):
+        stream, pipes = mocks[:2]
+        self._setUp(*mocks[2:])
+        pipes.return_value.files = {'F':'F.fq','R':'R.fq','NP':'NP.fq'}
+        self.parse_args.return_value.stream = True
+        self.parse_args.return_value.sort_memory = '1G'
+        res = self._C()
+        eq_(
+            [call([('F.fq','R.fq'),('NP.fq',None)], '/reference.fa', 'tdir/out.bam', threads=1, memory='1G', level=None, index=True)],
+            stream.call_args_list
+        )
+        eq_( 0, self.bwa_mem_mock.call_count )
+        eq_( 0, self.sort.call_count )
+        eq_( 0, self.merge.call_count )
+        self.index.assert_called_with('tdir/out.bam')
+        eq_( 0, self.compile_reads_mock.call_count )
+        eq_( [call([('r1.fq','r2.fq')], 'tdir/bwa/reads')], pipes.call_args_list )
+        ok_( pipes.return_value.wait.called )
+        ok_( pipes.return_value.close.called )
+
+    @patch('ngs_mapper.run_bwa.ReadPipes')
+    @patch('ngs_mapper.run_bwa.stream_bwa_mem')
+    def test_stream_closes_pipes_when_mapping_fails(self, *mocks):
+        from ngs_mapper.run_bwa import BWAError
+        stream, pipes = mocks[:2]
+        self._setUp(*mocks[2:])
+        pipes.return_value.files = {'F':None,'R':None,'NP':'NP.fq'}
+        self.parse_args.return_value.stream = True
+        stream.side_effect = BWAError('failed')
+        assert_raises( BWAError, self._C )
+        ok_( pipes.return_value.close.called )
+        eq_( 0, self.index.call_count )
+
+    @patch('ngs_mapper.run_bwa.ReadPipes')
+    @patch('ngs_mapper.run_bwa.map_shards')
+    @patch('ngs_mapper.run_bwa.split_reads')
+    def test_shards_are_merged(self, *mocks):
+        split, shard, pipes = mocks[:3]
+        self._setUp(*mocks[3:])
+        pipes.return_value.files = {'F':'F.fq','R':'R.fq','NP':None}
+        self.parse_args.return_value.shard_size = 10
+        self.parse_args.return_value.shard_workers = 2
+        self.parse_args.return_value.shard_queue = None
+        split.return_value = ['s1', 's2']
+        shard.return_value = ['b1.bam', 'b2.bam']
+        res = self._C()
+        eq_( [call({'F':'F.fq','R':'R.fq','NP':None}, 10, 'tdir/bwa/shards')], split.call_args_list )
+        eq_(
+            [call(['s1','s2'], '/reference.fa', 'tdir/bwa/shards', threads=1, memory=None, workers=2, queue=None, level=0)],
+            shard.call_args_list
+        )
+        self.merge.assert_called_with(['b1.bam', 'b2.bam'], 'tdir/out.bam', level=None)
+        self.index.assert_called_with('tdir/out.bam')
+
     @attr('current')
+    @patch('ngs_mapper.run_bwa.compile_directory', Mock(return_value='reference.fa'))
     def test_bwa_error_should_raise_exception(self,*args):
         with patch('ngs_mapper.run_bwa.os') as os:
             from ngs_mapper.run_bwa import BWAError
             bwa_mem_mock = args[4]
             bwa_mem_mock.return_value = 1
+            args[9].return_value.refstore = None
+            args[9].return_value.stream = False
+            args[9].return_value.shard_size = 0
+            args[9].return_value.shm = False
+            args[9].return_value.screen = 0
             try:
                 self._C()
                 ok_(False,"Did not raise Exception for bwa error")
@@ -311,6 +654,17 @@ class TestIntegrateMainArgs(Base):
         assert not os.path.exists( 'bwa' ), "Temp directory still exists"
         assert os.path.exists( 'merged.bam.bai' )
 
+    @patch('ngs_mapper.run_bwa.BATCH_BASES', 5000)
+    def test_shards_map_like_all_reads(self):
+        ref = self.fixture_files['REF']
+        self._CM( ['expected/reads', ref, '-o', 'whole.bam'] )
+        self._CM( ['expected/reads', ref, '-o', 'sharded.bam', '--shard-size', '10', '--shard-workers', '2'] )
+        # Header has the bwa command lines and alignments at the same position can be in any order
+        alignments = lambda bam: sorted( compat.check_output( ['samtools', 'view', bam] ).splitlines() )
+        whole = alignments( 'whole.bam' )
+        ok_( whole )
+        eq_( whole, alignments( 'sharded.bam' ) )
+
     def test_keepfiles(self):
         ff = self.fixture_files
         res = 'merged.bam'
@@ -89,13 +89,15 @@ class TestMakeProjectRepo(Base):
         ok_( self.check_git_repo( path ) )
 
 class TestFunctional(Base):
-    def _run_runsample( self, readdir, reference, fileprefix, od=None, configfile=None,qsubargs=[] ):
+    def _run_runsample( self, readdir, reference, fileprefix, od=None, configfile=None,qsubargs=[],extra=[] ):
         script_path = 'runsample'
         cmd = script_path + ' {0} {1} {2}'.format(readdir, reference, fileprefix)
         if od is not None:
             cmd += ' -od {0}'.format(od)
         if configfile:
             cmd += ' -c {0}'.format(configfile)
+        if extra:
+            cmd += ' {0}'.format(' '.join(extra))
         if qsubargs:
             cmd += ' {0}'.format(' '.join(qsubargs))
         print "Running: {0}".format(cmd)
@@ -142,6 +144,9 @@ class TestFunctional(Base):
         efiles.append( (f,join( outdir, 'flagstats.txt') ) )
         efiles.append( (f,join( outdir, prefix + '.std.log') ) )
         efiles.append( (f,join( outdir, prefix + '.log') ) )
+        efiles.append( (f,join( outdir, prefix + '.summary.json') ) )
+        efiles.append( (f,join( outdir, prefix + '.stages.json') ) )
+        efiles.append( (f,join( outdir, prefix + '.metrics.json') ) )
         efiles.append( (f,bamfile + '.vcf') )
         efiles.append( (d,join( outdir, 'qualdepth') ) )
         efiles.append( (d,join( outdir, 'trimmed_reads' )) )
@@ -209,6 +214,18 @@ class TestFunctional(Base):
         eq_( -1, ret )
         assert 'AlreadyExists' in res, "Did not raise exception"
 
+    def test_resume_only_runs_changed_stages( self ):
+        res,ret = self._run_runsample( self.reads_by_sample, self.ref, 'tests', 'outdir' )
+        eq_( 0, ret )
+        res,ret = self._run_runsample(
+            self.reads_by_sample, self.ref, 'tests', 'outdir', extra=['--resume', '-minth', '0.9']
+        )
+        print res
+        eq_( 0, ret )
+        assert 'Using cached results for stage run_bwa_on_samplename' in res
+        assert 'Starting stage base_caller' in res
+        self._ensure_expected_output_files( 'outdir', 'tests' )
+
     def test_outdir_exists_empty( self ):
         os.mkdir( 'outdir' )
         out,ret = self._run_runsample( self.reads_by_sample, self.ref, 'tests', 'outdir' )
@@ -242,6 +259,7 @@ class TestFunctional(Base):
         ok_( 7 <= len(loglines), "Should be at least 7 loglines in log file" )
 
 import mock
+import json
 import unittest
 import sh
 from nose import tools
@@ -312,3 +330,254 @@ class TestUnitArgs(unittest.TestCase):
         res = runsample.parse_args(args)
         args, qsub_args = res
         eq_(args.drop_ns, True)
+
+    def test_threads_and_stage_cpus(self):
+        args = [
+            'ReadsBySample','Reference.fasta','Sample1', '--threads', '4'
+        ]
+        args, qsub_args = runsample.parse_args(args)
+        eq_(4, args.threads)
+        eq_(
+            set(['ngs_filter', 'trim_reads', 'kmer_filter', 'run_bwa_on_samplename', 'base_caller']),
+            set(args.stage_cpus)
+        )
+
+    def test_resume_and_stage_config(self):
+        args, _ = runsample.parse_args(['ReadsBySample','Reference.fasta','Sample1'])
+        eq_(False, args.resume)
+        ok_('minth' in args.stage_config['base_caller'])
+        ok_('threads' not in args.stage_config['base_caller'])
+        args, _ = runsample.parse_args(['ReadsBySample','Reference.fasta','Sample1','--resume'])
+        eq_(True, args.resume)
+
+class TestMakeStages(unittest.TestCase):
+    cmd_args = {
+        'samplename': 'Sample1', 'tdir': 'tdir', 'readsdir': 'ReadsBySample',
+        'reference': 'tdir/Reference.fasta', 'bamfile': 'tdir/Sample1.bam',
+        'flagstats': 'tdir/flagstats.txt', 'consensus': 'c.fasta',
+        'vcf': 'tdir/Sample1.bam.vcf', 'CN': None, 'trim_qual': 20,
+        'trim_outdir': 'tdir/trimmed_reads', 'filtered_dir': 'tdir/filtered',
+        'head_crop': 0, 'minth': 0.8, 'config': None, 'platforms': [],
+        'drop_ns': False, 'index_min': 0, 'primer_info': (None,None,None,None)
+    }
+
+    def setUp(self):
+        args, _ = runsample.parse_args(['ReadsBySample','Reference.fasta','Sample1'])
+        cmd_args = dict(self.cmd_args)
+        self.cmd_args = cmd_args
+        self.stages = dict(
+            (s.name, s) for s in
+            runsample.make_stages(args, cmd_args, None, 'bwa.log', 'flagstats.txt')
+        )
+
+    def test_stages_after_tagreads_only_need_tagged_bam(self):
+        for name in ('base_caller', 'flagstat', 'graphsample'):
+            eq_(['tagreads'], self.stages[name].requires)
+
+    def test_fqstats_only_needs_trimmed_reads(self):
+        eq_(['trim_reads'], self.stages['fqstats'].requires)
+
+    def test_isolated_stages_use_subprocess(self):
+        args, _ = runsample.parse_args([
+            'ReadsBySample','Reference.fasta','Sample1',
+            '--stage-mode', 'inline', '--isolate', 'base_caller'
+        ])
+        eq_('inline', args.stage_mode)
+        eq_(['base_caller'], args.isolate)
+
+    def test_mapping_is_critical(self):
+        ok_(self.stages['run_bwa_on_samplename'].critical)
+
+    def test_valid_graph(self):
+        from ngs_mapper.stages import check_stage_graph
+        check_stage_graph(self.stages.values())
+
+    def test_params_do_not_contain_tdir(self):
+        for stage in self.stages.values():
+            ok_('tdir/' not in json.dumps(stage.params), stage.name)
+
+    def test_tagreads_modifies_mapped_bam(self):
+        ok_('tdir/Sample1.bam' in self.stages['tagreads'].outputs)
+        ok_('tdir/Sample1.bam' in self.stages['run_bwa_on_samplename'].outputs)
+
+    def test_kmer_filter_only_when_asked(self):
+        ok_('kmer_filter' not in self.stages)
+        eq_(['trim_reads'], self.stages['run_bwa_on_samplename'].requires)
+        args, _ = runsample.parse_args(['ReadsBySample','Reference.fasta','Sample1','--kmer-filter'])
+        stages = dict(
+            (s.name, s) for s in
+            runsample.make_stages(args, self.cmd_args, None, 'bwa.log', 'flagstats.txt')
+        )
+        eq_(['trim_reads'], stages['kmer_filter'].requires)
+        eq_(['kmer_filter'], stages['run_bwa_on_samplename'].requires)
+        ok_('tdir/kmer_filtered' in stages['kmer_filter'].outputs)
+        eq_(args.stage_cpus['kmer_filter'], stages['kmer_filter'].cpus)
+        ok_(' -t ' not in stages['kmer_filter'].params['command'])
+        ok_(stages['run_bwa_on_samplename'].params['command'].startswith(
+            'run_bwa_on_samplename ./kmer_filtered '))
+        from ngs_mapper.stages import check_stage_graph
+        check_stage_graph(stages.values())
+
+    def test_minth_only_changes_base_caller_key(self):
+        from ngs_mapper.stages import stage_keys
+        args, _ = runsample.parse_args(['ReadsBySample','Reference.fasta','Sample1'])
+        self.cmd_args['minth'] = 0.9
+        stages = runsample.make_stages(args, self.cmd_args, None, 'bwa.log', 'flagstats.txt')
+        before = stage_keys(self.stages.values())
+        after = stage_keys(stages)
+        eq_(
+            set(['base_caller', 'vcf_consensus']),
+            set(n for n in after if after[n] != before[n])
+        )
+
+class TestMakeStagesBroker(unittest.TestCase):
+    def setUp(self):
+        runsample.logger = mock.Mock()
+        self.args, _ = runsample.parse_args(['ReadsBySample','Reference.fasta','Sample1'])
+        self.cmd_args = TestMakeStages.cmd_args
+        self.broker = mock.MagicMock(cpus=16)
+        grant = self.broker.grant.return_value.__enter__.return_value
+        grant.cpus = 6
+        grant.memory = 0
+
+    def _stages(self, broker):
+        return dict(
+            (s.name, s) for s in
+            runsample.make_stages(self.args, self.cmd_args, None, 'bwa.log', 'flagstats.txt', broker)
+        )
+
+    @mock.patch.object(runsample, 'command')
+    def test_threads_from_grant(self, m_command):
+        m_command.return_value.return_value = 0
+        stages = self._stages(self.broker)
+        eq_(1, stages['base_caller'].cpus)
+        eq_(0, stages['base_caller'].run())
+        self.broker.grant.assert_called_once_with(cpus=16, memory=0)
+        ok_(m_command.call_args[0][0].endswith('--threads 6'))
+
+    @mock.patch.object(runsample, 'command')
+    def test_single_threaded_stage_asks_for_one_cpu(self, m_command):
+        m_command.return_value.return_value = 0
+        self._stages(self.broker)['vcf_consensus'].run()
+        self.broker.grant.assert_called_once_with(cpus=1, memory=0)
+
+    @mock.patch.object(runsample, 'command')
+    def test_threads_from_config_without_broker(self, m_command):
+        m_command.return_value.return_value = 0
+        self.args.stage_cpus['base_caller'] = 3
+        stages = self._stages(None)
+        eq_(3, stages['base_caller'].cpus)
+        stages['base_caller'].run()
+        ok_(m_command.call_args[0][0].endswith('--threads 3'))
+
+    @mock.patch.object(runsample, 'sh')
+    def test_ngs_filter_threads_with_config(self, m_sh):
+        self.cmd_args = dict(self.cmd_args, config='config.yaml')
+        eq_(0, self._stages(self.broker)['ngs_filter'].run())
+        eq_(6, m_sh.ngs_filter.call_args[1]['threads'])
+        eq_('config.yaml', m_sh.ngs_filter.call_args[1]['config'])
+
+    def test_trim_reads_single_threaded_without_broker(self):
+        eq_(1, self._stages(None)['trim_reads'].cpus)
+
+    @mock.patch.object(runsample, 'command')
+    def test_shm_is_not_a_mapping_param(self, m_command):
+        m_command.return_value.return_value = 0
+        before = self._stages(None)['run_bwa_on_samplename'].params
+        self.args.refstore = 'refs'
+        self.args.shm = True
+        stages = self._stages(None)
+        eq_(before, stages['run_bwa_on_samplename'].params)
+        stages['run_bwa_on_samplename'].run()
+        ok_(' --refstore refs --shm -t ' in m_command.call_args[0][0])
+
+    @mock.patch.object(runsample, 'command')
+    def test_mapped_bam_uses_temp_compression(self, m_command):
+        m_command.return_value.return_value = 0
+        before = self._stages(None)['run_bwa_on_samplename'].params
+        self.args.temp_compression = 1
+        stages = self._stages(None)
+        eq_(before, stages['run_bwa_on_samplename'].params)
+        stages['run_bwa_on_samplename'].run()
+        ok_(' --compression 1 --temp-compression 1 ' in m_command.call_args[0][0])
+
+class TestResumeInto(unittest.TestCase):
+    def setUp(self):
+        self.outdir = tempfile.mkdtemp()
+        self.tdir = tempfile.mkdtemp('runsample', 'Sample1', dir=self.outdir)
+        self.oldtdir = tempfile.mkdtemp('runsample', 'Sample1', dir=self.outdir)
+        os.mkdir(join(self.outdir, 'trimmed_reads'))
+        open(join(self.outdir, 'Sample1.bam'), 'w').close()
+
+    def tearDown(self):
+        shutil.rmtree(self.outdir)
+
+    def test_moves_previous_output(self):
+        runsample.resume_into(self.outdir, self.tdir, 'Sample1')
+        eq_(
+            sorted(['trimmed_reads', 'Sample1.bam']),
+            sorted(os.listdir(self.tdir))
+        )
+        eq_(
+            sorted([basename(self.tdir), basename(self.oldtdir)]),
+            sorted(os.listdir(self.outdir))
+        )
+
+    def test_move_replace_replaces_directory(self):
+        os.mkdir(join(self.tdir, 'trimmed_reads'))
+        open(join(self.tdir, 'trimmed_reads', 'old.fastq'), 'w').close()
+        runsample.move_replace(join(self.outdir, 'trimmed_reads'), self.tdir)
+        eq_([], os.listdir(join(self.tdir, 'trimmed_reads')))
+
+class TestCommand(unittest.TestCase):
+    def setUp(self):
+        runsample.logger = mock.Mock()
+        self.main = mock.Mock(return_value=0)
+        self.mains = {'tagreads': self.main}
+
+    @mock.patch.object(runsample, 'wait_popen')
+    @mock.patch.object(runsample, 'run_cmd')
+    def test_subprocess_without_main(self, m_run_cmd, m_wait_popen):
+        m_wait_popen.return_value = 2
+        r = runsample.command('fqstats -o out.png', 'stdout', mode='fork', mains=self.mains)()
+        eq_(2, r)
+        m_wait_popen.assert_called_once_with(m_run_cmd.return_value, 'fqstats -o out.png', mock.ANY)
+        m_run_cmd.assert_called_once_with(
+            'fqstats -o out.png', stdout='stdout', stderr=subprocess.STDOUT, script_dir=None
+        )
+
+    @mock.patch.object(runsample, 'fork_main')
+    def test_fork(self, m_fork_main):
+        m_fork_main.return_value = 0
+        r = runsample.command('tagreads bam -CN foo', 'stdout', mode='fork', mains=self.mains)()
+        eq_(0, r)
+        m_fork_main.assert_called_once_with(self.main, ['bam', '-CN', 'foo'], 'stdout')
+
+    def test_inline(self):
+        r = runsample.command('tagreads bam', StringIO(), mode='inline', mains=self.mains)()
+        eq_(0, r)
+        self.main.assert_called_once_with(['bam'])
+
+    def test_inline_writes_bwa_log(self):
+        tdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tdir)
+        bwalog = join(tdir, 'bwa.log')
+        def main(argv):
+            print 'mapped'
+            sys.stderr.write('[M::bwa_idx_load_from_disk]\n')
+            return 0
+        with open(bwalog, 'wb') as blog:
+            r = runsample.command(
+                'run_bwa_on_samplename reads ref.fa', stdout=blog, mode='inline',
+                mains={'run_bwa_on_samplename': main}
+            )()
+        eq_(0, r)
+        eq_('mapped\n[M::bwa_idx_load_from_disk]\n', open(bwalog).read())
+
+    @mock.patch.object(runsample, 'wait_popen')
+    @mock.patch.object(runsample, 'run_cmd')
+    def test_script_dir_always_subprocess(self, m_run_cmd, m_wait_popen):
+        m_wait_popen.return_value = 0
+        runsample.command('tagreads bam', 'stdout', script_dir='', mode='inline', mains=self.mains)()
+        ok_(m_run_cmd.called)
+        ok_(not self.main.called)
@@ -0,0 +1,343 @@
+from imports import *
+
+from ngs_mapper import runsamplesheet
+from ngs_mapper.runsamplesheet import SampleQueue, PENDING, RUNNING, DONE, FAILED
+
+class Base(BaseTester):
+    modulepath = 'ngs_mapper.runsamplesheet'
+
+    def setUp(self):
+        self.tdir = tempfile.mkdtemp()
+        self.cwd = os.getcwd()
+        os.chdir(self.tdir)
+        os.mkdir(runsamplesheet.QUEUEDIR)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tdir)
+
+    def _queue(self, samples):
+        queue = SampleQueue(join(runsamplesheet.QUEUEDIR, 'queue.json'))
+        for name, ref, size in samples:
+            queue.add(name, ref, size)
+        queue.reorder()
+        return queue
+
+class TestReadSamplesheet(Base):
+    functionname = 'read_samplesheet'
+
+    def test_skips_comments_and_invalid_lines(self):
+        open('ref.fasta', 'w').close()
+        with open('samplesheet.tsv', 'w') as fh:
+            fh.write('#Sample\tReference\n')
+            fh.write('s1\tref.fasta\r\n')
+            fh.write('s2 ref.fasta\n')
+            fh.write('s3\n')
+            fh.write('s4\tmissing.fasta\n')
+            fh.write('\n')
+        eq_([('s1', 'ref.fasta'), ('s2', 'ref.fasta')], self._C('samplesheet.tsv'))
+
+class TestSampleSize(Base):
+    functionname = 'sample_size'
+
+    def test_sums_read_files(self):
+        os.makedirs('s1/sub')
+        with open('s1/r1.fastq', 'w') as fh:
+            fh.write('A' * 10)
+        with open('s1/sub/r2.fastq', 'w') as fh:
+            fh.write('A' * 5)
+        eq_(15, self._C('s1'))
+
+class TestOrderSamples(Base):
+    functionname = 'order_samples'
+
+    def test_groups_by_reference_largest_first(self):
+        samples = [
+            {'name': 'a', 'reference': 'den1', 'size': 10},
+            {'name': 'b', 'reference': 'den2', 'size': 50},
+            {'name': 'c', 'reference': 'den1', 'size': 100},
+            {'name': 'd', 'reference': 'den2', 'size': 60},
+        ]
+        eq_(['c', 'a', 'd', 'b'], self._C(samples))
+
+    def test_predicted_walltime_over_size(self):
+        samples = [
+            {'name': 'a', 'reference': 'den1', 'size': 10, 'walltime': 600},
+            {'name': 'b', 'reference': 'den2', 'size': 50, 'walltime': 60},
+        ]
+        eq_(['a', 'b'], self._C(samples))
+        # Only used when every sample has a prediction
+        samples[0]['walltime'] = None
+        eq_(['b', 'a'], self._C(samples))
+
+class TestSampleQueue(Base):
+    def test_next_follows_order_and_persists(self):
+        queue = self._queue([('small', 'ref', 1), ('big', 'ref', 100)])
+        s = queue.next()
+        eq_('big', s['name'])
+        eq_(1, s['attempts'])
+        reloaded = SampleQueue(queue.path)
+        eq_(RUNNING, reloaded.samples['big']['status'])
+        eq_(['big', 'small'], reloaded.order)
+
+    def test_failed_sample_is_retried(self):
+        queue = self._queue([('s1', 'ref', 1)])
+        queue.next()
+        eq_(PENDING, queue.finish('s1', 1, retries=1))
+        queue.next()
+        eq_(FAILED, queue.finish('s1', 1, retries=1))
+        eq_(None, queue.next())
+
+    def test_reset_requeues_running_and_retryable(self):
+        queue = self._queue([('s1', 'ref', 1), ('s2', 'ref', 2), ('s3', 'ref', 3)])
+        queue.samples['s1'].update(status=RUNNING, attempts=1)
+        queue.samples['s2'].update(status=FAILED, attempts=2)
+        queue.samples['s3'].update(status=DONE, attempts=1)
+        queue.reset(retries=2)
+        eq_(PENDING, queue.samples['s1']['status'])
+        eq_(PENDING, queue.samples['s2']['status'])
+        eq_(DONE, queue.samples['s3']['status'])
+
+    def test_add_keeps_existing(self):
+        queue = self._queue([('s1', 'ref', 1)])
+        queue.samples['s1']['status'] = DONE
+        ok_(not queue.add('s1', 'ref', 1, 30.0))
+        eq_(DONE, queue.samples['s1']['status'])
+        eq_(30.0, queue.samples['s1']['walltime'])
+
+class TestThroughput(Base):
+    functionname = 'throughput'
+
+    def test_rates_and_eta(self):
+        queue = self._queue([('s1', 'ref', 1024**2 * 60), ('s2', 'ref', 1024**2 * 60)])
+        queue.samples['s1'].update(status=DONE, end=100)
+        r = self._C(queue, 0, now=3600)
+        ok_('1/2 samples done' in r, r)
+        ok_('1.0 samples/hour' in r, r)
+        ok_('1.0 MB/minute' in r, r)
+        ok_('about 60 minutes left' in r, r)
+
+    def test_nothing_finished(self):
+        queue = self._queue([('s1', 'ref', 1)])
+        eq_('0/1 samples done, 0 failed, 0 running, 1 pending', self._C(queue, 0, now=10))
+
+class TestRunsampleCommand(Base):
+    functionname = 'runsample_command'
+
+    def test_command(self):
+        sample = {'name': 's1', 'reference': 'ref.fasta'}
+        eq_(
+            ['runsample', 'reads/s1', 'ref.fasta', 's1', '-od', 'Projects/s1',
+             '--broker', 'b', '--resume', '-minth', '0.9'],
+            self._C('reads', sample, ['-minth', '0.9'], 'b', True)
+        )
+
+class TestRunQueue(Base):
+    functionname = 'run_queue'
+
+    def test_runs_every_sample_with_retries(self):
+        queue = self._queue([('s1', 'ref', 1), ('s2', 'ref', 2), ('s3', 'ref', 3)])
+        calls = []
+        def runner(readsdir, sample, options, broker):
+            calls.append((sample['name'], sample['attempts']))
+            if sample['name'] == 's2':
+                return 1
+            return 0
+        self._C(queue, 'reads', 2, 1, [], runner=runner)
+        eq_(DONE, queue.samples['s1']['status'])
+        eq_(FAILED, queue.samples['s2']['status'])
+        eq_(DONE, queue.samples['s3']['status'])
+        eq_(sorted([('s3',1), ('s2',1), ('s2',2), ('s1',1)]), sorted(calls))
+
+class TestRunsampleOptions(Base):
+    functionname = 'runsample_options'
+
+    def test_refstore_and_shm(self):
+        args = runsamplesheet.parse_args(['reads', 'sheet.tsv', '--refstore', 'refs', '--shm',
+            '--runsample-options', '-minth 0.9'])
+        eq_(['--refstore', 'refs', '--shm', '-minth', '0.9'], self._C(args))
+
+    def test_shm_needs_refstore(self):
+        args = runsamplesheet.parse_args(['reads', 'sheet.tsv', '--refstore', '', '--shm'])
+        eq_([], self._C(args))
+
+class TestPostSteps(Base):
+    functionname = 'post_steps'
+
+    @patch('ngs_mapper.runsamplesheet.subprocess.Popen')
+    def test_runs_both_at_once(self, popen):
+        popen.return_value.wait.return_value = 0
+        r = self._C()
+        eq_({'graphs.sh': 0, 'consensuses.sh': 0}, r)
+        # Both were started before either was waited on
+        eq_(2, popen.call_count)
+        ok_(call(['graphs.sh', '-norecreate']) in popen.call_args_list)
+
+    @patch('ngs_mapper.runsamplesheet.subprocess.Popen')
+    def test_missing_command(self, popen):
+        popen.side_effect = OSError('missing')
+        eq_({'graphs.sh': 1, 'consensuses.sh': 1}, self._C())
+
+class TestPackSamples(Base):
+    functionname = 'pack_samples'
+
+    def _samples(self, sizes):
+        return [{'name': 's{0}'.format(i), 'reference': 'ref', 'size': s} for i, s in enumerate(sizes)]
+
+    def test_packs_small_samples_together(self):
+        groups = self._C(self._samples([6, 1, 3, 2, 4]), 7)
+        eq_([[6, 1], [4, 3], [2]], [[s['size'] for s in g] for g in groups])
+
+    def test_large_sample_alone(self):
+        groups = self._C(self._samples([20, 1, 1]), 5)
+        eq_([[20], [1, 1]], [[s['size'] for s in g] for g in groups])
+
+    def test_by_walltime(self):
+        samples = self._samples([1, 1, 1])
+        for s, walltime in zip(samples, [50, 30, 20]):
+            s['walltime'] = walltime
+        groups = self._C(samples, 60, 'walltime')
+        eq_([['s0'], ['s1', 's2']], [[s['name'] for s in g] for g in groups])
+
+class TestArrayResources(Base):
+    functionname = 'array_resources'
+
+    def test_largest_element(self):
+        groups = [
+            [{'walltime': 3600, 'memory': 100}, {'walltime': 1800, 'memory': 300}, {'walltime': 1800, 'memory': 200}],
+            [{'walltime': 600, 'memory': 1000.5}],
+        ]
+        # 7200 / 2 + 3600 / 2 seconds and 300 + 200 at once for the first element
+        eq_('nodes=1:ppn=2,walltime=01:30:00,mem=1001mb', self._C(groups, 'nodes=1:ppn=2'))
+
+    def test_keeps_requested(self):
+        groups = [[{'walltime': 60, 'memory': None}]]
+        eq_('nodes=1:ppn=1,walltime=10:00:00', self._C(groups, 'nodes=1:ppn=1,walltime=10:00:00'))
+
+class TestManifest(Base):
+    functionname = 'read_manifest'
+
+    def test_round_trip(self):
+        groups = [
+            [{'name': 's1', 'reference': 'ref1', 'size': 5}],
+            [{'name': 's2', 'reference': 'ref2', 'size': 2}, {'name': 's3', 'reference': 'ref1', 'size': 1}],
+        ]
+        runsamplesheet.write_manifest('array.tsv', groups)
+        eq_(groups[0], self._C('array.tsv', 0))
+        eq_(groups[1], self._C('array.tsv', 1))
+        eq_([], self._C('array.tsv', 2))
+
+class TestPbsArrayJob(Base):
+    functionname = 'pbs_array_job'
+
+    def test_valid_script(self):
+        script = self._C(
+            '/reads', '/path/sheet.tsv', 'runsamplesheet/array.tsv', 3,
+            'nodes=1:ppn=4,walltime=10:00:00', 'me@example.com', '-minth 0.9'
+        )
+        ok_('#PBS -t 0-2\n' in script)
+        ok_('#PBS -l nodes=1:ppn=4,walltime=10:00:00\n' in script)
+        ok_('#PBS -M me@example.com\n' in script)
+        ok_("-j 4 --no-post --runsample-options '-minth 0.9'" in script)
+        script = self._C(
+            '/reads', '/path/sheet.tsv', 'runsamplesheet/array.tsv', 3,
+            'nodes=1:ppn=4', element_options=['--retries', '2', '--broker', '']
+        )
+        ok_("-j 4 --no-post --retries 2 --broker ''\n" in script)
+        with open('array.pbs', 'w') as fh:
+            fh.write(script)
+        eq_(0, subprocess.call(['bash', '-n', 'array.pbs']))
+
+class TestMainArray(Base):
+    functionname = 'main'
+
+    def setUp(self):
+        super(TestMainArray, self).setUp()
+        os.mkdir('reads')
+        open('ref.fasta', 'w').close()
+        with open('sheet.tsv', 'w') as fh:
+            for i, size in enumerate([3, 1, 2, 4]):
+                name = 's{0}'.format(i)
+                os.mkdir(join('reads', name))
+                with open(join('reads', name, 'r.fastq'), 'w') as rfh:
+                    rfh.write('A' * size * 1024**2)
+                fh.write('{0}\tref.fasta\n'.format(name))
+
+    def _main(self, args):
+        with patch('sys.stdout', new_callable=StringIO) as out:
+            rc = self._C(['reads', 'sheet.tsv'] + args)
+        return rc, out.getvalue()
+
+    def test_every_sample_in_one_element(self):
+        rc, out = self._main(['--pbs-array', '--pack-size', '5', '--qsub_l', 'nodes=1:ppn=2'])
+        eq_(0, rc)
+        eq_('', out)
+        script = open(join(runsamplesheet.QUEUEDIR, 'array.pbs')).read()
+        ok_(script.startswith('#!/bin/bash\n'))
+        ok_('#PBS -t 0-1\n' in script)
+        names = []
+        for element in (0, 1):
+            names += [s['name'] for s in runsamplesheet.read_manifest(
+                join(runsamplesheet.QUEUEDIR, 'array.tsv'), element
+            )]
+        eq_(['s0', 's1', 's2', 's3'], sorted(names))
+
+    def test_element_options(self):
+        with patch.dict('os.environ', {'TMPDIR': '/tmp'}):
+            rc, out = self._main(['--pbs-array', '--refstore', 'refs', '--shm', '--retries', '3',
+                '--broker', '/shared/broker', '--runsample-options', '-minth 0.9'])
+        eq_(0, rc)
+        script = open(join(runsamplesheet.QUEUEDIR, 'array.pbs')).read()
+        ok_("--no-post --retries 3 --broker /shared/broker --refstore refs --shm "
+            "--runsample-options '-minth 0.9'\n" in script)
+
+    def test_node_broker_left_to_elements(self):
+        with patch.dict('os.environ', {'TMPDIR': '/scratch'}):
+            os.environ.pop('BROKER', None)
+            os.environ.pop('REFSTORE', None)
+            rc, out = self._main(['--pbs-array'])
+        script = open(join(runsamplesheet.QUEUEDIR, 'array.pbs')).read()
+        ok_(script.endswith('--no-post --retries 1\n'))
+
+    def test_output(self):
+        rc, out = self._main(['--pbs-array', '-o', 'array.pbs'])
+        eq_(0, rc)
+        ok_(open('array.pbs').read().startswith('#!/bin/bash\n'))
+
+    def test_element_dry_run(self):
+        self._main(['--pbs-array', '--pack-size', '5'])
+        rc, out = self._main(['--array-element', '1', '--dry-run', '--broker', '', '--refstore', 'refs'])
+        eq_(0, rc)
+        eq_(
+            'runsample reads/s0 ref.fasta s0 -od Projects/s0 --refstore refs\n'
+            'runsample reads/s2 ref.fasta s2 -od Projects/s2 --refstore refs\n',
+            out
+        )
+        ok_(not exists(join(runsamplesheet.QUEUEDIR, 'array-1.json')))
+
+    def test_predict(self):
+        from ngs_mapper import predict, summary
+        from test_predict import make_history
+        for h in make_history([1, 2, 3]):
+            projdir = join(runsamplesheet.PROJDIR, h['samplename'])
+            os.makedirs(projdir)
+            summary.write_summary(summary.project_summary_path(projdir), h)
+        with patch.object(predict, 'input_features') as input_features:
+            input_features.side_effect = lambda readsdir, ref: {
+                'input_bytes': {'MiSeq': 10 * 1024**2 if readsdir.endswith('s0') else 0},
+                'reference_length': 1000
+            }
+            rc, out = self._main(['--predict'])
+        eq_(0, rc)
+        lines = out.splitlines()
+        eq_('sample\treference\tinput_mb\twalltime\tmemory_mb', lines[0])
+        # 130 and 40 seconds, 120 and 102MB with the 1.25 margin
+        eq_(['s0', 'ref.fasta', '3.0', '00:03:00', '150'], lines[1].split('\t'))
+        eq_(['s1', 'ref.fasta', '1.0', '00:01:00', '128'], lines[2].split('\t'))
+
+    def test_predict_without_history(self):
+        eq_(1, self._main(['--predict'])[0])
+
+    def test_predict_array_element(self):
+        with patch('sys.stderr', new_callable=StringIO):
+            assert_raises(SystemExit, self._main, ['--predict', '--array-element', '0'])
@@ -0,0 +1,94 @@
+from imports import *
+
+from ngs_mapper.shmindex import SharedIndex, SharedIndexError, shm_prefix
+from ngs_mapper.refstore import RefStore, BWA_INDEX
+
+from test_refstore import fake_indexer
+
+# Keeps the names bwa shm would have loaded in a file next to it
+FAKE_BWA = '''#!/bin/sh
+here=$(dirname "$0")
+case "$2" in
+    -l) cat "$here/loaded" 2>/dev/null; true ;;
+    -d) : > "$here/loaded"; echo drop >> "$here/calls" ;;
+    *) printf "%s\\t100\\n" "$(basename "$2")" >> "$here/loaded"; echo "load $(basename "$2")" >> "$here/calls" ;;
+esac
+'''
+
+def dead_pid():
+    p = subprocess.Popen(['true'])
+    p.wait()
+    return p.pid
+
+class Base(BaseTester):
+    modulepath = 'ngs_mapper.shmindex'
+
+    def setUp(self):
+        self.tdir = tempfile.mkdtemp()
+        self.root = join(self.tdir, 'refs')
+        self.bwa = join(self.tdir, 'bwa')
+        with open(self.bwa, 'w') as fh:
+            fh.write(FAKE_BWA)
+        os.chmod(self.bwa, 0755)
+        self.refs = []
+        for name, seq in (('den1', 'AAAAC'), ('den3', 'ACGTACGT')):
+            self.refs.append(join(self.tdir, name + '.fasta'))
+            with open(self.refs[-1], 'w') as fh:
+                fh.write('>{0}\n{1}\n'.format(name, seq))
+        self.shared = SharedIndex(self.root, self.bwa)
+        self.shared.store = RefStore(self.root, fake_indexer)
+
+    def tearDown(self):
+        shutil.rmtree(self.tdir)
+
+    def _calls(self):
+        path = join(self.tdir, 'calls')
+        if not exists(path):
+            return []
+        return open(path).read().splitlines()
+
+class TestShmPrefix(Base):
+    functionname = 'shm_prefix'
+
+    def test_named_after_contents(self):
+        store = RefStore(self.root, fake_indexer)
+        prefix = self._C(store, self.refs[0])
+        stored = store.reference(self.refs[0])
+        eq_(dirname(stored), dirname(prefix))
+        eq_(basename(dirname(stored)) + '.fasta', basename(prefix))
+        for ext in ('',) + BWA_INDEX:
+            eq_(os.path.realpath(stored + ext), os.path.realpath(prefix + ext))
+        eq_(prefix, self._C(store, self.refs[0]))
+
+class TestSharedIndex(Base):
+    def test_loaded_once_and_unloaded_by_last_holder(self):
+        prefix = self.shared.acquire(self.refs[0], pid=os.getpid())
+        eq_(prefix, self.shared.acquire(self.refs[0], pid=os.getppid()))
+        eq_([basename(prefix)], self.shared.loaded())
+        self.shared.release(prefix, pid=os.getppid())
+        eq_([basename(prefix)], self.shared.loaded())
+        self.shared.release(prefix)
+        eq_([], self.shared.loaded())
+        eq_(['load ' + basename(prefix), 'drop'], self._calls())
+
+    def test_held_indexes_are_loaded_again(self):
+        p1 = self.shared.acquire(self.refs[0])
+        p2 = self.shared.acquire(self.refs[1], pid=os.getppid())
+        self.shared.release(p1)
+        eq_([basename(p2)], self.shared.loaded())
+
+    def test_dead_holders_are_dropped(self):
+        prefix = self.shared.acquire(self.refs[0], pid=dead_pid())
+        with self.shared.hold(self.refs[1]) as other:
+            eq_([basename(other)], self.shared.loaded())
+        eq_([], self.shared.loaded())
+
+    def test_hold(self):
+        with self.shared.hold(self.refs[0]) as prefix:
+            eq_([basename(prefix)], self.shared.loaded())
+        eq_([], self.shared.loaded())
+
+    def test_bwa_fails(self):
+        with open(self.bwa, 'w') as fh:
+            fh.write('#!/bin/sh\necho no shared memory\nexit 1\n')
+        assert_raises(SharedIndexError, self.shared.acquire, self.refs[0])
@@ -0,0 +1,375 @@
+from imports import *
+
+import threading
+import time
+
+from ngs_mapper.stages import Stage, StageGraphError
+
+class Base(BaseTester):
+    modulepath = 'ngs_mapper.stages'
+
+class TestCheckStageGraph(Base):
+    functionname = 'check_stage_graph'
+
+    def _stage(self, name, requires=()):
+        return Stage(name, lambda: 0, requires=requires)
+
+    def test_valid_graph(self):
+        self._C([self._stage('a'), self._stage('b', ['a']), self._stage('c', ['a','b'])])
+
+    def test_returns_requirement_order(self):
+        r = self._C([self._stage('c', ['b']), self._stage('a'), self._stage('b', ['a'])])
+        eq_(['a', 'b', 'c'], r)
+
+    @raises(StageGraphError)
+    def test_duplicate_names(self):
+        self._C([self._stage('a'), self._stage('a')])
+
+    @raises(StageGraphError)
+    def test_unknown_requirement(self):
+        self._C([self._stage('a', ['b'])])
+
+    @raises(StageGraphError)
+    def test_circular_requirements(self):
+        self._C([self._stage('a', ['c']), self._stage('b', ['a']), self._stage('c', ['b'])])
+
+class TestRunStages(Base):
+    functionname = 'run_stages'
+
+    def setUp(self):
+        self.lock = threading.Lock()
+        self.running = 0
+        self.maxrunning = 0
+        self.order = []
+
+    def _run(self, name, returncode=0, sleep=0.05):
+        def run():
+            with self.lock:
+                self.running += 1
+                self.maxrunning = max(self.maxrunning, self.running)
+                self.order.append(name)
+            time.sleep(sleep)
+            with self.lock:
+                self.running -= 1
+            return returncode
+        return run
+
+    def test_returns_returncodes_in_declared_order(self):
+        stages = [
+            Stage('b', self._run('b', 1)),
+            Stage('a', self._run('a')),
+        ]
+        r = self._C(stages, 2)
+        eq_([('b',1), ('a',0)], r.items())
+
+    def test_requirements_run_first(self):
+        stages = [
+            Stage('c', self._run('c'), requires=['b']),
+            Stage('b', self._run('b'), requires=['a']),
+            Stage('a', self._run('a')),
+        ]
+        self._C(stages, 4)
+        eq_(['a','b','c'], self.order)
+
+    def test_independent_stages_run_concurrently(self):
+        stages = [Stage(n, self._run(n)) for n in 'abc']
+        self._C(stages, 3)
+        eq_(3, self.maxrunning)
+
+    def test_respects_cpu_budget(self):
+        stages = [Stage(n, self._run(n), cpus=2) for n in 'abcd']
+        self._C(stages, 4)
+        eq_(2, self.maxrunning)
+
+    def test_stage_larger_than_budget_runs_alone(self):
+        stages = [
+            Stage('a', self._run('a'), cpus=8),
+            Stage('b', self._run('b')),
+        ]
+        r = self._C(stages, 2)
+        eq_(1, self.maxrunning)
+        eq_([0, 0], r.values())
+
+    def test_skips_stages_whose_requirements_failed(self):
+        stages = [
+            Stage('a', self._run('a', 1)),
+            Stage('b', self._run('b'), requires=['a']),
+            Stage('c', self._run('c'), requires=['b']),
+            Stage('d', self._run('d')),
+        ]
+        r = self._C(stages, 1)
+        eq_({'a':1, 'b':None, 'c':None, 'd':0}, dict(r))
+
+    def test_critical_failure_stops_new_stages(self):
+        stages = [
+            Stage('a', self._run('a', 2), critical=True),
+            Stage('b', self._run('b')),
+        ]
+        r = self._C(stages, 1)
+        eq_({'a':2, 'b':None}, dict(r))
+        eq_(['a'], self.order)
+
+    def test_exception_is_failure(self):
+        def boom():
+            raise ValueError('boom')
+        r = self._C([Stage('a', boom), Stage('b', self._run('b'), requires=['a'])])
+        eq_({'a':1, 'b':None}, dict(r))
+
+    def test_records_timings(self):
+        timings = []
+        self._C([Stage('a', self._run('a')), Stage('b', self._run('b', 3), requires=['a'])], timings=timings)
+        eq_(['a','b'], [t['name'] for t in timings])
+        eq_([0, 3], [t['returncode'] for t in timings])
+        ok_(timings[0]['end'] <= timings[1]['start'])
+        ok_(timings[0]['duration'] >= 0.05)
+
+    def test_records_usage_of_waited_processes(self):
+        from ngs_mapper.stages import wait_popen
+        def run():
+            p = subprocess.Popen(['python', '-c', 'x = "a" * 50 * 1024**2'])
+            return wait_popen(p)
+        timings = []
+        self._C([Stage('a', run), Stage('b', self._run('b'))], timings=timings)
+        timings = dict((t['name'], t) for t in timings)
+        ok_(timings['a']['maxrss'] >= 50)
+        ok_(timings['a']['cpu'] > 0)
+        eq_(timings['a']['cpu'], timings['a']['user'] + timings['a']['sys'])
+        eq_(1, len(timings['a']['processes']))
+        process = timings['a']['processes'][0]
+        eq_(None, process['command'])
+        ok_(process['write_bytes'] >= 0)
+        # Nothing was waited on
+        ok_('maxrss' not in timings['b'])
+        eq_([], timings['b'].get('processes', []))
+
+    def test_fork_main_records_command(self):
+        from ngs_mapper.stages import fork_main
+        def main(argv):
+            return 0
+        def run():
+            return fork_main(main, ['-x', 'y'])
+        timings = []
+        self._C([Stage('a', run)], timings=timings)
+        process = timings[0]['processes'][0]
+        eq_(__name__ + ' -x y', process['command'])
+        ok_(process['wall'] >= 0)
+
+class TestCallMain(Base):
+    functionname = 'call_main'
+
+    def _main(self, result=None, exc=None):
+        def main(argv):
+            self.argv = argv
+            if exc is not None:
+                raise exc
+            return result
+        return main
+
+    def test_passes_argv(self):
+        eq_(0, self._C(self._main(), ['-o', 'out']))
+        eq_(['-o', 'out'], self.argv)
+
+    def test_int_return_is_exit_code(self):
+        eq_(3, self._C(self._main(3), []))
+
+    def test_other_return_is_success(self):
+        eq_(0, self._C(self._main('out.bam'), []))
+
+    def test_sys_exit(self):
+        eq_(0, self._C(self._main(exc=SystemExit()), []))
+        eq_(2, self._C(self._main(exc=SystemExit(2)), []))
+        eq_(1, self._C(self._main(exc=SystemExit('message')), []))
+
+    def test_exception(self):
+        eq_(1, self._C(self._main(exc=ValueError('bad')), []))
+
+class TestForkMain(Base):
+    functionname = 'fork_main'
+
+    def setUp(self):
+        self.tdir = tempfile.mkdtemp()
+        self.outfile = join(self.tdir, 'out.log')
+
+    def tearDown(self):
+        shutil.rmtree(self.tdir)
+
+    def test_runs_in_child_with_redirected_output(self):
+        def main(argv):
+            sys.stdout.write(' '.join(argv))
+            os.chdir(self.tdir)
+            return 4
+        cwd = os.getcwd()
+        with open(self.outfile, 'w') as fh:
+            r = self._C(main, ['a', 'b'], fh)
+        eq_(4, r)
+        eq_('a b', open(self.outfile).read())
+        # The child's chdir does not affect this process
+        eq_(cwd, os.getcwd())
+
+    def test_killed_child(self):
+        import signal
+        def main(argv):
+            os.kill(os.getpid(), signal.SIGTERM)
+        eq_(-signal.SIGTERM, self._C(main, []))
+
+class TestInlineMain(Base):
+    functionname = 'inline_main'
+
+    def test_holds_inline_lock(self):
+        from ngs_mapper.stages import INLINE_LOCK
+        def main(argv):
+            ok_(not INLINE_LOCK.acquire(False))
+        eq_(0, self._C(main, []))
+        ok_(INLINE_LOCK.acquire(False))
+        INLINE_LOCK.release()
+
+    def test_redirects_output(self):
+        import logging
+        stdout = sys.stdout
+        handler = logging.StreamHandler(sys.stdout)
+        log = logging.getLogger('test_inline_main')
+        log.addHandler(handler)
+        def main(argv):
+            print 'out'
+            sys.stderr.write('err\n')
+            log.warning('logged')
+        try:
+            out, err = StringIO(), StringIO()
+            eq_(0, self._C(main, [], out, err))
+        finally:
+            log.removeHandler(handler)
+        eq_('out\nlogged\n', out.getvalue())
+        eq_('err\n', err.getvalue())
+        ok_(sys.stdout is stdout)
+        ok_(handler.stream is stdout)
+
+class CacheBase(Base):
+    def setUp(self):
+        self.tdir = tempfile.mkdtemp()
+        self.ran = []
+
+    def tearDown(self):
+        shutil.rmtree(self.tdir)
+
+    def _path(self, name):
+        return join(self.tdir, name)
+
+    def _write(self, name, contents):
+        with open(self._path(name), 'w') as fh:
+            fh.write(contents)
+        return self._path(name)
+
+    def _stage(self, name, requires=(), outputs=None, params=None, inputs=(), returncode=0):
+        if outputs is None:
+            outputs = [self._path(name + '.out')]
+        def run():
+            self.ran.append(name)
+            for o in outputs:
+                with open(o, 'a') as fh:
+                    fh.write(name)
+            return returncode
+        return Stage(name, run, requires=requires, params=params, inputs=inputs, outputs=outputs)
+
+    def _cache(self):
+        from ngs_mapper.stages import StageCache
+        return StageCache(self._path('stages.json'), self.tdir)
+
+class TestFileDigest(CacheBase):
+    functionname = 'file_digest'
+
+    def test_file_contents(self):
+        a = self._write('a', 'ACGT')
+        b = self._write('b', 'ACGT')
+        eq_(self._C(a), self._C(b))
+        self._write('b', 'ACGA')
+        ok_(self._C(a) != self._C(b))
+
+    def test_directory(self):
+        os.mkdir(self._path('d'))
+        self._write('d/r1.fastq', 'ACGT')
+        r1 = self._C(self._path('d'))
+        self._write('d/r2.fastq', 'ACGT')
+        ok_(r1 != self._C(self._path('d')))
+
+    def test_missing(self):
+        eq_(None, self._C(self._path('missing')))
+
+class TestStageKeys(CacheBase):
+    functionname = 'stage_keys'
+
+    def test_requirement_key_changes_key(self):
+        r1 = self._C([self._stage('a', params=1), self._stage('b', ['a'])])
+        r2 = self._C([self._stage('a', params=2), self._stage('b', ['a'])])
+        ok_(r1['a'] != r2['a'])
+        ok_(r1['b'] != r2['b'])
+
+    def test_input_contents_change_key(self):
+        ref = self._write('ref.fasta', 'ACGT')
+        r1 = self._C([self._stage('a', inputs=[ref])])
+        eq_(r1, self._C([self._stage('a', inputs=[ref])]))
+        self._write('ref.fasta', 'ACGA')
+        ok_(r1 != self._C([self._stage('a', inputs=[ref])]))
+
+    @patch('ngs_mapper.stages.find_executable')
+    def test_tool_version_changes_key(self, find_executable):
+        tool = self._write('bwa', 'version1')
+        find_executable.return_value = tool
+        stage = self._stage('a')
+        stage.tools = ['bwa']
+        r1 = self._C([stage])
+        self._write('bwa', 'version2')
+        ok_(r1 != self._C([stage]))
+
+class TestRunStagesCache(CacheBase):
+    functionname = 'run_stages'
+
+    def _stages(self, minth=0.8):
+        return [
+            self._stage('map'),
+            self._stage('tag', ['map'], outputs=[self._path('map.out')]),
+            self._stage('call', ['tag'], params={'minth': minth}),
+            self._stage('graph', ['tag']),
+        ]
+
+    def test_second_run_runs_nothing(self):
+        self._C(self._stages(), cache=self._cache())
+        eq_(['map', 'tag', 'call', 'graph'], sorted(self.ran, key=['map','tag','call','graph'].index))
+        self.ran = []
+        r = self._C(self._stages(), cache=self._cache())
+        eq_([], self.ran)
+        eq_([0, 0, 0, 0], r.values())
+
+    def test_changed_params_only_rerun_stage_and_dependants(self):
+        self._C(self._stages(), cache=self._cache())
+        self.ran = []
+        self._C(self._stages(0.9), cache=self._cache())
+        eq_(['call'], self.ran)
+
+    def test_changed_output_reruns_stage_and_dependants(self):
+        self._C(self._stages(), cache=self._cache())
+        self.ran = []
+        os.unlink(self._path('graph.out'))
+        self._C(self._stages(), cache=self._cache())
+        eq_(['graph'], self.ran)
+
+    def test_rerunning_stage_reruns_stage_whose_output_it_modifies(self):
+        self._C(self._stages(), cache=self._cache())
+        self.ran = []
+        stages = self._stages()
+        stages[1].params = 'new CN'
+        self._C(stages, cache=self._cache())
+        eq_(set(['map', 'tag', 'call', 'graph']), set(self.ran))
+
+    def test_failed_stage_is_not_cached(self):
+        stages = self._stages()
+        stages[2] = self._stage('call', ['tag'], returncode=1)
+        self._C(stages, cache=self._cache())
+        self.ran = []
+        self._C(self._stages(), cache=self._cache())
+        eq_(['call'], self.ran)
+
+    def test_stages_without_outputs_always_run(self):
+        stages = [self._stage('a', outputs=[])]
+        self._C(stages, cache=self._cache())
+        self._C(stages, cache=self._cache())
+        eq_(['a', 'a'], self.ran)
@@ -0,0 +1,85 @@
+from imports import *
+
+import json
+
+class Base(BaseTester):
+    modulepath = 'ngs_mapper.summary'
+
+    def setUp(self):
+        self.tdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tdir)
+
+    def _qualdepth(self):
+        return {
+            'unmapped_reads': 5,
+            'Ref1': {'length': 4, 'reflen': 5, 'mapped_reads': 10, 'depths': [0,1,2,3]},
+            'Ref2': {'length': 5, 'mapped_reads': 20, 'depths': [1,1,1,1,1]},
+        }
+
+class TestProjectSummaryPath(Base):
+    functionname = 'project_summary_path'
+
+    def test_named_after_project(self):
+        eq_('Projects/s1/s1.summary.json', self._C('Projects/s1/'))
+
+class TestQualdepthSummary(Base):
+    functionname = 'qualdepth_summary'
+
+    def test_counts_and_breadth(self):
+        r = self._C(self._qualdepth())
+        eq_(35, r['reads'])
+        eq_(30, r['mapped_reads'])
+        eq_(5, r['unmapped_reads'])
+        # reflen is preferred over the pileup length
+        eq_(5, r['references']['Ref1']['length'])
+        eq_(3/5.0, r['references']['Ref1']['breadth'])
+        eq_(1.0, r['references']['Ref2']['breadth'])
+        eq_(8/10.0, r['breadth'])
+
+class TestMakeSummary(Base):
+    functionname = 'make_summary'
+
+    def test_combines_qualdepth_and_stages(self):
+        qdfile = join(self.tdir, 's1.bam.qualdepth.json')
+        with open(qdfile, 'w') as fh:
+            json.dump(self._qualdepth(), fh)
+        stages = [
+            {'name':'a', 'start':10.0, 'end':20.0, 'duration':10.0},
+            {'name':'b', 'start':20.0, 'end':35.0, 'duration':15.0},
+        ]
+        r = self._C('s1', qdfile, stages)
+        eq_('s1', r['samplename'])
+        eq_(30, r['mapped_reads'])
+        eq_(25.0, r['duration'])
+        eq_(stages, r['stages'])
+        ok_('cached' not in r)
+
+    def test_reads_feature_from_qualdepth(self):
+        qdfile = join(self.tdir, 's1.bam.qualdepth.json')
+        with open(qdfile, 'w') as fh:
+            json.dump(self._qualdepth(), fh)
+        features = {'input_bytes': {'MiSeq': 10}, 'reference_length': 5}
+        r = self._C('s1', qdfile, [], features, ['trim_reads'])
+        eq_(r['reads'], r['features']['reads'])
+        eq_(['trim_reads'], r['cached'])
+        ok_('reads' not in features)
+
+    def test_missing_qualdepth(self):
+        r = self._C('s1', join(self.tdir, 'missing.json'), [])
+        eq_({'samplename':'s1', 'stages':[]}, r)
+
+    def test_features(self):
+        features = {'input_bytes': {'MiSeq': 10}, 'reference_length': 5}
+        r = self._C('s1', None, [], features)
+        eq_(features, r['features'])
+
+class TestWriteLoadSummary(Base):
+    functionname = 'write_summary'
+
+    def test_roundtrip(self):
+        from ngs_mapper.summary import load_summary
+        path = join(self.tdir, 's1.summary.json')
+        self._C(path, {'samplename':'s1', 'duration':1.5})
+        eq_({'samplename':'s1', 'duration':1.5}, load_summary(path))
@@ -179,6 +179,59 @@ class TestUnitTagReads(Base):
         eq_( 1, counts['Sanger'] )
         eq_( 996, counts['MiSeq'] )
 
+    @patch('ngs_mapper.tagreads.indexbam')
+    @patch('ngs_mapper.tagreads.Popen')
+    @patch('ngs_mapper.tagreads.samtools')
+    def test_streams_tagged_reads_without_sorting( self, samtools, popen, indexbam ):
+        from StringIO import StringIO
+        bam = join( self.tempdir, 'in.bam' )
+        written = []
+        def fake_popen( cmd, stdin ):
+            p = Mock( returncode=0 )
+            p.stdin.write.side_effect = written.append
+            p.wait.side_effect = lambda: open( cmd[4], 'w' ).close()
+            return p
+        popen.side_effect = fake_popen
+        samtools.view.return_value = StringIO(
+            'AAAAA:00000:00000\t0\tRef1\t1\t60\t*\t=\t0\t0\t*\t*\n' \
+            'TestingAread_sanger\t0\tRef1\t2\t60\t*\t=\t0\t0\t*\t*\n'
+        )
+        self._C( bam, '@HD\tSO:coordinate\n' )
+        eq_( ['samtools','view','-Sb','-o',bam+'.tagged','-'], popen.call_args[0][0] )
+        eq_( '@HD\tSO:coordinate\n', written[0] )
+        ok_( written[1].startswith( 'AAAAA' ) and written[1].endswith( '\tRG:Z:IonTorrent\n' ) )
+        ok_( written[2].endswith( '\tRG:Z:Sanger\n' ) )
+        ok_( os.path.exists( bam ) )
+        ok_( not os.path.exists( bam + '.tagged' ) )
+        indexbam.assert_called_once_with( bam )
+
+    @patch('ngs_mapper.tagreads.indexbam')
+    @patch('ngs_mapper.tagreads.Popen')
+    @patch('ngs_mapper.tagreads.samtools')
+    def test_failed_samtools_raises( self, samtools, popen, indexbam ):
+        from StringIO import StringIO
+        samtools.view.return_value = StringIO( '' )
+        popen.return_value.returncode = 1
+        assert_raises( subprocess.CalledProcessError, self._C, join( self.tempdir, 'in.bam' ), '' )
+        ok_( not indexbam.called )
+
+class TestUnitTagLine(Base):
+    functionname = 'tag_line'
+
+    def test_appends_tag( self ):
+        eq_(
+            'TestingAread_sanger\t0\tRef1\t1\t60\t*\t=\t0\t0\t*\t*\tNM:i:0\tRG:Z:Sanger',
+            self._C( 'TestingAread_sanger\t0\tRef1\t1\t60\t*\t=\t0\t0\t*\t*\tNM:i:0' )
+        )
+
+    def test_does_not_duplicate( self ):
+        line = 'TestingAread_sanger\t0\tRef1\t1\t60\t*\t=\t0\t0\t*\t*\tRG:Z:Sanger'
+        eq_( line, self._C( line ) )
+
+    def test_skips_supplementary( self ):
+        line = 'TestingAread_sanger\t2048\tRef1\t1\t60\t*\t=\t0\t0\t*\t*'
+        eq_( line, self._C( line ) )
+
 class TestUnitTagReadGroup(Base):
     functionname = 'tag_readgroup'
 
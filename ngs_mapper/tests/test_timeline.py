@@ -0,0 +1,79 @@
+from imports import *
+
+import json
+
+from ngs_mapper import metrics
+
+class Base(BaseTester):
+    modulepath = 'ngs_mapper.timeline'
+
+def stage(name, start, duration, pid=100, tid=7, processes=()):
+    return {
+        'name': name, 'start': start, 'end': start + duration, 'duration': duration,
+        'returncode': 0, 'pid': pid, 'tid': tid, 'cpu': 1.0, 'processes': list(processes),
+    }
+
+class TestSampleEvents(Base):
+    functionname = 'sample_events'
+
+    def test_stages_and_processes(self):
+        process = {'command': 'bwa mem ref r1', 'pid': 101, 'end': 14.0, 'wall': 3.0, 'user': 2.0}
+        m = {'samplename': 's1', 'host': 'node1', 'stages': [stage('bwa', 10.0, 5.0, processes=[process])]}
+        events = self._C(m, 3)
+        eq_('s1 on node1 pid 100', events[0]['args']['name'])
+        eq_(3, events[0]['pid'])
+        bwa = events[1]
+        eq_(('bwa', 'X', 3, 7, 10000000, 5000000), (bwa['name'], bwa['ph'], bwa['pid'], bwa['tid'], bwa['ts'], bwa['dur']))
+        eq_(1.0, bwa['args']['cpu'])
+        eq_(100, bwa['args']['pid'])
+        p = events[2]
+        eq_(('bwa', 'process', 11000000, 3000000), (p['name'], p['cat'], p['ts'], p['dur']))
+
+    def test_process_without_wall(self):
+        m = {'stages': [stage('a', 0, 1, processes=[{'command': None, 'wall': None, 'end': 1.0}])]}
+        eq_(2, len(self._C(m, 1)))
+
+class TestRunningCounter(Base):
+    functionname = 'running_counter'
+
+    def test_counts_samples_in_each_stage(self):
+        events = [
+            {'name': 'bwa', 'cat': 'stage', 'ts': 0, 'dur': 10},
+            {'name': 'bwa', 'cat': 'stage', 'ts': 5, 'dur': 10},
+            {'name': 'trim', 'cat': 'stage', 'ts': 10, 'dur': 5},
+        ]
+        counters = self._C(events)
+        eq_(
+            [(0, {'bwa': 1}), (5, {'bwa': 2}), (10, {'bwa': 1, 'trim': 1}), (15, {'bwa': 0, 'trim': 0})],
+            [(c['ts'], c['args']) for c in counters]
+        )
+
+class TestMain(Base):
+    functionname = 'main'
+
+    def setUp(self):
+        self.tdir = tempfile.mkdtemp()
+        self.cwd = os.getcwd()
+        os.chdir(self.tdir)
+        for i, name in enumerate(['s1', 's2']):
+            p = join('Projects', name)
+            os.makedirs(p)
+            metrics.write_metrics(
+                metrics.project_metrics_path(p),
+                metrics.make_metrics(name, [stage('bwa', 10.0 + i, 5.0, pid=100 + i)])
+            )
+        # Ran before there were metrics files
+        os.makedirs(join('Projects', 's3'))
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tdir)
+
+    def test_merges_every_project(self):
+        eq_(0, self._C(['-o', 'out.json']))
+        with open('out.json') as fh:
+            trace = json.load(fh)
+        stages = [e for e in trace['traceEvents'] if e.get('cat') == 'stage']
+        eq_([1, 2], sorted(e['pid'] for e in stages))
+        counters = [e for e in trace['traceEvents'] if e['ph'] == 'C']
+        eq_(2, max(c['args']['bwa'] for c in counters))
@@ -35,3 +35,18 @@ class TestBuildDatafiles(unittest.TestCase):
             ],
             r
         )
+
+class TestPoolMap(unittest.TestCase):
+    def test_single_thread_runs_in_process(self):
+        with mock.patch.object(util, 'multiprocessing') as m_mp:
+            r = util.pool_map(abs, [-1,-2], 1)
+            self.assertFalse(m_mp.Pool.called)
+        self.assertEqual([1,2], r)
+
+    def test_uses_given_pool(self):
+        pool = mock.Mock()
+        util.pool_map(abs, [-1], pool=pool)
+        pool.map.assert_called_once_with(abs, [-1])
+
+    def test_creates_pool_for_threads(self):
+        self.assertEqual([1,2,3], util.pool_map(abs, [-1,-2,-3], 2))
@@ -0,0 +1,163 @@
+"""
+Merge the stages of many samples into a single timeline in the Chrome trace
+event format so you can see how the stages of samples that ran at the same time
+overlap. Open the file in chrome://tracing, https://ui.perfetto.dev or any other
+viewer that reads Chrome traces.
+
+Each sample is a process in the timeline(named after the sample, its host and
+the pid of its runsample) with a row for every thread a stage ran in. Every
+stage is a slice with the commands it ran nested inside of it. The
+``running stages`` counter shows how many samples were inside of each stage at
+any moment which makes it easy to spot every sample entering bwa at once.
+
+The timeline is built from the samplename.metrics.json file runsample writes
+for every sample(See :py:mod:`ngs_mapper.metrics`) so there is nothing to turn
+on while the samples run.
+
+    .. code-block:: bash
+
+        trace_timeline -o trace.json Projects/*
+
+``runsamplesheet --trace trace.json`` writes the timeline of the samples in the
+samplesheet once they have all finished.
+"""
+
+import argparse
+import json
+import sys
+from glob import glob
+from os.path import join
+
+import metrics
+import log
+
+logger = log.setup_logger( 'timeline', log.get_config() )
+
+def microseconds( seconds ):
+    return int( round( seconds * 1000000 ) )
+
+def sample_events( m, pid ):
+    '''
+    Trace events for a single sample's metrics
+
+    :param dict m: loaded metrics file
+    :param int pid: process id the sample has in the trace. Samples can run on
+                    different hosts so their real pids are not unique
+    :return: list of trace event dictionaries
+    '''
+    stages = m.get( 'stages', [] )
+    realpids = sorted( set( s['pid'] for s in stages if s.get( 'pid' ) ) )
+    name = m.get( 'samplename', str(pid) )
+    if m.get( 'host' ):
+        name += ' on {0}'.format(m['host'])
+    if realpids:
+        name += ' pid {0}'.format(','.join( str(p) for p in realpids ))
+    events = [
+        {'name': 'process_name', 'ph': 'M', 'pid': pid, 'tid': 0, 'args': {'name': name}},
+    ]
+    for s in stages:
+        tid = s.get( 'tid' ) or 0
+        args = dict(
+            (k, v) for k, v in s.items()
+            if k not in ('name', 'start', 'end', 'duration', 'processes', 'tid')
+        )
+        events.append({
+            'name': s['name'], 'cat': 'stage', 'ph': 'X', 'pid': pid, 'tid': tid,
+            'ts': microseconds( s['start'] ), 'dur': microseconds( s['duration'] ),
+            'args': args,
+        })
+        for p in s.get( 'processes', [] ):
+            if p.get( 'wall' ) is None or p.get( 'end' ) is None:
+                continue
+            command = p.get( 'command' ) or 'process'
+            events.append({
+                'name': command.split()[0], 'cat': 'process', 'ph': 'X', 'pid': pid, 'tid': tid,
+                'ts': microseconds( p['end'] - p['wall'] ), 'dur': microseconds( p['wall'] ),
+                'args': p,
+            })
+    return events
+
+def running_counter( events ):
+    '''
+    Counter events with how many samples are inside of each stage whenever
+    a stage starts or ends
+
+    :param list events: trace events with the stage slices of every sample
+    :return: list of counter trace event dictionaries
+    '''
+    changes = []
+    for e in events:
+        if e.get( 'cat' ) == 'stage':
+            changes.append( (e['ts'], 1, e['name']) )
+            changes.append( (e['ts'] + e['dur'], -1, e['name']) )
+    # Ends before starts at the same time
+    changes.sort( key=lambda c: (c[0], c[1]) )
+    running = {}
+    counters = []
+    for ts, change, name in changes:
+        running[name] = running.get( name, 0 ) + change
+        if counters and counters[-1]['ts'] == ts:
+            counters[-1]['args'] = dict( running )
+        else:
+            counters.append({
+                'name': 'running stages', 'ph': 'C', 'pid': 0, 'tid': 0, 'ts': ts,
+                'args': dict( running ),
+            })
+    return counters
+
+def merge_projects( projects ):
+    '''
+    Trace of every project's stages
+
+    :param list projects: runsample project directories
+    :return: trace dictionary in the Chrome trace event format
+    '''
+    events = [
+        {'name': 'process_name', 'ph': 'M', 'pid': 0, 'tid': 0, 'args': {'name': 'All samples'}},
+    ]
+    pid = 0
+    for p in sorted( projects ):
+        try:
+            m = metrics.load_metrics( metrics.project_metrics_path( p ) )
+        except (IOError, ValueError):
+            logger.debug( "No metrics for {0}".format(p) )
+            continue
+        pid += 1
+        events += sample_events( m, pid )
+    events += running_counter( events )
+    return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+def write_trace( path, trace ):
+    with open( path, 'w' ) as fh:
+        json.dump( trace, fh )
+    return path
+
+def parse_args( args=sys.argv[1:] ):
+    parser = argparse.ArgumentParser(
+        description='Merge the stage timings of many samples into one Chrome trace'
+    )
+
+    parser.add_argument(
+        dest='projects',
+        nargs='*',
+        help='Project directories to include[Default: Projects/*]'
+    )
+
+    parser.add_argument(
+        '-o',
+        '--output',
+        dest='output',
+        default='trace.json',
+        help='Where to write the trace[Default: %(default)s]'
+    )
+
+    return parser.parse_args( args )
+
+def main( args=sys.argv[1:] ):
+    args = parse_args( args )
+    projects = args.projects or glob( join( 'Projects', '*' ) )
+    trace = merge_projects( projects )
+    samples = len( [e for e in trace['traceEvents'] if e['ph'] == 'M'] ) - 1
+    write_trace( args.output, trace )
+    logger.info( "Wrote the timeline of {0} samples to {1}".format(samples, args.output) )
+    return 0
@@ -18,15 +18,16 @@ import log
 lconfig = log.get_config()
 logger = log.setup_logger( 'trim_reads', lconfig )
 
-def main():
-    args = parse_args()
+def main( args=sys.argv[1:] ):
+    args = parse_args( args )
     trim_reads_in_dir(
         args.readsdir,
         args.q,
         args.outputdir,
         head_crop=args.headcrop,
         platforms=args.platforms,
-        primer_info=[args.primer_file, args.primer_seed, args.palindrom_clip, args.simple_clip]
+        primer_info=[args.primer_file, args.primer_seed, args.palindrom_clip, args.simple_clip],
+        threads=args.threads
     )
 
 def trim_reads_in_dir( *args, **kwargs ):
@@ -39,6 +40,7 @@ def trim_reads_in_dir( *args, **kwargs ):
         :param str out_path: Output directory path
         :param int head_crop: How many bases to crop off ends
         :param list platforms: List of platform's reads to use
+        :param int threads: How many threads trimmomatic uses
     '''
     readdir = args[0]
     qual_th = args[1]
@@ -46,6 +48,7 @@ def trim_reads_in_dir( *args, **kwargs ):
     headcrop = kwargs.get('head_crop', 0)
     platforms = kwargs.get('platforms', None)
     primer_info = kwargs.get('primer_info')
+    threads = kwargs.get('threads', 1)
     logger.info(
         "Only accepting the following platform's read files: {0}".format(
             platforms
@@ -79,7 +82,7 @@ def trim_reads_in_dir( *args, **kwargs ):
                 if inreads is None:
                     continue
                 try:
-                    r = trim_read( inreads, qual_th, outreads, head_crop=headcrop, primer_info=primer_info )
+                    r = trim_read( inreads, qual_th, outreads, head_crop=headcrop, primer_info=primer_info, threads=threads )
                     logger.debug("Output from trim_read {0}".format(r))
                     unpaired += r[1::2]
                     logger.debug("Added {0} to unpaired list".format(r[1::2]))
@@ -117,6 +120,7 @@ def trim_read( *args, **kwargs ):
         @param qual_th - Quality threshold to trim reads on
         @param out_paths - Where to put the trimmed file[s]
         @param head_crop - How many bases to trim off the front
+        @param threads - How many threads trimmomatic uses
 
         @returns path to the trimmed fastq file
     '''
@@ -134,6 +138,7 @@ def trim_read( *args, **kwargs ):
         out_paths = (None,None)
     headcrop = kwargs.get('head_crop', 0)
     primer_info = kwargs.get('primer_info')
+    threads = kwargs.get('threads', 1)
 
     from Bio import SeqIO
     tfile = None
@@ -172,14 +177,14 @@ def trim_read( *args, **kwargs ):
         output = run_trimmomatic(
             'SE', readpaths[0], out_paths[0],
             ('LEADING',qual_th), ('TRAILING',qual_th), ('HEADCROP',headcrop),
-            threads=1, trimlog=stats_file, primer_info=primer_info
+            threads=threads, trimlog=stats_file, primer_info=primer_info
         )
     else:
         retpaths = [out_paths[0],out_paths[0]+'.unpaired',out_paths[1],out_paths[1]+'.unpaired']
         output = run_trimmomatic(
             'PE', readpaths[0], readpaths[1], out_paths[0], out_paths[0]+'.unpaired', out_paths[1], out_paths[1]+'.unpaired',
             ('LEADING',qual_th), ('TRAILING',qual_th), ('HEADCROP',headcrop),
-            threads=1, trimlog=stats_file, primer_info=primer_info
+            threads=threads, trimlog=stats_file, primer_info=primer_info
         )
 
     # Prepend stats file with stdout from trimmomatic
@@ -342,4 +347,13 @@ def parse_args( args=sys.argv[1:] ):
         help=defaults['simpleclip']['help']
     )
 
+    parser.add_argument(
+        '-t',
+        '--threads',
+        dest='threads',
+        type=int,
+        default=defaults['threads']['default'],
+        help=defaults['threads']['help']
+    )
+
     return parser.parse_args( args )
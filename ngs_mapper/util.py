@@ -1,5 +1,6 @@
 import os
 import os.path
+import multiprocessing
 
 def build_datafiles(prefix, datadir):
     '''
@@ -17,3 +18,27 @@ def build_datafiles(prefix, datadir):
         _prefix = os.path.normpath(root.replace(datadir, prefix))
         manifest.append((_prefix, [os.path.join(root,f) for f in files]))
     return manifest
+
+def pool_map(func, items, threads=1, pool=None):
+    '''
+    Map func over items using pool if given, otherwise a new pool of threads
+    processes. With a single thread everything runs in this process.
+
+    func has to be defined at module level so it can be pickled
+
+    :param callable func: function to call on each item
+    :param list items: items to map over
+    :param int threads: number of processes to use if pool is not given
+    :param multiprocessing.Pool pool: existing pool to use
+    :return: list of func(item) for each item
+    '''
+    if pool is not None:
+        return pool.map(func, items)
+    if threads <= 1 or len(items) <= 1:
+        return map(func, items)
+    pool = multiprocessing.Pool(min(threads, len(items)))
+    try:
+        return pool.map(func, items)
+    finally:
+        pool.close()
+        pool.join()
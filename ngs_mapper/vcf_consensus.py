@@ -6,8 +6,8 @@ from Bio import SeqIO
 import vcf
 import os
 
-def main():
-    args = parse_args()
+def main( args=sys.argv[1:] ):
+    args = parse_args( args )
     seqs = iter_refs( args.vcffile, args.fastaid )
     write_fasta( seqs, args.output_file )
 
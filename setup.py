@@ -17,6 +17,8 @@ setup(
     entry_points = {
         'console_scripts': [
             'is_sanger = ngs_mapper.scripts:is_sanger',
+            'jobqueue = ngs_mapper.jobqueue:main',
+            'kmer_filter = ngs_mapper.kmer_filter:main',
             'convert_sangers = ngs_mapper.scripts:convert_sangers',
             'sff_to_fastq = ngs_mapper.file_formats:main_sff_convert',
             'convert_formats = ngs_mapper.file_formats:main_convert_formats',
@@ -29,14 +31,17 @@ setup(
             'fqstats = ngs_mapper.fqstats:main',
             'graph_mapunmap = ngs_mapper.graph_mapunmap:main',
             'graphsample = ngs_mapper.graphsample:main',
+            'graph_projects = ngs_mapper.graphsample:main_projects',
             'graph_times = ngs_mapper.graph_times:main',
             'miseq_sync = ngs_mapper.miseq_sync:main',
             'rename_sample = ngs_mapper.rename_sample:main',
             'run_bwa_on_samplename = ngs_mapper.run_bwa:main',
             'runsample = ngs_mapper.runsample:main',
+            'runsamplesheet = ngs_mapper.runsamplesheet:main',
             'sanger_sync = ngs_mapper.sanger_sync:main',
             'stats_at_refpos = ngs_mapper.stats_at_refpos:main',
             'tagreads = ngs_mapper.tagreads:main',
+            'trace_timeline = ngs_mapper.timeline:main',
             'trim_reads = ngs_mapper.trim_reads:main',
             'vcf_consensus = ngs_mapper.vcf_consensus:main',
             'vcf_diff = ngs_mapper.vcf_diff:main',